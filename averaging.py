@@ -0,0 +1,269 @@
+"""
+.. py:module:: averaging
+Averaging Module
+================
+
+Signal averaging of the repetitions of multi-average studies. The
+repetitions are added to a single preallocated accumulator one at a time,
+as they are decoded, so a study is averaged without holding more than one
+repetition and the running mean in memory.
+
+The accumulator holds the running mean, updated with Welford's method, so
+it stays accurate however many repetitions are added. Either the complex
+k-space is averaged, which is then reconstructed once, or the magnitude
+images of the repetitions, which keeps the signal of repetitions whose
+phase differs but does not average the noise down as far.
+
+Each repetition can be phase corrected first: its zero order phase
+relative to the running mean, e.g. from frequency drift, is removed frame
+by frame, and its motion can be removed, see :mod:`registration`.
+Repetitions spoilt by motion or spikes can be rejected: the relative
+difference of each repetition from the running mean is tracked with
+running Welford statistics, and one that is more than :data:`REJECT_SIGMA`
+standard deviations above their mean is left out.
+
+"""
+
+import numpy as np
+
+import registration
+
+
+# what is averaged, complex k-space or magnitude images
+METHODS = ('complex', 'magnitude')
+
+# remove the zero order phase of each repetition by default
+PHASE_CORRECTION = True
+
+# repetitions further above the mean difference are rejected by default
+REJECT_SIGMA = 3.0
+
+# repetitions accepted before any are rejected
+MIN_SAMPLES = 3
+
+
+class Averager(object):
+    """
+    Running mean of repetitions with phase correction and outlier rejection.
+
+    Parameters
+    ----------
+    Shape : tuple
+        Shape of one repetition.
+
+    Method : string, optional
+        One of :data:`METHODS`. Magnitude repetitions are given as images,
+        complex ones as anything. Defaults to 'complex'.
+
+    PhaseCorrection : bool, optional
+        Remove the zero order phase of each repetition relative to the mean
+        before it is added. Only used for complex averaging. Defaults to
+        :data:`PHASE_CORRECTION`.
+
+    Reject : float or None, optional
+        Standard deviations above the mean difference from the running
+        mean beyond which a repetition is rejected. None keeps every
+        repetition. Defaults to :data:`REJECT_SIGMA`.
+
+    PhaseAxes : tuple, optional
+        Axes each phase is estimated over, e.g. (0, -2, -1) to share one
+        phase between the coils of a frame. Defaults to the last two.
+
+    """
+    def __init__(self, Shape, Method='complex', PhaseCorrection=None,
+                 Reject=REJECT_SIGMA, PhaseAxes=(-2, -1)):
+        if Method not in METHODS:
+            raise ValueError('unknown averaging method %r' % (Method,))
+        if PhaseCorrection is None:
+            PhaseCorrection = PHASE_CORRECTION
+        self.method = Method
+        self.phaseCorrection = PhaseCorrection and Method == 'complex'
+        self.reject = Reject
+        self.phaseAxes = PhaseAxes
+        dtype = np.complex64 if Method == 'complex' else np.float32
+        self.mean = np.zeros(Shape, dtype=dtype)
+        self._scratch = np.empty(Shape, dtype=dtype)
+        self.count = 0
+        self.rejected = []
+        # Welford statistics of the relative difference from the mean
+        self.samples = 0
+        self.meanDifference = 0.0
+        self._m2 = 0.0
+
+    @property
+    def spread(self):
+        """ Standard deviation of the differences of the accepted reps """
+        if self.samples < 2:
+            return 0.0
+        return float(np.sqrt(self._m2/(self.samples-1)))
+
+    def add(self, Data, Index=None):
+        """
+        Adds a repetition to the mean, unless it is rejected.
+
+        Parameters
+        ----------
+        Data : array
+            The repetition, of the averager's shape.
+
+        Index : hashable, optional
+            Recorded in :attr:`rejected` if the repetition is rejected.
+            Defaults to the number of repetitions seen so far.
+
+        Returns
+        -------
+        Accepted : bool
+            False if the repetition was left out.
+
+        """
+        if Index is None:
+            Index = self.count+len(self.rejected)
+        data = self._scratch
+        if self.method == 'magnitude':
+            np.abs(Data, out=data, casting='unsafe')
+        else:
+            data[...] = Data
+        if self.count == 0:
+            self.mean[...] = data
+            self.count = 1
+            return True
+        if self.phaseCorrection:
+            overlap = np.sum(np.conj(self.mean)*data, axis=self.phaseAxes,
+                             keepdims=True)
+            data *= np.exp(-1j*np.angle(overlap)).astype(data.dtype)
+        scale = np.linalg.norm(self.mean)
+        # data becomes its difference from the mean, which is all that is
+        # needed to update it
+        data -= self.mean
+        difference = float(np.linalg.norm(data)/max(scale, 1e-30))
+        if self.reject is not None and self.samples >= MIN_SAMPLES and \
+                difference > self.meanDifference+self.reject*self.spread:
+            self.rejected.append(Index)
+            return False
+        self.samples += 1
+        delta = difference-self.meanDifference
+        self.meanDifference += delta/self.samples
+        self._m2 += delta*(difference-self.meanDifference)
+        self.count += 1
+        data /= self.count
+        self.mean += data
+        return True
+
+    def stats(self):
+        """
+        Returns the repetitions used and rejected.
+
+        Returns
+        -------
+        Stats : dictionary
+            Accepted count, rejected indices, and the mean and standard
+            deviation of the relative differences from the running mean.
+
+        """
+        return {'count': self.count, 'rejected': list(self.rejected),
+                'difference': self.meanDifference, 'spread': self.spread}
+
+
+def averageKspace(Kspace, Receivers=1, Frame=None, PhaseCorrection=None,
+                  Reject=REJECT_SIGMA, Shifts=None):
+    """
+    Averages the complex k-space of the repetitions of a study.
+
+    The repetitions are read and added one at a time.
+
+    Parameters
+    ----------
+    Kspace : array-like
+        The decoded (rep, slice, echo, phase-encode, readout) k-space, e.g.
+        a :class:`fid_reader.LazyKspace`, with the coils of each repetition
+        next to each other on the first axis.
+
+    Receivers : int, optional
+        The :func:`fid_reader.receiverCount` of the study. The coils of a
+        frame share one phase correction. Defaults to 1.
+
+    Frame : tuple, optional
+        The (slice, echo) of a single frame to average. Defaults to every
+        frame.
+
+    PhaseCorrection : bool, optional
+        See :class:`Averager`.
+
+    Reject : float or None, optional
+        See :class:`Averager`.
+
+    Shifts : 4D array, optional
+        The (rep, slice, echo, 2) motion of each frame, removed before it is
+        added, see :func:`registration.studyShifts`. Defaults to none.
+
+    Returns
+    -------
+    Averager : :class:`Averager`
+        Its mean is the (coil, slice, echo, phase-encode, readout) average,
+        or (coil, phase-encode, readout) for a single frame, which is the
+        shape of a single repetition of the study.
+
+    """
+    shape = np.shape(Kspace)
+    reps = shape[0]//Receivers
+    select = () if Frame is None else tuple(Frame)
+    phaseAxes = (0, -2, -1) if Receivers > 1 else (-2, -1)
+    averager = None
+    for rep in range(reps):
+        data = np.asarray(Kspace[(slice(rep*Receivers, (rep+1)*Receivers),)
+                                 + select])
+        if Shifts is not None:
+            data = registration.shiftKspace(data, -Shifts[(rep,)+select])
+        if averager is None:
+            averager = Averager(data.shape, 'complex', PhaseCorrection,
+                                Reject, phaseAxes)
+        averager.add(data, rep)
+    return averager
+
+
+def averageMagnitudes(Frames, Forward, Reject=REJECT_SIGMA):
+    """
+    Averages the magnitude images of the repetitions of a study.
+
+    Parameters
+    ----------
+    Frames : iterable
+        The output of :func:`recon.reconstructFrames`: the header, leading
+        shape and stack, then (frame, datafilt, image) in repetition order.
+
+    Forward : callable
+        Transforms an image into k-space, e.g. :func:`recon.forwardTransform`,
+        for the datafilt of the averaged frames.
+
+    Reject : float or None, optional
+        See :class:`Averager`.
+
+    Yields
+    ------
+    Frames : tuple
+        The header, the leading (1, slice, echo) shape and the stack, then
+        each averaged frame in the same form as Frames.
+
+    """
+    frames = iter(Frames)
+    dic, leading, stack = next(frames)
+    yield dic, (1,)+tuple(leading[1:]), stack
+    averager = None
+    images = None
+    rep = 0
+    for frame, _, image in frames:
+        if frame[0] != rep:
+            averager.add(images, rep)
+            rep = frame[0]
+        if images is None:
+            # one repetition of magnitudes, gathered as they arrive
+            images = np.zeros(tuple(leading[1:])+np.shape(image),
+                              dtype=np.float32)
+            averager = Averager(images.shape, 'magnitude', Reject=Reject)
+        images[frame[1:]] = np.abs(image)
+    if averager is None:
+        return
+    averager.add(images, rep)
+    for index in np.ndindex(*averager.mean.shape[:-2]):
+        image = averager.mean[index].astype(np.complex64)
+        yield (0,)+index, Forward(image).astype(np.complex64), image
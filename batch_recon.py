@@ -0,0 +1,297 @@
+"""
+Batch reconstruction of Varian FIDs without the GUI.
+
+Searches the supplied directories for \*.fid folders, reconstructs each one
+on a pool of worker processes, and writes the results to the output
+directory as a :class:`recon_store.ReconStore` plus magnitude PNGs. Neither
+PyQt4 nor an X display is needed, so it can be run on headless nodes::
+
+    python batch_recon.py /data/study1 /data/study2 -o /data/recon -w 8
+
+The filter stack can be given as a JSON file holding the list of filter
+parameter dictionaries produced by :func:`filters.stackSpec`. Without one
+only the DC offset correction is applied.
+
+Results are kept in a :class:`result_cache.ResultCache`, so a study that has
+already been reconstructed with the same stack is written out from the
+cache.
+
+Partial Fourier studies are reconstructed with the homodyne method, or the
+one given with -p, see :mod:`partial_fourier`. The coils of multi-receiver
+studies are combined by root sum of squares, or the method given with -c,
+see :mod:`coils`.
+
+With -z the images are zero-filled to that multiple of the acquired matrix,
+see :func:`recon.zeroFillSize`.
+
+With -a the repetitions of multi-average studies are averaged, either the
+complex k-space or the magnitude images, see :mod:`averaging`. With
+--register the motion of the repetitions is corrected first, see
+:mod:`registration`.
+
+With --segments dynamic series acquired in that many interleaved segments
+are reconstructed with a sliding window, giving a frame for every
+repetition, see :mod:`sliding_window`.
+
+With --watch the directories are watched instead, and studies are
+reconstructed block by block as the scanner writes them, see
+:class:`watch.FolderWatcher`.
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import averaging
+import coils
+import filters as filt
+import fid_reader
+import partial_fourier
+import recon
+import recon_store
+import result_cache
+import sliding_window
+import stream_recon
+import watch
+
+
+def processFID(Path, Output, Spec=None, Workers=1, ZeroFill=None,
+               PartialFourier='homodyne', Coils='rss', Segments=None,
+               Average=None, Register=False):
+    """
+    Reconstructs one study and writes it out. Run in the worker processes.
+
+    The image and filtered k-space of each frame are written to the store
+    Name.mrs as soon as they are reconstructed, and the magnitude is saved
+    as Name_b<block>_s<slice>_e<echo>.png. Studies found in the result cache
+    are written out from there instead of being reconstructed.
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Output : string
+        Directory the files are written to.
+
+    Spec : list of Dictionaries, optional
+        The filter stack, see :func:`filters.stackSpec`.
+
+    Workers : int, optional
+        Decoding threads for this study. Defaults to 1, since the studies
+        themselves are spread over processes.
+
+    ZeroFill : float, optional
+        Interpolation factor for the images, see :func:`recon.zeroFillSize`.
+        Defaults to none.
+
+    PartialFourier : string, optional
+        Method used for partial Fourier studies, one of
+        :data:`partial_fourier.METHODS`. Defaults to 'homodyne'.
+
+    Coils : string, optional
+        Combination of the coils of multi-receiver studies, one of
+        :data:`coils.METHODS`. Defaults to 'rss'.
+
+    Segments : int, optional
+        Number of interleaved segments of a dynamic series, reconstructed
+        with a sliding window, see :mod:`sliding_window`. Zero-filling is
+        not applied to them. Defaults to a frame per repetition as usual.
+
+    Average : string, optional
+        Averages the repetitions, one of :data:`averaging.METHODS`, see
+        :func:`recon.reconstructFrames`. Defaults to none.
+
+    Register : bool, optional
+        Corrects the motion of the repetitions, see
+        :func:`recon.reconstructFrames`. Defaults to False.
+
+    Returns
+    -------
+    Files : list of strings
+        The files written.
+
+    """
+    # imported here so the Agg backend is used, never a GUI one
+    from matplotlib import image as mplImage
+
+    name = os.path.splitext(os.path.basename(Path.rstrip(os.sep)))[0]
+    files = [os.path.join(Output, name+'.mrs')]
+    spec = Spec or filt.stackSpec(recon.defaultStack())
+    cache = result_cache.ResultCache()
+    procpar = fid_reader.readProcpar(Path)
+    oversampling = recon.readoutOversampling(procpar)
+    options = {'study': True, 'oversample': oversampling,
+               'zerofill': ZeroFill}
+    if 'fract_ky' in procpar:
+        options['partial'] = PartialFourier
+    if fid_reader.receiverCount(procpar) > 1:
+        options['coils'] = Coils
+    if Segments is not None:
+        options['sliding'] = Segments
+    if Average is not None:
+        options['average'] = Average
+    if Register:
+        options['register'] = True
+    key = result_cache.resultKey(result_cache.contentHash(Path), spec,
+                                 Options=options)
+    cached = cache.get(key)
+    entry = None
+    if cached is not None:
+        leading = cached['image'].shape[:-2]
+        frames = ((frame, cached['datafilt'][frame], cached['image'][frame])
+                  for frame in np.ndindex(*leading))
+    elif Segments is not None:
+        frames = sliding_window.reconstructSliding(Path, Spec, Segments)
+    elif ZeroFill is not None or Average is not None or Register:
+        # zero-filling, averaging and registration are done on whole frames
+        frames = recon.reconstructFrames(Path, Spec, Workers,
+                                         ZeroFill=ZeroFill,
+                                         PartialFourier=PartialFourier,
+                                         Coils=Coils, Average=Average,
+                                         Register=Register)
+    else:
+        try:
+            # line by line when the stack allows, to bound the memory used
+            frames = stream_recon.reconstructStream(Path, Spec)
+        except stream_recon.StreamingError:
+            frames = recon.reconstructFrames(Path, Spec, Workers,
+                                             PartialFourier=PartialFourier,
+                                             Coils=Coils)
+    if cached is None:
+        dic, leading, stack = next(frames)
+        procpar, spec = dic['procpar'], filt.stackSpec(stack)
+        # the results are written into the cache as they are produced
+        entry = cache.create(key)
+    store = recon_store.ReconStore(files[0])
+    # a rerun replaces the frames of an earlier one, which may have had a
+    # different number, instead of adding to them
+    store.remove('image')
+    store.remove('datafilt')
+    store.setMetadata(procpar, spec)
+    try:
+        for frame, datafilt, image in frames:
+            if entry is not None:
+                if not entry.arrays:
+                    for arrayName, shape, dtype in (
+                            ('image', image.shape, np.complex64),
+                            ('datafilt', datafilt.shape, np.complex64),
+                            ('magnitude', image.shape, np.float32),
+                            ('phase', image.shape, np.float32)):
+                        entry.array(arrayName, leading+shape, dtype)
+                for arrayName, value in result_cache.derived(
+                        image, datafilt).items():
+                    entry.arrays[arrayName][frame] = value
+            # written by index, so rerunning a study replaces its frames
+            index = int(np.ravel_multi_index(frame, leading))
+            store.write('image', index, image)
+            store.write('datafilt', index, datafilt)
+            files.append(os.path.join(Output, '%s_b%d_s%d_e%d.png' %
+                                      ((name,)+frame)))
+            mplImage.imsave(files[-1], np.abs(image), cmap='gray')
+    except Exception:
+        if entry is not None:
+            entry.discard()
+        raise
+    if entry is not None:
+        if entry.arrays:
+            entry.commit()
+        else:
+            entry.discard()
+    store.setShape('image', leading)
+    store.setShape('datafilt', leading)
+    return files
+
+
+def main(Argv=None):
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(
+        description='Reconstruct Varian FIDs without the GUI.')
+    parser.add_argument('directories', nargs='+',
+                        help='directories searched for *.fid folders')
+    parser.add_argument('-o', '--output', default='.',
+                        help='directory the images are written to')
+    parser.add_argument('-s', '--stack',
+                        help='JSON file with the filter stack parameters')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('-z', '--zero-fill', type=float, default=None,
+                        help='zero-fill the images by this factor')
+    parser.add_argument('-p', '--partial-fourier', default='homodyne',
+                        choices=partial_fourier.METHODS,
+                        help='reconstruction of partial Fourier studies')
+    parser.add_argument('-c', '--coils', default='rss', choices=coils.METHODS,
+                        help='combination of the coils of array studies')
+    parser.add_argument('-a', '--average', default=None,
+                        choices=averaging.METHODS,
+                        help='average the repetitions of the studies')
+    parser.add_argument('--register', action='store_true',
+                        help='correct the motion between the repetitions')
+    parser.add_argument('--segments', type=int, default=None,
+                        help='sliding window reconstruction of dynamic '
+                        'series in this many interleaved segments')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep watching the directories for new studies')
+    parser.add_argument('--interval', type=float, default=2.0,
+                        help='seconds between scans in watch mode')
+    args = parser.parse_args(Argv)
+
+    spec = None
+    if args.stack:
+        with open(args.stack) as stackFile:
+            spec = json.load(stackFile)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    if args.watch:
+        # studies are reconstructed a repetition at a time as they grow, so
+        # nothing that needs every repetition at once can be done
+        for name, value in (('--average', args.average),
+                            ('--register', args.register),
+                            ('--segments', args.segments)):
+            if value:
+                parser.error('%s cannot be used with --watch' % name)
+        watcher = watch.FolderWatcher(args.directories, args.output, spec,
+                                      args.interval, Coils=args.coils,
+                                      PartialFourier=args.partial_fourier,
+                                      ZeroFill=args.zero_fill)
+        watcher.start()
+        try:
+            while True:
+                for path, _, frames, finished in watcher.updates():
+                    print('%s %s (%d frames)' % ('done   ' if finished else
+                                                 'partial', path, frames))
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            watcher.stop()
+        return 0
+
+    paths = fid_reader.findFIDs(args.directories)
+    failures = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = dict((pool.submit(processFID, path, args.output, spec,
+                                 ZeroFill=args.zero_fill,
+                                 PartialFourier=args.partial_fourier,
+                                 Coils=args.coils,
+                                 Segments=args.segments,
+                                 Average=args.average,
+                                 Register=args.register), path)
+                    for path in paths)
+        for job in as_completed(jobs):
+            try:
+                job.result()
+                print('done   %s' % jobs[job])
+            except Exception as error:
+                failures += 1
+                print('failed %s: %s' % (jobs[job], error))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
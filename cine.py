@@ -0,0 +1,291 @@
+"""
+.. py:module:: cine
+Cine Module
+===========
+
+Movie playback of dynamic and cardiac series. Drawing each frame with
+:meth:`mplwidget.mplCanvas.imshow` rebuilds the whole plot, which is far too
+slow for a movie, so frames are reconstructed and colour mapped ahead of
+time by a background thread into a fixed number of RGBA images, and the
+display only has to copy the next one to the screen on every tick of a
+timer, see :meth:`mplwidget.mplCanvas.showRGBA`.
+
+The images are held in a preallocated ring of :data:`RING_FRAMES` slots, so
+the memory used is bounded by the ring, not by the length of the series.
+Series no longer than the ring are rendered once and then loop from memory.
+
+Ticks that find the next frame not yet rendered are counted as dropped, and
+ticks that come late because the GUI was busy as late, see
+:meth:`CinePlayer.stats`. Playback starts with the first frame rendered, so
+the ticks waiting for it are neither dropped nor late.
+
+"""
+
+import threading
+import time
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+import memory_budget
+
+
+# frames rendered ahead of the display
+RING_FRAMES = 32
+
+# default frame rate
+FRAME_RATE = 20.0
+
+# ticks this much longer than the period are counted as late
+LATE_FACTOR = 1.5
+
+
+def colourTable(CMap):
+    """
+    Returns the colour map as a lookup table.
+
+    Parameters
+    ----------
+    CMap : string
+        Name of a matplotlib colour map.
+
+    Returns
+    -------
+    Table : 2D array of uint8
+        The 256 RGBA colours of the map.
+
+    """
+    return np.asarray(plt.get_cmap(CMap)(np.linspace(0, 1, 256), bytes=True),
+                      dtype=np.uint8)
+
+
+def render(Image, Table, Window, Out=None, Contrast=None):
+    """
+    Colour maps a magnitude image.
+
+    Parameters
+    ----------
+    Image : 2D array
+        The magnitude image.
+
+    Table : 2D array of uint8
+        See :func:`colourTable`.
+
+    Window : tuple
+        The (min, max) of the displayed range, the same for every frame so
+        the brightness does not flicker.
+
+    Out : 3D array of uint8, optional
+        Where the (rows, columns, 4) RGBA image is written.
+
+    Contrast : callable, optional
+        Contrast adjustment applied before windowing, e.g.
+        :attr:`mplwidget.mplCanvas.cadj`. Window is of the adjusted image.
+
+    Returns
+    -------
+    Out : 3D array of uint8
+        The RGBA image.
+
+    """
+    image = np.asarray(Image, dtype=np.float32)
+    if Contrast is not None:
+        image = np.asarray(Contrast(image), dtype=np.float32)
+    low, high = Window
+    scale = (len(Table)-1)/max(high-low, np.finfo(np.float32).tiny)
+    index = np.clip((image-low)*scale, 0, len(Table)-1).astype(np.intp)
+    return np.take(Table, index, axis=0, out=Out)
+
+
+def ringFrames(Shape, Frames=None):
+    """
+    Chooses the number of slots of the ring.
+
+    Parameters
+    ----------
+    Shape : tuple
+        The (rows, columns) of the displayed images.
+
+    Frames : int, optional
+        Slots wanted. Defaults to :data:`RING_FRAMES`, or fewer if the
+        memory governor cannot make room for them.
+
+    Returns
+    -------
+    Frames : int
+        At least 2.
+
+    """
+    if Frames is None:
+        Frames = RING_FRAMES
+        frame = int(np.prod(Shape))*4
+        while Frames > 2 and not memory_budget.governor().reserve(
+                Frames*frame, memory_budget.PRIORITY_DISPLAY):
+            Frames //= 2
+    return max(2, int(Frames))
+
+
+class CinePlayer(object):
+    """
+    Renders the frames of a series ahead of a timer.
+
+    Parameters
+    ----------
+    Frames : list
+        The frame indices, in playback order.
+
+    Reconstruct : callable
+        Takes a frame index and returns its 2D magnitude image, displayed
+        transposed as the canvases do. Called on the render thread.
+
+    Shape : tuple
+        The (rows, columns) of the images Reconstruct returns.
+
+    Table : 2D array of uint8
+        See :func:`colourTable`.
+
+    Window : tuple, optional
+        The (min, max) displayed. Defaults to the range of the first frame.
+
+    Contrast : callable, optional
+        See :func:`render`.
+
+    Size : int, optional
+        Slots of the ring, see :func:`ringFrames`.
+
+    FrameRate : float, optional
+        Frames per second, defaults to :data:`FRAME_RATE`.
+
+    """
+    def __init__(self, Frames, Reconstruct, Shape, Table, Window=None,
+                 Contrast=None, Size=None, FrameRate=FRAME_RATE):
+        self.frames = list(Frames)
+        self.reconstruct = Reconstruct
+        self.table = Table
+        self.window = Window
+        self.contrast = Contrast
+        self.period = 1.0/FrameRate
+        size = max(2, min(ringFrames(Shape[::-1], Size), len(self.frames)))
+        self.ring = np.zeros((size,)+tuple(Shape[::-1])+(4,), dtype=np.uint8)
+        # sequence number of the frame in each slot, -1 when empty
+        self.slots = np.full(size, -1, dtype=np.int64)
+        self.rendered = 0  # sequence number of the next frame to render
+        self.shown = 0  # sequence number of the next frame to show
+        self.dropped = 0
+        self.late = 0
+        self.started = None
+        self.lastTick = None
+        self.error = None
+        self._ready = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._render, daemon=True)
+        memory_budget.governor().register(self, 'cine',
+                                          memory_budget.PRIORITY_DISPLAY)
+        self._thread.start()
+
+    def memoryUsage(self):
+        """ Bytes held by the ring """
+        return memory_budget.residentBytes(self.ring)
+
+    def _looped(self):
+        """ True once the whole series fits in the ring and is rendered """
+        return len(self.frames) <= len(self.ring) and \
+            self.rendered >= len(self.frames)
+
+    def _render(self):
+        """ Fills the ring ahead of the display, run on a thread """
+        size = len(self.ring)
+        while True:
+            with self._ready:
+                # wait for a free slot, the one shown the longest time ago,
+                # never the one on screen
+                while not self._stop and not self._looped() and \
+                        self.rendered-self.shown >= size-1:
+                    self._ready.wait()
+                if self._stop or self._looped():
+                    return
+                sequence = self.rendered
+            frame = self.frames[sequence % len(self.frames)]
+            try:
+                image = np.asarray(self.reconstruct(frame)).T
+            except Exception as error:
+                # shown by whoever is playing, the movie stops here
+                self.error = error
+                return
+            if self.window is None:
+                adjusted = image if self.contrast is None else \
+                    self.contrast(image)
+                self.window = (float(np.min(adjusted)),
+                               float(np.max(adjusted)))
+            slot = sequence % size
+            render(image, self.table, self.window, self.ring[slot],
+                   self.contrast)
+            with self._ready:
+                self.slots[slot] = sequence
+                self.rendered += 1
+                self._ready.notify_all()
+
+    def next(self):
+        """
+        Returns the frame due on this tick.
+
+        Returns
+        -------
+        Frame : index or None
+            The frame index, or None if it is not rendered yet. The tick is
+            counted as dropped once the first frame has been shown.
+
+        Image : 3D array of uint8 or None
+            The RGBA image. Only valid until the next call.
+
+        """
+        now = time.time()
+        with self._ready:
+            if self._looped():
+                slot = self.shown % len(self.frames)
+            else:
+                slot = self.shown % len(self.ring)
+                if self.slots[slot] != self.shown:
+                    # still waiting for the first frame is not a drop
+                    if self.started is not None:
+                        self._tick(now)
+                        self.dropped += 1
+                    return None, None
+            self._tick(now)
+            frame = self.frames[self.shown % len(self.frames)]
+            self.shown += 1
+            self._ready.notify_all()
+        return frame, self.ring[slot]
+
+    def _tick(self, Now):
+        """ Starts the clock on the first frame, and counts late ticks """
+        if self.started is None:
+            self.started = Now
+        elif Now-self.lastTick > LATE_FACTOR*self.period:
+            self.late += 1
+        self.lastTick = Now
+
+    def stats(self):
+        """
+        Returns the playback statistics.
+
+        Returns
+        -------
+        Stats : dictionary
+            Frames shown, ticks dropped and late, the achieved and target
+            frame rates, and the ring size.
+
+        """
+        elapsed = 0.0 if self.started is None else \
+            self.lastTick-self.started
+        return {'shown': self.shown, 'dropped': self.dropped,
+                'late': self.late,
+                'rate': self.shown/elapsed if elapsed > 0 else 0.0,
+                'target': 1.0/self.period, 'ring': len(self.ring)}
+
+    def stop(self):
+        """ Stops the render thread """
+        with self._ready:
+            self._stop = True
+            self._ready.notify_all()
+        self._thread.join()
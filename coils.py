@@ -0,0 +1,252 @@
+"""
+.. py:module:: coils
+Coil Combination Module
+=======================
+
+Combination of the images from multi-receiver studies into one image. The
+k-space of every coil is first prewhitened, so the coils have independent
+noise of equal power, using a noise covariance estimated from a noise scan
+or from the corners of k-space, where there is little signal. The
+prewhitening is a single matrix multiply over all of the samples of a
+frame.
+
+The coil images are then combined by:
+
+* rss: the root sum of squares, which needs nothing but the images but
+  throws away the phase.
+* adaptive: a sensitivity weighted sum, with the sensitivities estimated
+  from the dominant eigenvector of the coil covariance over a small
+  neighbourhood of each pixel (Walsh et al, MRM 43:682, 2000). This keeps
+  the phase and gives a better signal to noise ratio in the low signal
+  regions.
+
+The functions work on (coil, phase-encode, readout) arrays, so a study is
+combined one frame at a time.
+
+"""
+
+import numpy as np
+from scipy import ndimage
+
+
+# coil combination methods
+METHODS = ('rss', 'adaptive')
+
+# width in pixels of the neighbourhood of the adaptive combination
+ADAPTIVE_SIZE = 7
+
+
+def coilFrame(Kspace, Frame, Receivers):
+    """
+    Pulls the coils of one frame out of a multi-receiver study.
+
+    Parameters
+    ----------
+    Kspace : 5D array-like
+        The decoded k-space, with the coils of each repetition next to each
+        other on the first axis, see :func:`fid_reader.acquisitionOrder`.
+
+    Frame : tuple
+        The (rep, slice, echo) index of the frame.
+
+    Receivers : int
+        The :func:`fid_reader.receiverCount` of the study.
+
+    Returns
+    -------
+    Kspace : 3D array
+        The (coil, phase-encode, readout) k-space.
+
+    """
+    rep, slc, echo = Frame
+    return np.asarray(Kspace[rep*Receivers:(rep+1)*Receivers, slc, echo])
+
+
+def cornerSamples(Kspace, Size=10):
+    """
+    Gathers the samples in the corners of k-space.
+
+    Parameters
+    ----------
+    Kspace : array
+        The (coil, ..., phase-encode, readout) k-space.
+
+    Size : int, optional
+        Width of the square taken from each corner. Defaults to 10.
+
+    Returns
+    -------
+    Samples : 2D array
+        The (coil, sample) corner samples. Samples that are zero on every
+        coil, e.g. lines that were not acquired, are left out.
+
+    """
+    Kspace = np.asarray(Kspace)
+    coils = Kspace.shape[0]
+    corners = [Kspace[..., rows, columns]
+               for rows in (slice(None, Size), slice(-Size, None))
+               for columns in (slice(None, Size), slice(-Size, None))]
+    samples = np.concatenate([corner.reshape(coils, -1)
+                              for corner in corners], axis=1)
+    return samples[:, np.any(samples != 0, axis=0)]
+
+
+def noiseCovariance(Samples):
+    """
+    Estimates the noise covariance between the coils.
+
+    Parameters
+    ----------
+    Samples : 2D array
+        (coil, sample) noise samples, from a noise scan or
+        :func:`cornerSamples`.
+
+    Returns
+    -------
+    Covariance : 2D array of complex
+        The (coil, coil) covariance, with any DC offset removed.
+
+    """
+    Samples = np.asarray(Samples, dtype=np.complex128)
+    Samples = Samples-Samples.mean(axis=1, keepdims=True)
+    return np.dot(Samples, Samples.conj().T)/max(Samples.shape[1]-1, 1)
+
+
+def whitener(Covariance):
+    """
+    Builds the prewhitening matrix for a noise covariance.
+
+    Parameters
+    ----------
+    Covariance : 2D array
+        The :func:`noiseCovariance` of the coils.
+
+    Returns
+    -------
+    Whitener : 2D array of complex64
+        The inverse of the Cholesky factor of the covariance, which takes
+        the coils to unit, uncorrelated noise.
+
+    """
+    Covariance = np.asarray(Covariance, dtype=np.complex128)
+    # a little loading keeps a singular estimate, e.g. a silent coil, usable
+    loading = 1e-6*max(np.real(np.trace(Covariance))/len(Covariance),
+                       np.finfo(np.float32).tiny)
+    lower = np.linalg.cholesky(Covariance+loading*np.eye(len(Covariance)))
+    return np.linalg.inv(lower).astype(np.complex64)
+
+
+def prewhiten(Kspace, Whitener):
+    """
+    Decorrelates the noise of the coils.
+
+    Parameters
+    ----------
+    Kspace : array
+        The (coil, ...) k-space.
+
+    Whitener : 2D array
+        The :func:`whitener` of the study.
+
+    Returns
+    -------
+    Kspace : array of complex64
+        The whitened k-space, in one matrix multiply over all of the samples.
+
+    """
+    Kspace = np.asarray(Kspace)
+    shape = Kspace.shape
+    return np.dot(Whitener, Kspace.reshape(shape[0], -1)).reshape(
+        shape).astype(np.complex64)
+
+
+def rss(Images):
+    """ Root sum of squares combination of (coil, ...) images """
+    return np.sqrt(np.sum(np.abs(Images)**2, axis=0))
+
+
+def adaptiveMaps(Images, Size=ADAPTIVE_SIZE):
+    """
+    Estimates the coil sensitivities from the images.
+
+    Parameters
+    ----------
+    Images : 3D array
+        The (coil, phase-encode, readout) prewhitened coil images.
+
+    Size : int, optional
+        Width of the neighbourhood averaged over. Defaults to
+        :data:`ADAPTIVE_SIZE`.
+
+    Returns
+    -------
+    Maps : 3D array of complex64
+        The (coil, phase-encode, readout) unit sensitivity of each pixel,
+        with the phase of the first coil taken as the reference.
+
+    """
+    coils = Images.shape[0]
+    covariance = np.empty(Images.shape[1:]+(coils, coils),
+                          dtype=np.complex64)
+    for row in range(coils):
+        for column in range(row, coils):
+            product = Images[row]*np.conj(Images[column])
+            value = (ndimage.uniform_filter(product.real, Size) +
+                     1j*ndimage.uniform_filter(product.imag, Size))
+            covariance[..., row, column] = value
+            covariance[..., column, row] = np.conj(value)
+    # the dominant eigenvector of each pixel, eigh sorts them ascending
+    _, vectors = np.linalg.eigh(covariance)
+    maps = vectors[..., -1]
+    reference = maps[..., :1]
+    maps = maps*np.conj(reference)/np.maximum(np.abs(reference), 1e-12)
+    return np.moveaxis(maps, -1, 0).astype(np.complex64)
+
+
+def sensitivityCombine(Images, Maps):
+    """
+    Sensitivity weighted combination of (coil, ...) images.
+
+    Parameters
+    ----------
+    Images : array
+        The coil images.
+
+    Maps : array
+        The coil sensitivities, of the same shape.
+
+    Returns
+    -------
+    Image : array of complex
+        sum(conj(Maps)*Images)/sum(abs(Maps)**2) over the coils.
+
+    """
+    weight = np.sum(np.abs(Maps)**2, axis=0)
+    return np.sum(np.conj(Maps)*Images, axis=0) / \
+        np.where(weight > 0, weight, 1)
+
+
+def combine(Images, Method='rss'):
+    """
+    Combines coil images.
+
+    Parameters
+    ----------
+    Images : 3D array
+        The (coil, phase-encode, readout) prewhitened coil images.
+
+    Method : string, optional
+        One of :data:`METHODS`. Defaults to 'rss'.
+
+    Returns
+    -------
+    Image : 2D array of complex64
+        The combined image.
+
+    """
+    if Method == 'rss':
+        return rss(Images).astype(np.complex64)
+    if Method == 'adaptive':
+        return sensitivityCombine(Images, adaptiveMaps(Images)).astype(
+            np.complex64)
+    raise ValueError('unknown coil combination %r' % (Method,))
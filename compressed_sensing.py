@@ -0,0 +1,484 @@
+"""
+.. py:module:: compressed_sensing
+Compressed Sensing Module
+=========================
+
+Iterative reconstruction of undersampled k-space. The image x is found by
+minimising
+
+    0.5*||M F x - y||**2 + Lambda*||Psi x||_1
+
+where F is the same shifted 2D FFT as :func:`recon.transform` (here with
+orthonormal scaling), M the sampling mask and y the acquired k-space. Two
+priors Psi are supported:
+
+* wavelet: an orthonormal multi-level Haar transform, solved with FISTA.
+  Each iteration is a gradient step, two FFTs, and a soft threshold of the
+  wavelet coefficients.
+* tv: anisotropic total variation, solved with ADMM. The finite differences
+  are circulant, so the x update is an exact divide in k-space, again two
+  FFTs per iteration, followed by a shrinkage of the differences.
+
+The solvers keep preallocated complex64 work buffers for a frame size, do
+their proximal steps in place, run the FFTs on every core through
+scipy.fft, and can start each frame from the result for the same coil of
+the slice before it, which is close to the answer. Only the frames that
+are given their (rep, slice, echo) are warm started, so a frame never
+starts from an unrelated one, and the slices have to be solved in order
+for every one after the first to have a start. Each solve records its
+convergence in :attr:`Solver.telemetry`, and the last one is kept for
+display by :func:`lastTelemetry`.
+
+The mask is taken from which samples of the k-space are non-zero, so the
+stage has to see the data as acquired, see :func:`filters.makeCS`.
+
+"""
+
+import threading
+import time
+
+import numpy as np
+from scipy import fft as spfft
+
+import memory_budget
+
+
+# priors, and the solver used for each
+METHODS = ('wavelet', 'tv')
+
+# default iterations, regularisation and stopping tolerance
+ITERATIONS = 30
+LAMBDA = 0.01
+TOLERANCE = 1e-4
+
+# deepest Haar decomposition used
+WAVELET_LEVELS = 4
+
+# ADMM penalty, the weight of the split differences against the data
+ADMM_PENALTY = 0.5
+
+# results kept for warm starts, e.g. the coils and echoes of a slice, the
+# oldest dropped first
+WARM_FRAMES = 128
+
+
+class CentredFFT(object):
+    """
+    Orthonormal shifted 2D FFT of frames of one size.
+
+    For even sizes the FFT shifts are folded into a checkerboard sign on
+    the input and output, so a transform is one multiply into a work buffer
+    and one in place FFT.
+
+    Parameters
+    ----------
+    Dim : tuple
+        Size of the (phase-encode, readout) frames.
+
+    """
+    def __init__(self, Dim):
+        self.dim = tuple(Dim)
+        self.even = all(size % 2 == 0 for size in self.dim)
+        if self.even:
+            sign = np.outer(1-2*(np.arange(self.dim[0]) % 2),
+                            1-2*(np.arange(self.dim[1]) % 2))
+            self.sign = sign.astype(np.complex64)
+            self.outSign = self.sign*(-1)**(self.dim[0]//2+self.dim[1]//2)
+
+    def _apply(self, Data, Out, Function, Shift):
+        """ One transform of Data into the buffer Out """
+        if not self.even:
+            Out[...] = Shift(Function(Shift(Data), norm='ortho',
+                                      workers=-1))
+            return Out
+        np.multiply(Data, self.sign, out=Out)
+        Out[...] = Function(Out, norm='ortho', overwrite_x=True, workers=-1)
+        Out *= self.outSign
+        return Out
+
+    def forward(self, Image, Out):
+        """ Image to centred k-space, written into Out """
+        return self._apply(Image, Out, spfft.fft2, np.fft.fftshift)
+
+    def inverse(self, Kspace, Out):
+        """ Centred k-space to image, written into Out """
+        return self._apply(Kspace, Out, spfft.ifft2, np.fft.ifftshift)
+
+
+def waveletLevels(Dim, Levels=WAVELET_LEVELS):
+    """ Haar levels that divide both sides of a frame evenly """
+    levels = 0
+    while levels < Levels and all(size % 2**(levels+1) == 0
+                                  for size in Dim):
+        levels += 1
+    return levels
+
+
+def haar(Image, Levels):
+    """
+    Orthonormal multi-level 2D Haar transform, in place.
+
+    The coefficients of each level are written over the top left corner
+    of the one before, in the usual pyramid layout.
+
+    """
+    rows, columns = Image.shape
+    for _ in range(Levels):
+        block = Image[:rows, :columns]
+        quads = block.reshape(rows//2, 2, columns//2, 2)
+        a, b = quads[:, 0, :, 0].copy(), quads[:, 0, :, 1].copy()
+        c, d = quads[:, 1, :, 0].copy(), quads[:, 1, :, 1].copy()
+        rows, columns = rows//2, columns//2
+        block[:rows, :columns] = (a+b+c+d)/2
+        block[:rows, columns:] = (a-b+c-d)/2
+        block[rows:, :columns] = (a+b-c-d)/2
+        block[rows:, columns:] = (a-b-c+d)/2
+    return Image
+
+
+def inverseHaar(Coefficients, Levels):
+    """ Inverse of :func:`haar`, in place """
+    rows, columns = Coefficients.shape
+    sizes = [(rows >> level, columns >> level)
+             for level in range(Levels, 0, -1)]
+    for rows, columns in sizes:
+        block = Coefficients[:2*rows, :2*columns]
+        low, horizontal = block[:rows, :columns].copy(), \
+            block[:rows, columns:].copy()
+        vertical, diagonal = block[rows:, :columns].copy(), \
+            block[rows:, columns:].copy()
+        quads = block.reshape(rows, 2, columns, 2)
+        quads[:, 0, :, 0] = (low+horizontal+vertical+diagonal)/2
+        quads[:, 0, :, 1] = (low-horizontal+vertical-diagonal)/2
+        quads[:, 1, :, 0] = (low+horizontal-vertical-diagonal)/2
+        quads[:, 1, :, 1] = (low-horizontal-vertical+diagonal)/2
+    return Coefficients
+
+
+def softThreshold(Data, Threshold, Scratch):
+    """
+    Complex soft threshold of Data, in place.
+
+    Scratch is a real buffer of the same shape.
+
+    """
+    np.abs(Data, out=Scratch)
+    np.maximum(Scratch, Threshold, out=Scratch)
+    np.divide(Threshold, Scratch, out=Scratch)
+    np.subtract(1, Scratch, out=Scratch)
+    Data *= Scratch
+    return Data
+
+
+def _difference(Image, Out):
+    """ Circular forward differences along each axis, into Out[0], Out[1] """
+    np.subtract(Image[1:], Image[:-1], out=Out[0, :-1])
+    np.subtract(Image[0], Image[-1], out=Out[0, -1])
+    np.subtract(Image[:, 1:], Image[:, :-1], out=Out[1, :, :-1])
+    np.subtract(Image[:, 0], Image[:, -1], out=Out[1, :, -1])
+    return Out
+
+
+def _divergence(Differences, Out):
+    """ The adjoint of :func:`_difference`, into Out """
+    rows, columns = Differences[0], Differences[1]
+    np.subtract(rows[:-1], rows[1:], out=Out[1:])
+    np.subtract(rows[-1], rows[0], out=Out[0])
+    Out[:, 1:] += columns[:, :-1]-columns[:, 1:]
+    Out[:, 0] += columns[:, -1]-columns[:, 0]
+    return Out
+
+
+class Solver(object):
+    """
+    Compressed sensing reconstruction of frames of one size.
+
+    Parameters
+    ----------
+    Dim : tuple
+        Size of the (phase-encode, readout) frames.
+
+    Method : string, optional
+        One of :data:`METHODS`. Defaults to 'wavelet'.
+
+    Lambda : float, optional
+        Weight of the prior, relative to the largest value of the zero
+        filled image. Defaults to :data:`LAMBDA`.
+
+    Iterations : int, optional
+        Most iterations run. Defaults to :data:`ITERATIONS`.
+
+    Tolerance : float, optional
+        Stops once the relative change of the image falls below this.
+        Defaults to :data:`TOLERANCE`.
+
+    WarmStart : bool, optional
+        Starts each frame from the result for the same coil of the slice
+        before it, if that was solved, instead of the zero filled image.
+        Defaults to False.
+
+    """
+    def __init__(self, Dim, Method='wavelet', Lambda=LAMBDA,
+                 Iterations=ITERATIONS, Tolerance=TOLERANCE,
+                 WarmStart=False):
+        if Method not in METHODS:
+            raise ValueError('unknown compressed sensing prior %r' %
+                             (Method,))
+        self.dim = tuple(Dim)
+        self.method = Method
+        self.lam = Lambda
+        self.iterations = Iterations
+        self.tolerance = Tolerance
+        self.warmStart = WarmStart
+        self.fft = CentredFFT(self.dim)
+        self.levels = waveletLevels(self.dim)
+        self.previous = {}
+        self.telemetry = {}
+        # work buffers, reused by every frame
+        self.image = np.empty(self.dim, dtype=np.complex64)
+        self.last = np.empty(self.dim, dtype=np.complex64)
+        self.momentum = np.empty(self.dim, dtype=np.complex64)
+        self.kspace = np.empty(self.dim, dtype=np.complex64)
+        self.work = np.empty(self.dim, dtype=np.complex64)
+        self.scratch = np.empty(self.dim, dtype=np.float32)
+        if Method == 'tv':
+            self.split = np.empty((2,)+self.dim, dtype=np.complex64)
+            self.dual = np.empty((2,)+self.dim, dtype=np.complex64)
+            self.gradient = np.empty((2,)+self.dim, dtype=np.complex64)
+            self.splitScratch = np.empty((2,)+self.dim, dtype=np.float32)
+            # the circulant difference operator is diagonal in k-space
+            frequencies = [np.fft.fftshift(2-2*np.cos(
+                2*np.pi*np.arange(size)/size)) for size in self.dim]
+            self.laplacian = np.add.outer(*frequencies).astype(np.float32)
+        self._lock = threading.Lock()
+
+    def memoryUsage(self):
+        """ Bytes held by the work buffers and warm starts """
+        return memory_budget.residentBytes(
+            *list(vars(self).values())+list(self.previous.values()))
+
+    def solve(self, Kspace, Key=(), Frame=None):
+        """
+        Reconstructs one frame.
+
+        Parameters
+        ----------
+        Kspace : 2D array
+            Centred (phase-encode, readout) k-space, with the samples that
+            were not acquired zero.
+
+        Key : tuple, optional
+            Which coil the frame is, so a warm start comes from the same
+            coil of the previous slice.
+
+        Frame : tuple, optional
+            The (rep, slice, echo) of the frame. Results are kept for the
+            next slice to start from, see WarmStart. Frames without one are
+            not warm started.
+
+        Returns
+        -------
+        Kspace : 2D array of complex64
+            The k-space of the reconstructed image, with the acquired
+            samples kept as they were.
+
+        """
+        with self._lock:
+            data = np.asarray(Kspace, dtype=np.complex64)
+            mask = (data != 0).astype(np.float32)
+            start = time.time()
+            self.fft.inverse(data, self.last)
+            # the threshold scales with the data
+            threshold = self.lam*float(np.abs(self.last).max() or 1.0)
+            warm = self.warmStart and Frame is not None
+            if warm:
+                rep, slc, echo = Frame
+                # each start is used once, so they do not pile up
+                previous = self.previous.pop(Key+(rep, slc-1, echo), None)
+                if previous is not None:
+                    self.last[...] = previous
+            if self.method == 'wavelet':
+                history = self._fista(data, mask, threshold)
+            else:
+                history = self._admm(data, mask, threshold)
+            if warm:
+                self.previous[Key+tuple(Frame)] = self.image.copy()
+                while len(self.previous) > WARM_FRAMES:
+                    del self.previous[next(iter(self.previous))]
+            self.telemetry = {'method': self.method,
+                              'iterations': len(history),
+                              'change': history,
+                              'converged': bool(history and
+                                                history[-1] <
+                                                self.tolerance),
+                              'seconds': time.time()-start}
+            out = self.fft.forward(self.image, self.kspace).copy()
+            acquired = mask > 0
+            out[acquired] = data[acquired]
+            return out
+
+    def _change(self):
+        """ Relative change between the current and last image """
+        np.subtract(self.image, self.last, out=self.work)
+        norm = np.linalg.norm(self.image)
+        return float(np.linalg.norm(self.work)/norm) if norm else 0.0
+
+    def _fista(self, Data, Mask, Threshold):
+        """ FISTA with a Haar wavelet prior, step 1 as F is orthonormal """
+        self.momentum[...] = self.last
+        step = 1.0
+        history = []
+        for _ in range(self.iterations):
+            # gradient of the data term, F^H (M F z - y)
+            self.fft.forward(self.momentum, self.kspace)
+            self.kspace *= Mask
+            self.kspace -= Data
+            self.fft.inverse(self.kspace, self.work)
+            np.subtract(self.momentum, self.work, out=self.image)
+            # proximal step on the wavelet coefficients
+            haar(self.image, self.levels)
+            softThreshold(self.image, Threshold, self.scratch)
+            inverseHaar(self.image, self.levels)
+            nextStep = (1+np.sqrt(1+4*step*step))/2
+            history.append(self._change())
+            # z = x + (t-1)/t' (x - x_last)
+            np.subtract(self.image, self.last, out=self.momentum)
+            self.momentum *= (step-1)/nextStep
+            self.momentum += self.image
+            self.last[...] = self.image
+            step = nextStep
+            if history[-1] < self.tolerance:
+                break
+        return history
+
+    def _admm(self, Data, Mask, Threshold):
+        """ ADMM with an anisotropic total variation prior """
+        penalty = ADMM_PENALTY
+        self.image[...] = self.last
+        _difference(self.image, self.split)
+        self.dual[...] = 0
+        denominator = Mask+penalty*self.laplacian
+        denominator[denominator == 0] = 1
+        history = []
+        for _ in range(self.iterations):
+            # x = (F^H M F + rho D^T D)^-1 (F^H y + rho D^T (z - u))
+            np.subtract(self.split, self.dual, out=self.gradient)
+            _divergence(self.gradient, self.work)
+            self.fft.forward(self.work, self.kspace)
+            self.kspace *= penalty
+            self.kspace += Data
+            self.kspace /= denominator
+            self.fft.inverse(self.kspace, self.image)
+            # z = shrink(D x + u), u = u + D x - z
+            _difference(self.image, self.gradient)
+            self.gradient += self.dual
+            self.split[...] = self.gradient
+            softThreshold(self.split, Threshold/penalty, self.splitScratch)
+            np.subtract(self.gradient, self.split, out=self.gradient)
+            # the primal residual D x - z is the change of the dual
+            self.dual -= self.gradient
+            residual = np.linalg.norm(self.dual)
+            scale = np.linalg.norm(self.split)
+            self.dual[...] = self.gradient
+            history.append(max(self._change(),
+                               float(residual/scale) if scale else 0.0))
+            self.last[...] = self.image
+            if history[-1] < self.tolerance:
+                break
+        return history
+
+    def __call__(self, Kspace, Frame=None):
+        """
+        Reconstructs every frame of (..., phase-encode, readout) k-space,
+        e.g. the coils of the (rep, slice, echo) Frame.
+
+        """
+        Kspace = np.asarray(Kspace)
+        if Kspace.ndim == 2:
+            return self.solve(Kspace, Frame=Frame)
+        out = np.empty(Kspace.shape, dtype=np.complex64)
+        for index in np.ndindex(*Kspace.shape[:-2]):
+            out[index] = self.solve(Kspace[index], index, Frame)
+        return out
+
+
+class _SolverCache(dict):
+    """ Solvers, keyed by frame size and settings """
+    def memoryUsage(self):
+        """ Bytes held by the solvers """
+        return sum(solver.memoryUsage() for solver in list(self.values()))
+
+    def release(self, Bytes):
+        """ Drops the solvers when the memory governor needs the space """
+        freed = self.memoryUsage()
+        self.clear()
+        return freed
+
+
+_SOLVERS = _SolverCache()
+_SOLVER_LOCK = threading.Lock()
+_LAST = [None]
+memory_budget.governor().register(_SOLVERS, 'compressed sensing buffers',
+                                  memory_budget.PRIORITY_DERIVED)
+
+
+def solver(Dim, Method='wavelet', Lambda=LAMBDA, Iterations=ITERATIONS,
+           Tolerance=TOLERANCE, WarmStart=False):
+    """ Returns the cached :class:`Solver` for a frame size and settings """
+    key = (tuple(Dim), Method, Lambda, Iterations, Tolerance, WarmStart)
+    with _SOLVER_LOCK:
+        if key not in _SOLVERS:
+            _SOLVERS[key] = Solver(Dim, Method, Lambda, Iterations,
+                                   Tolerance, WarmStart)
+        return _SOLVERS[key]
+
+
+def reconstruct(Kspace, Method='wavelet', Lambda=LAMBDA,
+                Iterations=ITERATIONS, Tolerance=TOLERANCE, WarmStart=False,
+                Frame=None):
+    """
+    Fills the missing samples of undersampled k-space.
+
+    Parameters
+    ----------
+    Kspace : array
+        The (..., phase-encode, readout) k-space, e.g. the coils of a
+        frame, with the samples that were not acquired zero.
+
+    Method, Lambda, Iterations, Tolerance, WarmStart : optional
+        The prior and solver settings, see :class:`Solver`.
+
+    Frame : tuple, optional
+        The (rep, slice, echo) of the frame, needed for a warm start, see
+        :meth:`Solver.solve`.
+
+    Returns
+    -------
+    Kspace : array of complex64
+        The k-space of the reconstructed images, or Kspace unchanged if it
+        is fully sampled.
+
+    """
+    Kspace = np.asarray(Kspace)
+    if np.all(Kspace != 0):
+        return Kspace
+    method = solver(Kspace.shape[-2:], Method, Lambda, Iterations,
+                    Tolerance, WarmStart)
+    out = method(Kspace, Frame)
+    _LAST[0] = method.telemetry
+    return out
+
+
+def lastTelemetry():
+    """
+    Returns the convergence of the last frame reconstructed.
+
+    Returns
+    -------
+    Telemetry : dictionary or None
+        The prior ('method'), the 'iterations' run, the relative 'change'
+        of the image at each of them, whether it 'converged' within the
+        tolerance, and the 'seconds' taken.
+
+    """
+    return _LAST[0]
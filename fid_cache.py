@@ -0,0 +1,363 @@
+"""
+.. py:module:: fid_cache
+FID Cache Module
+================
+
+Sidecar cache for previously opened FIDs. The decoded k-space of each study
+is stored in a user cache directory as an aligned .npy file that can be
+memory mapped straight back in, next to a pickled copy of the parsed header
+and procpar dictionary. Entries are keyed by the path, modification time and
+size of the fid and procpar files, plus a digest of the whole procpar and
+of the first and last :data:`SAMPLE_BYTES` of the fid. Reading the whole fid
+would cost as much as decoding it, and a reacquired or edited study changes
+its modification time, so it is never served stale data.
+
+The cache is kept under a size limit by removing the least recently opened
+entries, see :func:`trim`. Entries are written to hidden partial
+directories first, and partial directories left behind by a process that
+died while writing one are removed once they are :data:`PARTIAL_SECONDS`
+old.
+
+"""
+
+import hashlib
+import os
+import pickle
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import fid_reader
+
+
+# bytes hashed from each end of the fid for the cache key
+SAMPLE_BYTES = 1 << 20
+
+# bytes read at a time when streaming through a file
+CHUNK_BYTES = 8 << 20
+
+# changed whenever the layout of the cached k-space changes
+CACHE_VERSION = 4
+
+# default size limit of the cache, overridden by MRMAGIC_FID_CACHE_BYTES
+LIMIT_BYTES = 8 << 30
+
+# partial entries untouched for this long were left by a dead writer
+PARTIAL_SECONDS = 24*60*60
+
+# prefix of the directories entries are written to
+PARTIAL_PREFIX = '.partial-'
+
+
+def cacheDirectory():
+    """
+    Returns the directory used to hold the cached FIDs.
+
+    The MRMAGIC_CACHE environment variable is used if it is set, otherwise
+    the platform's per-user cache location. The other caches, e.g. of
+    results and gridding operators, are subdirectories of it, which
+    :func:`trim` leaves alone.
+
+    """
+    if 'MRMAGIC_CACHE' in os.environ:
+        return os.environ['MRMAGIC_CACHE']
+    if platform.system() == 'Windows':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'mr_magic', 'fid')
+
+
+def cacheLimit():
+    """
+    Returns the size limit of the cache in bytes.
+
+    The MRMAGIC_FID_CACHE_BYTES environment variable is used if it is set,
+    otherwise :data:`LIMIT_BYTES`.
+
+    """
+    return int(os.environ.get('MRMAGIC_FID_CACHE_BYTES', LIMIT_BYTES))
+
+
+def _hashFile(Digest, Filename, Start=0, Length=None):
+    """ Streams part of a file through a hashlib digest """
+    with open(Filename, 'rb') as dataFile:
+        dataFile.seek(Start)
+        remaining = Length
+        while remaining is None or remaining > 0:
+            size = CHUNK_BYTES if remaining is None else \
+                min(CHUNK_BYTES, remaining)
+            chunk = dataFile.read(size)
+            if not chunk:
+                break
+            Digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+
+
+def cacheKey(Path):
+    """
+    Builds the cache key for a \*.fid folder.
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Returns
+    -------
+    Key : string
+        Hex digest of the cache version, path, modification times, sizes,
+        the whole procpar and the first and last :data:`SAMPLE_BYTES` of the
+        fid.
+
+    """
+    fidName = os.path.abspath(fid_reader.fidFilename(Path))
+    procparName = os.path.join(os.path.dirname(fidName), 'procpar')
+    digest = hashlib.sha1(('%d;' % CACHE_VERSION).encode('ascii'))
+    digest.update(fidName.encode('utf-8'))
+    for name in (fidName, procparName):
+        info = os.stat(name)
+        digest.update(('%d:%d;' % (info.st_mtime_ns, info.st_size))
+                      .encode('ascii'))
+    _hashFile(digest, procparName)
+    size = os.path.getsize(fidName)
+    _hashFile(digest, fidName, 0, SAMPLE_BYTES)
+    _hashFile(digest, fidName, max(size-SAMPLE_BYTES, 0), SAMPLE_BYTES)
+    return digest.hexdigest()
+
+
+def load(Path):
+    """
+    Opens a cached FID.
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Returns
+    -------
+    dic : dictionary or None
+        Header fields and procpar as returned by :func:`fid_reader.readFID`,
+        or None if the study is not cached.
+
+    data : 5D memory mapped array or None
+        The (rep, slice, echo, phase-encode, readout) k-space, or None.
+
+    """
+    entry = os.path.join(cacheDirectory(), cacheKey(Path))
+    try:
+        with open(os.path.join(entry, 'dic.pickle'), 'rb') as dicFile:
+            dic = pickle.load(dicFile)
+        data = np.load(os.path.join(entry, 'kspace.npy'), mmap_mode='r')
+        # the modification time orders the entries for eviction
+        os.utime(entry)
+    except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None, None
+    return dic, data
+
+
+def store(Path, Dic, Data, Workers=None):
+    """
+    Decodes a FID into the cache.
+
+    The data is decoded with :meth:`fid_reader.LazyKspace.decodeInto`
+    straight into the memory mapped .npy file, so the full dataset never has
+    to be held in memory. The entry is written to a temporary directory and
+    renamed into place, so readers never see a partial entry. Incomplete
+    acquisitions, and studies larger than :func:`cacheLimit`, are not
+    stored. Older entries are removed first to make room for the new one
+    under the cache's size limit, see :func:`trim`.
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Dic : dictionary
+        Header fields and procpar as returned by :func:`fid_reader.readFID`.
+
+    Data : :class:`fid_reader.LazyKspace`
+        The lazily decoded data.
+
+    Workers : int, optional
+        Number of decoding threads. Defaults to the number of processors.
+
+    Returns
+    -------
+    Stored : bool
+        True if the entry was written.
+
+    """
+    if not Data.fid.complete:
+        return False
+    root = cacheDirectory()
+    entry = os.path.join(root, cacheKey(Path))
+    if os.path.isdir(entry):
+        return True
+    size = int(np.prod(Data.shape))*np.dtype(np.complex64).itemsize
+    if size > cacheLimit():
+        # storing it would empty the cache and still not fit
+        return False
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    trim(cacheLimit()-size, root)
+    working = tempfile.mkdtemp(dir=root, prefix=PARTIAL_PREFIX)
+    try:
+        out = np.lib.format.open_memmap(os.path.join(working, 'kspace.npy'),
+                                        mode='w+', dtype=np.complex64,
+                                        shape=Data.shape)
+        Data.decodeInto(out, Workers)
+        out.flush()
+        del out
+        with open(os.path.join(working, 'dic.pickle'), 'wb') as dicFile:
+            pickle.dump(Dic, dicFile, pickle.HIGHEST_PROTOCOL)
+        os.rename(working, entry)
+    except OSError:
+        # another process cached the same study first
+        shutil.rmtree(working, ignore_errors=True)
+        return os.path.isdir(entry)
+    except Exception:
+        shutil.rmtree(working, ignore_errors=True)
+        raise
+    return True
+
+
+def _entries(Root):
+    """ (last use, size, path) of every entry """
+    entries = []
+    for name in os.listdir(Root):
+        path = os.path.join(Root, name)
+        # only the keyed entries, not the partial or other directories
+        if len(name) != 40 or name.strip('0123456789abcdef') or \
+                not os.path.isdir(path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(path, item))
+                       for item in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            # removed by another process
+            continue
+    return entries
+
+
+def removeStale(Root=None, Age=PARTIAL_SECONDS):
+    """
+    Removes the partial entries left behind by writers that died.
+
+    Parameters
+    ----------
+    Root : string, optional
+        The cache directory. Defaults to :func:`cacheDirectory`.
+
+    Age : float, optional
+        Seconds since a partial entry, or any file in it, was last written
+        after which it is taken to be abandoned. Defaults to
+        :data:`PARTIAL_SECONDS`.
+
+    Returns
+    -------
+    Removed : int
+        Number of partial entries removed.
+
+    """
+    root = cacheDirectory() if Root is None else Root
+    if not os.path.isdir(root):
+        return 0
+    now = time.time()
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.startswith(PARTIAL_PREFIX) or not os.path.isdir(path):
+            continue
+        try:
+            written = max([os.path.getmtime(path)] +
+                          [os.path.getmtime(os.path.join(path, item))
+                           for item in os.listdir(path)])
+        except OSError:
+            continue
+        if now-written > Age:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def trim(Limit=None, Root=None):
+    """
+    Removes the least recently opened entries until the cache fits.
+
+    Abandoned partial entries are removed first, see :func:`removeStale`.
+
+    Parameters
+    ----------
+    Limit : int, optional
+        Size to trim to in bytes. Defaults to :func:`cacheLimit`.
+
+    Root : string, optional
+        The cache directory. Defaults to :func:`cacheDirectory`.
+
+    Returns
+    -------
+    Removed : int
+        Bytes freed from the entries.
+
+    """
+    root = cacheDirectory() if Root is None else Root
+    if Limit is None:
+        Limit = cacheLimit()
+    if not os.path.isdir(root):
+        return 0
+    removeStale(root)
+    entries = sorted(_entries(root))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in entries:
+        if total <= Limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += size
+    return removed
+
+
+def readFID(Path, Workers=None):
+    """
+    Opens a \*.fid folder through the cache.
+
+    A cached study is memory mapped straight back in. Otherwise the study is
+    decoded into the cache and then mapped, or if it is still being acquired,
+    too large to cache or cannot be mapped back, it is returned as a
+    :class:`fid_reader.LazyKspace`.
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Workers : int, optional
+        Number of decoding threads. Defaults to the number of processors.
+
+    Returns
+    -------
+    dic : dictionary
+        Header fields and procpar.
+
+    data : 5D array-like
+        The (rep, slice, echo, phase-encode, readout) k-space.
+
+    """
+    dic, data = load(Path)
+    if data is None:
+        dic, data = fid_reader.readFID(Path)
+        if store(Path, dic, data, Workers):
+            # the entry may have been trimmed by another process since
+            cachedDic, cached = load(Path)
+            if cached is not None:
+                dic, data = cachedDic, cached
+    return dic, data
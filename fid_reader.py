@@ -0,0 +1,898 @@
+"""
+.. py:module:: fid_reader
+FID Reader Module
+=================
+
+Lazy reader for Varian FID files. The file header and block headers are
+parsed directly and the data region is memory mapped, so traces are only read
+from disk and decoded into complex64 when they are indexed. Data stored as
+int16, int32 or float32 is supported.
+
+The raw file is exposed by :class:`LazyFID` as a (block, trace, readout)
+array-like, and :class:`LazyKspace` maps the stored traces onto
+(rep, slice, echo, phase-encode, readout) so that single frames or
+phase-encode ranges can be pulled out of multi-GB acquisitions. The mapping
+is built from the procpar by :func:`acquisitionOrder`, which unscrambles
+interleaved slices, standard and compressed loops and petable orderings.
+The partitions of 3D studies, the nv2 phase-encode loop, are put on the
+slice axis.
+Studies acquired on several receivers have the coils of each repetition
+next to each other on the first axis, see :func:`receiverCount`. When the
+whole dataset is needed, :func:`parallelDecode` decodes it on a
+thread pool into a single preallocated array.
+
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nmrglue as ng
+
+import memory_budget
+
+
+# 32 byte big-endian header at the start of every fid file
+FILE_HEADER = np.dtype([('nblocks', '>i4'),
+                        ('ntraces', '>i4'),
+                        ('np', '>i4'),
+                        ('ebytes', '>i4'),
+                        ('tbytes', '>i4'),
+                        ('bbytes', '>i4'),
+                        ('vers_id', '>i2'),
+                        ('status', '>i2'),
+                        ('nbheaders', '>i4')])
+
+# 28 byte big-endian header in front of the data of every block
+BLOCK_HEADER = np.dtype([('scale', '>i2'),
+                         ('status', '>i2'),
+                         ('index', '>i2'),
+                         ('mode', '>i2'),
+                         ('ctcount', '>i4'),
+                         ('lpval', '>f4'),
+                         ('rpval', '>f4'),
+                         ('lvl', '>f4'),
+                         ('tlt', '>f4')])
+
+# status bits of the file header that describe the storage type
+S_32 = 0x4
+S_FLOAT = 0x8
+
+
+def fidFilename(Path):
+    """
+    Returns the path of the binary fid file for a \*.fid folder or file.
+
+    Parameters
+    ----------
+    Path : string
+        Either the top level \*.fid folder, or the fid file inside it.
+
+    Returns
+    -------
+    Filename : string
+        Path to the binary fid file.
+
+    """
+    if os.path.isdir(Path):
+        return os.path.join(Path, 'fid')
+    return Path
+
+
+def findFIDs(Directories):
+    """
+    Lists every \*.fid folder below the supplied directories.
+
+    Parameters
+    ----------
+    Directories : list of strings
+        Directories to search. A \*.fid folder may also be given directly.
+
+    Returns
+    -------
+    Paths : list of strings
+        The \*.fid folders, sorted.
+
+    """
+    found = set()
+    for directory in Directories:
+        if directory.rstrip(os.sep).endswith('.fid'):
+            found.add(os.path.abspath(directory))
+            continue
+        for root, dirs, _ in os.walk(directory):
+            for name in list(dirs):
+                if name.endswith('.fid'):
+                    found.add(os.path.abspath(os.path.join(root, name)))
+                    # a fid folder never holds other studies
+                    dirs.remove(name)
+    return sorted(found)
+
+
+def readFileHeader(Filename):
+    """
+    Reads the file header of a Varian fid file.
+
+    Parameters
+    ----------
+    Filename : string
+        Path to the binary fid file.
+
+    Returns
+    -------
+    Header : dictionary
+        The header fields, keyed by the names used in :data:`FILE_HEADER`.
+
+    """
+    with open(Filename, 'rb') as fidFile:
+        head = np.frombuffer(fidFile.read(FILE_HEADER.itemsize), FILE_HEADER)
+    if head.size != 1:
+        raise IOError('%s is too short to be a fid file' % Filename)
+    return dict((name, int(head[name][0])) for name in FILE_HEADER.names)
+
+
+def elementType(Header):
+    """
+    Returns the big-endian numpy type of the stored data points.
+
+    Parameters
+    ----------
+    Header : dictionary
+        File header as returned by :func:`readFileHeader`.
+
+    Returns
+    -------
+    dtype : numpy dtype
+        One of big-endian float32, int32 or int16.
+
+    """
+    if Header['status'] & S_FLOAT:
+        return np.dtype('>f4')
+    elif Header['status'] & S_32:
+        return np.dtype('>i4')
+    return np.dtype('>i2')
+
+
+def readProcpar(Path):
+    """
+    Reads the procpar file that accompanies a fid.
+
+    Parameters
+    ----------
+    Path : string
+        Either the top level \*.fid folder, or the fid file inside it.
+
+    Returns
+    -------
+    Procpar : dictionary
+        The parameter dictionary in the format used by nmrglue.
+
+    """
+    folder = os.path.dirname(fidFilename(Path))
+    return ng.varian.read_procpar(os.path.join(folder, 'procpar'))
+
+
+def procparValue(Procpar, Name, Default=None, Index=0):
+    """
+    Convenience function to read a single procpar value as a float.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary returned by :func:`readProcpar`.
+
+    Name : string
+        Name of the parameter.
+
+    Default : optional
+        Returned if the parameter is missing. Defaults to None.
+
+    Index : int, optional
+        Element of an arrayed parameter to return. Defaults to the first.
+
+    Returns
+    -------
+    Value : float, string or Default
+        The value as a float, or the raw string if it is not numeric.
+
+    """
+    if Name not in Procpar:
+        return Default
+    value = Procpar[Name]['values'][Index]
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def decodeTraces(Raw, Out=None):
+    """
+    Converts interleaved real/imaginary points into complex64.
+
+    Parameters
+    ----------
+    Raw : array
+        Stored points with the real/imaginary pairs on the last axis, in any
+        of the storage types returned by :func:`elementType`.
+
+    Out : array, optional
+        Preallocated complex64 array of shape Raw.shape[:-1] to decode into.
+
+    Returns
+    -------
+    Data : array of complex64
+        The decoded traces.
+
+    """
+    if Out is None:
+        Out = np.empty(Raw.shape[:-1], dtype=np.complex64)
+    # the byte swap and type conversion are done while copying each part
+    Out.real = Raw[..., 0]
+    Out.imag = Raw[..., 1]
+    return Out
+
+
+def parallelDecode(Raw, Order, Out=None, Workers=None):
+    """
+    Decodes every block of a fid on a thread pool.
+
+    The (block, trace) positions are split into ranges that are byte swapped
+    and converted into their own section of one preallocated output. The
+    numpy copies release the GIL, so the decode scales across cores and the
+    memory mapped reads are issued in parallel.
+
+    Parameters
+    ----------
+    Raw : 4D array
+        Stored points as (block, trace, readout, real/imaginary), usually the
+        raw attribute of a :class:`LazyFID`.
+
+    Order : 1D array of ints
+        The traces to decode from each block, in output order.
+
+    Out : 3D array, optional
+        Preallocated complex64 output of shape (block, len(Order), readout).
+
+    Workers : int, optional
+        Number of threads. Defaults to the number of processors.
+
+    Returns
+    -------
+    Data : 3D array of complex64
+        The decoded (block, position, readout) data.
+
+    """
+    Order = np.asarray(Order, dtype=np.intp)
+    blocks, positions = Raw.shape[0], Order.size
+    if Out is None:
+        Out = np.empty((blocks, positions, Raw.shape[2]), dtype=np.complex64)
+    if Workers is None:
+        Workers = os.cpu_count() or 1
+    # a contiguous order can be read as a slice, skipping the gather copy
+    if positions > 0 and np.array_equal(Order, np.arange(Order[0],
+                                                         Order[0]+positions)):
+        Order = slice(Order[0], Order[0]+positions)
+    # aim for a few tasks per thread so uneven reads still balance out
+    tasks = []
+    if blocks >= 4*Workers:
+        perTask = -(-blocks//(4*Workers))
+        for start in range(0, blocks, perTask):
+            tasks.append((slice(start, start+perTask), slice(None)))
+    else:
+        perTask = max(1, (blocks*positions)//(4*Workers))
+        for block in range(blocks):
+            for start in range(0, positions, perTask):
+                tasks.append((block, slice(start, start+perTask)))
+
+    def decodeRange(Blocks, Positions):
+        if isinstance(Order, slice):
+            start, stop, _ = Positions.indices(positions)
+            traces = slice(Order.start+start, Order.start+stop)
+        else:
+            traces = Order[Positions]
+        decodeTraces(Raw[Blocks, traces], Out[Blocks, Positions])
+    if Workers == 1 or len(tasks) == 1:
+        for task in tasks:
+            decodeRange(*task)
+    else:
+        with ThreadPoolExecutor(max_workers=Workers) as pool:
+            # list() re-raises any exception from the workers
+            list(pool.map(lambda task: decodeRange(*task), tasks))
+    return Out
+
+
+def readPetable(Name, Directories):
+    """
+    Reads the phase-encode table of a study.
+
+    Parameters
+    ----------
+    Name : string
+        The petable parameter, the file name of the table.
+
+    Directories : list of strings
+        Directories searched for the table, in order.
+
+    Returns
+    -------
+    Table : 1D array of ints or None
+        The t1 entries, the phase-encode step of each acquired line in
+        acquisition order, or None if no table was found.
+
+    """
+    for directory in Directories:
+        filename = os.path.join(directory, Name)
+        if not os.path.isfile(filename):
+            continue
+        with open(filename) as tableFile:
+            tokens = tableFile.read().replace('=', ' = ').split()
+        values = []
+        if 't1' in tokens:
+            for token in tokens[tokens.index('t1')+1:]:
+                if token == '=':
+                    continue
+                try:
+                    values.append(int(token))
+                except ValueError:
+                    # the start of the next table
+                    break
+        if values:
+            return np.array(values, dtype=np.intp)
+    return None
+
+
+class _OrderCache(dict):
+    """ Trace orders already built, keyed by the protocol """
+    def memoryUsage(self):
+        """ Bytes held by the cached orders """
+        return memory_budget.residentBytes(*self.values())
+
+    def release(self, Bytes):
+        """ Drops the orders when the memory governor needs the space """
+        freed = self.memoryUsage()
+        self.clear()
+        return freed
+
+
+_ORDERS = _OrderCache()
+memory_budget.governor().register(_ORDERS, 'trace orders',
+                                  memory_budget.PRIORITY_DERIVED)
+
+
+def receiverCount(Procpar):
+    """
+    Returns the number of receivers a study was acquired with.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary returned by :func:`readProcpar`.
+
+    Returns
+    -------
+    Receivers : int
+        The number of receivers switched on in the rcvrs parameter, e.g.
+        'yyyy', or 1 if it is missing.
+
+    """
+    rcvrs = procparValue(Procpar, 'rcvrs', 'y')
+    if not isinstance(rcvrs, str):
+        return 1
+    return max(1, rcvrs.lower().count('y'))
+
+
+def acquisitionOrder(Procpar, Blocks, Traces, Table=None):
+    """
+    Builds the permutation from stored traces to (rep, slice, echo, pe).
+
+    The seqcon parameter says whether the echo, slice and phase-encode
+    loops are compressed, i.e. acquired within a block, or standard, i.e.
+    each step is its own block. Compressed loops are stored with the echoes
+    varying fastest, then the slices, then the phase-encode lines. Standard
+    loops are stored over blocks in the same order, inside the repetitions.
+
+    Slices are put in order of position, so interleaved acquisitions, where
+    pss lists the slices in acquisition order, are unscrambled. With a
+    petable the lines are put in order of their phase-encode step. The nv2
+    loop of a 3D study, stored outside the phase-encode loop, is put on the
+    slice axis.
+
+    Each receiver stores its own copy of every block, one after the other.
+    The coils are put next to each other on the rep axis, so with C
+    receivers rep r of coil c is at r*C+c.
+
+    Orders are cached per protocol, so studies acquired with the same
+    parameters share one array.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary returned by :func:`readProcpar`.
+
+    Blocks : int
+        Number of blocks in the fid, as given by its header.
+
+    Traces : int
+        Number of traces in each block.
+
+    Table : 1D array of ints, optional
+        The petable, see :func:`readPetable`.
+
+    Returns
+    -------
+    Order : 4D array of ints
+        Read-only. The flat trace number, block*Traces+trace, for every
+        (rep, slice, echo, phase-encode) position. If the parameters do not
+        account for every trace, each block is one repetition and each
+        trace its own phase-encode line.
+
+    Raises
+    ------
+    ValueError
+        If the blocks are not a whole number of copies, one per receiver.
+
+    """
+    positions = [float(value) for value in Procpar['pss']['values']] \
+        if 'pss' in Procpar else [0.0]
+    echoes = int(procparValue(Procpar, 'ne', 1))
+    lines = int(procparValue(Procpar, 'nv', Traces))
+    fract = procparValue(Procpar, 'fract_ky')
+    if isinstance(fract, float) and 1 <= fract < lines//2:
+        # partial Fourier only acquires fract_ky lines before the centre
+        lines = lines//2+int(fract)
+    partitions = int(procparValue(Procpar, 'nv2', 1) or 1)
+    seqcon = str(procparValue(Procpar, 'seqcon', 'nccnn')).ljust(4, 'n')
+    receivers = receiverCount(Procpar)
+    if Blocks % receivers != 0:
+        raise ValueError('%d blocks cannot be split between %d receivers' %
+                         (Blocks, receivers))
+    if Table is not None and (Table.size != lines or
+                              np.unique(Table).size != lines):
+        # not a permutation of the lines, so it cannot be unscrambled
+        Table = None
+    key = (tuple(positions), echoes, lines, partitions, seqcon[:4], Blocks,
+           Traces, receivers, None if Table is None else Table.tobytes())
+    order = _ORDERS.get(key)
+    if order is not None:
+        return order
+    # the loops are laid out over the blocks of one receiver
+    Blocks //= receivers
+
+    # (size, acquisition slot of each canonical index, canonical axis) of
+    # the echo, slice, phase-encode and partition loops, fastest first
+    loops = [(echoes, np.arange(echoes), 2),
+             (len(positions), np.argsort(positions, kind='stable'), 1),
+             (lines, np.arange(lines) if Table is None else
+              np.argsort(Table, kind='stable'), 3),
+             (partitions, np.arange(partitions), 1)]
+    standard = [seqcon[index] == 's' for index in range(4)]
+    perBlock = int(np.prod([size for (size, _, _), std in
+                            zip(loops, standard) if not std]))
+    perRep = int(np.prod([size for (size, _, _), std in
+                          zip(loops, standard) if std]))
+    if perBlock != Traces or Blocks % perRep != 0 or \
+            (partitions > 1 and len(positions) > 1):
+        order = np.arange(Blocks*Traces).reshape(Blocks, 1, 1, Traces)
+    else:
+        # broadcast the slot of each loop onto (rep, slice, echo, pe)
+        trace = np.zeros((1, 1, 1, 1), dtype=np.intp)
+        block = np.arange(Blocks//perRep).reshape(-1, 1, 1, 1)*perRep
+        blockStride = traceStride = 1
+        for index, (size, slots, axis) in enumerate(loops):
+            shape = [1, 1, 1, 1]
+            shape[axis] = size
+            slots = slots.reshape(shape)
+            if standard[index]:
+                block = block+slots*blockStride
+                blockStride *= size
+            else:
+                trace = trace+slots*traceStride
+                traceStride *= size
+        order = block*Traces+trace
+    if receivers > 1:
+        block, trace = np.divmod(order[:, None], Traces)
+        coil = np.arange(receivers).reshape(1, -1, 1, 1, 1)
+        order = ((block*receivers+coil)*Traces+trace).reshape(
+            (-1,)+order.shape[1:])
+    order = np.ascontiguousarray(order, dtype=np.intp)
+    order.flags.writeable = False
+    if len(_ORDERS) >= 64:
+        _ORDERS.clear()
+    _ORDERS[key] = order
+    return order
+
+
+def procparOrder(Procpar, Blocks, Traces, Directory=None):
+    """
+    Builds the trace order of a study, see :func:`acquisitionOrder`.
+
+    The petable, if the study used one, is looked for in the study folder,
+    in the directories listed in the MRMAGIC_TABLIB environment variable,
+    and in the user and system VnmrJ tablib directories.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary returned by :func:`readProcpar`.
+
+    Blocks : int
+        Number of blocks in the fid, as given by its header.
+
+    Traces : int
+        Number of traces in each block.
+
+    Directory : string, optional
+        The \*.fid folder.
+
+    Returns
+    -------
+    Order : 4D array of ints
+        The flat trace number for every (rep, slice, echo, pe) position.
+
+    """
+    table = None
+    name = procparValue(Procpar, 'petable', '')
+    if isinstance(name, str) and name not in ('', 'n', 'none'):
+        directories = [] if Directory is None else [Directory]
+        directories += [path for path in
+                        os.environ.get('MRMAGIC_TABLIB', '').split(os.pathsep)
+                        if path]
+        directories += [os.path.join(os.path.expanduser('~'), 'vnmrsys',
+                                     'tablib'),
+                        os.path.join(os.sep, 'vnmr', 'tablib')]
+        table = readPetable(name, directories)
+    return acquisitionOrder(Procpar, Blocks, Traces, table)
+
+
+def _expandKey(Key, Ndim):
+    """ Normalises an index into a tuple of exactly Ndim entries """
+    if not isinstance(Key, tuple):
+        Key = (Key,)
+    if any(k is Ellipsis for k in Key):
+        where = [k is Ellipsis for k in Key].index(True)
+        fill = (slice(None),)*(Ndim-len(Key)+1)
+        Key = Key[:where]+fill+Key[where+1:]
+    if len(Key) > Ndim:
+        raise IndexError('too many indices for a %dD dataset' % Ndim)
+    return Key+(slice(None),)*(Ndim-len(Key))
+
+
+class LazyFID(object):
+    """
+    Memory mapped, array-like access to a Varian fid file.
+
+    Indexing with (block, trace, readout) reads only the requested traces
+    and returns them decoded as complex64. The headers are parsed when the
+    object is created, but no data is read.
+
+    Parameters
+    ----------
+    Path : string
+        Either the top level \*.fid folder, or the fid file inside it.
+
+    """
+    dtype = np.dtype(np.complex64)
+    ndim = 3
+
+    def __init__(self, Path):
+        self.filename = fidFilename(Path)
+        self.header = readFileHeader(self.filename)
+        self.elementType = elementType(self.header)
+        self.ntraces = self.header['ntraces']
+        self.npoints = self.header['np']//2
+        self.blockDtype = np.dtype([('head', BLOCK_HEADER,
+                                     (self.header['nbheaders'],)),
+                                    ('data', self.elementType,
+                                     (self.ntraces, self.npoints, 2))])
+        if self.blockDtype.itemsize != self.header['bbytes']:
+            raise IOError('%s has inconsistent block sizes' % self.filename)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-maps the file, picking up any blocks written since the last call.
+
+        A fid that is still being acquired holds fewer complete blocks than
+        its header promises, only the complete blocks are exposed.
+
+        """
+        size = os.path.getsize(self.filename)-FILE_HEADER.itemsize
+        self.nblocks = min(self.header['nblocks'],
+                           max(size, 0)//self.blockDtype.itemsize)
+        if self.nblocks > 0:
+            self._blocks = np.memmap(self.filename, dtype=self.blockDtype,
+                                     mode='r', offset=FILE_HEADER.itemsize,
+                                     shape=(self.nblocks,))
+        else:
+            self._blocks = np.zeros(0, dtype=self.blockDtype)
+        # (block, trace, readout, real/imag) view of the stored points
+        self.raw = self._blocks['data']
+        return self.nblocks
+
+    @property
+    def complete(self):
+        """ True once every block promised by the header is on disk """
+        return self.nblocks == self.header['nblocks']
+
+    def partialTraces(self):
+        """
+        Maps the traces written so far of the block being acquired.
+
+        Returns
+        -------
+        Raw : 3D array
+            The (trace, readout, real/imag) stored points of the complete
+            traces of block :attr:`nblocks`, empty if the fid is complete
+            or none of its traces are written yet. Decode with
+            :func:`decodeTraces`.
+
+        """
+        pointsDtype = self.blockDtype['data']
+        traceBytes = pointsDtype.itemsize//self.ntraces
+        start = FILE_HEADER.itemsize+self.nblocks*self.blockDtype.itemsize
+        start += self.blockDtype['head'].itemsize
+        written = os.path.getsize(self.filename)-start
+        traces = 0 if self.complete else \
+            min(self.ntraces, max(written, 0)//traceBytes)
+        if traces == 0:
+            return np.zeros((0, self.npoints, 2), dtype=self.elementType)
+        return np.memmap(self.filename, dtype=self.elementType, mode='r',
+                         offset=start, shape=(traces, self.npoints, 2))
+
+    @property
+    def shape(self):
+        """ Shape of the decoded data, (block, trace, readout) """
+        return (self.nblocks, self.ntraces, self.npoints)
+
+    @property
+    def blockHeaders(self):
+        """ Structured array of the block headers, (block, header) """
+        return self._blocks['head']
+
+    def __len__(self):
+        return self.nblocks
+
+    def __getitem__(self, Key):
+        block, trace, readout = _expandKey(Key, 3)
+        return decodeTraces(self.raw[block, trace, readout])
+
+    def load(self, Workers=None):
+        """
+        Decodes the whole file with :func:`parallelDecode`.
+
+        Parameters
+        ----------
+        Workers : int, optional
+            Number of threads. Defaults to the number of processors.
+
+        Returns
+        -------
+        Data : 3D array of complex64
+            The (block, trace, readout) data.
+
+        """
+        return parallelDecode(self.raw, np.arange(self.ntraces),
+                              Workers=Workers)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.load()
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+
+class LazyKspace(object):
+    """
+    Array-like (rep, slice, echo, phase-encode, readout) view of a fid.
+
+    The Order array gives, for each (rep, slice, echo, phase-encode)
+    position, the flat number block*ntraces+trace of the stored trace that
+    holds it, so any acquisition order is undone by a single gather. Only
+    the traces that are indexed are read from the file. For the common
+    protocols each repetition is one block, and the first axis is the block.
+
+    Parameters
+    ----------
+    Fid : :class:`LazyFID`
+        The file to read from.
+
+    Order : 4D array of ints
+        Flat trace number for each (rep, slice, echo, phase-encode)
+        position, see :func:`acquisitionOrder`. A 3D (slice, echo,
+        phase-encode) array of trace numbers is taken to apply to every
+        block in turn.
+
+    """
+    dtype = np.dtype(np.complex64)
+    ndim = 5
+
+    def __init__(self, Fid, Order):
+        self.fid = Fid
+        order = np.asarray(Order, dtype=np.intp)
+        if order.ndim == 3:
+            blocks = np.arange(Fid.header['nblocks'])
+            order = blocks.reshape(-1, 1, 1, 1)*Fid.ntraces+order
+        self.order = order
+        # last block each repetition needs, to find the complete ones
+        self._lastBlock = order.reshape(order.shape[0], -1).max(axis=1) \
+            // Fid.ntraces if order.size else np.zeros(0, dtype=np.intp)
+        # the traces of each block when every repetition is one block with
+        # the same layout, so the faster per block decode can be used
+        self.blockOrder = None
+        steps = np.arange(order.shape[0]).reshape(-1, 1, 1, 1)*Fid.ntraces
+        if order.size and order[0].min() >= 0 and \
+                order[0].max() < Fid.ntraces and \
+                np.array_equal(order, order[0]+steps):
+            self.blockOrder = order[0]
+
+    @classmethod
+    def fromProcpar(cls, Fid, Procpar):
+        """
+        Builds the view with the order given by the procpar.
+
+        Parameters
+        ----------
+        Fid : :class:`LazyFID`
+            The file to read from.
+
+        Procpar : dictionary
+            The parameter dictionary returned by :func:`readProcpar`.
+
+        See Also
+        --------
+        procparOrder : builds the order from seqcon, pss, ne, nv and petable.
+
+        """
+        return cls(Fid, procparOrder(Procpar, Fid.header['nblocks'],
+                                     Fid.ntraces,
+                                     os.path.dirname(Fid.filename)))
+
+    @property
+    def reps(self):
+        """ Number of repetitions whose blocks are all on disk """
+        return int(np.searchsorted(np.maximum.accumulate(self._lastBlock),
+                                   self.fid.nblocks))
+
+    @property
+    def shape(self):
+        """ Shape of the decoded data, (rep, slice, echo, pe, readout) """
+        return (self.reps,)+self.order.shape[1:]+(self.fid.npoints,)
+
+    def __len__(self):
+        return self.reps
+
+    def __getitem__(self, Key):
+        rep, slc, echo, line, readout = _expandKey(Key, 5)
+        traces = self.order[:self.reps][rep, slc, echo, line]
+        # one gather pulls the traces out of whichever blocks hold them
+        blocks, traces = np.divmod(traces, self.fid.ntraces)
+        return decodeTraces(self.fid.raw[blocks, traces][..., readout, :])
+
+    def partialRep(self):
+        """
+        Decodes the traces on disk of the repetition being acquired.
+
+        Returns
+        -------
+        Present : 3D array of bools or None
+            Which (slice, echo, phase-encode) lines of repetition
+            :attr:`reps` are on disk, in complete blocks or in the complete
+            traces of the block being written. None if every repetition is
+            complete.
+
+        Lines : 4D array of complex64 or None
+            The (slice, echo, phase-encode, readout) lines, zero where they
+            are not present.
+
+        """
+        rep = self.reps
+        if rep >= self.order.shape[0]:
+            return None, None
+        blocks, traces = np.divmod(self.order[rep], self.fid.ntraces)
+        written = self.fid.partialTraces()
+        complete = blocks < self.fid.nblocks
+        partial = (blocks == self.fid.nblocks) & (traces < len(written))
+        lines = np.zeros(blocks.shape+(self.fid.npoints,),
+                         dtype=np.complex64)
+        lines[complete] = decodeTraces(self.fid.raw[blocks[complete],
+                                                    traces[complete]])
+        lines[partial] = decodeTraces(written[traces[partial]])
+        return complete | partial, lines
+
+    def frame(self, Slice=0, Echo=0, Block=0):
+        """
+        Returns a single 2D (phase-encode, readout) frame.
+
+        Parameters
+        ----------
+        Slice : int, optional
+            Defaults to the first slice.
+
+        Echo : int, optional
+            Defaults to the first echo.
+
+        Block : int, optional
+            The repetition. Defaults to the first.
+
+        """
+        return self[Block, Slice, Echo]
+
+    def decodeInto(self, Out, Workers=None):
+        """
+        Decodes the complete repetitions into a preallocated array.
+
+        When every repetition is one block with the same layout the traces
+        are gathered into order by :func:`parallelDecode` as they are
+        decoded, otherwise each repetition is gathered on a thread pool.
+
+        Parameters
+        ----------
+        Out : 5D array of complex64
+            Output of :attr:`shape`.
+
+        Workers : int, optional
+            Number of threads. Defaults to the number of processors.
+
+        """
+        reps = self.reps
+        flat = Out.reshape((reps, -1, self.fid.npoints))
+        if self.blockOrder is not None:
+            parallelDecode(self.fid.raw[:reps], self.blockOrder.ravel(),
+                           Out=flat, Workers=Workers)
+            return Out
+        traces = self.order[:reps].reshape(reps, -1)
+
+        def decodeRep(Rep):
+            blocks, positions = np.divmod(traces[Rep], self.fid.ntraces)
+            decodeTraces(self.fid.raw[blocks, positions], flat[Rep])
+        with ThreadPoolExecutor(max_workers=Workers) as pool:
+            list(pool.map(decodeRep, range(reps)))
+        return Out
+
+    def load(self, Workers=None):
+        """
+        Decodes the whole dataset, see :meth:`decodeInto`.
+
+        Parameters
+        ----------
+        Workers : int, optional
+            Number of threads. Defaults to the number of processors.
+
+        Returns
+        -------
+        Data : 5D array of complex64
+            The (rep, slice, echo, phase-encode, readout) data.
+
+        """
+        return self.decodeInto(np.empty(self.shape, dtype=np.complex64),
+                               Workers)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.load()
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+
+def readFID(Path):
+    """
+    Opens a \*.fid folder without reading any of its data.
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Returns
+    -------
+    dic : dictionary
+        The file header fields, with the parameters under dic['procpar'] as
+        in nmrglue.
+
+    data : :class:`LazyKspace`
+        The lazily decoded (rep, slice, echo, phase-encode, readout) data.
+
+    """
+    fid = LazyFID(Path)
+    dic = dict(fid.header)
+    dic['procpar'] = readProcpar(Path)
+    return dic, LazyKspace.fromProcpar(fid, dic['procpar'])
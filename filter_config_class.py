@@ -5,6 +5,7 @@ Configuration window for the various filters.
 import numpy as np
 from PyQt4 import QtGui
 
+import compressed_sensing
 import filters as filt
 
 from filter_config import Ui_filterConfig
@@ -14,6 +15,9 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
     """
     Starts a sub-window used to configure the filter stack.
 
+    The 3D low pass filter is offered when Volume, the (partition,
+    phase-encode, readout) size of the k-space of a 3D study, is given.
+
     """
     diameter = 32
     width = 5
@@ -27,6 +31,8 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
                     'Boxcar': 'boxcar',
                     'Dolph-Chebyshev': 'chebwin',
                     'DC Offset': 'DC Offset',
+                    'GRAPPA': 'GRAPPA',
+                    'Compressed Sensing': 'Compressed Sensing',
                     'Flat Top': 'flattop',
                     'Gaussian': 'gaussian',
                     'Hamming': 'hamming',
@@ -37,17 +43,21 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
                     'Slepian': 'slepian',
                     'Triangle': 'triang'}
 
-    def __init__(self, Dim=(128, 128), FilterStack=[], Parent=None):
+    def __init__(self, Dim=(128, 128), FilterStack=[], Parent=None,
+                 Volume=None):
         QtGui.QDialog.__init__(self, Parent)
         self.setupUi(self)
 
         #Build reverse filter dictionary
         self.REV_FILTER_NAMES = {v: k for k, v in self.FILTER_NAMES.items()}
         self.dim = Dim
+        self.volume = None if Volume is None else tuple(Volume)
         self.filterStack = FilterStack
         #Add filters to the combobox
         self.windowCB.addItems(sorted(self.FILTER_NAMES.keys()))
         self.diameterSB.setValue(np.max(Dim))
+        self._addCSControls()
+        self._addVolumeControls()
 
         #Connect widgets to their callbacks functions
         self.windowCB.currentIndexChanged.connect(self._updateWindow)
@@ -60,6 +70,7 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
         self.vbandstopRB.toggled.connect(self._enableVBS)
         self.hbandstopRB.toggled.connect(self._enableHBS)
         self.notchRB.toggled.connect(self._enableNotch)
+        self.lowpass3dRB.toggled.connect(self._enable3D)
 
         self.outerRB.toggled.connect(self._rbToggle)
         self.rotationalRB.toggled.connect(self._rbToggle)
@@ -72,12 +83,59 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
         self.hcenterSB.valueChanged.connect(self._updateFilter)
         self.vcenterSB.valueChanged.connect(self._updateFilter)
 
+        self.priorCB.currentIndexChanged.connect(self._updateFilter)
+        self.lambdaSB.valueChanged.connect(self._updateFilter)
+        self.iterationsSB.valueChanged.connect(self._updateFilter)
+        self.warmStartCB.toggled.connect(self._updateFilter)
+
         self.filterList.itemClicked.connect(self._changeFilter)
         self._updateList()
         if self.filterList.count() > 0:
             self.filterList.setCurrentRow(self.filterList.count()-1)
         self._changeFilter()
 
+    def _addCSControls(self):
+        """ Adds the settings of the compressed sensing stage """
+        self.csGroup = QtGui.QGroupBox('Compressed Sensing', self.frame)
+        layout = QtGui.QGridLayout(self.csGroup)
+        self.priorCB = QtGui.QComboBox(self.csGroup)
+        self.priorCB.addItems(list(compressed_sensing.METHODS))
+        self.lambdaSB = QtGui.QDoubleSpinBox(self.csGroup)
+        self.lambdaSB.setDecimals(4)
+        self.lambdaSB.setRange(0.0001, 1.0)
+        self.lambdaSB.setSingleStep(0.001)
+        self.lambdaSB.setValue(compressed_sensing.LAMBDA)
+        self.iterationsSB = QtGui.QSpinBox(self.csGroup)
+        self.iterationsSB.setRange(1, 1000)
+        self.iterationsSB.setValue(compressed_sensing.ITERATIONS)
+        self.warmStartCB = QtGui.QCheckBox('Warm start from the last slice',
+                                           self.csGroup)
+        for row, (name, widget) in enumerate((('Prior', self.priorCB),
+                                              ('Lambda', self.lambdaSB),
+                                              ('Iterations',
+                                               self.iterationsSB))):
+            layout.addWidget(widget, row, 0)
+            layout.addWidget(QtGui.QLabel(name, self.csGroup), row, 1)
+        layout.addWidget(self.warmStartCB, 3, 0, 1, 2)
+        self.verticalLayout_3.addWidget(self.csGroup)
+        self._enableCS(False)
+
+    def _addVolumeControls(self):
+        """ Adds the 3D low pass filter, shown for 3D studies only """
+        self.lowpass3dRB = QtGui.QRadioButton('Low Pass 3D',
+                                              self.layoutWidget)
+        self.gridLayout.addWidget(self.lowpass3dRB, 3, 0, 1, 1)
+        self.layoutWidget.resize(self.layoutWidget.width(),
+                                 self.layoutWidget.height()*4//3)
+        self.lowpass3dRB.setVisible(self.volume is not None)
+        self.lowpass3dRB.setEnabled(False)
+
+    def _enableCS(self, Active):
+        """ Sets the compressed sensing settings active """
+        for widget in (self.priorCB, self.lambdaSB, self.iterationsSB,
+                       self.warmStartCB):
+            widget.setEnabled(Active)
+
     def _updateFilter(self):
         """Update the filter in the stack and redisplay"""
         if self.filterStack == []:
@@ -90,6 +148,16 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
         if window == 'DC Offset':
             workingFilter = filt.makeDCO()
 
+        elif window == 'GRAPPA':
+            workingFilter = filt.makeGRAPPA()
+
+        elif window == 'Compressed Sensing':
+            workingFilter = \
+                filt.makeCS(Method=str(self.priorCB.currentText()),
+                            Lambda=self.lambdaSB.value(),
+                            Iterations=self.iterationsSB.value(),
+                            WarmStart=self.warmStartCB.isChecked())
+
         elif self.lowpassRB.isChecked():
             workingFilter = \
                 filt.makeLPF(Window=window,
@@ -134,7 +202,20 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
                                         Center=center,
                                         Width=self.widthSB.value())
 
-        self.filterDisplay.imshow(workingFilter.function(np.ones(self.dim)))
+        elif self.lowpass3dRB.isChecked():
+            workingFilter = \
+                filt.makeLPF3D(Window=window,
+                               Dim=self.volume,
+                               Diameter=self.diameterSB.value(),
+                               Outer=self.outerRB.isChecked())
+
+        if workingFilter.params.get('Volume'):
+            # the middle partition of the 3D window
+            self.filterDisplay.imshow(workingFilter.function(
+                np.ones(self.volume))[self.volume[0]//2])
+        else:
+            self.filterDisplay.imshow(
+                workingFilter.function(np.ones(self.dim)))
         index = self.filterList.currentRow()
         self.filterStack[index] = workingFilter
         self._updateList()
@@ -185,6 +266,7 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
             self.vbandstopRB.setEnabled(True)
             self.hbandstopRB.setEnabled(True)
             self.notchRB.setEnabled(True)
+            self.lowpass3dRB.setEnabled(self.volume is not None)
 
             self.diameterSB.setEnabled(True)
             self.widthSB.setEnabled(False)
@@ -212,6 +294,7 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
             self.vbandstopRB.setEnabled(True)
             self.hbandstopRB.setEnabled(True)
             self.notchRB.setEnabled(True)
+            self.lowpass3dRB.setEnabled(self.volume is not None)
 
             self.diameterSB.setEnabled(True)
             self.widthSB.setEnabled(True)
@@ -239,6 +322,7 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
             self.vbandstopRB.setEnabled(True)
             self.hbandstopRB.setEnabled(True)
             self.notchRB.setEnabled(True)
+            self.lowpass3dRB.setEnabled(self.volume is not None)
 
             self.diameterSB.setEnabled(False)
             self.widthSB.setEnabled(True)
@@ -266,6 +350,7 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
             self.vbandstopRB.setEnabled(True)
             self.hbandstopRB.setEnabled(True)
             self.notchRB.setEnabled(True)
+            self.lowpass3dRB.setEnabled(self.volume is not None)
 
             self.diameterSB.setEnabled(False)
             self.widthSB.setEnabled(True)
@@ -279,6 +364,34 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
             self.percentRB.setEnabled(False)
             self._updateFilter()
 
+    def _enable3D(self, Active):
+        """
+        Activates the widgets needed to configure 3D low pass filters.
+
+        """
+        if Active:
+            self.windowCB.setEnabled(True)
+
+            self.lowpassRB.setEnabled(True)
+            self.highpassRB.setEnabled(True)
+            self.cbandstopRB.setEnabled(True)
+            self.vbandstopRB.setEnabled(True)
+            self.hbandstopRB.setEnabled(True)
+            self.notchRB.setEnabled(True)
+            self.lowpass3dRB.setEnabled(True)
+
+            self.diameterSB.setEnabled(True)
+            self.widthSB.setEnabled(False)
+            self.hcenterSB.setEnabled(False)
+            self.vcenterSB.setEnabled(False)
+
+            self.outerRB.setEnabled(True)
+            self.rotationalRB.setEnabled(True)
+
+            self.pixelRB.setEnabled(False)
+            self.percentRB.setEnabled(False)
+            self._updateFilter()
+
     def _enableNotch(self, Active):
         """ Activates the widgets needed to notch filters """
         if Active:
@@ -290,6 +403,7 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
             self.vbandstopRB.setEnabled(True)
             self.hbandstopRB.setEnabled(True)
             self.notchRB.setEnabled(True)
+            self.lowpass3dRB.setEnabled(self.volume is not None)
 
             self.diameterSB.setEnabled(False)
             self.widthSB.setEnabled(True)
@@ -313,6 +427,7 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
         self.vbandstopRB.setEnabled(False)
         self.hbandstopRB.setEnabled(False)
         self.notchRB.setEnabled(False)
+        self.lowpass3dRB.setEnabled(False)
 
         self.diameterSB.setEnabled(False)
         self.widthSB.setEnabled(False)
@@ -325,6 +440,7 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
 
         self.pixelRB.setEnabled(False)
         self.percentRB.setEnabled(False)
+        self._enableCS(False)
 
     def _updateWindow(self):
         """ Updates widgets when the filter window is changed """
@@ -332,8 +448,9 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
         if (window == 'Dolph-Chebyshev') or (window == 'Gaussian') or\
                 (window == 'Kaiser') or (window == 'Slepian'):
             self.shapeSB.setEnabled(True)
-        elif window == 'DC Offset':
+        elif window in ('DC Offset', 'GRAPPA', 'Compressed Sensing'):
             self._disableAll()
+            self._enableCS(window == 'Compressed Sensing')
             self.filterDisplay.imshow(np.zeros(self.dim))
         else:
             self.shapeSB.setEnabled(False)
@@ -402,6 +519,12 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
             self.widthSB.setValue(Filt.params['Width'])
             self.vcenterSB.setValue(Filt.params['Center'])
 
+        elif Filt.params['Type'] == 'Low Pass 3D':
+            self._enable3D(True)
+            self.lowpass3dRB.setChecked(True)
+            self.diameterSB.setValue(Filt.params['Diameter'])
+            self._setOuter(Filt)
+
         elif Filt.params['Type'] == 'Notch':
             self._enableNotch(True)
             self.notchRB.setChecked(True)
@@ -409,6 +532,16 @@ class FilterConfig(QtGui.QDialog, Ui_filterConfig):
             self.hcenterSB.setValue(Filt.params['Center'][0])
             self.vcenterSB.setValue(Filt.params['Center'][1])
 
+        elif Filt.params['Type'] == 'Compressed Sensing':
+            self._disableAll()
+            self._enableCS(True)
+            self.priorCB.setCurrentIndex(
+                self.priorCB.findText(Filt.params['Method']))
+            self.lambdaSB.setValue(Filt.params['Lambda'])
+            self.iterationsSB.setValue(Filt.params['Iterations'])
+            self.warmStartCB.setChecked(Filt.params['WarmStart'])
+            self.filterDisplay.imshow(np.zeros(self.dim))
+
         else:
             self._disableAll()
             self.filterDisplay.imshow(np.zeros(self.dim))
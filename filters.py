@@ -5,15 +5,23 @@ Filters Module
 
 Module for building 2D filters of various types. Can build high and low
 pass, band pass/stop in both circular and linear, log transform, gamma
-transform, and DC offset correction. It also includes convinence functions and
-classes for building and applying a stack of filters.
+transform, and DC offset correction, plus GRAPPA and compressed sensing as
+k-space stages for accelerated data, and 3D low pass windows for volumes.
+It also includes convinence functions and classes for building and
+applying a stack of filters.
 
 """
 
+import json
+
 import numpy as np
 from scipy import interpolate
 from scipy import signal
 
+import compressed_sensing
+import grappa
+import memory_budget
+
 
 def build2DLP(Window, Dim, Diameter=0, Outer=False, Cont=False):
     """
@@ -169,6 +177,148 @@ def makeLPF(Window, Dim, Diameter=0, Outer=False, Cont=False):
     return filt
 
 
+def build3DLP(Window, Dim, Diameter=0, Outer=False, Rows=None):
+    """
+    Builds a 3D low pass filter matrix, or a slab of one.
+    
+    A window of Diameter points is centred in a volume of size Dim. The 3D
+    window is either the 1D window rotated about the centre, or the outer
+    product of the 1D window along each axis. Only the phase-encode rows
+    asked for are built, so a volume larger than memory can be filtered a
+    slab at a time.
+    
+    Parameters
+    ----------
+    Window : string
+        Name of the function to be used. See the scipy.signal documentation for
+        descriptions of the available windows.
+        
+    Dim : tuple
+        Size of the volume in (partition, phase-encode, readout) format.
+        
+    Diameter : int, optional
+        Size of the window in pixels. Defaults to the largest dimension of
+        the volume.
+        
+    Outer : Bool, optional
+        Selects between using an outer product (True) or rotational
+        construction method for the 3D filter. Defaults to False, which is
+        a rotational construction.
+        
+    Rows : slice, optional
+        The phase-encode rows of the slab. Defaults to all of them.
+            
+    Returns
+    -------
+    Window : 3D array
+        The filter is returned as a 3D array of floats.
+        
+    See Also
+    --------
+    makeLPF3D : builds a 3D low pass filter function and returns a
+    :class:`GFilter` object.
+        
+    """
+    if Diameter == 0:
+        Diameter = max(Dim)
+    window1 = signal.get_window(Window, Diameter)
+    lenX = (Diameter-1)/2.0
+    distX = np.linspace(-lenX, lenX, Diameter)
+    #distance of each pixel from the centre of the window, along each axis
+    dist = [np.arange(size)-(size-Diameter)//2-lenX for size in Dim]
+    if Rows is not None:
+        dist[1] = dist[1][Rows]
+    dist = [dist[0][:, None, None], dist[1][None, :, None],
+            dist[2][None, None, :]]
+    if Outer:
+        #the product of the 1D window along each axis
+        factors = [np.interp(axis, distX, window1, left=0, right=0)
+                   for axis in dist]
+        return factors[0]*factors[1]*factors[2]
+    #the 1D window at the distance of every pixel from the centre
+    cutoff = np.sqrt(dist[0]**2.0+dist[1]**2.0+dist[2]**2.0)
+    return np.interp(cutoff, distX, window1, right=0)
+
+
+def makeLPF3D(Window, Dim, Diameter=0, Outer=False):
+    """
+    Constructs a 3D low pass filter object.
+    
+    The filter is applied to the k-space of a whole volume before the
+    partitions are transformed, see :mod:`volume`, so it is not applied
+    with the 2D filters by :func:`applyStack`.
+    
+    Parameters
+    ----------
+    Window : string
+        Name of the function to be used. See the scipy.signal documentation for
+        descriptions of the available windows.
+        
+    Dim : tuple
+        Size of the volume in (partition, phase-encode, readout) format.
+        
+    Diameter : int, optional
+        Size of the window in pixels. Defaults to the largest dimension of
+        the volume.
+        
+    Outer : Bool, optional
+        Selects between using an outer product (True) or rotational
+        construction method for the 3D filter. Defaults to False, which is
+        a rotational construction.
+            
+    Returns
+    -------
+    Filter : :class:`GFilter`
+        The returned object described by the following attributes
+        
+        =============== ============= =========================================
+        Attribute       Value         Description
+        =============== ============= =========================================
+        Par['Type']     'Low Pass 3D' String defining the filter type as 3D
+                                      low pass
+        --------------- ------------- -----------------------------------------
+        Par['Linear']   True          Type of filter
+        --------------- ------------- -----------------------------------------
+        Par['Volume']   True          Applied to the k-space of the volume
+        --------------- ------------- -----------------------------------------
+        Par['Dim']      Dim           Three element (z, y, x) tuple
+        --------------- ------------- -----------------------------------------
+        Par['Diameter'] Diameter      Int for the window length
+        --------------- ------------- -----------------------------------------
+        Par['Outer']    Outer         Bool for the construction method
+        --------------- ------------- -----------------------------------------
+        Par['Name']     Window        Filter window name
+        --------------- ------------- -----------------------------------------
+        Par['Shape']    Shape         optional, only found with some windows
+        --------------- ------------- -----------------------------------------
+        function        function      Filters a volume, or the slab of rows
+                                      given as its second argument
+        =============== ============= =========================================
+        
+    See Also
+    --------
+    build3DLP : builds a 3D low pass filter matrix.
+
+    """
+    Dim = tuple(Dim)
+    filt = GFilter(Par={'Type': 'Low Pass 3D',
+                        'Linear': True,
+                        'Volume': True,
+                        'Dim': Dim,
+                        'Diameter': Diameter,
+                        'Outer': Outer})
+
+    if isinstance(Window, str):
+        filt.params['Name'] = Window
+    else:
+        filt.params['Name'] = Window[0]
+        filt.params['Shape'] = Window[1]
+
+    filt.function = lambda x, Rows=None: x*build3DLP(Window, Dim, Diameter,
+                                                     Outer, Rows)
+    return filt
+
+
 def build2DHP(Window, Dim, Diameter=0, Outer=False, Cont=False):
     """
     Constructs a 2D highpass filter.
@@ -1231,23 +1381,38 @@ def resizeToMatch(Window, Size, Cont=False, Center=None):
 def computeDCOffset(Kspace, Size=5):
     """
     Computes the average value of the data in the four corners.
-    
+
+    Only the rows that hold data are used. The rows a partial Fourier
+    study did not acquire, left zero by :func:`partial_fourier.padLines`,
+    would otherwise pull the offset towards zero, so the corners are those
+    of the acquired rows, and the offset is subtracted from them alone.
+
     Parameters
     ----------
     Size : int, optional
         The number of pixels averaged over in order to calculate the DC offset
         of the data. Defaults to 5 pixels in each corner
-    
+
     Returns
     -------
     Kspace : 2D array
         The frequency domain data, with the DC offset subtracted from it.
     """
-    corner1 = np.mean(Kspace[:Size, :Size])
-    corner2 = np.mean(Kspace[:-Size, :Size])
-    corner3 = np.mean(Kspace[:-Size, :-Size])
-    corner4 = np.mean(Kspace[:Size, :-Size])
-    return Kspace-((corner1+corner2+corner3+corner4)/4)
+    rows = np.flatnonzero(np.any(Kspace != 0, axis=-1))
+    if len(rows) == 0:
+        return Kspace
+    start, stop = rows[0], rows[-1]+1
+    acquired = Kspace[start:stop]
+    corner1 = np.mean(acquired[:Size, :Size])
+    corner2 = np.mean(acquired[:-Size, :Size])
+    corner3 = np.mean(acquired[:-Size, :-Size])
+    corner4 = np.mean(acquired[:Size, :-Size])
+    offset = (corner1+corner2+corner3+corner4)/4
+    if start == 0 and stop == len(Kspace):
+        return Kspace-offset
+    corrected = np.copy(Kspace)
+    corrected[start:stop] -= offset
+    return corrected
 
 
 def makeDCO(Size=10):
@@ -1297,27 +1462,274 @@ def makeDCO(Size=10):
 def mask(Image, Threshold=0.1):
     """
     Builds a binary mask for the supplied image.
-    
+
     Parameters
     ----------
     Image : 2D array
         The image that a mask is to be generated for.
-    
+
+    Threshold : float or None
+        The cut-off value for including a pixel in the masked image. If None
+        the threshold is selected automatically with :func:`otsuThreshold`.
+
+    Returns
+    -------
+    imageMask : 2D array of bools
+        A 2D boolean array that is True in pixels at or above the Threshold
+        and False elsewhere.
+
+    """
+    magnitude = np.abs(Image)
+    if Threshold is None:
+        Threshold = otsuThreshold(magnitude)
+    # pixels with no signal are never included, even for a zero threshold
+    return np.greater_equal(magnitude, max(Threshold, np.finfo(float).tiny))
+
+
+def otsuThreshold(Image, Bins=256):
+    """
+    Selects a mask threshold using Otsu's method.
+
+    A single histogram of the image magnitude is built, and the threshold that
+    maximises the between class variance of the two resulting classes is
+    returned.
+
+    Parameters
+    ----------
+    Image : 2D array
+        The image that a threshold is to be found for. Complex images are
+        converted to magnitude.
+
+    Bins : int, optional
+        Number of histogram bins. Defaults to 256.
+
+    Returns
+    -------
     Threshold : float
-        The cut-off value for including a pixel in the masked image.
+        The magnitude that best separates signal from background.
+
+    """
+    magnitude = np.abs(Image)
+    counts, edges = np.histogram(magnitude, bins=Bins)
+    centers = (edges[:-1]+edges[1:])/2.0
+    # class weights and means for every candidate split, from cumulative sums
+    weight1 = np.cumsum(counts).astype(float)
+    weight2 = weight1[-1]-weight1
+    sum1 = np.cumsum(counts*centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = sum1/weight1
+        mean2 = (sum1[-1]-sum1)/weight2
+        between = weight1*weight2*(mean1-mean2)**2
+    between[~np.isfinite(between)] = 0
+    return edges[np.argmax(between)+1]
+
+
+class MaskCache(object):
+    """
+    Caches the binary mask of an image between redraws.
+
+    The mask is rebuilt only when the image version or threshold changes, so
+    toggling the mask on several displays costs a single pass over the image.
+
+    Parameters
+    ----------
+    Threshold : float or None, optional
+        The cut-off value passed to :func:`mask`. Defaults to 0.1, the
+        threshold the displays have always masked at. None selects the
+        threshold automatically with :func:`otsuThreshold`.
+
+    """
+    def __init__(self, Threshold=0.1):
+        self.threshold = Threshold
+        self.version = None
+        self.mask = None
+        memory_budget.governor().register(self, 'mask cache',
+                                          memory_budget.PRIORITY_DERIVED)
+
+    def memoryUsage(self):
+        """ Bytes held by the cached mask """
+        return memory_budget.residentBytes(self.mask)
+
+    def release(self, Bytes):
+        """ Drops the mask when the memory governor needs the space. """
+        freed = self.memoryUsage()
+        self.clear()
+        return freed
+
+    def get(self, Image, Version):
+        """
+        Returns the mask for Image, building it if Version is not cached.
+
+        Parameters
+        ----------
+        Image : 2D array
+            The image that a mask is to be generated for.
+
+        Version : hashable
+            Identifies the contents of Image. Any change to the image must be
+            accompanied by a new version.
+
+        Returns
+        -------
+        imageMask : 2D array of bools
+            The cached mask, see :func:`mask`.
+
+        """
+        key = (Version, self.threshold)
+        if self.mask is None or self.version != key:
+            self.clear()
+            memory_budget.governor().reserve(np.size(Image),
+                                             memory_budget.PRIORITY_DERIVED)
+            self.mask = mask(Image, self.threshold)
+            self.version = key
+        return self.mask
+
+    def setThreshold(self, Threshold=None):
+        """ Change the threshold, invalidating the cached mask. """
+        self.threshold = Threshold
+        self.clear()
+
+    def clear(self):
+        """ Drops the cached mask. """
+        self.mask = None
+        self.version = None
+
+
+def makeGRAPPA(Lines=grappa.KERNEL_LINES, Width=grappa.KERNEL_WIDTH,
+               Regularisation=grappa.REGULARISATION):
+    """
+    Creates a GRAPPA k-space stage
+    
+    Parameters
+    ----------
+    Lines : int, optional
+        Acquired phase-encode lines in the kernel. Defaults to
+        :data:`grappa.KERNEL_LINES`.
+
+    Width : int, optional
+        Readout points in the kernel. Defaults to
+        :data:`grappa.KERNEL_WIDTH`.
+
+    Regularisation : float, optional
+        Tikhonov weight of the calibration. Defaults to
+        :data:`grappa.REGULARISATION`.
+
+    Returns
+    -------
+    Filter : :class:`GFilter`
+        The returned object described by the following attributes
         
+        =============== ====================== ================================
+        Attribute       Value                   Description
+        =============== ====================== ================================
+        Par['Name']     'GRAPPA'               Name of the filter type
+        --------------- ---------------------- --------------------------------
+        Par['Type']     'GRAPPA'               String defining the filter type
+                                               as a GRAPPA reconstruction
+        --------------- ---------------------- --------------------------------
+        Par['Linear']   False                  Type of filter
+        --------------- ---------------------- --------------------------------
+        Par['Coils']    True                   Works on the k-space of all of
+                                               the coils at once
+        --------------- ---------------------- --------------------------------
+        Par['Lines']    Lines                  Kernel lines
+        --------------- ---------------------- --------------------------------
+        Par['Width']    Width                  Kernel readout points
+        --------------- ---------------------- --------------------------------
+        Par['Reg...']   Regularisation         Calibration regularisation
+        --------------- ---------------------- --------------------------------
+        function        function               :func:`grappa.grappa`
+        =============== ====================== ================================
+
+    See Also
+    --------
+    applyStack : coil stages are applied before the other filters.
+    
+    """
+    filt = GFilter(Par={'Name': 'GRAPPA',
+                        'Type': 'GRAPPA',
+                        'Linear': False,
+                        'Coils': True,
+                        'Lines': Lines,
+                        'Width': Width,
+                        'Regularisation': Regularisation})
+
+    filt.function = lambda x, Frame=None: grappa.grappa(x, Lines, Width,
+                                                        Regularisation)
+    return filt
+
+
+def makeCS(Method='wavelet', Lambda=compressed_sensing.LAMBDA,
+           Iterations=compressed_sensing.ITERATIONS, WarmStart=False):
+    """
+    Creates a compressed sensing k-space stage
+    
+    Parameters
+    ----------
+    Method : string, optional
+        The prior, one of :data:`compressed_sensing.METHODS`. Defaults to
+        'wavelet'.
+
+    Lambda : float, optional
+        Weight of the prior, relative to the zero filled image. Defaults to
+        :data:`compressed_sensing.LAMBDA`.
+
+    Iterations : int, optional
+        Most iterations per frame. Defaults to
+        :data:`compressed_sensing.ITERATIONS`.
+
+    WarmStart : bool, optional
+        Starts each slice from the result of the one before. Only frames
+        filtered with their index are warm started, see :func:`applyStack`.
+        Defaults to False.
+
     Returns
     -------
-    imageMask : 2D array
-        A 2D binary array with ones in pixels above the Threshold and zeros
-        elsewhere.
+    Filter : :class:`GFilter`
+        The returned object described by the following attributes
         
+        =============== ====================== ================================
+        Attribute       Value                   Description
+        =============== ====================== ================================
+        Par['Name']     'Compressed Sensing'   Name of the filter type
+        --------------- ---------------------- --------------------------------
+        Par['Type']     'Compressed Sensing'   String defining the filter type
+                                               as an iterative reconstruction
+        --------------- ---------------------- --------------------------------
+        Par['Linear']   False                  Type of filter
+        --------------- ---------------------- --------------------------------
+        Par['Coils']    True                   Works on the k-space as
+                                               acquired, before other filters
+        --------------- ---------------------- --------------------------------
+        Par['Method']   Method                 The sparsifying prior
+        --------------- ---------------------- --------------------------------
+        Par['Lambda']   Lambda                 Weight of the prior
+        --------------- ---------------------- --------------------------------
+        Par['Iter...']  Iterations             Most iterations per frame
+        --------------- ---------------------- --------------------------------
+        Par['Warm...']  WarmStart              Warm start from the last slice
+        --------------- ---------------------- --------------------------------
+        function        function               :func:`compressed_sensing.
+                                               reconstruct`
+        =============== ====================== ================================
+
+    See Also
+    --------
+    applyStack : coil stages are applied before the other filters.
+    
     """
-    imageMask = np.copy(Image)
-    imageMask[np.abs(imageMask)<Threshold] = 0
-    imageMask[np.abs(imageMask)>0] = 1
-    imageMask = np.abs(imageMask)
-    return imageMask
+    filt = GFilter(Par={'Name': 'Compressed Sensing',
+                        'Type': 'Compressed Sensing',
+                        'Linear': False,
+                        'Coils': True,
+                        'Method': Method,
+                        'Lambda': Lambda,
+                        'Iterations': Iterations,
+                        'WarmStart': WarmStart})
+
+    filt.function = lambda x, Frame=None: compressed_sensing.reconstruct(
+        x, Method, Lambda, Iterations, WarmStart=WarmStart, Frame=Frame)
+    return filt
 
 
 def makeLogTransform():
@@ -1411,14 +1823,16 @@ class GFilter(object):
         self.params = Par
 
 
-def applyStack(Data, Stack):
+def applyStack(Data, Stack, Frame=None):
     """
     Returns image filtered by the stack of :class:`GFilter` objects
     
     Filter objects in the `Stack` will be sequentially applied to the image 
     supplied as `Data`. The filter is applied by calling filt.function
     on the data. Filters can be linear or non-linear, and the stack order is
-    preserved.
+    preserved, except that coil stages such as :func:`makeGRAPPA` and
+    :func:`makeCS` need the data as acquired, so they are applied first, and
+    volume stages such as :func:`makeLPF3D` are left out.
     
     Parameters
     ----------
@@ -1427,13 +1841,252 @@ def applyStack(Data, Stack):
         
     Stack : 1D array :class:`GFilter`\s
         containing the filter objects to be applied.
+
+    Frame : tuple, optional
+        The (rep, slice, echo) of the data, passed to the coil stages, e.g.
+        for the warm start of :func:`makeCS`.
         
     See Also
     --------
     :class:`GFilter` : the filter object used
+    applyCoilStack : applies a stack to the k-space of several coils
     
     """
     filtered = np.copy(Data)
-    for filt in Stack:
+    for filt in coilStages(Stack):
+        filtered = filt.function(filtered, Frame)
+    for filt in frameStages(Stack):
         filtered = filt.function(filtered)
     return filtered
+
+
+def coilStages(Stack):
+    """
+    Returns the filters of a stack that work on all coils at once. Their
+    functions also take the (rep, slice, echo) of the frame, or None.
+
+    """
+    return [filt for filt in Stack if filt.params.get('Coils')]
+
+
+def warmStarted(Stack):
+    """ True if a coil stage of a stack starts each slice from the last """
+    return any(filt.params.get('WarmStart') for filt in coilStages(Stack))
+
+
+def frameStages(Stack):
+    """ Returns the filters of a stack that work on one frame at a time """
+    return [filt for filt in Stack if not filt.params.get('Coils') and
+            not filt.params.get('Volume')]
+
+
+def volumeStages(Stack):
+    """ Returns the filters of a stack that work on a whole volume """
+    return [filt for filt in Stack if filt.params.get('Volume')]
+
+
+def applyCoilStack(Data, Stack, Frame=None):
+    """
+    Returns the k-space of several coils filtered by a stack
+
+    The coil stages, such as :func:`makeGRAPPA`, are given the k-space of
+    all of the coils at once, then the rest of the filters are applied to
+    each coil in turn, as in :func:`applyStack`.
+
+    Parameters
+    ----------
+    Data : 3D array
+        The (coil, phase-encode, readout) k-space.
+
+    Stack : 1D array :class:`GFilter`\s
+        containing the filter objects to be applied.
+
+    Frame : tuple, optional
+        The (rep, slice, echo) of the data, see :func:`applyStack`.
+
+    """
+    filtered = np.copy(Data)
+    for filt in coilStages(Stack):
+        filtered = filt.function(filtered, Frame)
+    frames = frameStages(Stack)
+    return np.stack([applyStack(coil, frames) for coil in filtered])
+
+
+def makeFilter(Par, Dim=None):
+    """
+    Rebuilds a :class:`GFilter` object from its parameter dictionary.
+
+    The filter functions are lambdas, so a stack cannot be pickled or saved
+    directly. The parameter dictionaries can, and this turns one back into
+    a working filter.
+
+    Parameters
+    ----------
+    Par : Dictionary
+        The params attribute of a :class:`GFilter`, as built by one of the
+        make functions in this module.
+
+    Dim : tuple, optional
+        Overrides Par['Dim'], so the same filter can be rebuilt for data of
+        a different size.
+
+    Returns
+    -------
+    Filter : :class:`GFilter`
+        A new filter object equivalent to the one that Par came from.
+
+    See Also
+    --------
+    stackSpec : the parameter dictionaries of a whole stack.
+
+    """
+    kind = Par['Type']
+    if kind == 'DC Offset':
+        return makeDCO(Par.get('Size', 10))
+    elif kind == 'Log Transform':
+        return makeLogTransform()
+    elif kind == 'Gamma Transform':
+        return makeGammaTransform(Par.get('Gamma', 1))
+    elif kind == 'GRAPPA':
+        return makeGRAPPA(Par.get('Lines', grappa.KERNEL_LINES),
+                          Par.get('Width', grappa.KERNEL_WIDTH),
+                          Par.get('Regularisation', grappa.REGULARISATION))
+    elif kind == 'Compressed Sensing':
+        return makeCS(Par.get('Method', 'wavelet'),
+                      Par.get('Lambda', compressed_sensing.LAMBDA),
+                      Par.get('Iterations', compressed_sensing.ITERATIONS),
+                      Par.get('WarmStart', False))
+
+    if 'Shape' in Par:
+        window = (Par['Name'], Par['Shape'])
+    else:
+        window = Par['Name']
+    if kind == 'Low Pass 3D':
+        # a frame size does not say how many partitions a volume has
+        if Dim is None or len(Dim) != 3:
+            Dim = Par['Dim']
+        return makeLPF3D(window, tuple(Dim), Par['Diameter'], Par['Outer'])
+
+    if Dim is None:
+        Dim = Par['Dim']
+    Dim = tuple(Dim)
+
+    if kind in ('Low Pass', 'High Pass'):
+        maker = makeLPF if kind == 'Low Pass' else makeHPF
+        return maker(window, Dim, Par['Diameter'], Par['Outer'],
+                     Par['Contour'])
+    elif kind in ('Band Pass', 'Band Stop'):
+        maker = makeBPF if kind == 'Band Pass' else makeBSF
+        return maker(window, Dim, Par['Diameter'], Par['Width'],
+                     Par['Contour'])
+    makers = {'Vertical Band Pass': makeVBPF,
+              'Vertical Band Stop': makeVBSF,
+              'Horizontal Band Pass': makeHBPF,
+              'Horizontal Band Stop': makeHBSF,
+              'Notch': makeNF}
+    if kind not in makers:
+        raise ValueError('Unknown filter type %s' % kind)
+    center = Par['Center']
+    if isinstance(center, list):
+        center = tuple(center)
+    return makers[kind](window, Dim, center, Par['Width'])
+
+
+def stackSpec(Stack):
+    """
+    Returns a picklable description of a filter stack.
+
+    Parameters
+    ----------
+    Stack : 1D array :class:`GFilter`\s
+        The filter objects.
+
+    Returns
+    -------
+    Spec : list of Dictionaries
+        Copies of the params of each filter, in stack order.
+
+    """
+    return [dict(filt.params) for filt in Stack]
+
+
+def buildStack(Spec, Dim=None):
+    """
+    Rebuilds a filter stack from the output of :func:`stackSpec`.
+
+    Parameters
+    ----------
+    Spec : list of Dictionaries
+        The filter parameters, in stack order.
+
+    Dim : tuple, optional
+        Rebuilds every filter for data of this size.
+
+    Returns
+    -------
+    Stack : list of :class:`GFilter`\s
+        The filter objects.
+
+    """
+    return [makeFilter(par, Dim) for par in Spec]
+
+
+def canonicalSpec(Spec):
+    """
+    Returns a canonical string form of a filter stack description.
+
+    Two stacks give the same string exactly when they filter frames of the
+    same size identically, so it can be used as a cache or batching key.
+    The Dim entries are dropped, since stacks are rebuilt for the size of
+    the data they are applied to.
+
+    Parameters
+    ----------
+    Spec : list of Dictionaries
+        The output of :func:`stackSpec`.
+
+    Returns
+    -------
+    Key : string
+        A JSON encoding of Spec with sorted keys.
+
+    """
+    return json.dumps([dict((key, value) for key, value in par.items()
+                            if key != 'Dim') for par in Spec],
+                      sort_keys=True, default=str)
+
+
+def precomputeStack(Stack, Dim):
+    """
+    Builds the window of every linear filter in a stack once.
+
+    The functions of the linear filters rebuild their window on every call.
+    The returned stack multiplies by windows built here instead, which is
+    much faster when it is applied to many frames of the same size.
+
+    Parameters
+    ----------
+    Stack : 1D array :class:`GFilter`\s
+        The filter objects, built for frames of size Dim.
+
+    Dim : tuple
+        Size of the frames the stack will be applied to.
+
+    Returns
+    -------
+    Stack : list of :class:`GFilter`\s
+        Equivalent filter objects. Non-linear and volume filters are passed
+        through.
+
+    """
+    built = []
+    for filt in Stack:
+        if filt.params.get('Linear') and not filt.params.get('Volume'):
+            fixed = GFilter(Par=dict(filt.params))
+            window = filt.function(np.ones(Dim))
+            fixed.function = lambda x, window=window: x*window
+            fixed.window = window
+            built.append(fixed)
+        else:
+            built.append(filt)
+    return built
@@ -0,0 +1,306 @@
+"""
+.. py:module:: frame_cache
+Frame Cache Module
+==================
+
+In memory cache of the reconstructed frames of the open study, filled ahead
+of the user by a background thread. While frame n is on screen, the frames
+after and before it along the axis being stepped through are reconstructed
+in order of distance, so stepping through the slices of a study shows each
+one without waiting for it.
+
+How far ahead to go adapts to the measured reconstruction time: the
+prefetch depth is the number of frames that take about
+:data:`PREFETCH_SECONDS` to reconstruct, between 1 and :data:`MAX_DEPTH`.
+Cheap frames are fetched far ahead, expensive ones, e.g. with compressed
+sensing, only next door.
+
+Frames are reconstructed one at a time, so a frame asked for while a
+prefetch is running waits for it to finish, at most one reconstruction.
+
+The cached frames depend on the reconstruction settings. Changing them with
+:meth:`FrameCache.setSettings` drops the cache, and prefetches still in
+flight for the old settings are thrown away when they finish. The cache is
+registered with the memory governor and drops the frames furthest from the
+current one first.
+
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import memory_budget
+
+
+# seconds of reconstruction queued ahead of the current frame
+PREFETCH_SECONDS = 1.0
+
+# most frames prefetched on each side of the current frame
+MAX_DEPTH = 16
+
+# weight of the newest timing in the running mean
+TIMING_WEIGHT = 0.3
+
+
+class FrameCache(object):
+    """
+    Reconstructed frames of one study, with background prefetch.
+
+    Parameters
+    ----------
+    Workers : int, optional
+        Threads reconstructing frames in the background. Defaults to 1, so
+        the prefetch does not compete with the displayed frame for cores.
+
+    """
+    def __init__(self, Workers=1):
+        self.frames = {}
+        self.pending = {}
+        self.settings = None
+        self.generation = 0
+        self.current = None
+        self.seconds = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # the stages keep scratch buffers, e.g. compressed sensing, so one
+        # frame is reconstructed at a time
+        self._reconstructing = threading.Lock()
+        self._pool = ThreadPoolExecutor(Workers)
+        memory_budget.governor().register(self, 'frame cache',
+                                          memory_budget.PRIORITY_CACHE)
+
+    def memoryUsage(self):
+        """ Bytes held by the cached frames """
+        with self._lock:
+            results = list(self.frames.values())
+        return sum(memory_budget.residentBytes(*arrays.values())
+                   for arrays in results)
+
+    def release(self, Bytes):
+        """ Drops the frames furthest from the current one first """
+        freed = 0
+        with self._lock:
+            for frame in sorted(self.frames, key=self._distance,
+                                reverse=True):
+                if freed >= Bytes:
+                    break
+                freed += memory_budget.residentBytes(
+                    *self.frames.pop(frame).values())
+        return freed
+
+    def _distance(self, Frame):
+        """ Steps between a frame and the current one """
+        if self.current is None:
+            return 0
+        return int(np.sum(np.abs(np.subtract(Frame, self.current))))
+
+    def setSettings(self, Settings):
+        """
+        Sets the reconstruction settings the cached frames are for.
+
+        Parameters
+        ----------
+        Settings : hashable
+            Anything that changes the reconstructed frames, e.g. the
+            canonical filter stack and options. The cache is dropped if it
+            differs from the last settings.
+
+        """
+        with self._lock:
+            if Settings == self.settings:
+                return
+            self.settings = Settings
+            self.generation += 1
+            self.frames.clear()
+            self.pending.clear()
+
+    def depth(self):
+        """ Frames prefetched on each side, from the measured recon time """
+        if self.seconds is None:
+            return 1
+        return int(min(MAX_DEPTH, max(1, PREFETCH_SECONDS/max(self.seconds,
+                                                              1e-3))))
+
+    def _time(self, Seconds):
+        """ Updates the running mean of the reconstruction time """
+        with self._lock:
+            if self.seconds is None:
+                self.seconds = Seconds
+            else:
+                self.seconds += TIMING_WEIGHT*(Seconds-self.seconds)
+
+    def get(self, Frame, Reconstruct):
+        """
+        Returns a frame, reconstructing it now if it is not cached.
+
+        Parameters
+        ----------
+        Frame : tuple
+            The (rep, slice, echo) index.
+
+        Reconstruct : callable
+            Takes a frame index and returns its result arrays, see
+            :func:`result_cache.derived`. Called on this thread if the frame
+            is neither cached nor being prefetched.
+
+        Returns
+        -------
+        Arrays : dictionary
+            The results of the frame. A frame reconstructed here is returned
+            even if the memory governor cannot make room for it, but it is
+            then not cached, and is reconstructed again if it is asked for
+            after it has left the screen.
+
+        """
+        Frame = tuple(Frame)
+        with self._lock:
+            self.current = Frame
+            results = self.frames.get(Frame)
+            future = self.pending.get(Frame)
+        if results is not None:
+            self.hits += 1
+            return results
+        if future is not None and future.cancel():
+            # still queued behind other prefetches, done here instead
+            with self._lock:
+                self.pending.pop(Frame, None)
+        elif future is not None:
+            # already on its way, wait for it rather than doing it twice
+            results = future.result()
+            if results is not None:
+                self.hits += 1
+                return results
+        self.misses += 1
+        with self._reconstructing:
+            start = time.time()
+            results = Reconstruct(Frame)
+        self._time(time.time()-start)
+        if memory_budget.governor().reserve(
+                memory_budget.residentBytes(*results.values())):
+            with self._lock:
+                self.frames[Frame] = results
+        return results
+
+    def reconstruct(self, Frame, Reconstruct):
+        """
+        Returns a frame without caching it, e.g. for cine playback.
+
+        The frame is taken from the cache if it is there, otherwise it is
+        reconstructed in turn with the prefetches.
+
+        Parameters
+        ----------
+        Frame : tuple
+            The (rep, slice, echo) index.
+
+        Reconstruct : callable
+            As for :meth:`get`.
+
+        Returns
+        -------
+        Arrays : dictionary
+            The results of the frame.
+
+        """
+        Frame = tuple(Frame)
+        with self._lock:
+            results = self.frames.get(Frame)
+        if results is not None:
+            return results
+        with self._reconstructing:
+            return Reconstruct(Frame)
+
+    def prefetch(self, Frame, Axis, Shape, Reconstruct):
+        """
+        Queues the neighbours of a frame for reconstruction.
+
+        Parameters
+        ----------
+        Frame : tuple
+            The (rep, slice, echo) index on screen.
+
+        Axis : int
+            The axis being stepped through, 0 for reps, 1 slices, 2 echoes.
+
+        Shape : tuple
+            The number of (rep, slice, echo) frames.
+
+        Reconstruct : callable
+            As for :meth:`get`, called on the prefetch thread.
+
+        """
+        Frame = tuple(Frame)
+        depth = self.depth()
+        neighbours = []
+        for step in range(1, depth+1):
+            for sign in (1, -1):
+                index = Frame[Axis]+sign*step
+                if 0 <= index < Shape[Axis]:
+                    neighbour = list(Frame)
+                    neighbour[Axis] = index
+                    neighbours.append(tuple(neighbour))
+        with self._lock:
+            self.current = Frame
+            generation = self.generation
+            # forget the queued frames that are no longer wanted
+            for frame in list(self.pending):
+                if frame not in neighbours and \
+                        self.pending[frame].cancel():
+                    del self.pending[frame]
+            for frame in neighbours:
+                if frame in self.frames or frame in self.pending:
+                    continue
+                self.pending[frame] = self._pool.submit(
+                    self._fetch, frame, generation, Reconstruct)
+
+    def _fetch(self, Frame, Generation, Reconstruct):
+        """ Reconstructs a frame on the prefetch thread """
+        with self._reconstructing:
+            # the settings may have changed while this was queued
+            if Generation != self.generation:
+                return None
+            start = time.time()
+            try:
+                results = Reconstruct(Frame)
+            except Exception:
+                # the frame is done again, and the error shown, if it is
+                # opened
+                results = None
+        self._time(time.time()-start)
+        # a prefetch only displaces what is cheaper to redo than itself
+        if results is not None and not memory_budget.governor().reserve(
+                memory_budget.residentBytes(*results.values()),
+                memory_budget.PRIORITY_CACHE):
+            results = None
+        with self._lock:
+            if self.pending.get(Frame) is not None and \
+                    Generation == self.generation:
+                del self.pending[Frame]
+                if results is not None:
+                    self.frames[Frame] = results
+            if Generation != self.generation:
+                results = None
+        return results
+
+    def stats(self):
+        """ Hits, misses, cached and pending frames, depth and recon time """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'frames': len(self.frames),
+                    'pending': len(self.pending),
+                    'depth': self.depth(), 'seconds': self.seconds}
+
+    def clear(self):
+        """ Drops every frame, e.g. when another study is opened """
+        with self._lock:
+            self.generation += 1
+            self.settings = None
+            self.current = None
+            self.frames.clear()
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
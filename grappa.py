@@ -0,0 +1,232 @@
+"""
+.. py:module:: grappa
+GRAPPA Module
+=============
+
+GRAPPA reconstruction of studies accelerated along the phase-encode
+direction. The missing lines of each coil are synthesised from the acquired
+lines of every coil around them, with weights fitted on the fully sampled
+auto-calibration signal (ACS) lines at the centre of k-space.
+
+Calibration and synthesis are both done without loops over k-space: the
+source and target points are gathered with strided views of the padded
+k-space, the weights come out of one regularised least squares solve for
+every target offset at once, and the missing lines are filled by one
+batched matrix multiply over all of the target points.
+
+The k-space is expected with the missing lines zero, and the acceleration
+and ACS lines are found from which lines hold data.
+
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# acquired lines in the kernel, along the phase-encode direction
+KERNEL_LINES = 4
+
+# readout points in the kernel, odd so it is centred on the target
+KERNEL_WIDTH = 5
+
+# Tikhonov regularisation, relative to the mean power of the sources
+REGULARISATION = 1e-3
+
+
+def samplingPattern(Kspace):
+    """
+    Finds the acceleration of undersampled k-space.
+
+    Parameters
+    ----------
+    Kspace : array
+        The (coil, phase-encode, readout) k-space, with the lines that were
+        not acquired zero.
+
+    Returns
+    -------
+    Acceleration : int
+        The spacing of the acquired lines outside of the ACS region, 1 if
+        every line was acquired.
+
+    First : int
+        The first acquired line.
+
+    ACS : slice
+        The longest run of consecutive acquired lines, the calibration
+        region.
+
+    """
+    acquired = np.flatnonzero(np.any(np.abs(Kspace) > 0, axis=(0, 2)))
+    if acquired.size == 0:
+        return 1, 0, slice(0, 0)
+    gaps = np.diff(acquired)
+    acceleration = int(gaps.max()) if gaps.size else 1
+    # the runs of consecutive lines, the longest is the ACS
+    breaks = np.flatnonzero(gaps > 1)
+    starts = np.concatenate([[0], breaks+1])
+    stops = np.concatenate([breaks+1, [acquired.size]])
+    longest = np.argmax(stops-starts)
+    acs = slice(int(acquired[starts[longest]]),
+                int(acquired[stops[longest]-1])+1)
+    return max(acceleration, 1), int(acquired[0]), acs
+
+
+def _sources(Padded, Acceleration, Lines, Width):
+    """
+    Strided view of the kernel sources around every (line, readout) point.
+
+    Returns an array of (line, readout, coil, kernel line, kernel point),
+    where kernel line k is Acceleration*k lines below the window start.
+
+    """
+    span = (Lines-1)*Acceleration+1
+    windows = sliding_window_view(Padded, (span, Width), axis=(1, 2))
+    # (coil, line, readout, span, width) -> every Acceleration'th line
+    windows = windows[..., ::Acceleration, :]
+    return np.moveaxis(windows, 0, 2)
+
+
+def calibrate(Acs, Acceleration, Lines=KERNEL_LINES, Width=KERNEL_WIDTH,
+              Regularisation=REGULARISATION):
+    """
+    Fits the GRAPPA weights on fully sampled calibration lines.
+
+    Parameters
+    ----------
+    Acs : 3D array
+        The (coil, line, readout) ACS region.
+
+    Acceleration : int
+        The undersampling factor.
+
+    Lines : int, optional
+        Acquired lines in the kernel. Defaults to :data:`KERNEL_LINES`.
+
+    Width : int, optional
+        Readout points in the kernel. Defaults to :data:`KERNEL_WIDTH`.
+
+    Regularisation : float, optional
+        Tikhonov weight relative to the mean source power. Defaults to
+        :data:`REGULARISATION`.
+
+    Returns
+    -------
+    Weights : 2D array of complex64
+        (coil*Lines*Width, coil*(Acceleration-1)) weights taking the
+        flattened sources to the missing points after each acquired line.
+
+    """
+    coils, rows, points = Acs.shape
+    span = (Lines-1)*Acceleration+1
+    if rows < span or points < Width:
+        raise ValueError('%d ACS lines cannot calibrate a %d line kernel at '
+                         'acceleration %d' % (rows, Lines, Acceleration))
+    sources = _sources(Acs, Acceleration, Lines, Width)
+    starts, centres = sources.shape[:2]
+    sources = sources.reshape(starts*centres, -1)
+    # targets follow the acquired line at the middle of the kernel
+    base = (Lines//2-1)*Acceleration
+    targets = np.stack([Acs[:, base+offset:base+offset+starts,
+                            Width//2:Width//2+centres]
+                        for offset in range(1, Acceleration)], axis=-1)
+    # (coil, line, readout, offset) -> (line, readout, coil, offset)
+    targets = np.moveaxis(targets, 0, 2).reshape(starts*centres, -1)
+    sources = sources.astype(np.complex128)
+    normal = np.dot(sources.conj().T, sources)
+    loading = Regularisation*np.real(np.trace(normal))/len(normal)
+    normal[np.diag_indices_from(normal)] += loading
+    weights = np.linalg.solve(normal, np.dot(sources.conj().T, targets))
+    return weights.astype(np.complex64)
+
+
+def synthesise(Kspace, Weights, Acceleration, First, Lines=KERNEL_LINES,
+               Width=KERNEL_WIDTH):
+    """
+    Fills the missing lines of undersampled k-space.
+
+    Parameters
+    ----------
+    Kspace : 3D array
+        The (coil, phase-encode, readout) k-space, missing lines zero.
+
+    Weights : 2D array
+        The :func:`calibrate` weights.
+
+    Acceleration : int
+        The undersampling factor.
+
+    First : int
+        An acquired line of the undersampled grid.
+
+    Lines : int, optional
+        Acquired lines in the kernel. Defaults to :data:`KERNEL_LINES`.
+
+    Width : int, optional
+        Readout points in the kernel. Defaults to :data:`KERNEL_WIDTH`.
+
+    Returns
+    -------
+    Kspace : 3D array of complex64
+        The k-space with every missing line filled, and the acquired lines
+        left as they were.
+
+    """
+    coils, rows, points = Kspace.shape
+    before = (Lines//2-1)*Acceleration
+    # every line of the undersampled grid is a kernel base, including the
+    # ones off the ends that still have targets inside
+    bases = np.arange(First % Acceleration-Acceleration, rows, Acceleration)
+    top = before-bases[0]
+    bottom = max(bases[-1]+(Lines-Lines//2)*Acceleration+1-rows, 0)
+    padded = np.zeros((coils, rows+top+bottom, points+Width-1),
+                      dtype=np.complex64)
+    padded[:, top:top+rows, Width//2:Width//2+points] = Kspace
+    sources = _sources(padded, Acceleration, Lines, Width)
+    sources = sources[bases+top-before]
+    # one multiply for all of the target points of every offset
+    targets = np.dot(sources.reshape(len(bases)*points, -1), Weights)
+    targets = targets.reshape(len(bases), points, coils, Acceleration-1)
+
+    out = np.array(Kspace, dtype=np.complex64)
+    acquired = np.any(np.abs(Kspace) > 0, axis=(0, 2))
+    for offset in range(1, Acceleration):
+        rowsOut = bases+offset
+        keep = (rowsOut >= 0) & (rowsOut < rows)
+        keep[keep] &= ~acquired[rowsOut[keep]]
+        out[:, rowsOut[keep]] = np.moveaxis(
+            targets[keep, :, :, offset-1], -1, 0)
+    return out
+
+
+def grappa(Kspace, Lines=KERNEL_LINES, Width=KERNEL_WIDTH,
+           Regularisation=REGULARISATION):
+    """
+    Calibrates on the ACS lines and fills the missing lines of a frame.
+
+    Parameters
+    ----------
+    Kspace : array
+        The (coil, phase-encode, readout) k-space, or a single coil
+        (phase-encode, readout) frame, with the missing lines zero.
+
+    Lines, Width, Regularisation : optional
+        The kernel size and regularisation, see :func:`calibrate`.
+
+    Returns
+    -------
+    Kspace : array of complex64
+        The filled k-space, or Kspace unchanged if it is fully sampled.
+
+    """
+    Kspace = np.asarray(Kspace)
+    single = Kspace.ndim == 2
+    if single:
+        Kspace = Kspace[None]
+    acceleration, first, acs = samplingPattern(Kspace)
+    if acceleration < 2:
+        return Kspace[0] if single else Kspace
+    weights = calibrate(Kspace[:, acs], acceleration, Lines, Width,
+                        Regularisation)
+    out = synthesise(Kspace, weights, acceleration, first, Lines, Width)
+    return out[0] if single else out
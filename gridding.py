@@ -0,0 +1,448 @@
+"""
+.. py:module:: gridding
+Gridding Module
+===============
+
+Reconstruction of radial and spiral studies, whose samples do not lie on a
+Cartesian grid. Each sample is spread onto an oversampled grid with a
+Kaiser-Bessel kernel, the grid is inverse Fourier transformed, the centre
+of the image is kept, and the apodization of the kernel is divided out.
+
+Everything that depends only on the trajectory is worked out once: the
+kernel weights of every sample, scaled by its density compensation, are
+held as one sparse matrix from the samples to the grid, and the
+deapodization as an image. Reconstructing a frame is then one sparse
+matrix-vector product, one FFT of the oversampled grid and one multiply.
+The operators are cached on disk, keyed by a digest of the trajectory, so
+a trajectory is only worked out the first time it is seen.
+
+Trajectories are in units of the pixels of k-space of the final image, so
+a trajectory for an N by N image runs from -N/2 to N/2 along each axis,
+with the (phase-encode, readout) coordinate of each sample on the last
+axis.
+
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from scipy import fft as spfft
+from scipy import signal
+from scipy import sparse
+
+import fid_cache
+import memory_budget
+from fid_reader import procparValue
+
+
+# trajectories that are gridded
+TRAJECTORIES = ('radial', 'spiral')
+
+# oversampling of the grid the samples are spread onto
+GRID_OVERSAMPLING = 2.0
+
+# width of the Kaiser-Bessel kernel, in grid points
+KERNEL_WIDTH = 4
+
+# points of the kernel lookup table per grid point
+TABLE_OVERSAMPLING = 256
+
+# iterations of the density compensation
+DENSITY_ITERATIONS = 10
+
+# the golden angle used by golden angle radial studies
+GOLDEN_ANGLE = np.pi*(np.sqrt(5)-1)/2
+
+# changed whenever the cached operators change
+GRIDDING_VERSION = 1
+
+
+def gridDirectory():
+    """ Returns the directory holding the cached gridding operators """
+    return os.path.join(fid_cache.cacheDirectory(), 'gridding')
+
+
+def radialTrajectory(Spokes, Points, Matrix=None, Golden=False):
+    """
+    Builds a radial trajectory.
+
+    Parameters
+    ----------
+    Spokes : int
+        Number of spokes, each through the centre of k-space.
+
+    Points : int
+        Samples along each spoke.
+
+    Matrix : int, optional
+        Size of the image, less than Points if the readout is oversampled.
+        Defaults to Points.
+
+    Golden : bool, optional
+        Steps the spokes by the golden angle instead of spreading them
+        evenly over 180 degrees. Defaults to False.
+
+    Returns
+    -------
+    Trajectory : 3D array
+        The (spoke, point, 2) sample positions.
+
+    """
+    if Matrix is None:
+        Matrix = Points
+    if Golden:
+        angles = (np.arange(Spokes)*GOLDEN_ANGLE) % np.pi
+    else:
+        angles = np.arange(Spokes)*np.pi/Spokes
+    radii = (np.arange(Points)-Points//2)*float(Matrix)/Points
+    return np.stack([np.outer(np.sin(angles), radii),
+                     np.outer(np.cos(angles), radii)], axis=-1)
+
+
+def spiralTrajectory(Interleaves, Points, Matrix):
+    """
+    Builds an Archimedean spiral trajectory.
+
+    Parameters
+    ----------
+    Interleaves : int
+        Number of interleaved spirals, rotated evenly about the centre.
+
+    Points : int
+        Samples along each spiral, from the centre out.
+
+    Matrix : int
+        Size of the image. The spirals make enough turns to sample the
+        radius at the Nyquist rate.
+
+    Returns
+    -------
+    Trajectory : 3D array
+        The (interleave, point, 2) sample positions.
+
+    """
+    turns = Matrix/(2.0*Interleaves)
+    time = np.arange(Points)/float(Points)
+    radii = Matrix/2.0*time
+    angles = (2*np.pi*turns*time[None, :] +
+              2*np.pi*np.arange(Interleaves)[:, None]/Interleaves)
+    return np.stack([radii*np.sin(angles), radii*np.cos(angles)], axis=-1)
+
+
+def trajectoryType(Procpar):
+    """
+    Returns the trajectory of a study.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary of the study.
+
+    Returns
+    -------
+    Trajectory : string or None
+        'radial' or 'spiral' if the sequence name says so, otherwise None
+        for a Cartesian study.
+
+    """
+    name = procparValue(Procpar, 'seqfil', '')
+    if not isinstance(name, str):
+        return None
+    for kind in TRAJECTORIES:
+        if kind in name.lower():
+            return kind
+    return None
+
+
+def studyTrajectory(Procpar, Shape, Oversampling=1.0):
+    """
+    Builds the trajectory of a non-Cartesian study.
+
+    The spokes or interleaves are decoded as the phase-encode lines of
+    each frame. Radial spokes are golden angle if the golden parameter is
+    'y', and the matrix of a spiral study comes from the nread parameter,
+    or is the size whose disc holds as many pixels as there are samples.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary of the study.
+
+    Shape : tuple
+        Shape of the decoded k-space.
+
+    Oversampling : float, optional
+        Readout oversampling of a radial study. Defaults to 1.
+
+    Returns
+    -------
+    Trajectory : 3D array or None
+        The (line, point, 2) sample positions, or None for a Cartesian
+        study.
+
+    Matrix : int or None
+        The size of the images.
+
+    """
+    kind = trajectoryType(Procpar)
+    if kind is None:
+        return None, None
+    lines, points = Shape[-2:]
+    if kind == 'radial':
+        matrix = max(1, int(round(points/Oversampling)))
+        golden = procparValue(Procpar, 'golden', 'n') == 'y'
+        return radialTrajectory(lines, points, matrix, golden), matrix
+    nread = procparValue(Procpar, 'nread')
+    if isinstance(nread, float) and nread >= 2:
+        matrix = int(nread)//2
+    else:
+        matrix = int(np.sqrt(4*lines*points/np.pi))
+    matrix += matrix % 2
+    return spiralTrajectory(lines, points, matrix), matrix
+
+
+def kaiserBessel(Width=KERNEL_WIDTH, Oversampling=GRID_OVERSAMPLING):
+    """
+    Builds the lookup table of the gridding kernel.
+
+    The shape parameter is the one of Beatty et al, IEEE TMI 24:799, 2005,
+    which keeps the aliasing low for the width and grid oversampling.
+
+    Returns
+    -------
+    Offsets : 1D array
+        Distances from the sample, from -Width/2 to Width/2 grid points.
+
+    Table : 1D array
+        The kernel at each offset, 1 at the centre.
+
+    """
+    beta = np.pi*np.sqrt((Width/Oversampling)**2*(Oversampling-0.5)**2-0.8)
+    size = Width*TABLE_OVERSAMPLING+1
+    table = signal.get_window(('kaiser', beta), size, fftbins=False)
+    return np.linspace(-Width/2.0, Width/2.0, size), table
+
+
+def _centredInverse(Grid):
+    """ Centred inverse 2D FFT of the last two axes, on every core """
+    axes = (-2, -1)
+    return spfft.fftshift(spfft.ifft2(spfft.ifftshift(Grid, axes=axes),
+                                      axes=axes, workers=-1), axes=axes)
+
+
+class GriddingPlan(object):
+    """
+    Gridding reconstruction of frames with one trajectory.
+
+    Parameters
+    ----------
+    Trajectory : array
+        The (..., 2) sample positions, see the module docstring.
+
+    Matrix : int
+        Size of the square images.
+
+    Oversampling : float, optional
+        Oversampling of the grid. Defaults to :data:`GRID_OVERSAMPLING`.
+
+    Width : int, optional
+        Kernel width in grid points. Defaults to :data:`KERNEL_WIDTH`.
+
+    """
+    def __init__(self, Trajectory, Matrix, Oversampling=GRID_OVERSAMPLING,
+                 Width=KERNEL_WIDTH):
+        self.samples = int(np.prod(np.shape(Trajectory)[:-1]))
+        self.matrix = int(Matrix)
+        self.grid = spfft.next_fast_len(int(np.ceil(Matrix*Oversampling)))
+        while self.grid % 2:
+            self.grid = spfft.next_fast_len(self.grid+1)
+        self.oversampling = Oversampling
+        self.width = Width
+        self.key = self._key(Trajectory)
+        if not self._load():
+            self._build(np.reshape(Trajectory, (-1, 2)))
+            self._store()
+
+    def _key(self, Trajectory):
+        """ Digest of the trajectory and settings """
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(Trajectory,
+                                           dtype=np.float64).tobytes())
+        digest.update(repr((self.matrix, self.grid, self.width,
+                            GRIDDING_VERSION)).encode())
+        return digest.hexdigest()
+
+    def _path(self):
+        return os.path.join(gridDirectory(), self.key+'.npz')
+
+    def _load(self):
+        """ Reads the operators from the disk cache """
+        try:
+            with np.load(self._path()) as stored:
+                self.operator = sparse.csr_matrix(
+                    (stored['data'], stored['indices'], stored['indptr']),
+                    shape=(self.grid*self.grid, self.samples))
+                self.density = stored['density']
+                self.deapodization = stored['deapodization']
+        except (IOError, OSError, KeyError, ValueError):
+            return False
+        return True
+
+    def _store(self):
+        """ Writes the operators to the disk cache, renamed into place """
+        root = gridDirectory()
+        try:
+            if not os.path.isdir(root):
+                os.makedirs(root)
+            handle, working = tempfile.mkstemp(dir=root, prefix='.partial-',
+                                               suffix='.npz')
+            with os.fdopen(handle, 'wb') as entry:
+                np.savez(entry, data=self.operator.data,
+                         indices=self.operator.indices,
+                         indptr=self.operator.indptr, density=self.density,
+                         deapodization=self.deapodization)
+            shutil.move(working, self._path())
+        except (IOError, OSError):
+            # a cache that cannot be written only costs the rebuild
+            pass
+
+    def _interpolation(self, Trajectory):
+        """ Sparse kernel weights from the samples to the grid """
+        offsets, table = kaiserBessel(self.width, self.oversampling)
+        scale = self.grid/float(self.matrix)
+        position = Trajectory*scale+self.grid//2
+        first = np.ceil(position-self.width/2.0).astype(int)
+        taps = np.arange(self.width)
+        # (sample, tap) grid points and weights along each axis
+        points, weights = [], []
+        for axis in range(2):
+            index = first[:, axis, None]+taps
+            weights.append(np.interp(index-position[:, axis, None],
+                                     offsets, table, left=0, right=0))
+            points.append(index % self.grid)
+        rows = (points[0][:, :, None]*self.grid +
+                points[1][:, None, :]).ravel()
+        values = (weights[0][:, :, None]*weights[1][:, None, :]).ravel()
+        columns = np.repeat(np.arange(len(Trajectory)), self.width**2)
+        return sparse.csr_matrix((values.astype(np.float32),
+                                  (rows, columns)),
+                                 shape=(self.grid*self.grid, len(Trajectory)))
+
+    def _build(self, Trajectory):
+        """ Works out the operators of a trajectory """
+        interpolation = self._interpolation(Trajectory)
+        # Pipe and Menon, MRM 41:179, 1999: w = w/(C*w) at the samples
+        density = np.ones(len(Trajectory), dtype=np.float64)
+        transpose = interpolation.T.tocsr()
+        for _ in range(DENSITY_ITERATIONS):
+            spread = transpose.dot(interpolation.dot(density))
+            density /= np.where(spread > 0, spread, 1)
+        # the iteration only fixes the weights up to a scale, so scale them
+        # for the compensated samples to spread over the middle of the grid
+        # as a Cartesian matrix would
+        centre = np.zeros((1, 2))
+        kernel = self._interpolation(centre).dot(np.ones(1)).reshape(
+            self.grid, self.grid)
+        spread = interpolation.dot(density).reshape(self.grid, self.grid)
+        middle = slice(self.grid//2-self.grid//8, self.grid//2+self.grid//8)
+        density *= kernel.sum()*(self.matrix/float(self.grid))**2 / \
+            spread[middle, middle].mean()
+        self.density = density.astype(np.float32)
+        self.operator = (interpolation.dot(
+            sparse.diags(self.density))).tocsr()
+        # the image of a kernel spread from the centre, scaled from the
+        # grid to the matrix so the images match the Cartesian transform
+        apodization = self._crop(_centredInverse(kernel)).real
+        apodization *= float(self.matrix)**2
+        self.deapodization = (1/apodization).astype(np.float32)
+
+    def _crop(self, Image):
+        """ The centre Matrix of an oversampled image """
+        start = self.grid//2-self.matrix//2
+        window = slice(start, start+self.matrix)
+        return Image[..., window, window]
+
+    def memoryUsage(self):
+        """ Bytes held by the operators """
+        return memory_budget.residentBytes(
+            self.operator.data, self.operator.indices, self.operator.indptr,
+            self.density, self.deapodization)
+
+    def transform(self, Kspace):
+        """
+        Reconstructs frames.
+
+        Parameters
+        ----------
+        Kspace : array
+            The (..., line, point) samples, in the order of the trajectory.
+
+        Returns
+        -------
+        Image : array of complex64
+            The (..., Matrix, Matrix) images.
+
+        """
+        Kspace = np.asarray(Kspace)
+        leading = Kspace.shape[:-2]
+        frames = Kspace.reshape(-1, self.samples)
+        # every frame is spread by the same sparse product
+        grid = self.operator.dot(frames.T).T.reshape(
+            (-1, self.grid, self.grid))
+        image = self._crop(_centredInverse(grid))*self.deapodization
+        return image.reshape(leading+image.shape[-2:]).astype(np.complex64)
+
+
+class _PlanCache(dict):
+    """ Gridding plans, keyed by the digest of their trajectory """
+    def memoryUsage(self):
+        """ Bytes held by the plans """
+        return sum(plan.memoryUsage() for plan in list(self.values()))
+
+    def release(self, Bytes):
+        """ Drops the plans, they are reloaded from disk when needed """
+        freed = self.memoryUsage()
+        self.clear()
+        return freed
+
+
+_PLANS = _PlanCache()
+_PLAN_LOCK = threading.Lock()
+memory_budget.governor().register(_PLANS, 'gridding operators',
+                                  memory_budget.PRIORITY_DERIVED)
+
+
+def plan(Procpar, Shape, Oversampling=1.0):
+    """
+    Returns the gridding plan of a study.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary of the study.
+
+    Shape : tuple
+        Shape of the decoded k-space.
+
+    Oversampling : float, optional
+        Readout oversampling of a radial study. Defaults to 1.
+
+    Returns
+    -------
+    Plan : :class:`GriddingPlan` or None
+        The cached plan, or None for a Cartesian study.
+
+    """
+    trajectory, matrix = studyTrajectory(Procpar, Shape, Oversampling)
+    if trajectory is None:
+        return None
+    key = (trajectoryType(Procpar), tuple(Shape[-2:]), matrix,
+           procparValue(Procpar, 'golden', 'n'))
+    with _PLAN_LOCK:
+        if key not in _PLANS:
+            _PLANS[key] = GriddingPlan(trajectory, matrix)
+        return _PLANS[key]
@@ -0,0 +1,279 @@
+"""
+.. py:module:: memory_budget
+Memory Budget Module
+====================
+
+A process wide memory governor. Caches and display buffers register with
+the :func:`governor`, and anything about to allocate a large array asks it
+to :meth:`MemoryGovernor.reserve` the space first. When the registered
+objects would go over the cap, the governor asks the least important ones
+to give memory back, so the program sheds cached results instead of
+pushing the workstation into swap.
+
+A registered object only needs two methods::
+
+    memoryUsage()     bytes currently held
+    release(Bytes)    drop at least Bytes if possible, return bytes freed
+
+Objects without a release method are counted against the cap but are never
+asked to give memory back, e.g. the arrays currently on screen. Objects are
+held by weak reference, so they drop out of the accounts when they are
+garbage collected.
+
+The cap is set with the MRMAGIC_MEMORY_LIMIT environment variable, in bytes,
+and otherwise defaults to half of the physical memory.
+
+"""
+
+import mmap
+import os
+import threading
+import weakref
+
+import numpy as np
+
+
+# priorities, lower priorities are evicted first
+PRIORITY_DERIVED = 10  # products that are cheap to recompute, e.g. masks
+PRIORITY_CACHE = 20  # caches of work that is slow to redo
+PRIORITY_DISPLAY = 30  # buffers backing what is on screen
+
+# cap used when the physical memory cannot be found
+DEFAULT_LIMIT = 4 << 30
+
+
+def physicalMemory():
+    """ Bytes of physical memory, or None if it cannot be found """
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def defaultLimit():
+    """ The cap used when none is given, see the module description """
+    if 'MRMAGIC_MEMORY_LIMIT' in os.environ:
+        return int(os.environ['MRMAGIC_MEMORY_LIMIT'])
+    physical = physicalMemory()
+    return DEFAULT_LIMIT if physical is None else physical//2
+
+
+def residentBytes(*Arrays):
+    """
+    Bytes of memory held by arrays, for memoryUsage methods.
+
+    Memory maps, and views of them, are backed by files and are not
+    counted, nor is anything that is not an array.
+
+    """
+    total = 0
+    for data in Arrays:
+        if not isinstance(data, np.ndarray):
+            continue
+        base = data
+        while isinstance(base, np.ndarray) and \
+                not isinstance(base, np.memmap) and base.base is not None:
+            base = base.base
+        if not isinstance(base, (np.memmap, mmap.mmap)):
+            total += data.nbytes
+    return total
+
+
+class Account(object):
+    """
+    The governor's record of one registered object.
+
+    Parameters
+    ----------
+    Owner : object
+        The registered object.
+
+    Name : string
+        Label used in the statistics.
+
+    Priority : int
+        Eviction priority, lower is evicted first.
+
+    """
+    def __init__(self, Owner, Name, Priority):
+        self.owner = weakref.ref(Owner)
+        self.name = Name
+        self.priority = Priority
+        self.evictions = 0  # times it was asked to release memory
+        self.freed = 0  # bytes it released
+
+    @property
+    def evictable(self):
+        """ True if the owner is alive and can release memory """
+        owner = self.owner()
+        return owner is not None and hasattr(owner, 'release')
+
+    def usage(self):
+        """ Bytes held by the owner, 0 once it has been collected """
+        owner = self.owner()
+        if owner is None:
+            return 0
+        return int(owner.memoryUsage())
+
+
+class MemoryGovernor(object):
+    """
+    Keeps the registered caches and buffers under a memory cap.
+
+    Parameters
+    ----------
+    Limit : int, optional
+        The cap in bytes. Defaults to :func:`defaultLimit`.
+
+    """
+    def __init__(self, Limit=None):
+        self.limit = defaultLimit() if Limit is None else Limit
+        self.accounts = []
+        self.denied = 0  # reservations that could not be met
+        self._lock = threading.RLock()
+
+    def register(self, Owner, Name=None, Priority=PRIORITY_CACHE):
+        """
+        Adds an object to the accounts.
+
+        Parameters
+        ----------
+        Owner : object
+            Has a memoryUsage method, and optionally a release method.
+
+        Name : string, optional
+            Label used in the statistics. Defaults to the class name.
+
+        Priority : int, optional
+            Eviction priority, lower is evicted first. Defaults to
+            :data:`PRIORITY_CACHE`.
+
+        Returns
+        -------
+        Account : :class:`Account`
+            The governor's record of the object.
+
+        """
+        if Name is None:
+            Name = type(Owner).__name__
+        account = Account(Owner, Name, Priority)
+        with self._lock:
+            self._prune()
+            self.accounts.append(account)
+        return account
+
+    def unregister(self, Owner):
+        """ Removes an object from the accounts. """
+        with self._lock:
+            self.accounts = [account for account in self.accounts
+                             if account.owner() is not None and
+                             account.owner() is not Owner]
+
+    def _prune(self):
+        """ Drops the accounts of collected objects """
+        self.accounts = [account for account in self.accounts
+                         if account.owner() is not None]
+
+    def used(self):
+        """ Bytes held by all of the registered objects """
+        with self._lock:
+            return sum(account.usage() for account in self.accounts)
+
+    def reserve(self, Bytes, Priority=None):
+        """
+        Makes room for a new allocation.
+
+        Registered objects are asked to release memory, lowest priority
+        first and the largest first within a priority, until Bytes more fit
+        under the cap.
+
+        Parameters
+        ----------
+        Bytes : int
+            Size of the allocation about to be made.
+
+        Priority : int, optional
+            Priority of the allocation. Only objects with a lower priority
+            are evicted for it. Defaults to evicting anything evictable.
+
+        Returns
+        -------
+        Fits : bool
+            False if the allocation would still go over the cap. It is up
+            to the caller whether to go ahead, or e.g. skip caching.
+
+        """
+        with self._lock:
+            self._prune()
+            usage = [(account, account.usage()) for account in self.accounts]
+            excess = sum(size for _, size in usage)+Bytes-self.limit
+            if excess <= 0:
+                return True
+            candidates = sorted([(account.priority, -size, index)
+                                 for index, (account, size) in
+                                 enumerate(usage) if size > 0 and
+                                 account.evictable and
+                                 (Priority is None or
+                                  account.priority < Priority)])
+            for _, _, index in candidates:
+                account = usage[index][0]
+                owner = account.owner()
+                if owner is None:
+                    continue
+                freed = int(owner.release(excess) or 0)
+                account.evictions += 1
+                account.freed += freed
+                excess -= freed
+                if excess <= 0:
+                    return True
+            self.denied += 1
+            return False
+
+    def trim(self):
+        """ Evicts until the registered objects are back under the cap. """
+        return self.reserve(0)
+
+    def setLimit(self, Limit):
+        """ Changes the cap, evicting straight away if needed. """
+        with self._lock:
+            self.limit = Limit
+            return self.trim()
+
+    def stats(self):
+        """
+        Returns the state of the accounts.
+
+        Returns
+        -------
+        Stats : dictionary
+            limit, used and denied, plus an accounts list holding the name,
+            priority, bytes, evictable flag, evictions and bytes freed of
+            every registered object.
+
+        """
+        with self._lock:
+            self._prune()
+            accounts = [{'name': account.name,
+                         'priority': account.priority,
+                         'bytes': account.usage(),
+                         'evictable': account.evictable,
+                         'evictions': account.evictions,
+                         'freed': account.freed}
+                        for account in self.accounts]
+            return {'limit': self.limit,
+                    'used': sum(account['bytes'] for account in accounts),
+                    'denied': self.denied,
+                    'accounts': accounts}
+
+
+_GOVERNOR = None
+_GOVERNOR_LOCK = threading.Lock()
+
+
+def governor():
+    """ Returns the process wide :class:`MemoryGovernor` """
+    global _GOVERNOR
+    with _GOVERNOR_LOCK:
+        if _GOVERNOR is None:
+            _GOVERNOR = MemoryGovernor()
+        return _GOVERNOR
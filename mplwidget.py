@@ -17,6 +17,7 @@ from matplotlib.figure import Figure
 import matplotlib.patches as pch
 import matplotlib.pyplot as plt
 
+import memory_budget
 from contrast import Ui_ContrastSettings
 from ColorMap import Ui_CMapDialog
 
@@ -129,6 +130,14 @@ class mplCanvas(FigureCanvasQTAgg):
         FigureCanvasQTAgg.updateGeometry(self)
 
         self.fig.canvas.mpl_connect('button_press_event', self._plotClick)
+        # what is on screen is counted, but never evicted
+        memory_budget.governor().register(self, 'display',
+                                          memory_budget.PRIORITY_DISPLAY)
+
+    def memoryUsage(self):
+        """ Bytes held by the displayed data and matplotlib's copy of it """
+        shown = None if self.im is None else self.im.get_array()
+        return memory_budget.residentBytes(self.data, self.mask, shown)
 
     def addMarker(self, Coord):
         """ Draws a small circle at the supplied data coordinates """
@@ -215,7 +224,7 @@ class mplCanvas(FigureCanvasQTAgg):
             - Data (array): the image to be shown
             - CMap (str): name of the mpl colormap to be used
             - Aspect (float): aspect ratio of the image
-            - Mask (array): binary array used to mask the image
+            - Mask (array): boolean array used to mask the image
             - MinMax (tuple): minimum and maximum values for windowing the 
                 image
         
@@ -236,9 +245,9 @@ class mplCanvas(FigureCanvasQTAgg):
         value was set, then it is used. If a value is supplied, then is stored
         in the class member aspectRatio. 
         
-        *Mask:* If a binary mask is not supplied, then the previous mask is
+        *Mask:* If a boolean mask is not supplied, then the previous mask is
         used. If it is supplied, then the mask is stored in the class member
-        mask.
+        mask. Pixels where the mask is False are left blank.
         
         *MinMax:* If a tuple of two elements is not supplied, then the class
         member minMax is used to set the display range. If no min or max has 
@@ -257,12 +266,8 @@ class mplCanvas(FigureCanvasQTAgg):
         if CMap is not None:
             self.CMap = CMap
 
-        mask = 1
         if Mask is not None:
             self.mask = Mask
-            mask = Mask
-        elif Mask is None and self.mask is not None:
-            mask = self.mask
 
         # Set the aspect ratio, default to a square
         if Aspect is None and self.aspectRatio is None:
@@ -285,12 +290,46 @@ class mplCanvas(FigureCanvasQTAgg):
         # Clean up anything that was already displayed, and go again
         self.ax.clear()
         self.ax.set_axis_off()
-        self.im = self.ax.imshow(X=self.cadj(self.data*mask),
+        # room for the contrast adjusted copy and matplotlib's own copy
+        memory_budget.governor().reserve(2*np.size(self.data)*8,
+                                         memory_budget.PRIORITY_DISPLAY)
+        image = self.cadj(self.data)
+        if self.mask is not None:
+            # mask out the background without copying the data into a float
+            # product, self.data is stored transposed so the mask is too
+            image = np.ma.masked_array(image, mask=~self.mask.T)
+        self.im = self.ax.imshow(X=image,
                                  cmap=self.CMap,
                                  **configs)
         self.ax.set_position([0, 0, 1, 1])
         self.refresh()
 
+    def showRGBA(self, Image):
+        """
+        Quickly shows a prerendered image, for cine playback.
+
+        Only the image is redrawn and copied to the screen, the rest of the
+        plot is left as it is. The first call after :meth:`imshow` sets the
+        plot up, and :meth:`imshow` goes back to the normal display.
+
+        **Args:**
+            - Image (array): (rows, columns, 4) RGBA uint8 image, already
+                transposed and colour mapped, see :func:`cine.render`
+
+        """
+        shown = None if self.im is None else self.im.get_array()
+        if shown is None or np.ndim(shown) != 3 or \
+                np.shape(shown) != np.shape(Image):
+            self.ax.clear()
+            self.ax.set_axis_off()
+            self.im = self.ax.imshow(X=Image, aspect=self.aspectRatio or 1)
+            self.ax.set_position([0, 0, 1, 1])
+            self.draw()
+            return
+        self.im.set_data(Image)
+        self.ax.draw_artist(self.im)
+        self.blit(self.ax.bbox)
+
     @QtCore.pyqtSlot()
     @QtCore.pyqtSlot(int)
     def _minMaxSlot(self, State=2):
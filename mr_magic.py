@@ -10,12 +10,22 @@ General purpose MRI image display.
     **Standard modules:**
     
     * numpy: Primary math and processing
-    * nmrglue: Varian FID importer, needs to be the modified version
+    * nmrglue: Varian procpar parser, needs to be the modified version
     * PyQt4: The GUI is built on this
     
     **Custom modules, general purpose:**
     
     * filters:  Builds the various filters and masks used to process images
+    * fid_reader: Memory mapped, lazily decoded Varian FID reader
+    * fid_cache: Sidecar cache of previously opened FIDs
+    * recon: Qt free reconstruction of the filtered images
+    * result_cache: Content addressed cache of reconstructed frames
+    * frame_cache: Background prefetch of the neighbouring frames
+    * cine: Movie playback of dynamic series from prerendered frames
+    * averaging: Streaming average of the repetitions of a study
+    * registration: Phase correlation motion correction of repetitions
+    * memory_budget: Keeps the caches and display buffers under a cap
+    * watch: Reconstructs studies as the scanner writes them
     
     **GUI element modules:**
     
@@ -44,12 +54,27 @@ _______________________
 import sys
 import os
 import platform
+import threading
 
 import numpy as np
-import nmrglue as ng
 from PyQt4 import QtGui, QtCore
 
+import averaging
+import cine
+import coils
+import compressed_sensing
 import filters as filt
+import fid_reader
+import fid_cache
+import frame_cache
+import gridding
+import memory_budget
+import partial_fourier
+import recon
+import registration
+import result_cache
+import volume
+import watch
 from main_window import Ui_MainWindow
 import startCMPUI
 from filter_config_class import FilterConfig
@@ -61,13 +86,47 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
     """
     dic = []  # sequence descriptor
+    kspaceData = None  # lazily decoded (block, slice, echo, pe, ro) data
+    frame = (0, 0, 0)  # (block, slice, echo) of the displayed frame
+    navigatorAxis = 1  # frame axis last stepped through, prefetched along
+    studyHash = None  # content digest of the study, once it is known
+    studyGeneration = 0  # incremented every time a study is opened
+    oversampling = 1.0  # readout oversampling removed from the frames
+    zeroFill = False  # interpolate the images to the display size
+    zeroFillFactor = 2  # least interpolation factor when zero-filling
+    lines = None  # acquired phase-encode lines of a partial Fourier study
+    partialFourier = 'homodyne'  # partial Fourier reconstruction method
+    receivers = 1  # coils of the study
+    whitener = None  # noise prewhitening of the coils
+    coilMethod = 'rss'  # coil combination method
+    average = False  # show the average of the repetitions
+    shifts = None  # motion of each frame, when registering the repetitions
+    registerPending = None  # k-space whose motion is being estimated
+    gridding = None  # gridding plan of radial and spiral studies
+    studyPath = None  # the \*.fid folder of the open study
+    rawKspace = None  # k-space of a 3D study before the partition transform
+    volumeSpec = None  # 3D filters the shown partitions were transformed with
+    volumePending = None  # 3D filters of the transform in progress
     data = []  # raw data
     datafilt = []  # filtered data
     image = []  # filtered reconstructed image
+    imageVersion = 0  # incremented every time the image is reconstructed
+    imageFrame = None  # the frame image and datafilt were reconstructed for
     aspectRatio = 1  # aspect ratio of the image
     subwindow = None  # dummy for any popup menus
+    watcher = None  # watch folder ingestion, when running
+    player = None  # cine playback, when running
+    cineResults = None  # reconstructs the results of a frame of the movie
     filterStack = []  # stack of filters
 
+    # a partition transform finished, with the study generation, the 3D
+    # filters and the hybrid k-space, or None if it could not be done
+    volumeReady = QtCore.pyqtSignal(int, object, object)
+
+    # a motion estimate finished, with the study generation, the k-space it
+    # was estimated from and the shifts, or None if it could not be done
+    shiftsReady = QtCore.pyqtSignal(int, object, object)
+
     # color maps for the different images
     CMaps = {'kspace': 'gray',
              'kphase': 'gist_rainbow',
@@ -85,11 +144,49 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.actionFID.triggered.connect(self._openFID)
         self.actionColor_Maps.triggered.connect(self._setCMaps)
         self.actionConfigureFilters.triggered.connect(self._filtConfigure)
+        self.volumeReady.connect(self._showVolume)
+        self.shiftsReady.connect(self._showShifts)
         self.actionKspace.triggered.connect(self.kspace.setContrast)
         self.actionKspace_Phase.triggered.connect(self.kspacePhase.setContrast)
         self.actionMagnitude.triggered.connect(self.magnitudeImage.setContrast)
         self.actionPhase_Map.triggered.connect(self.phaseImage.setContrast)
         self.actionExit.triggered.connect(self.exitProg)
+        self.actionWatch = QtGui.QAction("Watch Folder", self)
+        self.actionWatch.setCheckable(True)
+        self.menuFile.insertAction(self.actionExit, self.actionWatch)
+        self.actionWatch.triggered.connect(self._watchFolder)
+        self.actionZeroFill = QtGui.QAction("Zero Fill Images", self)
+        self.actionZeroFill.setCheckable(True)
+        self.menuSettings.addAction(self.actionZeroFill)
+        self.actionZeroFill.toggled.connect(self._setZeroFill)
+        self.menuPartialFourier = self.menuSettings.addMenu("Partial Fourier")
+        self.partialFourierGroup = QtGui.QActionGroup(self)
+        for method, label in zip(partial_fourier.METHODS,
+                                 ("Zero Fill", "Homodyne", "POCS")):
+            action = QtGui.QAction(label, self.partialFourierGroup)
+            action.setCheckable(True)
+            action.setChecked(method == self.partialFourier)
+            action.setData(method)
+            self.menuPartialFourier.addAction(action)
+        self.partialFourierGroup.triggered.connect(self._setPartialFourier)
+        self.menuCoils = self.menuSettings.addMenu("Coil Combination")
+        self.coilGroup = QtGui.QActionGroup(self)
+        for method, label in zip(coils.METHODS,
+                                 ("Root Sum of Squares", "Adaptive")):
+            action = QtGui.QAction(label, self.coilGroup)
+            action.setCheckable(True)
+            action.setChecked(method == self.coilMethod)
+            action.setData(method)
+            self.menuCoils.addAction(action)
+        self.coilGroup.triggered.connect(self._setCoilMethod)
+        self.actionAverage = QtGui.QAction("Average Repetitions", self)
+        self.actionAverage.setCheckable(True)
+        self.menuSettings.addAction(self.actionAverage)
+        self.actionAverage.toggled.connect(self._setAverage)
+        self.actionRegister = QtGui.QAction("Register Repetitions", self)
+        self.actionRegister.setCheckable(True)
+        self.menuSettings.addAction(self.actionRegister)
+        self.actionRegister.toggled.connect(self._setRegister)
         # Connect the show/hide control for the sub-windows
         self.actionData_Explorer.triggered.connect(self.dataExplorerToggle)
         self.actionMagnitude_Image.triggered.connect(self.magnitudeImageToggle)
@@ -119,6 +216,58 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.phaseImage.toggleMask.connect(self.maskPhase)
         self.magnitudeImage.maskable = True
         self.magnitudeImage.toggleMask.connect(self.maskImage)
+        # one mask is shared by both image displays
+        self.maskCache = filt.MaskCache()
+        # reconstructed frames, reused when a study and stack are reopened
+        self.resultCache = result_cache.ResultCache()
+        # frames next to the displayed one, reconstructed in the background
+        self.frameCache = frame_cache.FrameCache()
+        # the current frame is counted against the memory cap
+        memory_budget.governor().register(self, 'study',
+                                          memory_budget.PRIORITY_DISPLAY)
+
+        # rep, slice and echo sliders, shown for the axes a study has
+        self.navigator = QtGui.QWidget(self.ExplorerDockContents)
+        layout = QtGui.QGridLayout(self.navigator)
+        self.navigatorLabels = []
+        self.navigatorSliders = []
+        for row in range(3):
+            label = QtGui.QLabel(self.navigator)
+            slider = QtGui.QSlider(QtCore.Qt.Horizontal, self.navigator)
+            slider.setRange(0, 0)
+            slider.valueChanged.connect(self._navigate)
+            layout.addWidget(label, row, 0)
+            layout.addWidget(slider, row, 1)
+            self.navigatorLabels.append(label)
+            self.navigatorSliders.append(slider)
+        # plays the axis last stepped through as a movie
+        self.cineButton = QtGui.QPushButton("Play", self.navigator)
+        self.cineButton.setCheckable(True)
+        self.cineButton.toggled.connect(self._cineToggle)
+        self.cineRate = QtGui.QSpinBox(self.navigator)
+        self.cineRate.setRange(1, 100)
+        self.cineRate.setValue(int(cine.FRAME_RATE))
+        self.cineRate.setSuffix(" fps")
+        self.cineRate.valueChanged.connect(self._setCineRate)
+        layout.addWidget(self.cineButton, 3, 0)
+        layout.addWidget(self.cineRate, 3, 1)
+        self.cineTimer = QtCore.QTimer(self)
+        self.cineTimer.timeout.connect(self._cineStep)
+        self.horizontalLayout_2.addWidget(self.navigator)
+        self.navigator.hide()
+
+        # list of the studies published by the watch folder
+        self.studyList = QtGui.QListWidget(self.ExplorerDockContents)
+        self.horizontalLayout_2.addWidget(self.studyList)
+        self.studyList.hide()
+        self.studyList.itemDoubleClicked.connect(self._openListedStudy)
+        self.watchTimer = QtCore.QTimer(self)
+        self.watchTimer.timeout.connect(self._watchUpdates)
+
+    def memoryUsage(self):
+        """ Bytes held by the current frame, its filtered k-space and image """
+        return memory_budget.residentBytes(self.data, self.datafilt,
+                                           self.image)
 
     @QtCore.pyqtSlot()
     def _openFID(self):
@@ -139,27 +288,462 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
                                         options=QtGui.QFileDialog.ShowDirsOnly)
         # Open the FID file
         if FID:
-            self.dic, self.data = ng.varian.read(str(FID))
-            temp = (float(self.dic['procpar']['lpe']['values'][0]) /
-                    float(self.dic['procpar']['lro']['values'][0]))
-            self.aspectRatio = temp*(2*float(
-                               self.dic['procpar']['nv']['values'][0]) /
-                               float(self.dic['procpar']['np']['values'][0]))
-
-            # Add a DC offset corection filter
-            self.filterStack.insert(0, filt.makeDCO(Size=10))
-            # apply any default filters and recon
+            self.openStudy(str(FID))
+
+    def openStudy(self, Path):
+        """
+        Loads a \*.fid folder and displays it.
+
+        Parameters
+        ----------
+        Path : string
+            The top level \*.fid folder.
+
+        """
+        self.cineButton.setChecked(False)
+        # work still running for the last study can tell it is stale
+        self.studyGeneration += 1
+        # the motion of the last study does not carry over
+        self.actionRegister.blockSignals(True)
+        self.actionRegister.setChecked(False)
+        self.actionRegister.blockSignals(False)
+        self.shifts = None
+        self.registerPending = None
+        self.dic, self.kspaceData = fid_cache.load(Path)
+        if self.kspaceData is None:
+            # only the first frame is decoded now, the cache is filled in
+            # the background so the next open is a memory map
+            self.dic, self.kspaceData = fid_reader.readFID(Path)
+            threading.Thread(target=fid_cache.store,
+                             args=(Path, self.dic, self.kspaceData),
+                             daemon=True).start()
+        self.studyPath = Path
+        self.rawKspace = None
+        self.volumeSpec = None
+        self.volumePending = None
+        if volume.isVolume(self.dic['procpar']):
+            # the partitions of a 3D study are transformed on disk in the
+            # background, see _transformVolume, and shown untransformed
+            # until then
+            self.rawKspace = self.kspaceData
+        self.frame = (0, 0, 0)
+        # the oversampled readout is cropped before anything else is done
+        self.oversampling = recon.readoutOversampling(self.dic['procpar'])
+        # radial and spiral spokes are gridded with their oversampling
+        self.gridding = gridding.plan(self.dic['procpar'],
+                                      self.kspaceData.shape, self.oversampling)
+        if self.gridding is not None:
+            self.oversampling = 1.0
+        self.lines = partial_fourier.acquiredLines(self.dic['procpar'],
+                                                   self.kspaceData.shape[-2])
+        # the coils of array studies are kept together until they are combined
+        self.receivers = fid_reader.receiverCount(self.dic['procpar'])
+        if self.receivers > 1:
+            raw = coils.coilFrame(self.kspaceData, self.frame, self.receivers)
+            self.whitener = coils.whitener(coils.noiseCovariance(
+                coils.cornerSamples(raw)))
+        else:
+            self.whitener = None
+        self.data = self._frameData(self.frame)
+        self.frameCache.clear()
+        self._setupNavigator()
+        # the digest reads the whole fid, so the first display goes ahead
+        # without the result cache
+        self.studyHash = None
+        threading.Thread(target=self._hashStudy,
+                         args=(Path, self.studyGeneration),
+                         daemon=True).start()
+        self.aspectRatio = 1.0 if self.gridding is not None else \
+            recon.aspectRatio(self.dic['procpar'])
+
+        # Add a DC offset corection filter
+        self.filterStack.insert(0, filt.makeDCO(Size=10))
+        self._transformVolume()
+        # apply any default filters and recon
+        self.updateAll()
+
+    def _transformVolume(self):
+        """
+        Starts the partition transform of a 3D study with the 3D filters of
+        the stack, unless they are those already shown or being applied.
+
+        """
+        if self.rawKspace is None:
+            return
+        stages = filt.volumeStages(self.filterStack)
+        spec = filt.stackSpec(stages)
+        if spec == self.volumeSpec or spec == self.volumePending:
+            return
+        self.volumePending = spec
+        self.statusBar().showMessage('Transforming the partitions')
+        threading.Thread(target=self._buildVolume,
+                         args=(self.studyPath, self.rawKspace, stages, spec,
+                               self.studyGeneration),
+                         daemon=True).start()
+
+    def _buildVolume(self, Path, Kspace, Stages, Spec, Generation):
+        """ Transforms the partitions of a 3D study, run on a thread """
+        try:
+            hybrid = volume.hybridKspace(Path, Kspace, Stages)
+        except (IOError, OSError, ValueError):
+            # e.g. still acquiring, the partitions stay untransformed
+            hybrid = None
+        # handed to the GUI thread, which checks it is still wanted
+        self.volumeReady.emit(Generation, Spec, hybrid)
+
+    @QtCore.pyqtSlot(int, object, object)
+    def _showVolume(self, Generation, Spec, Hybrid):
+        """ QT slot that shows the partitions once they are transformed """
+        if Generation != self.studyGeneration:
+            return
+        if Spec == self.volumePending:
+            self.volumePending = None
+            self.statusBar().clearMessage()
+        if Hybrid is None or \
+                Spec != filt.stackSpec(filt.volumeStages(self.filterStack)):
+            # the 3D filters changed again since, and are being applied
+            return
+        self.kspaceData = Hybrid
+        self.volumeSpec = Spec
+        if self.shifts is not None:
+            # the motion of the new partitions is estimated again
+            self.shifts = None
+            self._setRegister(True)
+        if self.receivers > 1:
+            self.whitener = coils.whitener(coils.noiseCovariance(
+                coils.cornerSamples(coils.coilFrame(
+                    self.kspaceData, self.frame, self.receivers))))
+        self.data = self._frameData(self.frame)
+        self.updateAll()
+
+    def _hashStudy(self, Path, Generation):
+        """ Digests the study for the result cache, run on a thread """
+        try:
+            studyHash = result_cache.contentHash(Path)
+        except (IOError, OSError):
+            return
+        # another study may have been opened while this one was hashed
+        if Generation == self.studyGeneration:
+            self.studyHash = studyHash
+
+    @QtCore.pyqtSlot()
+    def _watchFolder(self):
+        """ QT slot that starts or stops watching a folder for new FIDs
+
+        New and growing \*.fid folders are reconstructed in the background
+        with the current filter stack and reconstruction settings, and
+        listed in the data explorer.
+
+        """
+        if self.watcher is not None:
+            self.watchTimer.stop()
+            self.watcher.stop()
+            self.watcher = None
+            self.actionWatch.setChecked(False)
+            return
+
+        folder = QtGui.QFileDialog.getExistingDirectory(caption="Watch Folder",
+                                        options=QtGui.QFileDialog.ShowDirsOnly)
+        if not folder:
+            self.actionWatch.setChecked(False)
+            return
+        output = os.path.join(fid_cache.cacheDirectory(), 'recon')
+        self.watcher = watch.FolderWatcher([str(folder)], output,
+                                           **self._watchSettings())
+        self.watcher.start()
+        self.watchTimer.start(1000)
+        self.actionWatch.setChecked(True)
+        self.studyList.show()
+        self.dataExplorerDock.show()
+
+    def _watchSettings(self):
+        """ The stack and options watched studies are reconstructed with """
+        spec = filt.stackSpec(self.filterStack)
+        if not any(par['Type'] == 'DC Offset' for par in spec):
+            spec.insert(0, filt.makeDCO(Size=10).params)
+        return {'Spec': spec, 'Coils': self.coilMethod,
+                'PartialFourier': self.partialFourier,
+                'ZeroFill': self.zeroFillFactor if self.zeroFill else None}
+
+    def _configureWatcher(self):
+        """ Reconstructs the watched studies again with the new settings """
+        if self.watcher is not None:
+            self.watcher.configure(**self._watchSettings())
+
+    @QtCore.pyqtSlot()
+    def _watchUpdates(self):
+        """ QT slot that lists the studies published by the watch folder """
+        for path, _, frames, finished in self.watcher.updates():
+            text = '%s (%d frames%s)' % (os.path.basename(path), frames,
+                                         '' if finished else ', acquiring')
+            items = [self.studyList.item(row) for row in
+                     range(self.studyList.count())]
+            match = [item for item in items if
+                     item.data(QtCore.Qt.UserRole) == path]
+            if match:
+                match[0].setText(text)
+            else:
+                item = QtGui.QListWidgetItem(text, self.studyList)
+                item.setData(QtCore.Qt.UserRole, path)
+
+    @QtCore.pyqtSlot(QtGui.QListWidgetItem)
+    def _openListedStudy(self, Item):
+        """ QT slot that opens a study from the watch folder list """
+        self.openStudy(str(Item.data(QtCore.Qt.UserRole)))
+
+    def _frameShape(self):
+        """ Number of (rep, slice, echo) frames of the open study """
+        shape = np.shape(self.kspaceData)[:3]
+        if self.average:
+            # the repetitions are shown as one frame
+            return (1,)+tuple(shape[1:])
+        return (shape[0]//self.receivers,)+tuple(shape[1:])
+
+    def _setupNavigator(self):
+        """ Fits the navigator sliders to the frames of the open study """
+        shape = self._frameShape()
+        for slider, label, size in zip(self.navigatorSliders,
+                                       self.navigatorLabels, shape):
+            slider.blockSignals(True)
+            slider.setRange(0, size-1)
+            slider.setValue(0)
+            slider.blockSignals(False)
+            slider.setVisible(size > 1)
+            label.setVisible(size > 1)
+        # prefetch along the longest axis until another is stepped through
+        self.navigatorAxis = int(np.argmax(shape))
+        self._labelNavigator()
+        if max(shape) > 1:
+            self.navigator.show()
+            self.dataExplorerDock.show()
+        else:
+            self.navigator.hide()
+
+    def _labelNavigator(self):
+        """ Shows the displayed frame next to the navigator sliders """
+        for name, label, index, size in zip(('Rep', 'Slice', 'Echo'),
+                                            self.navigatorLabels, self.frame,
+                                            self._frameShape()):
+            label.setText('%s %d/%d' % (name, index+1, size))
+
+    @QtCore.pyqtSlot(int)
+    def _navigate(self, Value):
+        """ QT slot that shows the frame picked with a navigator slider """
+        if self.kspaceData is None:
+            return
+        axis = self.navigatorSliders.index(self.sender())
+        frame = list(self.frame)
+        frame[axis] = Value
+        self.frame = tuple(frame)
+        self.navigatorAxis = axis
+        self._labelNavigator()
+        self.data = self._frameData(self.frame)
+        self.updateAll()
+
+    @QtCore.pyqtSlot(bool)
+    def _cineToggle(self, Checked):
+        """ QT slot that starts or stops playing the series as a movie
+
+        The axis last stepped through with the navigator is played from the
+        displayed frame, in the magnitude display. Frames are rendered ahead
+        of the timer, see :class:`cine.CinePlayer`.
+
+        """
+        if not Checked:
+            if self.player is None:
+                return
+            self.cineTimer.stop()
+            self.player.stop()
+            stats = self.player.stats()
+            self.player = None
+            self.cineResults = None
+            self.statusBar().showMessage(
+                'Cine: %d frames at %.1f fps of %.0f, %d dropped, %d late'
+                % (stats['shown'], stats['rate'], stats['target'],
+                   stats['dropped'], stats['late']))
+            # back to the normal display of the last frame shown
+            self.data = self._frameData(self.frame)
             self.updateAll()
+            return
+        axis = self.navigatorAxis
+        size = self._frameShape()[axis]
+        if self.data == [] or size < 2:
+            self.cineButton.setChecked(False)
+            return
+        frames = []
+        for step in range(size):
+            frame = list(self.frame)
+            frame[axis] = (self.frame[axis]+step) % size
+            frames.append(tuple(frame))
+        settings = self._settings()
+        reconstruct = lambda frame: self.frameCache.reconstruct(
+            frame, lambda frame: self._frameResults(frame, settings))
+        self.cineResults = reconstruct
+        self.player = cine.CinePlayer(
+            frames, lambda frame: reconstruct(frame)['magnitude'],
+            np.shape(self.image), cine.colourTable(self.CMaps['mag']),
+            self.magnitudeImage.minMax, self.magnitudeImage.cadj,
+            FrameRate=self.cineRate.value())
+        self.cineTimer.start(int(round(1000.0/self.cineRate.value())))
+
+    @QtCore.pyqtSlot()
+    def _cineStep(self):
+        """ QT slot that shows the next frame of the movie """
+        if self.player.error is not None:
+            error = self.player.error
+            self.cineButton.setChecked(False)
+            self.statusBar().showMessage('Cine stopped: %s' % (error,))
+            return
+        frame, image = self.player.next()
+        if frame is None:
+            return
+        self.magnitudeImage.showRGBA(image)
+        # image and datafilt follow when a pixel is read, see
+        # _reconstructShown
+        self.frame = frame
+        slider = self.navigatorSliders[self.navigatorAxis]
+        slider.blockSignals(True)
+        slider.setValue(frame[self.navigatorAxis])
+        slider.blockSignals(False)
+        self._labelNavigator()
+
+    @QtCore.pyqtSlot(int)
+    def _setCineRate(self, Rate):
+        """ QT slot that changes the frame rate of the movie """
+        if self.player is not None:
+            self.player.period = 1.0/Rate
+            self.cineTimer.setInterval(int(round(1000.0/Rate)))
 
     @QtCore.pyqtSlot()
     def _filtConfigure(self):
         """ QT slot that opens the Filter configuration window """
-        self.subwindow = FilterConfig(Dim=np.shape(self.data),
-                                      FilterStack=self.filterStack)
+        # 3D filters are applied to the volume as it was acquired
+        volumeDim = None if self.rawKspace is None else \
+            tuple(np.shape(self.rawKspace)[1:2]+np.shape(self.rawKspace)[-2:])
+        self.subwindow = FilterConfig(Dim=np.shape(self.data)[-2:],
+                                      FilterStack=self.filterStack,
+                                      Volume=volumeDim)
         if self.subwindow.exec_():
             self.filterStack = self.subwindow.filterStack
+            self._configureWatcher()
+            self._transformVolume()
+            self.updateAll()
+
+    @QtCore.pyqtSlot(bool)
+    def _setZeroFill(self, Checked):
+        """ QT slot that turns zero-filled interpolation of the images on """
+        self.zeroFill = Checked
+        self._configureWatcher()
+        self.updateAll()
+
+    @QtCore.pyqtSlot(QtGui.QAction)
+    def _setPartialFourier(self, Action):
+        """ QT slot that picks the partial Fourier reconstruction """
+        self.partialFourier = str(Action.data())
+        self._configureWatcher()
+        if self.lines is not None:
+            self.updateAll()
+
+    @QtCore.pyqtSlot(QtGui.QAction)
+    def _setCoilMethod(self, Action):
+        """ QT slot that picks the coil combination """
+        self.coilMethod = str(Action.data())
+        self._configureWatcher()
+        if self.receivers > 1:
             self.updateAll()
 
+    @QtCore.pyqtSlot(bool)
+    def _setAverage(self, Checked):
+        """ QT slot that shows the average of the repetitions, or each one """
+        self.average = Checked
+        if self.kspaceData is None:
+            return
+        self.frame = (0,)+tuple(self.frame[1:])
+        self._setupNavigator()
+        self.data = self._frameData(self.frame)
+        self.updateAll()
+
+    @QtCore.pyqtSlot(bool)
+    def _setRegister(self, Checked):
+        """ QT slot that corrects the motion between the repetitions """
+        if not Checked or self.kspaceData is None:
+            # an estimate still running is dropped when it finishes
+            self.registerPending = None
+            if self.shifts is not None:
+                self.shifts = None
+                if self.kspaceData is not None:
+                    self.data = self._frameData(self.frame)
+                    self.updateAll()
+        elif self.lines is not None or self.gridding is not None:
+            self.actionRegister.setChecked(False)
+            self.statusBar().showMessage('Only fully sampled Cartesian '
+                                         'studies are registered')
+        elif self.registerPending is not self.kspaceData:
+            # every frame is estimated at once, which reads the whole study,
+            # so it is done on a thread, see registration
+            self.registerPending = self.kspaceData
+            self.statusBar().showMessage('Registering the repetitions')
+            threading.Thread(target=self._estimateShifts,
+                             args=(self.kspaceData, self.receivers,
+                                   self.studyGeneration),
+                             daemon=True).start()
+
+    def _estimateShifts(self, Kspace, Receivers, Generation):
+        """ Estimates the motion of every repetition, run on a thread """
+        try:
+            shifts = registration.studyShifts(Kspace, Receivers)
+        except (IOError, OSError, ValueError):
+            # e.g. the study was truncated while it was read
+            shifts = None
+        # handed to the GUI thread, which checks it is still wanted
+        self.shiftsReady.emit(Generation, Kspace, shifts)
+
+    @QtCore.pyqtSlot(int, object, object)
+    def _showShifts(self, Generation, Kspace, Shifts):
+        """ QT slot that registers the repetitions once they are estimated """
+        if Generation != self.studyGeneration or \
+                Kspace is not self.registerPending:
+            # another study was opened, or registration was turned off
+            return
+        self.registerPending = None
+        if Kspace is not self.kspaceData:
+            # replaced meanwhile, e.g. by the partition transform
+            self._setRegister(self.actionRegister.isChecked())
+            return
+        if Shifts is None:
+            self.actionRegister.setChecked(False)
+            self.statusBar().showMessage('The repetitions could not be '
+                                         'registered')
+            return
+        self.shifts = Shifts
+        self.statusBar().showMessage(
+            'Registered %d repetitions, largest shift %.1f pixels'
+            % (len(self.shifts), np.abs(self.shifts).max()))
+        self.data = self._frameData(self.frame)
+        self.updateAll()
+
+    def _zeroFillSize(self):
+        """ Image size for the display, or None when not zero-filling """
+        if not self.zeroFill:
+            return None
+        # the displays show the transpose, so the phase-encode lines run
+        # across the widget
+        return recon.zeroFillSize(self._frameDim(), self.zeroFillFactor,
+                                  (self.magnitudeImage.width(),
+                                   self.magnitudeImage.height()))
+
+    def _frameDim(self):
+        """ Size of the images of the open study before zero-filling """
+        if self.gridding is not None:
+            # the spokes are gridded onto the trajectory's matrix
+            return (self.gridding.matrix, self.gridding.matrix)
+        return np.shape(self.data)[-2:]
+
+    def _imageAspect(self, Shape):
+        """ Aspect ratio of an image of the open study of that size """
+        return recon.zeroFillAspect(self.aspectRatio, self._frameDim(),
+                                    Shape)
+
     @QtCore.pyqtSlot()
     def _setCMaps(self):
         """ QT slot that opens the Color Map Configuration window"""
@@ -168,6 +752,116 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
             self.CMaps = self.subwindow.CMaps
             self.updateAll()
 
+    def _frameData(self, Frame):
+        """ The cropped and padded k-space of a frame of the open study """
+        if self.average:
+            # read a repetition at a time into the running mean
+            raw = averaging.averageKspace(self.kspaceData, self.receivers,
+                                          Frame[1:], Shifts=self.shifts).mean
+            if self.receivers == 1:
+                raw = raw[0]
+        elif self.receivers > 1:
+            raw = coils.coilFrame(self.kspaceData, Frame, self.receivers)
+        else:
+            raw = np.asarray(self.kspaceData[Frame])
+        if self.shifts is not None and not self.average:
+            # the motion is removed before the filters
+            raw = registration.shiftKspace(raw, -self.shifts[Frame])
+        return partial_fourier.padLines(recon.removeOversampling(
+            raw, self.oversampling), self.lines)
+
+    def _settings(self):
+        """
+        Takes a snapshot of what the frames are reconstructed with, so the
+        frames can be reconstructed off the GUI thread.
+
+        Returns
+        -------
+        Settings : dictionary
+            The stack, its spec and the reconstruction options, with key,
+            their digest, for the frame cache, and the study they are for.
+
+        """
+        zeroFill = self._zeroFillSize()
+        spec = filt.stackSpec(self.filterStack)
+        options = {'oversample': self.oversampling,
+                   'zerofill': zeroFill,
+                   'partial': self.partialFourier if self.lines else None,
+                   'coils': self.coilMethod if self.receivers > 1 else None,
+                   'average': 'complex' if self.average else None,
+                   'register': self.shifts is not None}
+        if self.rawKspace is not None:
+            # the frames of a 3D study depend on the partitions shown
+            options['volume'] = self.volumeSpec
+        return {'stack': list(self.filterStack),
+                'spec': spec,
+                'options': options,
+                'key': result_cache.resultKey('', spec, Options=options),
+                'zeroFill': zeroFill,
+                'plan': partial_fourier.plan(np.shape(self.data)[-2:],
+                                             self.lines, self.partialFourier),
+                'whitener': self.whitener,
+                'coilMethod': self.coilMethod,
+                'gridding': self.gridding,
+                'study': self.studyGeneration,
+                'studyHash': self.studyHash}
+
+    def _frameResults(self, Frame, Settings, Data=None):
+        """
+        Reconstructs a frame, run on the GUI or the prefetch thread.
+
+        Parameters
+        ----------
+        Frame : tuple
+            The (rep, slice, echo) index of the frame.
+
+        Settings : dictionary
+            See :meth:`_settings`.
+
+        Data : array, optional
+            The k-space of the frame, see :meth:`_frameData`. Read from the
+            study by default.
+
+        Returns
+        -------
+        Arrays : dictionary
+            See :func:`result_cache.derived`.
+
+        """
+        data = self._frameData(Frame) if Data is None else Data
+        # reuse the frame if this study and stack were reconstructed before
+        key = None
+        results = None
+        studyHash = Settings['studyHash']
+        if studyHash is not None:
+            options = dict(Settings['options'], frame=Frame)
+            key = result_cache.resultKey(studyHash, Settings['spec'],
+                                         Options=options)
+            results = self.resultCache.get(key)
+        if results is not None:
+            return results
+        # room for the filtered k-space and image, at double precision
+        # while they are built
+        zeroFill = Settings['zeroFill']
+        memory_budget.governor().reserve(
+            4*max(np.size(data), np.prod(zeroFill or 1))*16,
+            memory_budget.PRIORITY_DISPLAY)
+        # apply all of the filters and reconstruct
+        if Settings['whitener'] is None:
+            datafilt, image = recon.reconstructFrame(
+                data, Settings['stack'], zeroFill, Settings['plan'],
+                Settings['gridding'], tuple(Frame))
+        else:
+            datafilt, image = recon.combineFrame(
+                data, Settings['stack'], Settings['whitener'],
+                Settings['coilMethod'], zeroFill, Settings['plan'],
+                Settings['gridding'], tuple(Frame))
+        results = result_cache.derived(image, datafilt)
+        # a frame read after another study was opened is not this study's
+        if key is not None and Settings['study'] == self.studyGeneration:
+            self.resultCache.put(key, results)
+        return results
+
     def updateAll(self):
         """
         Refreshes all of the displays with the current data and color maps
@@ -177,11 +871,25 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         if self.data == []:
             return
 
-        # apply all of the filters
-        self.datafilt = filt.applyStack(self.data, self.filterStack)
-
-        self.image = np.fft.ifftshift(np.fft.ifft2(
-            np.fft.ifftshift(self.datafilt)))
+        settings = self._settings()
+        self.frameCache.setSettings(settings['key'])
+        misses = self.frameCache.misses
+        data = self.data
+        results = self.frameCache.get(
+            self.frame,
+            lambda frame: self._frameResults(frame, settings, data))
+        if self.frameCache.misses != misses:
+            # reconstructed just now, rather than a prefetched frame
+            self._showConvergence()
+        self.datafilt = results['datafilt']
+        self.image = results['image']
+        self.imageVersion += 1
+        self.imageFrame = self.frame
+        # keep any displayed masks in step with the new image
+        if self.magnitudeImage.mask is not None:
+            self.magnitudeImage.mask = self._currentMask()
+        if self.phaseImage.mask is not None:
+            self.phaseImage.mask = self._currentMask()
         # Display the kspace data
         self.kspace.imshow(np.abs(self.datafilt), self.CMaps['kspace'],
                            self.aspectRatio)
@@ -189,11 +897,29 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.kspacePhase.imshow(np.angle(self.datafilt), self.CMaps['kphase'],
                                 self.aspectRatio)
         # display the Image
-        self.magnitudeImage.imshow(np.abs(self.image), self.CMaps['mag'],
-                                   self.aspectRatio)
+        aspect = self._imageAspect(np.shape(results['magnitude']))
+        self.magnitudeImage.imshow(results['magnitude'], self.CMaps['mag'],
+                                   aspect)
         # display the phase map
-        self.phaseImage.imshow(np.angle(self.image), self.CMaps['phase'],
-                               self.aspectRatio)
+        self.phaseImage.imshow(results['phase'], self.CMaps['phase'], aspect)
+        # the neighbours are reconstructed while this frame is looked at
+        self.frameCache.prefetch(
+            self.frame, self.navigatorAxis, self._frameShape(),
+            lambda frame: self._frameResults(frame, settings))
+
+    def _showConvergence(self):
+        """ Puts the convergence of a compressed sensing stage on show """
+        telemetry = compressed_sensing.lastTelemetry()
+        if telemetry is None or not any(
+                stage.params['Type'] == 'Compressed Sensing'
+                for stage in self.filterStack):
+            return
+        self.statusBar().showMessage(
+            'Compressed sensing (%s): %d iterations, change %.2g%s, %.2f s'
+            % (telemetry['method'], telemetry['iterations'],
+               telemetry['change'][-1] if telemetry['change'] else 0,
+               '' if telemetry['converged'] else ' (not converged)',
+               telemetry['seconds']))
 
     @QtCore.pyqtSlot(int)
     def dataExplorerToggle(self):
@@ -238,6 +964,7 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
     @QtCore.pyqtSlot(int)
     def _plotClick(self, Event, DataPoint, PlotPoint):
         """ QT slot that handles clicks to place markers on paired plots"""
+        self._reconstructShown()
         if (Event.canvas == self.magnitudeImage):
             self.iMag.setText(str(np.abs(self.image[DataPoint])))
             self.iPhase.setText(str(np.angle(self.image[DataPoint])))
@@ -276,25 +1003,47 @@ class MainWindow(QtGui.QMainWindow, Ui_MainWindow):
         self.kMag.setText(' ')
         self.kPhase.setText(' ')
 
+    def _reconstructShown(self):
+        """
+        Brings image and datafilt up to the frame on screen.
+
+        A cine step only copies the frame's RGBA image to the screen, so the
+        frame under the movie is reconstructed when its values are read.
+
+        """
+        if self.cineResults is None or self.imageFrame == self.frame:
+            return
+        results = self.cineResults(self.frame)
+        self.datafilt = results['datafilt']
+        self.image = results['image']
+        self.imageVersion += 1
+        self.imageFrame = self.frame
+
+    def _currentMask(self):
+        """ Returns the cached mask for the current image """
+        return self.maskCache.get(self.image, self.imageVersion)
+
     @QtCore.pyqtSlot()
     def maskPhase(self):
         """ QT slot that toggles the mask for the phase map """
         if self.phaseImage.mask is None:
-            self.phaseImage.setMask(Mask=filt.mask(self.image))
+            self.phaseImage.setMask(Mask=self._currentMask())
         else:
-            self.phaseImage.setMask(None)
+            self.phaseImage.removeMask()
 
     @QtCore.pyqtSlot()
     def maskImage(self):
         """ QT slot that toggles the mask for the image """
         if self.magnitudeImage.mask is None:
-            self.magnitudeImage.setMask(Mask=filt.mask(self.image))
+            self.magnitudeImage.setMask(Mask=self._currentMask())
         else:
             self.magnitudeImage.removeMask()
 
     @QtCore.pyqtSlot(int)
     def exitProg(self):
         """ QT slot that exits the program"""
+        if self.watcher is not None:
+            self.watcher.stop()
         self.close()
 
 
@@ -0,0 +1,286 @@
+"""
+.. py:module:: partial_fourier
+Partial Fourier Module
+======================
+
+Reconstruction of studies that only acquire a little over half of the
+phase-encode lines. Simply zero-filling the missing lines halves the
+resolution along the phase-encode direction, instead the missing half is
+recovered from the conjugate symmetry of k-space:
+
+* homodyne: the acquired asymmetric side is weighted up by a ramp through
+  the symmetric centre, and the image is demodulated by a phase estimated
+  from the symmetric centre lines alone.
+* POCS: starting from the zero-filled image, the magnitude is given the low
+  resolution phase and transformed back, and the acquired lines are put
+  back, for a fixed number of iterations.
+
+The acquired lines are found from the nv and fract_ky parameters, where
+fract_ky is the number of lines acquired on the short side of the centre.
+The plans work on any number of leading axes, so all of the slices of a
+frame are done in one call, and keep the weights, phase window and FFT
+shift signs for each frame size so they are only built once.
+
+"""
+
+import threading
+
+import numpy as np
+from scipy import fft as spfft
+
+import memory_budget
+from fid_reader import procparValue
+
+
+# partial Fourier reconstruction methods
+METHODS = ('zerofill', 'homodyne', 'pocs')
+
+# iterations used by the POCS method
+POCS_ITERATIONS = 5
+
+
+def acquiredLines(Procpar, Lines):
+    """
+    Finds the phase-encode lines a partial Fourier study acquires.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary of the study.
+
+    Lines : int
+        Number of phase-encode lines in the decoded frames.
+
+    Returns
+    -------
+    Lines : tuple or None
+        (full, start, stop), the size of the full matrix and the rows of it
+        that were acquired, or None if the study is not partial Fourier or
+        the frames do not match the parameters.
+
+    """
+    nv = procparValue(Procpar, 'nv')
+    fract = procparValue(Procpar, 'fract_ky')
+    if not isinstance(nv, float) or not isinstance(fract, float):
+        return None
+    full = int(nv)
+    acquired = full//2+int(fract)
+    if acquired >= full or fract < 1 or Lines not in (acquired, full):
+        return None
+    # the short side of the centre is the start of k-space
+    return full, full-acquired, full
+
+
+def padLines(Kspace, Lines):
+    """
+    Places the acquired lines of a frame in the full matrix.
+
+    Parameters
+    ----------
+    Kspace : array
+        The (..., phase-encode, readout) k-space as decoded.
+
+    Lines : tuple or None
+        The :func:`acquiredLines` of the study.
+
+    Returns
+    -------
+    Kspace : array
+        The k-space with the full number of phase-encode lines, the missing
+        ones zero, or Kspace unchanged if it is already full size.
+
+    """
+    if Lines is None or np.shape(Kspace)[-2] == Lines[0]:
+        return Kspace
+    full, start, stop = Lines
+    shape = np.shape(Kspace)
+    out = np.zeros(shape[:-2]+(full, shape[-1]), dtype=np.complex64)
+    out[..., start:stop, :] = Kspace
+    return out
+
+
+class HomodynePlan(object):
+    """
+    Partial Fourier reconstruction of frames of one size.
+
+    Parameters
+    ----------
+    Dim : tuple
+        Size of the full (phase-encode, readout) frames.
+
+    Start : int
+        First acquired phase-encode row.
+
+    Stop : int
+        One past the last acquired phase-encode row. The acquired rows must
+        extend past the centre on both sides.
+
+    Iterations : int, optional
+        POCS iterations. Defaults to 0, a homodyne reconstruction.
+
+    """
+    def __init__(self, Dim, Start, Stop, Iterations=0):
+        self.dim = tuple(Dim)
+        self.start = Start
+        self.stop = Stop
+        self.iterations = Iterations
+        rows = self.dim[0]
+        centre = rows//2
+        # half width of the symmetrically sampled centre
+        half = min(centre-Start, Stop-centre)
+        if half < 1:
+            raise ValueError('rows %d to %d of %d do not cover the centre'
+                             % (Start, Stop, rows))
+        offset = np.arange(rows)-centre
+        acquired = (np.arange(rows) >= Start) & (np.arange(rows) < Stop)
+        # the ramp weights a line and its conjugate to a total of 2
+        side = 1 if Start > rows-Stop else -1
+        ramp = np.clip(1+side*offset/float(half), 0, 2)*acquired
+        window = np.where(np.abs(offset) < half,
+                          0.5*(1+np.cos(np.pi*offset/float(half))), 0)
+        self.acquired = acquired[:, None]
+        self.ramp = ramp[:, None].astype(np.float32)
+        self.window = window[:, None].astype(np.float32)
+        # for even sizes the FFT shifts are a checkerboard sign on the input
+        # and output, with an overall sign of (-1)**(n/2) per axis
+        self.even = all(size % 2 == 0 for size in self.dim)
+        if self.even:
+            sign = np.outer(1-2*(np.arange(self.dim[0]) % 2),
+                            1-2*(np.arange(self.dim[1]) % 2))
+            self.sign = sign.astype(np.complex64)
+            self.outSign = (self.sign *
+                            (-1)**(self.dim[0]//2+self.dim[1]//2))
+
+    def memoryUsage(self):
+        """ Bytes held by the weights and signs """
+        return memory_budget.residentBytes(
+            self.ramp, self.window, getattr(self, 'sign', None),
+            getattr(self, 'outSign', None))
+
+    def _centred(self, Data, Inverse=True, Work=None):
+        """
+        Centred 2D FFT of the last two axes, reusing Work when given.
+
+        """
+        axes = (-2, -1)
+        function = spfft.ifft2 if Inverse else spfft.fft2
+        if not self.even:
+            shift = np.fft.ifftshift if Inverse else np.fft.fftshift
+            return shift(function(shift(Data, axes=axes), axes=axes,
+                                  workers=-1), axes=axes)
+        if Work is None:
+            Work = np.empty(np.shape(Data), dtype=np.complex64)
+        np.multiply(Data, self.sign, out=Work)
+        out = function(Work, axes=axes, overwrite_x=True, workers=-1)
+        out *= self.outSign
+        return out
+
+    def phase(self, Kspace):
+        """
+        Returns the unit phasor of the low resolution image.
+
+        Parameters
+        ----------
+        Kspace : array
+            Full size (..., phase-encode, readout) k-space.
+
+        Returns
+        -------
+        Phase : array of complex
+            exp(i*phi) of the image of the symmetric centre lines.
+
+        """
+        lowres = self._centred(Kspace*self.window)
+        magnitude = np.abs(lowres)
+        lowres /= np.where(magnitude > 0, magnitude, 1)
+        return lowres
+
+    def transform(self, Kspace):
+        """
+        Reconstructs partial Fourier frames.
+
+        Parameters
+        ----------
+        Kspace : array
+            Full size (..., phase-encode, readout) k-space, the missing
+            lines are ignored.
+
+        Returns
+        -------
+        Image : array of complex64
+            The images, with the magnitude of the partial Fourier
+            reconstruction and the low resolution phase.
+
+        """
+        Kspace = np.asarray(Kspace)
+        work = np.empty(np.shape(Kspace), dtype=np.complex64)
+        phase = self.phase(Kspace)
+        if self.iterations < 1:
+            image = self._centred(Kspace*self.ramp, Work=work)
+            image *= np.conj(phase)
+            return (image.real*phase).astype(np.complex64)
+        measured = Kspace*self.acquired
+        estimate = measured
+        for _ in range(self.iterations):
+            image = self._centred(estimate, Work=work)
+            image = np.abs(image)*phase
+            estimate = self._centred(image, Inverse=False, Work=work)
+            estimate = np.where(self.acquired, measured, estimate)
+        return self._centred(estimate, Work=work).astype(np.complex64)
+
+    def kspace(self, Image):
+        """ Returns the centred k-space of reconstructed images """
+        return self._centred(Image, Inverse=False).astype(np.complex64)
+
+
+class _PlanCache(dict):
+    """ Partial Fourier plans, keyed by frame size, rows and iterations """
+    def memoryUsage(self):
+        """ Bytes held by the plans """
+        return sum(plan.memoryUsage() for plan in list(self.values()))
+
+    def release(self, Bytes):
+        """ Drops the plans when the memory governor needs the space """
+        freed = self.memoryUsage()
+        self.clear()
+        return freed
+
+
+_PLANS = _PlanCache()
+_PLAN_LOCK = threading.Lock()
+memory_budget.governor().register(_PLANS, 'partial Fourier plans',
+                                  memory_budget.PRIORITY_DERIVED)
+
+
+def plan(Dim, Lines, Method='homodyne'):
+    """
+    Returns the reconstruction plan for a study's frames.
+
+    Parameters
+    ----------
+    Dim : tuple
+        Size of the full (phase-encode, readout) frames.
+
+    Lines : tuple or None
+        The :func:`acquiredLines` of the study.
+
+    Method : string, optional
+        One of :data:`METHODS`. Defaults to 'homodyne'.
+
+    Returns
+    -------
+    Plan : :class:`HomodynePlan` or None
+        The cached plan, or None if the frames are not partial Fourier or
+        the method is 'zerofill', which is the plain reconstruction.
+
+    """
+    if Method not in METHODS:
+        raise ValueError('unknown partial Fourier method %r' % (Method,))
+    if Lines is None or Method == 'zerofill':
+        return None
+    iterations = POCS_ITERATIONS if Method == 'pocs' else 0
+    key = (tuple(Dim), Lines[1], Lines[2], iterations)
+    with _PLAN_LOCK:
+        if key not in _PLANS:
+            _PLANS[key] = HomodynePlan(Dim, Lines[1], Lines[2], iterations)
+        return _PLANS[key]
@@ -0,0 +1,796 @@
+"""
+.. py:module:: recon
+Reconstruction Module
+=====================
+
+Qt free image reconstruction. Removes any readout oversampling, applies a
+filter stack to the k-space of each frame, removes the DC offset, and
+inverse Fourier transforms the result into a complex image, with a
+homodyne or POCS reconstruction for partial Fourier studies. Radial and
+spiral studies are gridded instead, see :mod:`gridding`, and the
+partitions of 3D studies are transformed on disk first, see :mod:`volume`,
+so they are reconstructed as slices. The coils of
+multi-receiver studies are prewhitened and combined one frame at a time,
+see :mod:`coils`. The repetitions of multi-average studies can be averaged
+as they are decoded, see :mod:`averaging`, after they are registered to
+correct for motion, see :mod:`registration`. This is the
+same reconstruction that the main window does, pulled out so it can be used
+from scripts and on headless machines.
+
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import fft as spfft
+
+import averaging
+import coils
+import filters as filt
+import fid_cache
+import gridding
+import memory_budget
+import partial_fourier
+import registration
+import volume
+from fid_reader import procparValue, receiverCount
+
+
+# largest zero-fill, as a multiple of the acquired matrix
+MAX_ZERO_FILL = 4
+
+
+def aspectRatio(Procpar):
+    """
+    Computes the display aspect ratio of an image.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary of the study.
+
+    Returns
+    -------
+    Aspect : float
+        The ratio of the phase-encode to readout pixel sizes, built from the
+        lpe, lro, nv and np parameters. Square pixels are assumed if any of
+        them are missing.
+
+    """
+    values = [procparValue(Procpar, name) for name in
+              ('lpe', 'lro', 'nv', 'np')]
+    if None in values:
+        return 1.0
+    lpe, lro, nv, points = values
+    # the displayed readout has any oversampling removed
+    points = points/readoutOversampling(Procpar)
+    return (lpe/lro)*(2*nv/points)
+
+
+def readoutOversampling(Procpar):
+    """
+    Returns the readout oversampling factor of a study.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary of the study.
+
+    Returns
+    -------
+    Factor : float
+        The oversample parameter, or 1 if it is missing or not above 1.
+
+    """
+    factor = procparValue(Procpar, 'oversample', 1.0)
+    if not isinstance(factor, float) or factor <= 1.0:
+        return 1.0
+    return factor
+
+
+def fovPoints(Points, Factor):
+    """ Number of readout points left once oversampling is removed """
+    return max(1, min(Points, int(round(Points/Factor))))
+
+
+def frameSize(Procpar, Shape, Oversampling=None):
+    """
+    Returns the size of the frames that are filtered and transformed.
+
+    Parameters
+    ----------
+    Procpar : dictionary
+        The parameter dictionary of the study.
+
+    Shape : tuple
+        Shape of the decoded k-space, the last two axes are the
+        phase-encode lines and readout points.
+
+    Oversampling : float, optional
+        Readout oversampling removed from the frames. Defaults to the
+        study's :func:`readoutOversampling`.
+
+    Returns
+    -------
+    Dim : tuple
+        The (phase-encode, readout) size once the readout oversampling is
+        removed and any partial Fourier lines are filled out, see
+        :func:`partial_fourier.acquiredLines`. The spokes or interleaves of
+        a non-Cartesian study are filtered as they were acquired.
+
+    """
+    if gridding.trajectoryType(Procpar) is not None:
+        return tuple(Shape[-2:])
+    if Oversampling is None:
+        Oversampling = readoutOversampling(Procpar)
+    lines = partial_fourier.acquiredLines(Procpar, Shape[-2])
+    return (Shape[-2] if lines is None else lines[0],
+            fovPoints(Shape[-1], Oversampling))
+
+
+def removeOversampling(Kspace, Factor):
+    """
+    Crops an oversampled readout down to the prescribed field of view.
+
+    The readout direction is inverse Fourier transformed, cropped to the
+    centre 1/Factor of the field of view, and transformed back, so every
+    later filter, the 2D FFT and the displays work on the smaller array.
+    The image of the result is exactly the centre of the full image.
+
+    The filters work on k-space, so the crop cannot be folded into the
+    image transform at the end: the readout is transformed out and back
+    once more. That costs an inverse FFT of the full readout and an FFT of
+    the cropped one per line, about what the readout half of the final
+    ifft2 saves on the narrower frame, so the FFT work is roughly unchanged
+    and the gain is in the filters, the phase-encode FFT, the memory and
+    the displays, which all see 1/Factor of the points. The crop and the
+    centring shifts between the two transforms are done in one gather, and
+    the transforms run in single precision.
+
+    Parameters
+    ----------
+    Kspace : array
+        Centred k-space with the readout on the last axis. Any number of
+        leading axes are cropped together.
+
+    Factor : float
+        The oversampling factor, see :func:`readoutOversampling`.
+
+    Returns
+    -------
+    Kspace : array of complex64
+        The k-space with :func:`fovPoints` readout points, or Kspace
+        unchanged if Factor is 1.
+
+    """
+    points = np.shape(Kspace)[-1]
+    keep = fovPoints(points, Factor)
+    if keep == points:
+        return Kspace
+    # the centre pixel of the image stays the centre pixel of the crop
+    start = points//2-keep//2
+    lines = spfft.ifft(spfft.ifftshift(np.asarray(Kspace, np.complex64),
+                                       axes=-1), axis=-1, overwrite_x=True,
+                       workers=-1)
+    # the centre keep points of the centred image, in the uncentred order
+    # the forward FFT takes
+    index = (start+(np.arange(keep)-keep//2) % keep+points//2) % points
+    lines = spfft.fft(np.take(lines, index, axis=-1), axis=-1,
+                      overwrite_x=True, workers=-1)
+    return spfft.fftshift(lines, axes=-1)
+
+
+def defaultStack(Dim=None):
+    """
+    Returns the stack applied when no other filters have been configured.
+
+    Parameters
+    ----------
+    Dim : tuple, optional
+        Size of the k-space frames. Not used by the default filters.
+
+    Returns
+    -------
+    Stack : list of :class:`filters.GFilter`\s
+        A DC offset correction.
+
+    """
+    return [filt.makeDCO(Size=10)]
+
+
+def transform(Kspace):
+    """
+    Transforms centred k-space into a centred complex image.
+
+    Parameters
+    ----------
+    Kspace : array
+        Frequency domain data, the last two axes are transformed.
+
+    Returns
+    -------
+    Image : array of complex
+        The shifted inverse 2D Fourier transform of Kspace.
+
+    """
+    axes = (-2, -1)
+    return np.fft.ifftshift(np.fft.ifft2(np.fft.ifftshift(Kspace, axes=axes),
+                                         axes=axes), axes=axes)
+
+
+def forwardTransform(Image):
+    """
+    Transforms a centred image back into centred k-space.
+
+    Parameters
+    ----------
+    Image : array
+        The image, the last two axes are transformed.
+
+    Returns
+    -------
+    Kspace : array of complex
+        The inverse of :func:`transform`.
+
+    """
+    axes = (-2, -1)
+    return np.fft.fftshift(np.fft.fft2(np.fft.fftshift(Image, axes=axes),
+                                       axes=axes), axes=axes)
+
+
+def zeroFillSize(Dim, Factor=2, Minimum=None):
+    """
+    Chooses the matrix size a frame is zero-filled to.
+
+    Parameters
+    ----------
+    Dim : tuple
+        Size of the acquired (phase-encode, readout) frame.
+
+    Factor : float, optional
+        Interpolation factor. Defaults to 2.
+
+    Minimum : tuple, optional
+        Smallest size wanted, e.g. the pixel size of the display.
+
+    Returns
+    -------
+    Target : tuple
+        For each axis the next even size that the FFT is fast for, at least
+        Factor times the frame and Minimum, but at most
+        :data:`MAX_ZERO_FILL` times the frame.
+
+    """
+    if Minimum is None:
+        Minimum = (0,)*len(Dim)
+    target = []
+    for size, least in zip(Dim, Minimum):
+        wanted = max(int(np.ceil(size*Factor)), int(least), size)
+        length = spfft.next_fast_len(min(wanted, size*MAX_ZERO_FILL))
+        while length % 2:
+            length = spfft.next_fast_len(length+1)
+        target.append(length)
+    return tuple(target)
+
+
+def zeroFillAspect(Aspect, Dim, Target):
+    """
+    Returns the aspect ratio of a zero-filled image.
+
+    The axes are padded by different factors, so the pixels change shape.
+
+    Parameters
+    ----------
+    Aspect : float
+        The aspect ratio of the frame, see :func:`aspectRatio`.
+
+    Dim : tuple
+        Size of the (phase-encode, readout) image before zero-filling.
+
+    Target : tuple
+        Its size after, see :func:`zeroFillSize`.
+
+    Returns
+    -------
+    Aspect : float
+        The aspect ratio of the zero-filled image.
+
+    """
+    return Aspect*(float(Target[0])/Dim[0])/(float(Target[1])/Dim[1])
+
+
+class ZeroFillPlan(object):
+    """
+    Zero-filled 2D reconstruction into a fixed matrix size.
+
+    The padded k-space buffer is allocated and zeroed once. Each frame only
+    writes its own points, straight into the corners that the input FFT
+    shift would move them to, and the output shift is folded into the same
+    write as a checkerboard sign. So a zero-filled image costs one scatter
+    and one FFT of the padded size, with no shift or padding copies.
+
+    Parameters
+    ----------
+    Dim : tuple
+        Size of the (phase-encode, readout) frames.
+
+    Target : tuple
+        Size of the interpolated images, even along each axis and no
+        smaller than Dim, see :func:`zeroFillSize`.
+
+    """
+    def __init__(self, Dim, Target):
+        self.dim = tuple(Dim)
+        self.target = tuple(Target)
+        if any(size < frame or size % 2 for size, frame in
+               zip(self.target, self.dim)):
+            raise ValueError('cannot zero-fill %s to %s' % (self.dim,
+                                                            self.target))
+        self.buffer = np.zeros(self.target, dtype=np.complex64)
+        # the centre of the frame goes to the centre of the padded matrix,
+        # and from there to where ifftshift would move it
+        self.index = []
+        signs = []
+        for frame, size in zip(self.dim, self.target):
+            padded = np.arange(frame)+size//2-frame//2
+            shifted = (padded-size//2) % size
+            self.index.append(shifted)
+            signs.append(1-2*(shifted % 2))
+        # the output ifftshift is a (-1)**k modulation of the input, and the
+        # larger FFT is scaled back to the intensities of the plain recon
+        scale = float(np.prod(self.target))/np.prod(self.dim)
+        self.weights = (np.outer(signs[0], signs[1])*scale).astype(
+            np.complex64)
+        self.index = np.ix_(*self.index)
+        self._lock = threading.Lock()
+
+    def memoryUsage(self):
+        """ Bytes held by the padded buffer """
+        return memory_budget.residentBytes(self.buffer, self.weights)
+
+    def transform(self, Kspace):
+        """
+        Zero-fills and transforms one frame.
+
+        Parameters
+        ----------
+        Kspace : 2D array
+            Centred (phase-encode, readout) k-space of size Dim.
+
+        Returns
+        -------
+        Image : 2D array of complex64
+            The interpolated image, of size Target.
+
+        """
+        with self._lock:
+            self.buffer[self.index] = Kspace*self.weights
+            return spfft.ifft2(self.buffer, workers=-1)
+
+
+class _PlanCache(dict):
+    """ Zero-fill plans, keyed by (frame size, target size) """
+    def memoryUsage(self):
+        """ Bytes held by the plans """
+        return sum(plan.memoryUsage() for plan in list(self.values()))
+
+    def release(self, Bytes):
+        """ Drops the plans when the memory governor needs the space """
+        freed = self.memoryUsage()
+        self.clear()
+        return freed
+
+
+_PLANS = _PlanCache()
+memory_budget.governor().register(_PLANS, 'zero-fill plans')
+
+
+def zeroFillPlan(Dim, Target):
+    """ Returns the cached :class:`ZeroFillPlan` for a frame and target """
+    key = (tuple(Dim), tuple(Target))
+    plan = _PLANS.get(key)
+    if plan is None:
+        memory_budget.governor().reserve(int(np.prod(Target))*8)
+        plan = _PLANS[key] = ZeroFillPlan(Dim, Target)
+    return plan
+
+
+def transformFrames(Datafilt, ZeroFill=None, PartialFourier=None,
+                    Gridding=None):
+    """
+    Transforms filtered k-space into images.
+
+    Parameters
+    ----------
+    Datafilt : array
+        The filtered (..., phase-encode, readout) k-space.
+
+    ZeroFill : tuple, optional
+        Size the k-space is zero-filled to before the transform, see
+        :func:`zeroFillSize`. Defaults to no zero-filling.
+
+    PartialFourier : :class:`partial_fourier.HomodynePlan`, optional
+        Reconstructs the frames from partial Fourier data, see
+        :func:`partial_fourier.plan`. Defaults to a plain transform.
+
+    Gridding : :class:`gridding.GriddingPlan`, optional
+        Reconstructs the frames of a non-Cartesian study, see
+        :func:`gridding.plan`. Defaults to a plain transform.
+
+    Returns
+    -------
+    Image : array of complex
+        The reconstructed images, of size ZeroFill if it was given.
+
+    """
+    if Gridding is not None:
+        image = Gridding.transform(Datafilt)
+        if ZeroFill is None or tuple(ZeroFill) == image.shape[-2:]:
+            return image
+        # zero-fill the Cartesian k-space of the gridded image
+        Datafilt = forwardTransform(image)
+    shape = np.shape(Datafilt)
+    fill = ZeroFill is not None and tuple(ZeroFill) != shape[-2:]
+    if PartialFourier is not None:
+        image = PartialFourier.transform(Datafilt)
+        if not fill:
+            return image
+        # zero-fill the k-space of the partial Fourier image
+        Datafilt = PartialFourier.kspace(image)
+    elif not fill:
+        return transform(Datafilt)
+    plan = zeroFillPlan(shape[-2:], ZeroFill)
+    if len(shape) == 2:
+        return plan.transform(Datafilt)
+    image = np.empty(shape[:-2]+tuple(ZeroFill), dtype=np.complex64)
+    for index in np.ndindex(*shape[:-2]):
+        image[index] = plan.transform(Datafilt[index])
+    return image
+
+
+def reconstructFrame(Kspace, Stack, ZeroFill=None, PartialFourier=None,
+                     Gridding=None, Frame=None):
+    """
+    Filters and reconstructs a single 2D frame.
+
+    Parameters
+    ----------
+    Kspace : 2D array
+        The raw (phase-encode, readout) data, with any partial Fourier lines
+        filled out by :func:`partial_fourier.padLines`.
+
+    Stack : 1D array :class:`filters.GFilter`\s
+        Filters applied before the Fourier transform.
+
+    ZeroFill : tuple, optional
+        Size the filtered k-space is zero-filled to before the transform,
+        see :func:`zeroFillSize`. Defaults to no zero-filling.
+
+    PartialFourier : :class:`partial_fourier.HomodynePlan`, optional
+        Partial Fourier reconstruction, see :func:`transformFrames`.
+
+    Gridding : :class:`gridding.GriddingPlan`, optional
+        Non-Cartesian reconstruction, see :func:`transformFrames`.
+
+    Frame : tuple, optional
+        The (rep, slice, echo) of the frame, see :func:`filters.applyStack`.
+
+    Returns
+    -------
+    Datafilt : 2D array
+        The filtered k-space.
+
+    Image : 2D array of complex
+        The reconstructed image, of size ZeroFill if it was given.
+
+    """
+    datafilt = filt.applyStack(Kspace, Stack, Frame)
+    return datafilt, transformFrames(datafilt, ZeroFill, PartialFourier,
+                                     Gridding)
+
+
+def combineFrame(Kspace, Stack, Whitener=None, Method='rss', ZeroFill=None,
+                 PartialFourier=None, Gridding=None, Frame=None):
+    """
+    Filters, reconstructs and combines the coils of a single frame.
+
+    Parameters
+    ----------
+    Kspace : 3D array
+        The raw (coil, phase-encode, readout) data, see
+        :func:`coils.coilFrame`.
+
+    Stack : 1D array :class:`filters.GFilter`\s
+        Filters applied to each coil before the Fourier transform.
+
+    Whitener : 2D array, optional
+        The :func:`coils.whitener` of the study. Defaults to none.
+
+    Method : string, optional
+        The coil combination, one of :data:`coils.METHODS`. Defaults to
+        'rss'.
+
+    ZeroFill : tuple, optional
+        Size the images are zero-filled to, see :func:`transformFrames`.
+
+    PartialFourier : :class:`partial_fourier.HomodynePlan`, optional
+        Partial Fourier reconstruction, see :func:`transformFrames`.
+
+    Gridding : :class:`gridding.GriddingPlan`, optional
+        Non-Cartesian reconstruction, see :func:`transformFrames`.
+
+    Frame : tuple, optional
+        The (rep, slice, echo) of the frame, see :func:`filters.applyStack`.
+
+    Returns
+    -------
+    Datafilt : 2D array
+        The k-space of the combined image.
+
+    Image : 2D array of complex64
+        The combined image.
+
+    """
+    if Whitener is not None:
+        Kspace = coils.prewhiten(Kspace, Whitener)
+    datafilt = filt.applyCoilStack(Kspace, Stack, Frame)
+    image = coils.combine(transformFrames(datafilt, ZeroFill,
+                                          PartialFourier, Gridding), Method)
+    return forwardTransform(image).astype(np.complex64), image
+
+
+class Reconstruction(object):
+    """
+    Holds the result of reconstructing a study
+
+    Parameters
+    ----------
+    Dic : Dictionary
+        Header fields and procpar of the study.
+
+    Datafilt : array
+        The filtered (block, slice, echo, phase-encode, readout) k-space.
+
+    Image : array
+        The matching complex images.
+
+    Spec : list of Dictionaries
+        The filter stack as returned by :func:`filters.stackSpec`.
+
+    """
+    def __init__(self, Dic, Datafilt, Image, Spec):
+        self.dic = Dic
+        self.procpar = Dic['procpar']
+        self.datafilt = Datafilt
+        self.image = Image
+        self.spec = Spec
+        self.aspectRatio = aspectRatio(self.procpar)
+
+
+def reconstructFrames(FIDPath, Stack=None, Workers=None, Oversampling=None,
+                      ZeroFill=None, PartialFourier='homodyne', Coils='rss',
+                      Noise=None, Average=None, Register=False):
+    """
+    Reconstructs a study one frame at a time.
+
+    Parameters
+    ----------
+    FIDPath : string
+        The top level \*.fid folder.
+
+    Stack : 1D array :class:`filters.GFilter`\s or list of Dictionaries
+        Filters applied to each frame, either as filter objects or as the
+        output of :func:`filters.stackSpec`, which is rebuilt for the size of
+        the frames. Defaults to :func:`defaultStack`.
+
+    Workers : int, optional
+        Number of threads used to decode the FID, and to reconstruct the
+        slices of multi-receiver studies.
+
+    Oversampling : float, optional
+        Readout oversampling removed from each frame before it is filtered,
+        see :func:`removeOversampling`. Defaults to the study's
+        :func:`readoutOversampling`.
+
+    ZeroFill : float, optional
+        Interpolation factor, the images are zero-filled to
+        :func:`zeroFillSize` of the frame. Defaults to none.
+
+    PartialFourier : string, optional
+        How partial Fourier studies are reconstructed, one of
+        :data:`partial_fourier.METHODS`. Defaults to 'homodyne'. The slices
+        of each (block, echo) are reconstructed together, as they are for
+        radial and spiral studies, which are gridded, see
+        :func:`gridding.plan`.
+
+    Coils : string, optional
+        How the coils of multi-receiver studies are combined, one of
+        :data:`coils.METHODS`. Defaults to 'rss'.
+
+    Noise : 2D array, optional
+        (coil, sample) noise scan used to prewhiten the coils. Defaults to
+        the k-space corners of the first block.
+
+    Average : string, optional
+        Averages the repetitions into a single block, one of
+        :data:`averaging.METHODS`: 'complex' averages the k-space as it is
+        decoded, 'magnitude' the images. Phase correction and outlier
+        rejection are on, see :class:`averaging.Averager`. Defaults to no
+        averaging.
+
+    Register : bool, optional
+        Corrects the motion of each repetition from the first before the
+        stack is applied, see :func:`registration.studyShifts`. Defaults to
+        False.
+
+    Yields
+    ------
+    dic : dictionary
+        Header fields and procpar of the study, yielded once first, along
+        with the leading (block, slice, echo) shape and the stack used.
+
+    Frame : tuple
+        The (block, slice, echo) index, the filtered k-space and the complex
+        image of each frame in turn.
+
+    Raises
+    ------
+    ValueError
+        If Register is set for a partial Fourier or non-Cartesian study.
+
+    """
+    if Average == 'magnitude':
+        frames = reconstructFrames(FIDPath, Stack, Workers, Oversampling,
+                                   ZeroFill, PartialFourier, Coils, Noise,
+                                   Register=Register)
+        for frame in averaging.averageMagnitudes(frames, forwardTransform):
+            yield frame
+        return
+    dic, data = fid_cache.readFID(FIDPath, Workers)
+    if Oversampling is None:
+        Oversampling = readoutOversampling(dic['procpar'])
+    dim = frameSize(dic['procpar'], data.shape, Oversampling)
+    lines = partial_fourier.acquiredLines(dic['procpar'], data.shape[-2])
+    plan = partial_fourier.plan(dim, lines, PartialFourier)
+    grid = gridding.plan(dic['procpar'], data.shape, Oversampling)
+    if grid is not None:
+        # the spokes are filtered and gridded with any oversampling, and
+        # the images come out the size of the trajectory's matrix
+        Oversampling = 1.0
+    if Stack is None:
+        Stack = defaultStack(dim)
+    elif len(Stack) > 0 and isinstance(Stack[0], dict):
+        Stack = filt.buildStack(Stack, dim)
+    if volume.isVolume(dic['procpar']):
+        # the partitions are transformed in slabs, after which they are
+        # reconstructed as slices
+        data = volume.hybridKspace(FIDPath, data, Stack)
+    shifts = None
+    if Register:
+        if lines is not None or grid is not None:
+            raise ValueError('only fully sampled Cartesian studies are '
+                             'registered')
+        shifts = registration.studyShifts(data,
+                                          receiverCount(dic['procpar']))
+    if Average == 'complex':
+        # the repetitions are read one at a time into the running mean
+        data = averaging.averageKspace(data, receiverCount(dic['procpar']),
+                                       Shifts=shifts).mean
+        shifts = None
+    size = dim if grid is None else (grid.matrix, grid.matrix)
+    target = None if ZeroFill is None else zeroFillSize(size, ZeroFill)
+    receivers = receiverCount(dic['procpar'])
+    if receivers > 1:
+        # one frame at a time, so only the coils of one frame are held
+        reps = data.shape[0]//receivers
+        yield dic, (reps,)+tuple(data.shape[1:-2]), Stack
+        if Noise is None:
+            Noise = coils.cornerSamples(data[:receivers])
+        whitener = coils.whitener(coils.noiseCovariance(Noise))
+
+        def combined(Frame):
+            kspace = coils.coilFrame(data, Frame, receivers)
+            if shifts is not None:
+                kspace = registration.shiftKspace(kspace, -shifts[Frame])
+            kspace = partial_fourier.padLines(
+                removeOversampling(kspace, Oversampling), lines)
+            return (Frame,)+combineFrame(kspace, Stack, whitener, Coils,
+                                         target, plan, grid, Frame)
+
+        # the slices of each (block, echo) are combined in parallel, unless
+        # each starts from the one before
+        slices, echoes = data.shape[1:3]
+        with ThreadPoolExecutor(Workers) as pool:
+            mapper = map if filt.warmStarted(Stack) else pool.map
+            for rep, echo in np.ndindex(reps, echoes):
+                for result in mapper(combined, [(rep, index, echo) for
+                                                index in range(slices)]):
+                    yield result
+        return
+
+    yield dic, tuple(data.shape[:-2]), Stack
+    if plan is None and grid is None:
+        for frame in np.ndindex(*data.shape[:-2]):
+            kspace = np.asarray(data[frame])
+            if shifts is not None:
+                kspace = registration.shiftKspace(kspace, -shifts[frame])
+            kspace = partial_fourier.padLines(
+                removeOversampling(kspace, Oversampling), lines)
+            datafilt, image = reconstructFrame(kspace, Stack, target,
+                                               Frame=frame)
+            yield frame, datafilt, image
+        return
+
+    reps, slices, echoes = data.shape[:-2]
+    for rep, echo in np.ndindex(reps, echoes):
+        kspace = partial_fourier.padLines(
+            removeOversampling(np.asarray(data[rep, :, echo]), Oversampling),
+            lines)
+        datafilt = np.stack([filt.applyStack(frame, Stack, (rep, index, echo))
+                             for index, frame in enumerate(kspace)])
+        images = transformFrames(datafilt, target, plan, grid)
+        for index in range(slices):
+            yield (rep, index, echo), datafilt[index], images[index]
+
+
+def reconstruct(FIDPath, Stack=None, Workers=None, Oversampling=None,
+                ZeroFill=None, PartialFourier='homodyne', Coils='rss',
+                Noise=None, Average=None, Register=False):
+    """
+    Reconstructs every frame of a study.
+
+    Parameters
+    ----------
+    FIDPath : string
+        The top level \*.fid folder.
+
+    Stack : 1D array :class:`filters.GFilter`\s or list of Dictionaries
+        Filters applied to each frame, either as filter objects or as the
+        output of :func:`filters.stackSpec`, which is rebuilt for the size of
+        the frames. Defaults to :func:`defaultStack`.
+
+    Workers : int, optional
+        Number of threads used to decode the FID.
+
+    Oversampling : float, optional
+        Readout oversampling to remove. Defaults to the study's
+        :func:`readoutOversampling`.
+
+    ZeroFill : float, optional
+        Interpolation factor for the images, see :func:`zeroFillSize`.
+
+    PartialFourier : string, optional
+        Partial Fourier method, see :func:`reconstructFrames`.
+
+    Coils : string, optional
+        Coil combination, see :func:`reconstructFrames`.
+
+    Noise : 2D array, optional
+        Noise scan for the prewhitening, see :func:`reconstructFrames`.
+
+    Average : string, optional
+        Averaging of the repetitions, see :func:`reconstructFrames`.
+
+    Register : bool, optional
+        Motion correction of the repetitions, see :func:`reconstructFrames`.
+
+    Returns
+    -------
+    Result : :class:`Reconstruction`
+        The filtered k-space and complex images of every (block, slice,
+        echo) frame.
+
+    """
+    frames = reconstructFrames(FIDPath, Stack, Workers, Oversampling,
+                               ZeroFill, PartialFourier, Coils, Noise,
+                               Average, Register)
+    dic, leading, Stack = next(frames)
+    datafilt = image = None
+    for frame, frameData, frameImage in frames:
+        if datafilt is None:
+            datafilt = np.empty(leading+frameData.shape, dtype=np.complex64)
+            image = np.empty(leading+frameImage.shape, dtype=np.complex64)
+        datafilt[frame] = frameData
+        image[frame] = frameImage
+    return Reconstruction(dic, datafilt, image, filt.stackSpec(Stack))
@@ -0,0 +1,524 @@
+"""
+.. py:module:: recon_service
+Reconstruction Service Module
+=============================
+
+A local reconstruction server, so scripts and several GUI sessions can
+share one pool of worker processes. Clients connect to a Unix socket and
+send one JSON request per line::
+
+    {"id": 1, "fid": "/data/study.fid", "stack": [...]}
+
+where stack is the output of :func:`filters.stackSpec` and may be left out
+for the default stack. Requests that arrive within a short window of each
+other, and have the same frame size and filter stack, are batched into one
+job, so the filter windows are built once and shared by every study in the
+batch. Each job runs on a process pool.
+
+The images and filtered k-space are not sent over the socket. The workers
+copy them into shared memory blocks and the reply names them::
+
+    {"id": 1, "status": "ok", "shape": [...], "procpar": {...},
+     "arrays": {"image": {"name": ..., "shape": [...], "dtype": "<c8"},
+                "datafilt": {...}}}
+
+The client owns the blocks once it has the reply and must unlink them,
+:class:`ReconClient` does this after copying the arrays out. Blocks that
+never reach a client, e.g. because the study failed part way through or the
+client went away, are unlinked by the service. Failed requests are answered
+with {"id": 1, "status": "error", "error": message}.
+
+Only the headers of a study are read to find its frame size, on a thread,
+so the event loop never waits on the disk.
+
+The server is started with::
+
+    python recon_service.py --serve
+
+and a study can be reconstructed through it with::
+
+    python recon_service.py /data/study.fid
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import filters as filt
+import fid_reader
+import memory_budget
+import recon
+from recon_store import _toJSON
+
+
+# seconds requests are held back to be batched with matching ones
+BATCH_WINDOW = 0.05
+
+
+class _StackCache(dict):
+    """ Filter stacks with their windows built, per (spec, frame size) """
+    def memoryUsage(self):
+        """ Bytes held by the built windows """
+        return memory_budget.residentBytes(*[getattr(stackFilter, 'window',
+                                                     None)
+                                             for stack in self.values()
+                                             for stackFilter in stack])
+
+    def release(self, Bytes):
+        """ Drops every stack when the memory governor needs the space """
+        freed = self.memoryUsage()
+        self.clear()
+        return freed
+
+
+# kept in each worker process
+_STACK_CACHE = _StackCache()
+memory_budget.governor().register(_STACK_CACHE, 'service stacks')
+
+
+def socketPath():
+    """ Default path of the service socket, one per user """
+    return os.path.join(tempfile.gettempdir(),
+                        'mr_magic-%d.sock' % os.getuid())
+
+
+def _sharedArray(Data):
+    """
+    Copies an array into a new shared memory block.
+
+    The block outlives this process; whoever receives the handle unlinks it.
+
+    """
+    Data = np.ascontiguousarray(Data)
+    try:
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(Data.nbytes, 1),
+                                           track=False)
+    except TypeError:
+        # Python < 3.13 always tracks the block, and would remove it when
+        # this worker exits
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(Data.nbytes, 1))
+        resource_tracker.unregister(block._name, 'shared_memory')
+    np.ndarray(Data.shape, Data.dtype, buffer=block.buf)[...] = Data
+    handle = {'name': block.name,
+              'shape': list(Data.shape),
+              'dtype': Data.dtype.str}
+    block.close()
+    return handle
+
+
+def unlinkArrays(Arrays):
+    """
+    Removes the shared memory blocks of a reply that will not be used.
+
+    Parameters
+    ----------
+    Arrays : dictionary
+        Name to handle, as in the 'arrays' of a reply.
+
+    """
+    for handle in Arrays.values():
+        try:
+            block = shared_memory.SharedMemory(name=handle['name'])
+        except FileNotFoundError:
+            continue
+        block.close()
+        block.unlink()
+
+
+def attachArray(Handle):
+    """
+    Opens an array returned by the service.
+
+    Parameters
+    ----------
+    Handle : dictionary
+        The name, shape and dtype of the shared memory block.
+
+    Returns
+    -------
+    Data : array
+        A view of the block.
+
+    Block : SharedMemory
+        The block, to be closed, and unlinked by its last user, once the
+        view is no longer needed.
+
+    """
+    block = shared_memory.SharedMemory(name=Handle['name'])
+    data = np.ndarray(tuple(Handle['shape']), np.dtype(Handle['dtype']),
+                      buffer=block.buf)
+    return data, block
+
+
+def reconstructBatch(Paths, Spec, Dim):
+    """
+    Reconstructs studies that share a frame size and filter stack. Run in
+    the worker processes.
+
+    Parameters
+    ----------
+    Paths : list of strings
+        The top level \*.fid folders.
+
+    Spec : list of Dictionaries or None
+        The filter stack, see :func:`filters.stackSpec`. None for
+        :func:`recon.defaultStack`.
+
+    Dim : tuple
+        The (phase-encode, readout) frame size of every study.
+
+    Returns
+    -------
+    Replies : list of dictionaries
+        The reply body for each path, in order.
+
+    """
+    key = (None if Spec is None else filt.canonicalSpec(Spec), tuple(Dim))
+    stack = _STACK_CACHE.get(key)
+    if stack is None:
+        if Spec is None:
+            stack = recon.defaultStack(Dim)
+        else:
+            stack = filt.buildStack(Spec, Dim)
+        stack = filt.precomputeStack(stack, Dim)
+        _STACK_CACHE[key] = stack
+
+    replies = []
+    for path in Paths:
+        arrays = {}
+        try:
+            result = recon.reconstruct(path, stack, Workers=1)
+            for name in ('image', 'datafilt'):
+                arrays[name] = _sharedArray(getattr(result, name))
+            replies.append({
+                'status': 'ok',
+                'shape': list(result.image.shape),
+                'procpar': result.procpar,
+                'aspectRatio': result.aspectRatio,
+                'spec': result.spec,
+                'arrays': arrays})
+        except Exception as error:
+            # the blocks of a half answered study are never handed out
+            unlinkArrays(arrays)
+            replies.append(_errorReply(error))
+    return replies
+
+
+def _errorReply(Error):
+    """ The reply body for a request that failed with Error """
+    return {'status': 'error',
+            'error': '%s: %s' % (type(Error).__name__, Error)}
+
+
+def _frameSize(Path):
+    """ The frame size of a study, from its headers alone """
+    dic, kspace = fid_reader.readFID(Path)
+    return recon.frameSize(dic['procpar'], kspace.shape)
+
+
+class ReconService(object):
+    """
+    Serves reconstruction requests on a Unix socket.
+
+    Parameters
+    ----------
+    Path : string, optional
+        The socket. Defaults to :func:`socketPath`.
+
+    Workers : int, optional
+        Number of worker processes. Defaults to the number of processors.
+
+    Window : float, optional
+        Seconds a request waits for others to batch with. Defaults to
+        :data:`BATCH_WINDOW`.
+
+    """
+    def __init__(self, Path=None, Workers=None, Window=BATCH_WINDOW):
+        self.path = socketPath() if Path is None else Path
+        self.workers = Workers
+        self.window = Window
+        self.pool = None
+        # (spec key, frame size) -> [spec, [(path, future), ...]]
+        self.batches = {}
+        self.server = None
+
+    async def start(self):
+        """ Starts the pool and begins listening on the socket. """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.server = await asyncio.start_unix_server(self._connection,
+                                                      path=self.path)
+
+    async def serve(self):
+        """ Serves requests until cancelled. """
+        if self.server is None:
+            await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        """ Shuts the pool down and removes the socket. """
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def submit(self, Path, Spec=None):
+        """
+        Reconstructs a study, batched with matching requests.
+
+        Parameters
+        ----------
+        Path : string
+            The top level \*.fid folder.
+
+        Spec : list of Dictionaries, optional
+            The filter stack, see :func:`filters.stackSpec`.
+
+        Returns
+        -------
+        Reply : dictionary
+            The reply body. The caller owns any shared memory blocks it
+            names.
+
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            # the procpar is parsed and the headers read on a thread
+            dim = await loop.run_in_executor(None, _frameSize, Path)
+        except (IOError, OSError, ValueError) as error:
+            return _errorReply(error)
+        future = loop.create_future()
+        key = (None if Spec is None else filt.canonicalSpec(Spec), dim)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = [Spec, []]
+            loop.call_later(self.window, self._dispatch, key)
+        batch[1].append((Path, future))
+        return await future
+
+    def _dispatch(self, Key):
+        """ Sends a batch to the pool once its window has closed """
+        spec, jobs = self.batches.pop(Key)
+        asyncio.ensure_future(self._run(spec, Key[1], jobs))
+
+    async def _run(self, Spec, Dim, Jobs):
+        """ Runs a batch and resolves the futures of its requests """
+        loop = asyncio.get_running_loop()
+        # a study requested twice in one batch is only reconstructed once
+        paths = list(dict.fromkeys(path for path, _ in Jobs))
+        try:
+            replies = await loop.run_in_executor(self.pool, reconstructBatch,
+                                                 paths, Spec, Dim)
+        except Exception as error:
+            replies = [_errorReply(error)]*len(paths)
+        replies = dict(zip(paths, replies))
+        waiting = [(path, future) for path, future in Jobs
+                   if not future.done()]
+        handed = set()
+        for path, future in waiting:
+            reply = replies[path]
+            if path in handed and reply['status'] == 'ok':
+                # each client unlinks its own blocks, so duplicates get copies
+                reply = dict(reply, arrays=self._copyArrays(reply['arrays']))
+            handed.add(path)
+            future.set_result(reply)
+        # nobody is left to unlink the blocks of abandoned requests
+        for path, reply in replies.items():
+            if path not in handed and reply['status'] == 'ok':
+                unlinkArrays(reply['arrays'])
+
+    @staticmethod
+    def _copyArrays(Arrays):
+        """ Duplicates the shared memory blocks of a reply """
+        copies = {}
+        for name, handle in Arrays.items():
+            data, block = attachArray(handle)
+            copies[name] = _sharedArray(data)
+            del data
+            block.close()
+        return copies
+
+    async def _connection(self, Reader, Writer):
+        """ Answers the requests of one client, in any order """
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def answer(Request):
+            reply = {'status': 'error', 'error': 'bad request'}
+            try:
+                if 'fid' in Request:
+                    reply = await self.submit(Request['fid'],
+                                              Request.get('stack'))
+            finally:
+                reply = dict(reply, id=Request.get('id'))
+                try:
+                    async with lock:
+                        Writer.write(json.dumps(reply, default=_toJSON)
+                                     .encode()+b'\n')
+                        await Writer.drain()
+                except Exception:
+                    # the client has gone, so the blocks are never used
+                    unlinkArrays(reply.get('arrays', {}))
+                    raise
+
+        try:
+            while True:
+                line = await Reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = {}
+                task = asyncio.ensure_future(answer(request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            Writer.close()
+
+
+class ReconClient(object):
+    """
+    Blocking client for :class:`ReconService`.
+
+    Parameters
+    ----------
+    Path : string, optional
+        The socket. Defaults to :func:`socketPath`.
+
+    """
+    def __init__(self, Path=None):
+        self.path = socketPath() if Path is None else Path
+        self._socket = None
+        self._reader = None
+        self._next = 0
+
+    def connect(self):
+        """ Opens the connection, if it is not already open. """
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.path)
+            self._reader = self._socket.makefile('rb')
+
+    def close(self):
+        """ Closes the connection. """
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+            self._socket = self._reader = None
+
+    def reconstruct(self, FIDPath, Spec=None):
+        """
+        Reconstructs a study through the service.
+
+        Parameters
+        ----------
+        FIDPath : string
+            The top level \*.fid folder, as seen by the server.
+
+        Spec : list of Dictionaries, optional
+            The filter stack, see :func:`filters.stackSpec`.
+
+        Returns
+        -------
+        Reply : dictionary
+            The reply, with the arrays copied out of shared memory into
+            reply['image'] and reply['datafilt'].
+
+        Raises
+        ------
+        RuntimeError
+            If the service could not reconstruct the study.
+
+        """
+        self.connect()
+        self._next += 1
+        request = {'id': self._next, 'fid': os.path.abspath(FIDPath)}
+        if Spec is not None:
+            request['stack'] = Spec
+        self._socket.sendall(json.dumps(request, default=_toJSON).encode()
+                             + b'\n')
+        line = self._reader.readline()
+        if not line:
+            raise RuntimeError('no reply from service')
+        reply = json.loads(line)
+        if reply.get('status') != 'ok':
+            raise RuntimeError(reply.get('error', 'no reply from service'))
+        arrays = reply.pop('arrays')
+        try:
+            for name, handle in arrays.items():
+                data, block = attachArray(handle)
+                try:
+                    reply[name] = data.copy()
+                finally:
+                    del data
+                    block.close()
+        finally:
+            unlinkArrays(arrays)
+        return reply
+
+
+def main(Argv=None):
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(
+        description='Local reconstruction service.')
+    parser.add_argument('fids', nargs='*',
+                        help='*.fid folders reconstructed by the service')
+    parser.add_argument('--serve', action='store_true',
+                        help='run the service')
+    parser.add_argument('--socket', default=None,
+                        help='path of the service socket')
+    parser.add_argument('-s', '--stack',
+                        help='JSON file with the filter stack parameters')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes')
+    args = parser.parse_args(Argv)
+
+    if args.serve:
+        service = ReconService(args.socket, args.workers)
+        try:
+            asyncio.run(service.serve())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    spec = None
+    if args.stack:
+        with open(args.stack) as stackFile:
+            spec = json.load(stackFile)
+    client = ReconClient(args.socket)
+    failures = 0
+    try:
+        for path in args.fids:
+            try:
+                reply = client.reconstruct(path, spec)
+                print('done   %s %s' % (path, tuple(reply['shape'])))
+            except RuntimeError as error:
+                failures += 1
+                print('failed %s: %s' % (path, error))
+    finally:
+        client.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
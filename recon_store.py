@@ -0,0 +1,377 @@
+"""
+.. py:module:: recon_store
+Reconstruction Store Module
+===========================
+
+Chunked on-disk container for reconstruction results. A store is a
+directory holding a JSON manifest, the procpar and filter stack of the
+study, and one folder per array (e.g. image, datafilt) with one .npy chunk
+per 2D frame::
+
+    study.mrs/
+        manifest.json
+        image/000000.npy
+        image/000001.npy
+        ...
+
+Chunks are plain .npy files by default, which are memory mapped when read,
+so any frame can be read at random without loading the others. They can
+instead be written as zlib compressed (.npy.z) copies of the same bytes,
+which take less disk for images with large empty areas but have to be read
+and decompressed whole, so they are never memory mapped. Each frame is its
+own file, so frames can be written in parallel, appended as a batch
+reconstruction produces them, and read back individually.
+
+"""
+
+import io
+import json
+import os
+import shutil
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+MANIFEST = 'manifest.json'
+STORE_VERSION = 1
+
+
+class ReconStore(object):
+    """
+    Reads and writes a chunked reconstruction store.
+
+    Parameters
+    ----------
+    Path : string
+        The store directory. It is created if it does not exist.
+
+    Compression : int, optional
+        zlib level used for new chunks. Defaults to 0, which stores them
+        uncompressed so they can be memory mapped. Compressed chunks save
+        disk but are decompressed whole on every read.
+
+    """
+    def __init__(self, Path, Compression=0):
+        self.path = Path
+        self.compression = Compression
+        self._lock = threading.Lock()
+        manifest = os.path.join(Path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as manifestFile:
+                self.manifest = json.load(manifestFile)
+        else:
+            if not os.path.isdir(Path):
+                os.makedirs(Path)
+            self.manifest = {'version': STORE_VERSION,
+                             'arrays': {},
+                             'procpar': None,
+                             'spec': None}
+            self.flush()
+
+    @property
+    def names(self):
+        """ Names of the arrays in the store """
+        return sorted(self.manifest['arrays'])
+
+    @property
+    def procpar(self):
+        """ The procpar dictionary of the study, if one was saved """
+        return self.manifest['procpar']
+
+    @property
+    def spec(self):
+        """ The filter stack parameters, see :func:`filters.stackSpec` """
+        return self.manifest['spec']
+
+    def setMetadata(self, Procpar=None, Spec=None):
+        """
+        Saves the procpar and filter stack alongside the arrays.
+
+        Parameters
+        ----------
+        Procpar : dictionary, optional
+            The parameter dictionary of the study.
+
+        Spec : list of Dictionaries, optional
+            The filter stack as returned by :func:`filters.stackSpec`.
+
+        """
+        with self._lock:
+            if Procpar is not None:
+                self.manifest['procpar'] = Procpar
+            if Spec is not None:
+                # tuples become lists in JSON, which buildStack accepts
+                self.manifest['spec'] = Spec
+        self.flush()
+
+    def flush(self):
+        """ Writes the manifest, replacing the old one atomically. """
+        with self._lock:
+            temp = os.path.join(self.path, MANIFEST+'.tmp')
+            with open(temp, 'w') as manifestFile:
+                json.dump(self.manifest, manifestFile, indent=1,
+                          default=_toJSON)
+            os.replace(temp, os.path.join(self.path, MANIFEST))
+
+    def _entry(self, Name, Frame):
+        """ Returns the manifest entry for Name, creating it from Frame """
+        entry = self.manifest['arrays'].get(Name)
+        if entry is None:
+            entry = {'dtype': Frame.dtype.str,
+                     'frameShape': list(Frame.shape),
+                     'count': 0,
+                     'shape': None}
+            self.manifest['arrays'][Name] = entry
+            os.makedirs(os.path.join(self.path, Name), exist_ok=True)
+        elif list(Frame.shape) != entry['frameShape']:
+            raise ValueError('frames of %s must have shape %s' %
+                             (Name, tuple(entry['frameShape'])))
+        return entry
+
+    def _chunkName(self, Name, Index):
+        """ Path of a chunk, without the compression suffix """
+        return os.path.join(self.path, Name, '%06d.npy' % Index)
+
+    def write(self, Name, Index, Frame):
+        """
+        Writes one frame. Safe to call from several threads at once.
+
+        Parameters
+        ----------
+        Name : string
+            The array the frame belongs to.
+
+        Index : int
+            Flat index of the frame within the array.
+
+        Frame : 2D array
+            The data.
+
+        """
+        Frame = np.ascontiguousarray(Frame)
+        with self._lock:
+            entry = self._entry(Name, Frame)
+            entry['count'] = max(entry['count'], Index+1)
+        filename = self._chunkName(Name, Index)
+        buff = io.BytesIO()
+        np.lib.format.write_array(buff, Frame, allow_pickle=False)
+        if self.compression > 0:
+            data = zlib.compress(buff.getbuffer(), self.compression)
+            filename += '.z'
+        else:
+            data = buff.getbuffer()
+        with open(filename+'.tmp', 'wb') as chunkFile:
+            chunkFile.write(data)
+        os.replace(filename+'.tmp', filename)
+        # a rewritten frame may have changed compression
+        stale = filename[:-2] if filename.endswith('.z') else filename+'.z'
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    def append(self, Name, Frame, Flush=True):
+        """
+        Writes a frame after the last one in the array.
+
+        Parameters
+        ----------
+        Name : string
+            The array the frame belongs to.
+
+        Frame : 2D array
+            The data.
+
+        Flush : bool, optional
+            Update the manifest straight away so readers see the new frame.
+            Defaults to True.
+
+        Returns
+        -------
+        Index : int
+            The index the frame was written to.
+
+        """
+        with self._lock:
+            entry = self._entry(Name, np.asarray(Frame))
+            index = entry['count']
+            entry['count'] = index+1
+        self.write(Name, index, Frame)
+        if Flush:
+            self.flush()
+        return index
+
+    def writeFrames(self, Name, Data, Workers=None):
+        """
+        Writes every 2D frame of an array in parallel.
+
+        Parameters
+        ----------
+        Name : string
+            The array the frames belong to.
+
+        Data : array
+            The frames, stacked over any number of leading axes. The leading
+            shape is recorded so :meth:`load` can restore it.
+
+        Workers : int, optional
+            Number of threads compressing and writing chunks. Defaults to the
+            number of processors.
+
+        """
+        Data = np.asarray(Data)
+        leading = Data.shape[:-2]
+        frames = Data.reshape((-1,)+Data.shape[-2:])
+        with ThreadPoolExecutor(max_workers=Workers) as pool:
+            list(pool.map(lambda index: self.write(Name, index,
+                                                   frames[index]),
+                          range(frames.shape[0])))
+        self.setShape(Name, leading)
+
+    def setShape(self, Name, Shape):
+        """
+        Records the leading shape the flat frame index is unravelled into.
+
+        Parameters
+        ----------
+        Name : string
+            The array.
+
+        Shape : tuple
+            Shape of the leading axes, e.g. (block, slice, echo).
+
+        """
+        with self._lock:
+            self.manifest['arrays'][Name]['shape'] = list(Shape)
+        self.flush()
+
+    def remove(self, Name):
+        """
+        Removes an array and its chunks, e.g. before a study is
+        reconstructed again into the same store.
+
+        Parameters
+        ----------
+        Name : string
+            The array. Nothing is done if it is not in the store.
+
+        """
+        with self._lock:
+            if self.manifest['arrays'].pop(Name, None) is None:
+                return
+        self.flush()
+        shutil.rmtree(os.path.join(self.path, Name), ignore_errors=True)
+
+    def frames(self, Name):
+        """ Number of frames in an array """
+        return self.manifest['arrays'][Name]['count']
+
+    def read(self, Name, Index):
+        """
+        Reads one frame.
+
+        Uncompressed chunks are memory mapped, so only the pages that are
+        used are read from disk.
+
+        Parameters
+        ----------
+        Name : string
+            The array.
+
+        Index : int or tuple
+            Flat index of the frame, or an index into the leading shape.
+
+        Returns
+        -------
+        Frame : 2D array
+            The frame, read-only if it was memory mapped.
+
+        """
+        if isinstance(Index, tuple):
+            Index = int(np.ravel_multi_index(Index, self.shape(Name)[:-2]))
+        filename = self._chunkName(Name, Index)
+        if os.path.exists(filename):
+            return np.load(filename, mmap_mode='r', allow_pickle=False)
+        with open(filename+'.z', 'rb') as chunkFile:
+            data = zlib.decompress(chunkFile.read())
+        return np.lib.format.read_array(io.BytesIO(data),
+                                        allow_pickle=False)
+
+    def shape(self, Name):
+        """ Full shape of an array, leading axes followed by the frame """
+        entry = self.manifest['arrays'][Name]
+        leading = entry['shape']
+        if leading is None or int(np.prod(leading)) != entry['count']:
+            leading = [entry['count']]
+        return tuple(leading)+tuple(entry['frameShape'])
+
+    def load(self, Name, Workers=None):
+        """
+        Reads a whole array, decompressing the chunks in parallel.
+
+        Parameters
+        ----------
+        Name : string
+            The array.
+
+        Workers : int, optional
+            Number of threads. Defaults to the number of processors.
+
+        Returns
+        -------
+        Data : array
+            The frames, in the leading shape recorded by :meth:`setShape`.
+
+        """
+        shape = self.shape(Name)
+        out = np.empty(shape,
+                       dtype=np.dtype(self.manifest['arrays'][Name]['dtype']))
+        flat = out.reshape((-1,)+shape[-2:])
+
+        def readInto(Index):
+            flat[Index] = self.read(Name, Index)
+
+        with ThreadPoolExecutor(max_workers=Workers) as pool:
+            list(pool.map(readInto, range(flat.shape[0])))
+        return out
+
+
+def _toJSON(Value):
+    """ Converts the numpy values found in procpar and specs for JSON """
+    if isinstance(Value, np.generic):
+        return Value.item()
+    if isinstance(Value, np.ndarray):
+        return Value.tolist()
+    raise TypeError('%r is not JSON serializable' % (Value,))
+
+
+def saveReconstruction(Path, Result, Compression=0, Workers=None):
+    """
+    Saves a :class:`recon.Reconstruction` to a new store.
+
+    Parameters
+    ----------
+    Path : string
+        The store directory.
+
+    Result : :class:`recon.Reconstruction`
+        The reconstructed study.
+
+    Compression : int, optional
+        zlib level. Defaults to 0, memory mappable chunks.
+
+    Workers : int, optional
+        Number of threads writing chunks.
+
+    Returns
+    -------
+    Store : :class:`ReconStore`
+        The new store.
+
+    """
+    store = ReconStore(Path, Compression)
+    store.setMetadata(Result.procpar, Result.spec)
+    store.writeFrames('image', Result.image, Workers)
+    store.writeFrames('datafilt', Result.datafilt, Workers)
+    return store
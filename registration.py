@@ -0,0 +1,203 @@
+"""
+.. py:module:: registration
+Registration Module
+===================
+
+Rigid registration of the repetitions of a study by phase correlation. A
+translation of the image is a linear phase ramp across k-space, so the
+normalised cross-power spectrum of a frame and the reference, formed
+straight from their k-space, is a pure ramp whose inverse FFT peaks at the
+shift between them. The peak is refined to a fraction of a pixel from its
+larger neighbour.
+
+Every frame is estimated at once: the cross-power spectra of a chunk of
+:data:`CHUNK_FRAMES` frames are inverse transformed together, and the
+peaks found with one argmax. The coils of multi-receiver studies share
+one estimate, with their cross-power spectra summed before normalising.
+
+The correction is the opposite ramp, applied to the raw k-space of each
+frame before the filter stack, see :func:`shiftKspace`.
+
+"""
+
+import numpy as np
+from scipy import fft as spfft
+
+
+# frames whose cross-power spectra are transformed together
+CHUNK_FRAMES = 64
+
+# repetition the others are registered to by default
+REFERENCE = 0
+
+
+def _frequencies(Size):
+    """ Centred k-space index of each sample, as a fraction of Size """
+    return (np.arange(Size)-Size//2)/float(Size)
+
+
+def phaseRamp(Dim, Shifts):
+    """
+    Returns the k-space phase ramps that translate images.
+
+    Parameters
+    ----------
+    Dim : tuple
+        The (phase-encode, readout) size of the frames.
+
+    Shifts : array
+        The (..., 2) shifts, in pixels along phase-encode and readout.
+
+    Returns
+    -------
+    Ramp : array of complex64
+        The (..., phase-encode, readout) ramps. Multiplying centred k-space
+        by its ramp moves the image by the shift.
+
+    """
+    shifts = np.asarray(Shifts, dtype=float)
+    rows = np.exp(-2j*np.pi*shifts[..., 0, None]*_frequencies(Dim[0]))
+    columns = np.exp(-2j*np.pi*shifts[..., 1, None]*_frequencies(Dim[1]))
+    return (rows[..., :, None]*columns[..., None, :]).astype(np.complex64)
+
+
+def shiftKspace(Kspace, Shifts, Out=None):
+    """
+    Translates the images of k-space frames.
+
+    Parameters
+    ----------
+    Kspace : array
+        The centred (..., phase-encode, readout) k-space.
+
+    Shifts : array
+        The (..., 2) shifts of the frames, in pixels, broadcast against the
+        leading axes of Kspace.
+
+    Out : array, optional
+        Where the result is written. May be Kspace.
+
+    Returns
+    -------
+    Kspace : array
+        The shifted k-space.
+
+    """
+    ramp = phaseRamp(np.shape(Kspace)[-2:], Shifts)
+    return np.multiply(Kspace, ramp, out=Out)
+
+
+def _refine(Correlation, Peak, Axis):
+    """
+    Sub-pixel offset of the peaks along an axis.
+
+    The peak of a phase correlation is a sampled Dirichlet kernel, whose
+    offset follows from the ratio of the peak to its larger neighbour.
+
+    """
+    size = Correlation.shape[Axis]
+    index = [np.arange(len(Peak[0]))]+[peak for peak in Peak]
+    values = []
+    for step in (-1, 0, 1):
+        moved = list(index)
+        moved[Axis] = (moved[Axis]+step) % size
+        values.append(Correlation[tuple(moved)])
+    before, centre, after = values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(after > before, after/(after+centre),
+                          -before/(before+centre))
+    return np.clip(np.nan_to_num(offset), -0.5, 0.5)
+
+
+def estimateShifts(Kspace, Reference, Coils=False):
+    """
+    Estimates the translation of frames from a reference by phase
+    correlation.
+
+    Parameters
+    ----------
+    Kspace : array
+        The centred (frame, phase-encode, readout) k-space, or
+        (frame, coil, phase-encode, readout) if Coils is True.
+
+    Reference : array
+        The centred k-space of the reference, (phase-encode, readout) or
+        (coil, phase-encode, readout).
+
+    Coils : bool, optional
+        Kspace and Reference have a coil axis, whose cross-power spectra
+        are summed. Defaults to False.
+
+    Returns
+    -------
+    Shifts : 2D array
+        The (frame, 2) shift of each frame from the reference, in pixels
+        along phase-encode and readout. :func:`shiftKspace` with the
+        negated shifts registers the frames.
+
+    """
+    cross = np.asarray(Kspace)*np.conj(np.asarray(Reference))
+    if Coils:
+        cross = cross.sum(axis=1)
+    cross /= np.maximum(np.abs(cross), np.finfo(np.float32).tiny)
+    # the shifts are taken from the ramp alone, so no centring is needed
+    correlation = np.abs(spfft.ifft2(cross, axes=(-2, -1), workers=-1))
+    frames, rows, columns = correlation.shape
+    peak = np.unravel_index(np.argmax(correlation.reshape(frames, -1),
+                                      axis=1), (rows, columns))
+    shifts = np.empty((frames, 2))
+    for axis, (size, position) in enumerate(zip((rows, columns), peak)):
+        shift = position+_refine(correlation, peak, axis+1)
+        # peaks past the middle are negative shifts
+        shifts[:, axis] = (shift+size/2.0) % size-size/2.0
+    return shifts
+
+
+def studyShifts(Kspace, Receivers=1, Reference=REFERENCE,
+                Chunk=CHUNK_FRAMES):
+    """
+    Estimates the motion of every repetition of a study.
+
+    Parameters
+    ----------
+    Kspace : array-like
+        The decoded (rep, slice, echo, phase-encode, readout) k-space, e.g.
+        a :class:`fid_reader.LazyKspace`, with the coils of each repetition
+        next to each other on the first axis.
+
+    Receivers : int, optional
+        The :func:`fid_reader.receiverCount` of the study. Defaults to 1.
+
+    Reference : int, optional
+        The repetition the others are registered to. Defaults to
+        :data:`REFERENCE`.
+
+    Chunk : int, optional
+        Repetitions read and estimated at once.
+
+    Returns
+    -------
+    Shifts : 4D array
+        The (rep, slice, echo, 2) shift of each frame from the same slice
+        and echo of the reference.
+
+    """
+    shape = np.shape(Kspace)
+    reps, slices, echoes = shape[0]//Receivers, shape[1], shape[2]
+    coils = Receivers > 1
+    shifts = np.zeros((reps, slices, echoes, 2))
+    for slc, echo in np.ndindex(slices, echoes):
+        reference = np.asarray(Kspace[Reference*Receivers:
+                                      (Reference+1)*Receivers, slc, echo])
+        if not coils:
+            reference = reference[0]
+        for start in range(0, reps, Chunk):
+            stop = min(start+Chunk, reps)
+            frames = np.asarray(Kspace[start*Receivers:stop*Receivers, slc,
+                                       echo])
+            if coils:
+                frames = frames.reshape((stop-start, Receivers) +
+                                        frames.shape[-2:])
+            shifts[start:stop, slc, echo] = estimateShifts(frames, reference,
+                                                           coils)
+    return shifts
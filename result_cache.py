@@ -0,0 +1,351 @@
+"""
+.. py:module:: result_cache
+Result Cache Module
+===================
+
+Content addressed cache of reconstruction results. An entry is keyed by a
+digest of the FID and procpar contents, the canonical filter stack (see
+:func:`filters.canonicalSpec`), the precision and any other options that
+change the output, such as the frame shown. Entries do not depend on where
+a study lives or when it was copied, so reopening an identical study with an
+identical stack returns the stored arrays without filtering or transforming
+anything.
+
+Each entry is a directory of .npy files, typically the complex image, the
+filtered k-space and the image magnitude and phase, which are memory mapped
+when read. The cache is kept under a size limit by removing the least
+recently used entries.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+import filters as filt
+import fid_cache
+import fid_reader
+from recon_store import _toJSON
+
+
+# default size limit of the cache, overridden by MRMAGIC_RESULT_CACHE_BYTES
+LIMIT_BYTES = 2 << 30
+
+# bumped when the reconstruction of the same inputs changes, so results
+# stored by an older version are not reused
+RESULT_VERSION = 2
+
+# dtypes of the stored arrays for each precision
+PRECISIONS = {'single': (np.complex64, np.float32),
+              'double': (np.complex128, np.float64)}
+
+# content digests of the studies hashed so far, by path, mtime and size
+_HASHES = {}
+_HASH_LOCK = threading.Lock()
+
+
+def resultDirectory():
+    """ Returns the directory holding the cached results """
+    return os.path.join(fid_cache.cacheDirectory(), 'result')
+
+
+def contentHash(Path):
+    """
+    Digests the contents of a \*.fid folder.
+
+    The fid is memory mapped and streamed through the digest in chunks of
+    :data:`fid_cache.CHUNK_BYTES`, so it is never read into memory at once.
+    Digests are remembered for the life of the process against the path,
+    modification time and size of the files.
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Returns
+    -------
+    Digest : string
+        Hex blake2b digest of the fid and procpar.
+
+    """
+    fidName = os.path.abspath(fid_reader.fidFilename(Path))
+    procparName = os.path.join(os.path.dirname(fidName), 'procpar')
+    stamp = (fidName,)+tuple((info.st_mtime_ns, info.st_size) for info in
+                             (os.stat(fidName), os.stat(procparName)))
+    with _HASH_LOCK:
+        if stamp in _HASHES:
+            return _HASHES[stamp]
+
+    digest = hashlib.blake2b(digest_size=20)
+    if stamp[1][1] > 0:
+        raw = np.memmap(fidName, dtype=np.uint8, mode='r')
+        for start in range(0, raw.size, fid_cache.CHUNK_BYTES):
+            digest.update(memoryview(raw[start:start+fid_cache.CHUNK_BYTES]))
+        del raw
+    digest.update(b'procpar')
+    fid_cache._hashFile(digest, procparName)
+    value = digest.hexdigest()
+    with _HASH_LOCK:
+        _HASHES[stamp] = value
+    return value
+
+
+def resultKey(Content, Spec, Precision='single', Options=None):
+    """
+    Builds the key of a cached result.
+
+    Parameters
+    ----------
+    Content : string
+        The :func:`contentHash` of the study.
+
+    Spec : list of Dictionaries
+        The filter stack, see :func:`filters.stackSpec`.
+
+    Precision : string, optional
+        'single' or 'double'. Defaults to 'single'.
+
+    Options : dictionary, optional
+        Anything else that changes the result, e.g. {'frame': [0, 0, 0]}.
+
+    Returns
+    -------
+    Key : string
+        Hex digest of the above.
+
+    """
+    if Precision not in PRECISIONS:
+        raise ValueError('unknown precision %r' % (Precision,))
+    digest = hashlib.blake2b(digest_size=20)
+    # results follow the layout of the decoded k-space
+    digest.update(('%d;%d;' % (fid_cache.CACHE_VERSION, RESULT_VERSION))
+                  .encode('ascii'))
+    digest.update(Content.encode('ascii'))
+    digest.update(filt.canonicalSpec(Spec).encode('utf-8'))
+    digest.update(Precision.encode('ascii'))
+    digest.update(json.dumps(Options or {}, sort_keys=True,
+                             default=_toJSON).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def derived(Image, Datafilt, Precision='single'):
+    """
+    Returns the arrays stored for a reconstruction.
+
+    Parameters
+    ----------
+    Image : array
+        The complex image.
+
+    Datafilt : array
+        The filtered k-space.
+
+    Precision : string, optional
+        'single' or 'double'. Defaults to 'single'.
+
+    Returns
+    -------
+    Arrays : dictionary
+        image, datafilt, magnitude and phase, in the dtypes of Precision.
+
+    """
+    complexType, realType = PRECISIONS[Precision]
+    return {'image': np.asarray(Image, dtype=complexType),
+            'datafilt': np.asarray(Datafilt, dtype=complexType),
+            'magnitude': np.abs(Image).astype(realType),
+            'phase': np.angle(Image).astype(realType)}
+
+
+class PendingEntry(object):
+    """
+    An entry being written, see :meth:`ResultCache.create`.
+
+    The arrays are memory mapped .npy files in a temporary directory, which
+    is renamed into place by :meth:`commit`.
+
+    """
+    def __init__(self, Cache, Key):
+        self.cache = Cache
+        self.key = Key
+        if not os.path.isdir(Cache.root):
+            os.makedirs(Cache.root)
+        self.path = tempfile.mkdtemp(dir=Cache.root, prefix='.partial-')
+        self.arrays = {}
+
+    def array(self, Name, Shape, Dtype):
+        """ Returns a new writable memory mapped array of the entry """
+        out = np.lib.format.open_memmap(os.path.join(self.path, Name+'.npy'),
+                                        mode='w+', dtype=Dtype,
+                                        shape=tuple(Shape))
+        self.arrays[Name] = out
+        return out
+
+    def commit(self):
+        """ Moves the finished entry into the cache. """
+        for out in self.arrays.values():
+            out.flush()
+        self.arrays = {}
+        entry = os.path.join(self.cache.root, self.key)
+        try:
+            os.rename(self.path, entry)
+        except OSError:
+            # the same result was stored by someone else first
+            shutil.rmtree(self.path, ignore_errors=True)
+        self.cache.trim()
+
+    def discard(self):
+        """ Throws the entry away. """
+        self.arrays = {}
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class ResultCache(object):
+    """
+    Size limited, least recently used, store of reconstruction results.
+
+    Parameters
+    ----------
+    Root : string, optional
+        The cache directory. Defaults to :func:`resultDirectory`.
+
+    Limit : int, optional
+        Size limit in bytes. Defaults to the MRMAGIC_RESULT_CACHE_BYTES
+        environment variable, or :data:`LIMIT_BYTES`.
+
+    """
+    def __init__(self, Root=None, Limit=None):
+        self.root = resultDirectory() if Root is None else Root
+        if Limit is None:
+            Limit = int(os.environ.get('MRMAGIC_RESULT_CACHE_BYTES',
+                                       LIMIT_BYTES))
+        self.limit = Limit
+        self._lock = threading.Lock()
+
+    def get(self, Key):
+        """
+        Opens a cached result.
+
+        Parameters
+        ----------
+        Key : string
+            The :func:`resultKey` of the result.
+
+        Returns
+        -------
+        Arrays : dictionary or None
+            Read-only memory maps of the stored arrays, or None on a miss.
+
+        """
+        entry = os.path.join(self.root, Key)
+        try:
+            arrays = dict((name[:-4], np.load(os.path.join(entry, name),
+                                              mmap_mode='r'))
+                          for name in os.listdir(entry)
+                          if name.endswith('.npy'))
+            # the modification time orders the entries for eviction
+            os.utime(entry)
+        except (IOError, OSError, ValueError):
+            return None
+        return arrays or None
+
+    def create(self, Key):
+        """
+        Starts writing an entry whose arrays are filled in place.
+
+        Parameters
+        ----------
+        Key : string
+            The :func:`resultKey` of the result.
+
+        Returns
+        -------
+        Entry : :class:`PendingEntry`
+            Call :meth:`PendingEntry.commit` once the arrays are written.
+
+        """
+        return PendingEntry(self, Key)
+
+    def put(self, Key, Arrays):
+        """
+        Stores a result.
+
+        Parameters
+        ----------
+        Key : string
+            The :func:`resultKey` of the result.
+
+        Arrays : dictionary
+            Name to array, e.g. the output of :func:`derived`.
+
+        """
+        if os.path.isdir(os.path.join(self.root, Key)):
+            return
+        entry = self.create(Key)
+        try:
+            for name, data in Arrays.items():
+                data = np.asarray(data)
+                entry.array(name, data.shape, data.dtype)[...] = data
+            entry.commit()
+        except Exception:
+            entry.discard()
+            raise
+
+    def size(self):
+        """ Total size of the stored entries in bytes """
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """ (last use, size, path) of every entry """
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, item))
+                           for item in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                # removed by another process
+                continue
+        return entries
+
+    def trim(self, Limit=None):
+        """
+        Removes the least recently used entries until the cache fits.
+
+        Parameters
+        ----------
+        Limit : int, optional
+            Size to trim to in bytes. Defaults to the cache's limit.
+
+        Returns
+        -------
+        Removed : int
+            Bytes freed.
+
+        """
+        limit = self.limit if Limit is None else Limit
+        removed = 0
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= limit:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                removed += size
+        return removed
+
+    def clear(self):
+        """ Removes every entry. """
+        return self.trim(0)
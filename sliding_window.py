@@ -0,0 +1,301 @@
+"""
+.. py:module:: sliding_window
+Sliding Window Module
+=====================
+
+Sliding window reconstruction of dynamic series acquired in interleaved
+phase-encode segments. Each repetition acquires one segment, the lines
+Segment, Segment+Segments, Segment+2*Segments, ... of the frame, and each
+output frame combines the latest lines of every segment, so there is a new
+frame for every segment instead of every Segments repetitions.
+
+The lines are filtered and readout transformed as they arrive, as in
+:mod:`stream_recon`, and kept in a buffer holding the latest copy of every
+line. The phase-encode transform is linear, so when a segment is replaced
+the image is updated by the transform of the change in its lines alone,
+the product of the change with the columns of the centred inverse DFT
+matrix for those lines. That costs a multiply-add per image pixel for
+each line, against about log2 of the lines for the FFT of the whole
+buffer, so it is only used for segments of fewer than log2(lines) lines;
+larger segments are updated with a full FFT of the buffer. The
+incremental image is rebuilt with a full FFT every :data:`REFRESH`
+updates, so rounding errors do not build up.
+
+DC offsets are solved for from running sums kept for each segment, and
+subtracted from the image of the whole window when a frame is returned, the
+same way :class:`stream_recon.FrameAccumulator` does for a whole frame.
+
+"""
+
+import numpy as np
+
+import filters as filt
+import fid_reader
+import gridding
+import partial_fourier
+import recon
+import volume
+from fid_reader import procparValue
+from stream_recon import (LinePlan, StreamingError, _phaseTransform,
+                          _readoutTransform)
+
+
+# incremental updates between full rebuilds of the image
+REFRESH = 64
+
+
+def segments(Procpar):
+    """ Returns the number of interleaved segments of a study, 1 if none """
+    value = procparValue(Procpar, 'nseg', 1.0)
+    if not isinstance(value, float) or value < 1:
+        return 1
+    return int(value)
+
+
+def segmentRows(Lines, Segments, Segment):
+    """ The phase-encode lines acquired in a segment """
+    return np.arange(Segment % Segments, Lines, Segments)
+
+
+class SlidingWindow(object):
+    """
+    Incrementally updated image of the latest lines of every segment.
+
+    Parameters
+    ----------
+    Plan : :class:`stream_recon.LinePlan`
+        The filter stack.
+
+    Segments : int
+        Number of interleaved segments.
+
+    KeepKspace : bool, optional
+        Also keep the filtered k-space so the frame's datafilt can be
+        returned. Defaults to True.
+
+    """
+    def __init__(self, Plan, Segments, KeepKspace=True):
+        self.plan = Plan
+        self.segments = Segments
+        lines, points = Plan.dim
+        width = points if Plan.crop is None else min(Plan.crop, points)
+        self.rows = [segmentRows(lines, Segments, segment)
+                     for segment in range(Segments)]
+        # column j is the phase-encode transform of a line at row j alone,
+        # kept for the segments small enough to be updated incrementally
+        self.basis = [None]*Segments
+        incremental = [segment for segment, rows in enumerate(self.rows)
+                       if len(rows) < np.log2(max(lines, 2))]
+        if incremental:
+            inverse = _phaseTransform(np.eye(lines, dtype=np.complex128))
+            for segment in incremental:
+                self.basis[segment] = \
+                    inverse[:, self.rows[segment]].astype(np.complex64)
+        self.lines = np.zeros((lines, width), dtype=np.complex64)
+        self.image = np.zeros((lines, width), dtype=np.complex64)
+        self.kspace = None
+        if KeepKspace:
+            self.kspace = np.zeros(Plan.dim, dtype=np.complex64)
+        # running DC offset sums of the latest copy of each segment
+        self.sums = np.zeros((Segments, len(Plan.offsets)), dtype=complex)
+        # image of each DC offset spread, subtracted at the end
+        self.offsetImages = [_phaseTransform(offset['transformed'])
+                             for offset in Plan.offsets]
+        self.received = np.zeros(Segments, dtype=bool)
+        self.updates = 0
+
+    @property
+    def complete(self):
+        """ True once every segment has arrived """
+        return bool(self.received.all())
+
+    def update(self, Segment, Lines):
+        """
+        Replaces the lines of a segment.
+
+        Parameters
+        ----------
+        Segment : int
+            The segment, see :func:`segmentRows`.
+
+        Lines : 2D array
+            The raw (line, readout) lines of the segment, in row order.
+
+        """
+        rows = self.rows[Segment]
+        for index, offset in enumerate(self.plan.offsets):
+            self.sums[Segment, index] = np.sum(Lines*offset['weights'][rows])
+        filtered = Lines*self.plan.window[rows]
+        if self.kspace is not None:
+            self.kspace[rows] = filtered
+        transformed = _readoutTransform(filtered, self.plan.crop)
+        self.updates += 1
+        basis = self.basis[Segment]
+        if basis is None or self.updates % REFRESH == 0:
+            self.lines[rows] = transformed
+            self.image[:] = _phaseTransform(self.lines)
+        else:
+            change = transformed-self.lines[rows]
+            self.lines[rows] = transformed
+            self.image += basis @ change.astype(np.complex64)
+        self.received[Segment] = True
+
+    def frame(self):
+        """
+        Returns the frame of the current window.
+
+        Returns
+        -------
+        Datafilt : 2D array or None
+            The filtered k-space, if it was kept.
+
+        Image : 2D array of complex64
+            The reconstructed image.
+
+        """
+        constants = self.plan.constants(list(self.sums.sum(axis=0)))
+        image = self.image.copy()
+        datafilt = None if self.kspace is None else self.kspace.copy()
+        for value, offset, offsetImage in zip(constants, self.plan.offsets,
+                                              self.offsetImages):
+            image -= (value*offsetImage).astype(np.complex64)
+            if datafilt is not None:
+                datafilt -= (value*offset['spread']).astype(np.complex64)
+        return datafilt, image
+
+
+def slidingFrames(Kspace, Stack, Segments, Crop=None, KeepKspace=True,
+                  Oversampling=1.0):
+    """
+    Reconstructs a segmented dynamic series with a sliding window.
+
+    Repetition r acquires segment r % Segments, and reads only the lines
+    of that segment.
+
+    Parameters
+    ----------
+    Kspace : array-like
+        The (rep, slice, echo, phase-encode, readout) k-space, e.g. a
+        :class:`fid_reader.LazyKspace`.
+
+    Stack : 1D array :class:`filters.GFilter`\s
+        The filters, built for the (phase-encode, readout) frame size.
+
+    Segments : int
+        Number of interleaved segments.
+
+    Crop : int, optional
+        Number of readout points kept after the readout FFT.
+
+    KeepKspace : bool, optional
+        Also return the filtered k-space of each frame. Defaults to True.
+
+    Oversampling : float, optional
+        Readout oversampling removed from each line, see
+        :func:`recon.removeOversampling`. Defaults to 1, none.
+
+    Yields
+    ------
+    Frame : tuple
+        The (rep, slice, echo) index, the filtered k-space (or None) and
+        the complex image of the window ending at each repetition. The
+        window fills up over the first Segments repetitions.
+
+    Raises
+    ------
+    StreamingError
+        If the stack holds filters that cannot be applied line by line.
+
+    """
+    shape = np.shape(Kspace)
+    dim = (shape[-2], recon.fovPoints(shape[-1], Oversampling))
+    plan = LinePlan(Stack, dim, Crop)
+    return _slidingFrames(Kspace, plan, Segments, KeepKspace, Oversampling)
+
+
+def _slidingFrames(Kspace, Plan, Segments, KeepKspace, Oversampling):
+    """ Generator behind :func:`slidingFrames`, so errors raise early """
+    reps, slices, echoes = np.shape(Kspace)[:3]
+    windows = {}
+    for rep in range(reps):
+        segment = rep % Segments
+        for slc, echo in np.ndindex(slices, echoes):
+            if (slc, echo) not in windows:
+                windows[slc, echo] = SlidingWindow(Plan, Segments,
+                                                   KeepKspace)
+            window = windows[slc, echo]
+            lines = np.asarray(Kspace[rep, slc, echo, window.rows[segment]])
+            window.update(segment,
+                          recon.removeOversampling(lines, Oversampling))
+            datafilt, image = window.frame()
+            yield (rep, slc, echo), datafilt, image
+
+
+def reconstructSliding(FIDPath, Stack=None, Segments=None, Crop=None,
+                       Oversampling=None):
+    """
+    Sliding window version of :func:`stream_recon.reconstructStream`.
+
+    Parameters
+    ----------
+    FIDPath : string
+        The top level \*.fid folder.
+
+    Stack : 1D array :class:`filters.GFilter`\s or list of Dictionaries
+        Filters applied to each frame. Defaults to :func:`recon.defaultStack`.
+
+    Segments : int, optional
+        Number of interleaved segments. Defaults to the study's
+        :func:`segments`.
+
+    Crop : int, optional
+        Number of readout points kept after the readout FFT.
+
+    Oversampling : float, optional
+        Readout oversampling to remove. Defaults to the study's
+        :func:`recon.readoutOversampling`.
+
+    Returns
+    -------
+    Frames : generator
+        Yields the header, leading shape and stack, then each frame in the
+        same form as :func:`recon.reconstructFrames`.
+
+    Raises
+    ------
+    StreamingError
+        If the stack holds filters that cannot be applied line by line, or
+        the study is partial Fourier, has several receivers, is not
+        Cartesian or is 3D.
+
+    """
+    dic, kspace = fid_reader.readFID(FIDPath)
+    if partial_fourier.acquiredLines(dic['procpar'],
+                                     kspace.shape[-2]) is not None:
+        raise StreamingError('partial Fourier studies are reconstructed a '
+                             'frame at a time')
+    if fid_reader.receiverCount(dic['procpar']) > 1:
+        raise StreamingError('coils are combined a frame at a time')
+    if gridding.trajectoryType(dic['procpar']) is not None:
+        raise StreamingError('radial and spiral studies are gridded a frame '
+                             'at a time')
+    if volume.isVolume(dic['procpar']):
+        raise StreamingError('3D studies need every partition before they '
+                             'are transformed')
+    if Segments is None:
+        Segments = segments(dic['procpar'])
+    if Oversampling is None:
+        Oversampling = recon.readoutOversampling(dic['procpar'])
+    dim = (kspace.shape[-2], recon.fovPoints(kspace.shape[-1], Oversampling))
+    if Stack is None:
+        Stack = recon.defaultStack(dim)
+    elif len(Stack) > 0 and isinstance(Stack[0], dict):
+        Stack = filt.buildStack(Stack, dim)
+    frames = slidingFrames(kspace, Stack, Segments, Crop,
+                           Oversampling=Oversampling)
+
+    def generate():
+        yield dic, tuple(kspace.shape[:-2]), Stack
+        for frame in frames:
+            yield frame
+    return generate()
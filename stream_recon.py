@@ -0,0 +1,406 @@
+"""
+.. py:module:: stream_recon
+Streaming Reconstruction Module
+===============================
+
+Readout-first reconstruction that works on phase-encode lines as they are
+decoded. Each line is multiplied by its row of the filter stack and given
+its readout direction 1D FFT straight away, optionally cropped to the
+prescribed readout field of view. The phase-encode FFT is done once per
+frame, when the last line of that frame arrives.
+
+A stack of linear filters and DC offset corrections is an affine map of the
+k-space, so it can be applied a line at a time. The DC offsets are computed
+from running sums as the lines arrive, and subtracted from the readout
+transformed lines at the end of the frame using the linearity of the FFT.
+The result is the same as :func:`recon.reconstructFrame`. Stacks holding
+log or gamma transforms cannot be split up like this, and raise
+:class:`StreamingError`.
+
+Decoding runs on its own thread, a block of traces ahead of the filtering
+and FFTs.
+
+"""
+
+import queue
+import threading
+
+import numpy as np
+
+import filters as filt
+import fid_reader
+import gridding
+import partial_fourier
+import recon
+import volume
+
+
+# traces decoded at a time by the decoding thread
+CHUNK_TRACES = 256
+
+
+class StreamingError(ValueError):
+    """ Raised for filter stacks that cannot be applied line by line """
+
+
+def cornerWeights(Dim, Size):
+    """
+    Returns the weights that :func:`filters.computeDCOffset` averages with.
+
+    Parameters
+    ----------
+    Dim : tuple
+        Size of the k-space frame.
+
+    Size : int
+        The Size parameter of the DC offset filter.
+
+    Returns
+    -------
+    Weights : 2D array
+        The DC offset of a frame M is sum(M*Weights).
+
+    """
+    weights = np.zeros(Dim)
+    for region in (np.s_[:Size, :Size], np.s_[:-Size, :Size],
+                   np.s_[:-Size, :-Size], np.s_[:Size, :-Size]):
+        count = np.ones(Dim)[region].size
+        if count > 0:
+            weights[region] += 1.0/(4*count)
+    return weights
+
+
+def _readoutTransform(Lines, Crop=None):
+    """ Shifted inverse FFT along the last axis, cropped to Crop points """
+    out = np.fft.ifftshift(np.fft.ifft(np.fft.ifftshift(Lines, axes=-1),
+                                       axis=-1), axes=-1)
+    if Crop is not None and Crop < out.shape[-1]:
+        start = (out.shape[-1]-Crop)//2
+        out = out[..., start:start+Crop]
+    return out
+
+
+def _phaseTransform(Lines):
+    """ Shifted inverse FFT along the phase-encode axis """
+    return np.fft.ifftshift(np.fft.ifft(np.fft.ifftshift(Lines, axes=-2),
+                                        axis=-2), axes=-2)
+
+
+class LinePlan(object):
+    """
+    Precomputed form of a filter stack for line by line application.
+
+    Parameters
+    ----------
+    Stack : 1D array :class:`filters.GFilter`\s
+        The filters, in stack order.
+
+    Dim : tuple
+        Size of the (phase-encode, readout) k-space frames.
+
+    Crop : int, optional
+        Number of readout points kept, centred, after the readout FFT.
+        Defaults to keeping them all.
+
+    """
+    def __init__(self, Stack, Dim, Crop=None):
+        self.dim = tuple(Dim)
+        self.crop = Crop
+        product = np.ones(self.dim)
+        # one entry for each DC offset: the weights of its running sum, the
+        # matrix its constant is spread by, and its dependence on the
+        # constants of earlier offsets
+        self.offsets = []
+        for stackFilter in Stack:
+            par = stackFilter.params
+            if par.get('Type') == 'DC Offset':
+                weights = cornerWeights(self.dim, par.get('Size', 10))
+                prior = [np.sum(offset['spread']*weights)
+                         for offset in self.offsets]
+                self.offsets.append({'weights': product*weights,
+                                     'spread': np.ones(self.dim),
+                                     'prior': prior})
+            elif par.get('Linear') and not par.get('Volume'):
+                window = stackFilter.function(np.ones(self.dim))
+                product = product*window
+                for offset in self.offsets:
+                    offset['spread'] = offset['spread']*window
+            else:
+                raise StreamingError('%s filters cannot be streamed' %
+                                     par.get('Type'))
+        self.window = product
+        # readout transform of each spread matrix, for the end of frame fix
+        for offset in self.offsets:
+            offset['transformed'] = _readoutTransform(offset['spread'], Crop)
+
+    def constants(self, Sums):
+        """ Solves for the DC offsets from their running sums """
+        values = []
+        for offset, total in zip(self.offsets, Sums):
+            values.append(total-sum(value*weight for value, weight in
+                                    zip(values, offset['prior'])))
+        return values
+
+
+class FrameAccumulator(object):
+    """
+    Collects the readout transformed lines of one frame.
+
+    Parameters
+    ----------
+    Plan : :class:`LinePlan`
+        The filter stack.
+
+    KeepKspace : bool, optional
+        Also keep the filtered k-space lines so the frame's datafilt can be
+        returned. Defaults to True.
+
+    """
+    def __init__(self, Plan, KeepKspace=True):
+        self.plan = Plan
+        lines, points = Plan.dim
+        width = points if Plan.crop is None else min(Plan.crop, points)
+        self.lines = np.zeros((lines, width), dtype=np.complex64)
+        self.kspace = None
+        if KeepKspace:
+            self.kspace = np.zeros(Plan.dim, dtype=np.complex64)
+        self.sums = [0j]*len(Plan.offsets)
+        self.received = np.zeros(lines, dtype=bool)
+
+    @property
+    def complete(self):
+        """ True once every phase-encode line has arrived """
+        return bool(self.received.all())
+
+    def add(self, Lines, Rows):
+        """
+        Filters and readout transforms a group of lines of the frame.
+
+        Parameters
+        ----------
+        Lines : 2D array
+            The raw lines, (line, readout).
+
+        Rows : 1D array of ints
+            The phase-encode index of each line.
+
+        """
+        for index, offset in enumerate(self.plan.offsets):
+            self.sums[index] += np.sum(Lines*offset['weights'][Rows])
+        filtered = Lines*self.plan.window[Rows]
+        if self.kspace is not None:
+            self.kspace[Rows] = filtered
+        self.lines[Rows] = _readoutTransform(filtered, self.plan.crop)
+        self.received[Rows] = True
+
+    def finish(self):
+        """
+        Applies the DC offsets and the phase-encode FFT.
+
+        Returns
+        -------
+        Datafilt : 2D array or None
+            The filtered k-space, if it was kept.
+
+        Image : 2D array of complex64
+            The reconstructed image.
+
+        """
+        constants = self.plan.constants(self.sums)
+        for value, offset in zip(constants, self.plan.offsets):
+            self.lines -= value*offset['transformed']
+            if self.kspace is not None:
+                self.kspace -= value*offset['spread']
+        image = _phaseTransform(self.lines).astype(np.complex64)
+        return self.kspace, image
+
+
+def _prefetch(Iterable, Depth=2):
+    """ Runs an iterator on its own thread, Depth items ahead """
+    items = queue.Queue(Depth)
+    finished = object()
+
+    def produce():
+        try:
+            for item in Iterable:
+                items.put(item)
+        except Exception as error:
+            items.put(error)
+        items.put(finished)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is finished:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def decodeLines(Kspace, Chunk=CHUNK_TRACES):
+    """
+    Decodes a study in stored trace order.
+
+    Parameters
+    ----------
+    Kspace : :class:`fid_reader.LazyKspace`
+        The study.
+
+    Chunk : int, optional
+        Traces decoded at a time.
+
+    Yields
+    ------
+    Frames : 2D array of ints
+        The (rep, slice, echo) index of each line.
+
+    Rows : 1D array of ints
+        The phase-encode index of each line.
+
+    Lines : 2D array of complex64
+        The decoded lines.
+
+    """
+    fid = Kspace.fid
+    order = Kspace.order
+    # position of every stored trace in (rep, slice, echo, phase-encode)
+    # order, -1 for traces that are not used
+    position = np.full(fid.header['nblocks']*fid.ntraces, -1, dtype=np.intp)
+    position[order.ravel()] = np.arange(order.size)
+    reps, slices, echoes, rows = np.unravel_index(np.arange(order.size),
+                                                  order.shape)
+    for block in range(fid.nblocks):
+        for start in range(0, fid.ntraces, Chunk):
+            first = block*fid.ntraces+start
+            traces = position[first:first+min(Chunk, fid.ntraces-start)]
+            used = traces >= 0
+            lines = fid_reader.decodeTraces(
+                fid.raw[block, start:start+Chunk][used])
+            traces = traces[used]
+            frames = np.stack([reps[traces], slices[traces],
+                               echoes[traces]], axis=1)
+            yield frames, rows[traces], lines
+
+
+def streamFrames(Kspace, Stack, Crop=None, KeepKspace=True,
+                 Oversampling=1.0):
+    """
+    Reconstructs a study line by line.
+
+    Parameters
+    ----------
+    Kspace : :class:`fid_reader.LazyKspace`
+        The study.
+
+    Stack : 1D array :class:`filters.GFilter`\s
+        The filters, built for the (phase-encode, readout) frame size.
+
+    Crop : int, optional
+        Number of readout points kept after the readout FFT.
+
+    KeepKspace : bool, optional
+        Also return the filtered k-space of each frame. Defaults to True.
+
+    Oversampling : float, optional
+        Readout oversampling removed from each line as it is decoded, see
+        :func:`recon.removeOversampling`. The stack must be built for the
+        reduced frame size. Defaults to 1, none.
+
+    Yields
+    ------
+    Frame : tuple
+        The (rep, slice, echo) index, the filtered k-space (or None) and
+        the complex image of each frame, as soon as it is complete.
+
+    Raises
+    ------
+    StreamingError
+        If the stack holds filters that cannot be applied line by line.
+
+    """
+    dim = (Kspace.shape[-2], recon.fovPoints(Kspace.shape[-1], Oversampling))
+    plan = LinePlan(Stack, dim, Crop)
+    return _streamFrames(Kspace, plan, KeepKspace, Oversampling)
+
+
+def _streamFrames(Kspace, Plan, KeepKspace, Oversampling):
+    """ Generator behind :func:`streamFrames`, so errors raise early """
+    pending = {}
+    for frames, rows, lines in _prefetch(decodeLines(Kspace)):
+        lines = recon.removeOversampling(lines, Oversampling)
+        keys, inverse = np.unique(frames, axis=0, return_inverse=True)
+        for index, key in enumerate(keys):
+            key = tuple(int(k) for k in key)
+            group = inverse.ravel() == index
+            if key not in pending:
+                pending[key] = FrameAccumulator(Plan, KeepKspace)
+            pending[key].add(lines[group], rows[group])
+            if pending[key].complete:
+                datafilt, image = pending.pop(key).finish()
+                yield key, datafilt, image
+
+
+def reconstructStream(FIDPath, Stack=None, Crop=None, Oversampling=None):
+    """
+    Streaming version of :func:`recon.reconstructFrames`.
+
+    The study is read through the lazy reader rather than the cache, so
+    nothing beyond the frames in progress is held in memory.
+
+    Parameters
+    ----------
+    FIDPath : string
+        The top level \*.fid folder.
+
+    Stack : 1D array :class:`filters.GFilter`\s or list of Dictionaries
+        Filters applied to each frame. Defaults to :func:`recon.defaultStack`.
+
+    Crop : int, optional
+        Number of readout points kept after the readout FFT.
+
+    Oversampling : float, optional
+        Readout oversampling to remove. Defaults to the study's
+        :func:`recon.readoutOversampling`.
+
+    Returns
+    -------
+    Frames : generator
+        Yields the header, leading shape and stack, then each frame in the
+        same form as :func:`recon.reconstructFrames`.
+
+    Raises
+    ------
+    StreamingError
+        If the stack holds filters that cannot be applied line by line, or
+        the study is partial Fourier, has several receivers, is not
+        Cartesian or is 3D.
+
+    """
+    dic, kspace = fid_reader.readFID(FIDPath)
+    if partial_fourier.acquiredLines(dic['procpar'],
+                                     kspace.shape[-2]) is not None:
+        raise StreamingError('partial Fourier studies are reconstructed a '
+                             'frame at a time')
+    if fid_reader.receiverCount(dic['procpar']) > 1:
+        raise StreamingError('coils are combined a frame at a time')
+    if gridding.trajectoryType(dic['procpar']) is not None:
+        raise StreamingError('radial and spiral studies are gridded a frame '
+                             'at a time')
+    if volume.isVolume(dic['procpar']):
+        raise StreamingError('3D studies need every partition before they '
+                             'are transformed')
+    if Oversampling is None:
+        Oversampling = recon.readoutOversampling(dic['procpar'])
+    dim = (kspace.shape[-2], recon.fovPoints(kspace.shape[-1], Oversampling))
+    if Stack is None:
+        Stack = recon.defaultStack(dim)
+    elif len(Stack) > 0 and isinstance(Stack[0], dict):
+        Stack = filt.buildStack(Stack, dim)
+    frames = streamFrames(kspace, Stack, Crop, Oversampling=Oversampling)
+
+    def generate():
+        yield dic, tuple(kspace.shape[:-2]), Stack
+        for frame in frames:
+            yield frame
+    return generate()
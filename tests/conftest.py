@@ -0,0 +1,165 @@
+"""
+Shared fixtures of the tests. The modules live at the top of the
+repository, so it is put on the path, and studies are written as small
+Varian fids with a procpar next to them.
+
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import fid_reader  # noqa: E402
+
+
+def writeProcpar(Path, Params):
+    r"""
+    Writes a procpar file.
+
+    Parameters
+    ----------
+    Path : string
+        The \*.fid folder.
+
+    Params : dictionary
+        Parameter name to a value or list of values, strings or numbers.
+
+    """
+    lines = []
+    for name, value in Params.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if isinstance(values[0], str):
+            lines.append('%s 1 2 8 0 0 2 1 0 1 64' % name)
+            lines.append('%d %s' % (len(values), '\n'.join(
+                '"%s"' % item for item in values)))
+        else:
+            lines.append('%s 1 1 1e+18 -1e+18 0 2 1 0 1 64' % name)
+            lines.append('%d %s' % (len(values), ' '.join(
+                repr(float(item)) for item in values)))
+        lines.append('0')
+    with open(os.path.join(Path, 'procpar'), 'w') as procparFile:
+        procparFile.write('\n'.join(lines)+'\n')
+
+
+# status bits and stored dtype of each way the points can be stored
+STORAGE = {'float32': (fid_reader.S_FLOAT, '>f4'),
+           'int32': (fid_reader.S_32, '>i4'),
+           'int16': (0, '>i2')}
+
+
+def writeFID(Path, Data, Params, Storage='float32'):
+    r"""
+    Writes a study as blocks with one block header each.
+
+    Parameters
+    ----------
+    Path : string
+        The \*.fid folder, created if it does not exist.
+
+    Data : 3D array
+        The complex (block, trace, readout) data.
+
+    Params : dictionary
+        The procpar, see :func:`writeProcpar`.
+
+    Storage : string, optional
+        How the points are stored, one of :data:`STORAGE`. Integer points
+        are rounded. Defaults to 'float32'.
+
+    Returns
+    -------
+    Filename : string
+        The fid file.
+
+    """
+    if not os.path.isdir(Path):
+        os.makedirs(Path)
+    blocks, traces, points = Data.shape
+    status, dtype = STORAGE[Storage]
+    ebytes = np.dtype(dtype).itemsize
+    head = np.zeros(1, fid_reader.FILE_HEADER)
+    head['nblocks'] = blocks
+    head['ntraces'] = traces
+    head['np'] = points*2
+    head['ebytes'] = ebytes
+    head['tbytes'] = points*2*ebytes
+    head['bbytes'] = traces*points*2*ebytes+fid_reader.BLOCK_HEADER.itemsize
+    head['status'] = status | 1
+    head['nbheaders'] = 1
+    stored = np.empty((blocks, traces, points, 2), dtype=dtype)
+    if Storage == 'float32':
+        stored[..., 0] = Data.real
+        stored[..., 1] = Data.imag
+    else:
+        stored[..., 0] = np.round(Data.real)
+        stored[..., 1] = np.round(Data.imag)
+    filename = os.path.join(Path, 'fid')
+    with open(filename, 'wb') as fidFile:
+        fidFile.write(head.tobytes())
+        for block in stored:
+            fidFile.write(np.zeros(1, fid_reader.BLOCK_HEADER).tobytes())
+            fidFile.write(block.tobytes())
+    writeProcpar(Path, Params)
+    return filename
+
+
+def phantom(Lines, Points, Shift=(0.0, 0.0)):
+    """ A smooth off-centre ellipse, optionally moved by Shift pixels """
+    rows, columns = np.meshgrid(np.arange(Lines)-Lines/2.0-Shift[0],
+                                np.arange(Points)-Points/2.0-Shift[1],
+                                indexing='ij')
+    radius = (rows/(0.3*Lines))**2+((columns-0.1*Points)/(0.25*Points))**2
+    return np.exp(-4*radius**2).astype(np.complex64)
+
+
+def blocks(Size):
+    """ A piecewise constant image with sharp edges """
+    image = np.zeros((Size, Size), dtype=np.complex64)
+    image[Size//6:Size//2, Size//5:Size*5//8] = 1.0
+    image[Size*9//16:Size*7//8, Size//3:Size//2] = 0.6
+    rows, columns = np.mgrid[:Size, :Size]
+    image[(rows-Size*5//8)**2+(columns-Size*3//4)**2 < (Size//8)**2] = 0.8
+    return image
+
+
+def kspaceOf(Image):
+    """ Centred k-space of an image, the inverse of recon.transform """
+    return np.fft.fftshift(np.fft.fft2(np.fft.fftshift(Image))) \
+        .astype(np.complex64)
+
+
+def volumeStudy(Study, Reps=2):
+    """ A 3D study of 4 partitions, each an acquired block per rep """
+    partitions = 4
+    image = np.stack([phantom(16, 24, (part, 0.0))*(1+part)
+                      for part in range(partitions)])
+    kspace = np.fft.fftshift(np.fft.fftn(np.fft.fftshift(image)))
+    # the phase-encode loop runs inside the partition loop
+    traces = kspace.reshape(1, partitions*16, 24).astype(np.complex64)
+    return Study('volume', np.repeat(traces, Reps, axis=0), nv=16,
+                 nv2=partitions)
+
+
+@pytest.fixture
+def study(tmp_path):
+    r"""
+    Returns a function writing a 2D study of single-block repetitions.
+
+    The function takes the name of the study and its (rep, pe, readout)
+    k-space, and returns the \*.fid folder.
+
+    """
+    def write(Name, Kspace, **Params):
+        reps, lines, points = Kspace.shape
+        params = {'nv': lines, 'np': points*2, 'ne': 1, 'seqcon': 'nccnn',
+                  'lro': 1.0, 'lpe': 1.0}
+        params.update(Params)
+        path = str(tmp_path/(Name+'.fid'))
+        writeFID(path, np.asarray(Kspace), params)
+        return path
+    return write
@@ -0,0 +1,57 @@
+"""
+Tests of the averaging of repetitions.
+
+"""
+
+import numpy as np
+
+import averaging
+
+from conftest import kspaceOf, phantom
+
+
+def noisyReps(Reps, Seed=1):
+    """ (rep, pe, ro) k-space of repetitions of a phantom with noise """
+    rng = np.random.default_rng(Seed)
+    noise = rng.standard_normal((Reps, 32, 32, 2))*0.05
+    return (kspaceOf(phantom(32, 32)) +
+            (noise[..., 0]+1j*noise[..., 1])).astype(np.complex64)
+
+
+def testAverageKspaceIsTheMean():
+    reps = noisyReps(8)
+    averager = averaging.averageKspace(reps[:, None, None],
+                                       PhaseCorrection=False, Reject=None)
+    # one repetition of the (coil, slice, echo, pe, ro) study
+    assert averager.mean.shape == (1, 1, 1, 32, 32)
+    assert averager.count == 8
+    assert np.allclose(averager.mean[0, 0, 0], reps.mean(axis=0),
+                       atol=1e-4)
+
+
+def testPhaseCorrectionRemovesDrift():
+    reps = noisyReps(8)
+    rng = np.random.default_rng(2)
+    phases = np.exp(1j*rng.uniform(-3, 3, 8)).astype(np.complex64)
+    phases /= phases[0]
+    drifted = reps*phases[:, None, None]
+    averager = averaging.averageKspace(drifted[:, None, None], Reject=None)
+    scale = np.abs(reps).max()
+    assert np.allclose(averager.mean[0, 0, 0], reps.mean(axis=0),
+                       atol=1e-3*scale)
+    # without the correction the repetitions cancel
+    uncorrected = averaging.averageKspace(drifted[:, None, None],
+                                          PhaseCorrection=False, Reject=None)
+    assert np.abs(uncorrected.mean).max() < 0.8*np.abs(averager.mean).max()
+
+
+def testOutlierRepetitionIsRejected():
+    reps = noisyReps(8)
+    spoilt = reps.copy()
+    spoilt[5] += kspaceOf(phantom(32, 32, (6.0, 0.0)))
+    averager = averaging.averageKspace(spoilt[:, None, None],
+                                       PhaseCorrection=False)
+    assert averager.stats()['rejected'] == [5]
+    assert averager.count == 7
+    assert np.allclose(averager.mean[0, 0, 0],
+                       np.delete(reps, 5, axis=0).mean(axis=0), atol=1e-4)
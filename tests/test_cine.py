@@ -0,0 +1,122 @@
+"""
+Tests of the prerendered cine playback.
+
+"""
+
+import threading
+import time
+
+import numpy as np
+
+import cine
+
+
+def frameImage(Frame, Shape=(6, 4)):
+    """ A magnitude image telling its frame apart, (rows, columns) """
+    rows, columns = np.indices(Shape)
+    return (Frame+1)*(rows+2*columns).astype(np.float32)
+
+
+def waitFor(Condition, Seconds=10):
+    """ Polls until Condition is true, for at most Seconds """
+    end = time.time()+Seconds
+    while not Condition():
+        assert time.time() < end
+        time.sleep(0.001)
+
+
+def show(Player, Frames):
+    """ Ticks until Frames frames are shown, returning them and a copy """
+    shown = []
+    while len(shown) < Frames:
+        frame, image = Player.next()
+        if frame is None:
+            time.sleep(0.001)
+            continue
+        shown.append((frame, image.copy()))
+    return shown
+
+
+def testRingShowsEveryFrameInOrder():
+    table = cine.colourTable('gray')
+    window = (0.0, 100.0)
+    frames = list(range(10))
+    player = cine.CinePlayer(frames, frameImage, (6, 4), table, window,
+                             Size=4)
+    try:
+        assert player.ring.shape == (4, 4, 6, 4)
+        shown = show(player, 12)
+        # round the series and on, each the transposed image colour mapped
+        assert [frame for frame, _ in shown] == frames+frames[:2]
+        for frame, image in shown:
+            assert np.array_equal(image, cine.render(frameImage(frame).T,
+                                                     table, window))
+        # the renderer never gets further ahead than the ring
+        assert player.rendered-player.shown <= len(player.ring)-1
+    finally:
+        player.stop()
+    assert player.error is None
+
+
+def testShortSeriesLoopsFromTheRing():
+    calls = []
+
+    def reconstruct(Frame):
+        calls.append(Frame)
+        return frameImage(Frame)
+    player = cine.CinePlayer([0, 1, 2], reconstruct, (6, 4),
+                             cine.colourTable('gray'))
+    try:
+        assert len(player.ring) == 3
+        shown = show(player, 7)
+        assert [frame for frame, _ in shown] == [0, 1, 2, 0, 1, 2, 0]
+        assert np.array_equal(shown[0][1], shown[3][1])
+        # rendered once, with the window of the first frame
+        assert calls == [0, 1, 2]
+        assert player.window == (0.0, float(frameImage(0).max()))
+    finally:
+        player.stop()
+
+
+def testTicksWaitingForFirstFrameAreNotDropped():
+    gate = threading.Semaphore(0)
+
+    def reconstruct(Frame):
+        gate.acquire()
+        return frameImage(Frame)
+    player = cine.CinePlayer(list(range(4)), reconstruct, (6, 4),
+                             cine.colourTable('gray'), (0.0, 50.0),
+                             Size=4, FrameRate=1.0)
+    try:
+        for _ in range(3):
+            assert player.next() == (None, None)
+        assert player.stats()['dropped'] == 0 and player.started is None
+        gate.release()
+        waitFor(lambda: player.rendered == 1)
+        assert player.next()[0] == 0
+        # the second frame is late to render, which is a drop
+        assert player.next() == (None, None)
+        assert player.stats()['dropped'] == 1
+        # a tick well after the last one is late, as well as dropped
+        player.lastTick -= 2*cine.LATE_FACTOR*player.period
+        assert player.next() == (None, None)
+        gate.release()
+        waitFor(lambda: player.rendered == 2)
+        assert player.next()[0] == 1
+        stats = player.stats()
+        assert (stats['shown'], stats['dropped'], stats['late']) == (2, 2, 1)
+    finally:
+        gate.release()
+        gate.release()
+        player.stop()
+
+
+def testRenderErrorStopsThePlayer():
+    def reconstruct(Frame):
+        raise ValueError('frame %d' % Frame)
+    player = cine.CinePlayer([0, 1], reconstruct, (6, 4),
+                             cine.colourTable('gray'))
+    waitFor(lambda: player.error is not None)
+    player.stop()
+    assert str(player.error) == 'frame 0'
+    assert player.next() == (None, None)
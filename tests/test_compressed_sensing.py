@@ -0,0 +1,77 @@
+"""
+Tests of the compressed sensing reconstruction and its warm start.
+
+"""
+
+import numpy as np
+
+import compressed_sensing
+import filters
+import recon
+
+from conftest import blocks, kspaceOf, phantom
+
+
+def undersampled(Image, Seed=0):
+    """ Centred k-space of Image with a random third of the lines kept """
+    kspace = kspaceOf(Image)
+    lines = Image.shape[0]
+    rng = np.random.default_rng(Seed)
+    keep = rng.random(lines) < 0.35
+    # the centre is always acquired
+    keep[lines//2-4:lines//2+4] = True
+    return kspace*keep[:, None].astype(np.complex64)
+
+
+def error(Kspace, Image):
+    """ Relative error of the image of Kspace """
+    image = np.abs(recon.transform(Kspace))
+    truth = np.abs(recon.transform(kspaceOf(Image)))
+    return np.linalg.norm(image-truth)/np.linalg.norm(truth)
+
+
+def testReconstructionBeatsZeroFilling():
+    image = blocks(64)
+    kspace = undersampled(image)
+    for method in compressed_sensing.METHODS:
+        filled = compressed_sensing.reconstruct(kspace, method, Lambda=0.005,
+                                                Iterations=60)
+        acquired = kspace != 0
+        assert np.array_equal(filled[acquired], kspace[acquired])
+        assert error(filled, image) < 0.5*error(kspace, image)
+
+
+def testFullySampledKspaceIsUnchanged():
+    kspace = kspaceOf(phantom(32, 32))
+    assert compressed_sensing.reconstruct(kspace) is kspace
+
+
+def testWarmStartComesFromPreviousSlice():
+    first = undersampled(phantom(32, 32))
+    second = undersampled(phantom(32, 32, (1.0, 0.5)))
+    cold = compressed_sensing.Solver((32, 32), Iterations=3)
+    expected = cold.solve(second)
+    solver = compressed_sensing.Solver((32, 32), Iterations=3,
+                                       WarmStart=True)
+    solver.solve(first, Frame=(0, 0, 0))
+    # another echo, or a slice further on, has nothing to start from
+    assert np.array_equal(solver.solve(second, Frame=(0, 1, 1)), expected)
+    assert np.array_equal(solver.solve(second, Frame=(0, 2, 0)), expected)
+    assert np.array_equal(solver.solve(second), expected)
+    warm = solver.solve(second, Frame=(0, 1, 0))
+    assert not np.array_equal(warm, expected)
+    # each start is used once
+    assert (0, 0, 0) not in solver.previous
+
+
+def testCoilStagesAreGivenTheFrame():
+    coils = np.stack([undersampled(phantom(32, 32)*weight)
+                      for weight in (1.0, 0.5)])
+    stack = [filters.makeCS(Iterations=3, WarmStart=True)]
+    filters.applyCoilStack(coils, stack, (0, 0, 0))
+    solver = compressed_sensing.solver((32, 32), Iterations=3,
+                                       WarmStart=True)
+    assert (0, 0, 0, 0) in solver.previous and \
+        (1, 0, 0, 0) in solver.previous
+    assert filters.warmStarted(stack)
+    assert not filters.warmStarted([filters.makeCS()])
@@ -0,0 +1,103 @@
+"""
+Tests of the cache of decoded FIDs.
+
+"""
+
+import os
+import time
+
+import numpy as np
+
+import fid_cache
+import fid_reader
+
+from conftest import kspaceOf, phantom
+
+
+def series(Reps=3):
+    """ (rep, pe, ro) k-space of a few repetitions of the phantom """
+    return np.stack([kspaceOf(phantom(16, 24, (rep, 0.0)))
+                     for rep in range(Reps)])
+
+
+def age(Path, Seconds):
+    """ Moves the modification time of a file or directory back """
+    then = time.time()-Seconds
+    os.utime(Path, (then, then))
+
+
+def entries(Root):
+    """ The keyed entries of a cache directory """
+    return sorted(name for name in os.listdir(Root) if
+                  not name.startswith(fid_cache.PARTIAL_PREFIX))
+
+
+def testStoredStudyIsMappedBack(study, tmp_path, monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'cache'))
+    path = study('series', series())
+    assert fid_cache.load(path) == (None, None)
+    dic, data = fid_cache.readFID(path)
+    # decoded into the cache on the first open, and mapped from then on
+    assert isinstance(data, np.memmap)
+    expected = np.asarray(fid_reader.readFID(path)[1])
+    assert np.array_equal(data, expected)
+    assert dic['procpar'] == fid_reader.readFID(path)[0]['procpar']
+    _, cached = fid_cache.load(path)
+    assert np.array_equal(cached, expected)
+
+
+def testKeyChangesWhenFidIsTouched(study):
+    path = study('series', series())
+    key = fid_cache.cacheKey(path)
+    assert fid_cache.cacheKey(path) == key
+    age(fid_reader.fidFilename(path), 60)
+    assert fid_cache.cacheKey(path) != key
+
+
+def testReadFIDFallsBackWhenReloadFails(study, tmp_path, monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'cache'))
+    path = study('series', series())
+    # as if another process trimmed the entry straight after it was stored
+    monkeypatch.setattr(fid_cache, 'load', lambda Path: (None, None))
+    dic, data = fid_cache.readFID(path)
+    assert dic is not None
+    assert np.array_equal(np.asarray(data),
+                          np.asarray(fid_reader.readFID(path)[1]))
+
+
+def testStudiesLargerThanLimitAreNotStored(study, tmp_path, monkeypatch):
+    root = str(tmp_path/'cache')
+    monkeypatch.setenv('MRMAGIC_CACHE', root)
+    small = study('small', series(1))
+    fid_cache.readFID(small)
+    assert len(entries(root)) == 1
+    monkeypatch.setenv('MRMAGIC_FID_CACHE_BYTES', str(16*24*8*2))
+    large = study('large', series(3))
+    _, data = fid_cache.readFID(large)
+    assert isinstance(data, fid_reader.LazyKspace)
+    # the cache is not emptied for a study that could never fit
+    assert len(entries(root)) == 1
+
+
+def testTrimRemovesOldestEntriesAndStalePartials(study, tmp_path,
+                                                 monkeypatch):
+    root = str(tmp_path/'cache')
+    monkeypatch.setenv('MRMAGIC_CACHE', root)
+    paths = [study(name, series()) for name in ('first', 'second')]
+    for seconds, path in zip((120, 60), paths):
+        fid_cache.readFID(path)
+        age(os.path.join(root, fid_cache.cacheKey(path)), seconds)
+    stale = os.path.join(root, fid_cache.PARTIAL_PREFIX+'dead')
+    fresh = os.path.join(root, fid_cache.PARTIAL_PREFIX+'writing')
+    for partial in (stale, fresh):
+        os.makedirs(partial)
+    age(stale, 2*fid_cache.PARTIAL_SECONDS)
+    size = 3*16*24*8
+    freed = fid_cache.trim(2*size, root)
+    # the least recently used entry goes, and only the abandoned partial
+    assert freed >= size
+    assert entries(root) == [fid_cache.cacheKey(paths[1])]
+    assert not os.path.exists(stale) and os.path.isdir(fresh)
+    age(fresh, 2*fid_cache.PARTIAL_SECONDS)
+    assert fid_cache.removeStale(root) == 1
+    assert fid_cache.trim(0, root) > 0 and entries(root) == []
@@ -0,0 +1,202 @@
+"""
+Tests of the lazily decoded Varian FID reader.
+
+"""
+
+import os
+import warnings
+
+import nmrglue as ng
+import numpy as np
+import pytest
+
+import fid_reader
+
+from conftest import kspaceOf, phantom, writeFID
+
+
+def series(Reps=3, Lines=16, Points=24):
+    """ (rep, pe, ro) k-space of a phantom moving between repetitions """
+    return np.stack([kspaceOf(phantom(Lines, Points, (rep, 0.0)))
+                     for rep in range(Reps)])
+
+
+def readNmrglue(Path, Shape):
+    """ The baseline read: nmrglue's raw traces in the k-space shape """
+    with warnings.catch_warnings():
+        # the shape cannot be told from these procpars, which is expected
+        warnings.simplefilter('ignore')
+        _, data = ng.varian.read(Path)
+    return np.reshape(data, Shape)
+
+
+@pytest.mark.parametrize('storage', ['float32', 'int32', 'int16'])
+def testLazyKspaceMatchesNmrglue(tmp_path, storage):
+    # scaled to use most of the int16 range
+    kspace = series()*500
+    path = str(tmp_path/'series.fid')
+    writeFID(path, kspace, {'nv': 16, 'np': 48, 'ne': 1, 'seqcon': 'nccnn'},
+             storage)
+    dic, lazy = fid_reader.readFID(path)
+    assert lazy.shape == (3, 1, 1, 16, 24)
+    expected = readNmrglue(path, lazy.shape)
+    assert np.allclose(expected[:, 0, 0], kspace, atol=1)
+    assert np.array_equal(np.asarray(lazy), expected)
+    # indexing reads only the traces asked for
+    assert np.array_equal(lazy[1, 0, 0, 3:7], expected[1, 0, 0, 3:7])
+    assert np.array_equal(lazy.fid[2, ::3], expected[2, 0, 0, ::3])
+    assert dic['procpar']['nv']['values'] == ['16.0']
+
+
+def testPartialRepOfTruncatedFid(study):
+    kspace = series()
+    path = study('growing', kspace)
+    fidName = fid_reader.fidFilename(path)
+    fid = fid_reader.LazyFID(path)
+    traceBytes = fid.header['tbytes']
+    complete = fid.header['bbytes']
+    # two whole blocks, then the header, 5 traces and part of a sixth of
+    # the third
+    size = fid_reader.FILE_HEADER.itemsize+2*complete + \
+        fid_reader.BLOCK_HEADER.itemsize+5*traceBytes+traceBytes//2
+    with open(fidName, 'rb') as fidFile:
+        data = fidFile.read(size)
+    with open(fidName, 'wb') as fidFile:
+        fidFile.write(data)
+    _, lazy = fid_reader.readFID(path)
+    assert not lazy.fid.complete and lazy.reps == 2
+    assert np.array_equal(np.asarray(lazy)[:, 0, 0], kspace[:2])
+    present, lines = lazy.partialRep()
+    assert present.shape == (1, 1, 16)
+    assert np.array_equal(np.flatnonzero(present), np.arange(5))
+    assert np.array_equal(lines[0, 0, :5], kspace[2, :5])
+    assert not np.any(lines[0, 0, 5:])
+    # nothing is partial once the fid is complete
+    os.remove(fidName)
+    study('growing', kspace)
+    _, lazy = fid_reader.readFID(path)
+    assert lazy.partialRep() == (None, None)
+
+
+def testParallelDecodeMatchesSingleThread(tmp_path):
+    rng = np.random.default_rng(0)
+    data = (rng.integers(-2000, 2000, (13, 16, 24)) +
+            1j*rng.integers(-2000, 2000, (13, 16, 24)))
+    path = str(tmp_path/'blocks.fid')
+    writeFID(path, data, {'nv': 16, 'np': 48}, 'int16')
+    raw = fid_reader.LazyFID(path).raw
+    orders = [np.arange(16), rng.permutation(16), np.arange(4, 12)]
+    # by blocks, and by runs of traces that do not divide the blocks
+    for workers in (1, 3, 5, 7):
+        for order in orders:
+            expected = fid_reader.decodeTraces(raw[:, order])
+            decoded = fid_reader.parallelDecode(raw, order, Workers=workers)
+            assert np.array_equal(decoded, expected)
+    out = np.zeros((13, 8, 24), dtype=np.complex64)
+    assert fid_reader.parallelDecode(raw, orders[2], out, 3) is out
+    assert np.array_equal(out, data[:, 4:12])
+
+
+def testDecodeIntoMatchesIndexing(tmp_path):
+    kspace = series(6)
+    path = str(tmp_path/'blocks.fid')
+    writeFID(path, kspace, {'nv': 16, 'np': 48})
+    fid = fid_reader.LazyFID(path)
+    rng = np.random.default_rng(1)
+    # one block to each repetition, and repetitions split over two blocks
+    split = np.arange(6*16).reshape(3, 2, 16).transpose(0, 2, 1)
+    layouts = [rng.permutation(16).reshape(1, 1, 16),
+               split.reshape(3, 1, 1, 32)]
+    for order, blockOrder in zip(layouts, (True, False)):
+        lazy = fid_reader.LazyKspace(fid, order)
+        assert (lazy.blockOrder is not None) == blockOrder
+        expected = np.stack([lazy[rep] for rep in range(lazy.reps)])
+        for workers in (1, 4):
+            out = np.empty(lazy.shape, dtype=np.complex64)
+            assert lazy.decodeInto(out, workers) is out
+            assert np.array_equal(out, expected)
+
+
+def procpar(**Params):
+    """ A procpar dictionary of the given values """
+    return {name: {'values': [str(item) for item in
+                              (value if isinstance(value, list)
+                               else [value])]}
+            for name, value in Params.items()}
+
+
+def testCompressedLoopsVaryEchoesFastest():
+    order = fid_reader.acquisitionOrder(
+        procpar(seqcon='nccnn', ne=2, nv=4, pss=[0.0, 1.0]), 3, 16)
+    assert order.shape == (3, 2, 2, 4)
+    rep, slc, echo, line = np.indices(order.shape)
+    assert np.array_equal(order, rep*16+echo+2*slc+4*line)
+
+
+@pytest.mark.parametrize('seqcon', ['nscnn', 'ncsnn', 'sccnn'])
+def testStandardLoopsAreStoredOverBlocks(seqcon):
+    sizes = {'ne': 2, 'pss': [0.0, 1.0, 2.0], 'nv': 4}
+    loops = [('ne', 2), ('pss', 3), ('nv', 4)]
+    # the standard loop is the one marked 's', echo, slice or phase-encode
+    standard = {'sccnn': 'ne', 'nscnn': 'pss', 'ncsnn': 'nv'}[seqcon]
+    steps = dict(loops)[standard]
+    traces = 24//steps
+    order = fid_reader.acquisitionOrder(
+        procpar(seqcon=seqcon, **sizes), 2*steps, traces)
+    assert order.shape == (2, 3, 2, 4)
+    rep, slc, echo, line = np.indices(order.shape)
+    index = {'ne': echo, 'pss': slc, 'nv': line}
+    trace = np.zeros_like(order)
+    stride = 1
+    for name, size in loops:
+        if name != standard:
+            trace += index[name]*stride
+            stride *= size
+    block = rep*steps+index[standard]
+    assert np.array_equal(order, block*traces+trace)
+
+
+def testInterleavedSlicesAreSortedByPosition():
+    order = fid_reader.acquisitionOrder(
+        procpar(nv=4, pss=[0.2, -0.4, 0.0]), 1, 12)
+    # the slices were acquired as 0.2, -0.4, 0.0
+    assert np.array_equal(order[0, :, 0, 0], [1, 2, 0])
+    assert np.array_equal(order[0, :, 0, 1], [4, 5, 3])
+
+
+def testPartitionsAreOnTheSliceAxis():
+    order = fid_reader.acquisitionOrder(procpar(nv=4, nv2=3), 2, 12)
+    assert order.shape == (2, 3, 1, 4)
+    assert np.array_equal(order[1, 2], [[12+8+line for line in range(4)]])
+
+
+def testPetableReordersLines(tmp_path):
+    with open(str(tmp_path/'table'), 'w') as tableFile:
+        tableFile.write('t1 =\n 1 -2 0\n -1\nt2 = 5 6 7 8\n')
+    assert np.array_equal(fid_reader.readPetable('table', [str(tmp_path)]),
+                          [1, -2, 0, -1])
+    assert fid_reader.readPetable('missing', [str(tmp_path)]) is None
+    order = fid_reader.procparOrder(procpar(nv=4, petable='table'), 1, 4,
+                                    str(tmp_path))
+    # the lines come out in order of their step, -2, -1, 0, 1
+    assert np.array_equal(order[0, 0, 0], [1, 3, 2, 0])
+    # a table that is not a permutation of the lines is ignored
+    with open(str(tmp_path/'table'), 'w') as tableFile:
+        tableFile.write('t1 = 0 0 1 2\n')
+    order = fid_reader.procparOrder(procpar(nv=4, petable='table'), 1, 4,
+                                    str(tmp_path))
+    assert np.array_equal(order[0, 0, 0], np.arange(4))
+
+
+def testReceiverCopiesAreNextToEachOther():
+    order = fid_reader.acquisitionOrder(procpar(nv=4, rcvrs='yny'), 4, 4)
+    # rep r of coil c is at r*2+c, and each coil stores its own block
+    assert order.shape == (4, 1, 1, 4)
+    assert np.array_equal(order[:, 0, 0, 0], [0, 4, 8, 12])
+    with pytest.raises(ValueError):
+        fid_reader.acquisitionOrder(procpar(nv=4, rcvrs='yny'), 3, 4)
+
+
+def testUnexplainedLayoutIsOneBlockPerRep():
+    order = fid_reader.acquisitionOrder(procpar(nv=6, ne=2), 2, 8)
+    assert np.array_equal(order, np.arange(16).reshape(2, 1, 1, 8))
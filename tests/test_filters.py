@@ -0,0 +1,47 @@
+"""
+Tests of the image masks in filters.
+
+"""
+
+import inspect
+
+import numpy as np
+
+import filters
+
+from conftest import blocks
+
+
+def testMaskIsBooleanAtDefaultThreshold():
+    image = np.array([[0.0, 0.05, 0.1], [0.2, -0.5j, 1.0]])
+    assert inspect.signature(filters.mask).parameters['Threshold'] \
+        .default == 0.1
+    mask = filters.mask(image)
+    assert mask.dtype == bool and mask.shape == image.shape
+    # pixels at the threshold are kept, by magnitude
+    assert np.array_equal(mask, [[False, False, True], [True, True, True]])
+    # a zero threshold still leaves out pixels with no signal
+    assert np.array_equal(filters.mask(image, 0.0),
+                          [[False, True, True], [True, True, True]])
+
+
+def testOtsuThresholdSeparatesSignalFromBackground():
+    rng = np.random.default_rng(0)
+    noise = 0.02*rng.standard_normal((64, 64))
+    image = blocks(64)+noise
+    threshold = filters.otsuThreshold(image)
+    # between the noise and the weakest block, 0.6
+    assert np.abs(noise).max() < threshold < 0.6-np.abs(noise).max()
+    mask = filters.mask(image, None)
+    assert mask.dtype == bool
+    assert np.array_equal(mask, blocks(64) != 0)
+
+
+def testMaskCacheRebuildsOnNewVersion():
+    cache = filters.MaskCache()
+    assert cache.threshold == 0.1
+    image = blocks(16)
+    mask = cache.get(image, 1)
+    assert mask.dtype == bool
+    assert cache.get(2*image, 1) is mask
+    assert np.array_equal(cache.get(0.1*image, 2), 0.1*np.abs(image) >= 0.1)
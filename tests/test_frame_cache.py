@@ -0,0 +1,94 @@
+"""
+Tests of the cache of reconstructed frames and its prefetch.
+
+"""
+
+import threading
+
+import numpy as np
+
+import frame_cache
+import recon
+import result_cache
+
+from conftest import kspaceOf, phantom
+
+
+def series(Reps=5):
+    """ (rep, pe, ro) k-space of a moving phantom """
+    return np.stack([kspaceOf(phantom(16, 24, (rep, 0.0)))
+                     for rep in range(Reps)])
+
+
+def reconstructor(Kspace, Stack):
+    """ Reconstructs a (rep, 0, 0) frame of the series into its results """
+    def reconstruct(Frame):
+        return result_cache.derived(*reversed(recon.reconstructFrame(
+            Kspace[Frame[0]], Stack, Frame=Frame)))
+    return reconstruct
+
+
+def waitForPrefetch(Cache):
+    """ Waits for the queued prefetches, returning their results """
+    with Cache._lock:
+        pending = dict(Cache.pending)
+    return dict((frame, future.result()) for frame, future in
+                pending.items())
+
+
+def testPrefetchedFramesMatchDirectReconstruction():
+    kspace = series()
+    stack = recon.defaultStack()
+    reconstruct = reconstructor(kspace, stack)
+    cache = frame_cache.FrameCache()
+    cache.get((2, 0, 0), reconstruct)
+    # one reconstruction timed, so the depth follows from it
+    depth = cache.depth()
+    cache.prefetch((2, 0, 0), 0, (5, 1, 1), reconstruct)
+    prefetched = waitForPrefetch(cache)
+    assert sorted(prefetched) == [(rep, 0, 0) for rep in range(5)
+                                  if 0 < abs(rep-2) <= depth]
+    for frame in prefetched:
+        results = cache.get(frame, reconstruct)
+        datafilt, image = recon.reconstructFrame(kspace[frame[0]], stack,
+                                                 Frame=frame)
+        assert np.array_equal(results['image'], image)
+        assert np.array_equal(results['datafilt'], datafilt)
+        assert np.array_equal(results['magnitude'],
+                              np.abs(image).astype(np.float32))
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['hits'] == len(prefetched)
+
+
+def testNewSettingsDropPrefetchedFrames():
+    kspace = series()
+    cache = frame_cache.FrameCache()
+    cache.setSettings('old')
+    old = reconstructor(kspace, recon.defaultStack())
+    cache.prefetch((0, 0, 0), 0, (5, 1, 1), old)
+    waitForPrefetch(cache)
+    assert list(cache.frames) == [(1, 0, 0)]
+    started = threading.Event()
+    finish = threading.Event()
+
+    def blocked(Frame):
+        started.set()
+        finish.wait(10)
+        return old(Frame)
+    cache.prefetch((1, 0, 0), 0, (5, 1, 1), blocked)
+    assert started.wait(10)
+    futures = list(cache.pending.values())
+    # the settings change while a prefetch for the old ones is running
+    cache.setSettings('new')
+    assert cache.frames == {} and cache.stats()['pending'] == 0
+    finish.set()
+    # the running prefetch and those queued behind it are thrown away
+    assert [future.result() for future in futures] == [None]*len(futures)
+    assert cache.frames == {}
+    new = reconstructor(2*kspace, recon.defaultStack())
+    results = cache.get((1, 0, 0), new)
+    assert np.allclose(results['image'], 2*old((1, 0, 0))['image'],
+                       atol=1e-4)
+    # setting the same settings again keeps the frames
+    cache.setSettings('new')
+    assert list(cache.frames) == [(1, 0, 0)]
@@ -0,0 +1,52 @@
+"""
+Tests of the GRAPPA reconstruction of undersampled coil data.
+
+"""
+
+import numpy as np
+import pytest
+
+import grappa
+import recon
+
+from conftest import blocks, kspaceOf, phantom
+
+
+def coilKspace(Size=64):
+    """ (coil, pe, ro) k-space of four coils in the corners """
+    image = blocks(Size)+0.5*phantom(Size, Size)
+    rows, columns = np.mgrid[:Size, :Size]-Size/2.0
+    corners = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+    return np.array([kspaceOf(image*np.exp(
+        -((rows-row*Size/2.0)**2+(columns-column*Size/2.0)**2) /
+        (2*(0.375*Size)**2))*np.exp(0.05j*coil*rows))
+        for coil, (row, column) in enumerate(corners)])
+
+
+def rssError(Kspace, Truth):
+    """ Relative error of the root sum of squares image of Kspace """
+    image = np.sqrt(np.sum(np.abs(recon.transform(Kspace))**2, axis=0))
+    truth = np.sqrt(np.sum(np.abs(recon.transform(Truth))**2, axis=0))
+    return np.linalg.norm(image-truth)/np.linalg.norm(truth)
+
+
+@pytest.mark.parametrize('acceleration', [2, 3])
+def testGrappaFillsMissingLines(acceleration):
+    full = coilKspace()
+    acquired = np.zeros(64, dtype=bool)
+    acquired[::acceleration] = True
+    acquired[20:44] = True
+    undersampled = np.where(acquired[:, None], full, 0)
+    assert grappa.samplingPattern(undersampled)[:2] == (acceleration, 0)
+    filled = grappa.grappa(undersampled)
+    # the acquired lines are kept, and the missing ones come close to the
+    # fully sampled k-space
+    assert np.array_equal(filled[:, acquired], undersampled[:, acquired])
+    assert rssError(filled, full) < 0.03
+    assert rssError(filled, full) < 0.25*rssError(undersampled, full)
+
+
+def testGrappaLeavesFullySampledKspace():
+    full = coilKspace(32)
+    assert grappa.samplingPattern(full) == (1, 0, slice(0, 32))
+    assert grappa.grappa(full) is full
@@ -0,0 +1,51 @@
+"""
+Tests of the gridding of radial studies.
+
+"""
+
+import os
+
+import numpy as np
+
+import fid_cache
+import gridding
+
+from conftest import phantom
+
+
+def sampled(Image, Trajectory):
+    """ The exact centred k-space of Image at the trajectory's samples """
+    lines, points = Image.shape
+    rows = (np.arange(lines)-lines//2)/float(lines)
+    columns = (np.arange(points)-points//2)/float(points)
+    positions = Trajectory.reshape(-1, 2)
+    rowPhase = np.exp(-2j*np.pi*np.outer(positions[:, 0], rows))
+    columnPhase = np.exp(-2j*np.pi*np.outer(positions[:, 1], columns))
+    samples = np.einsum('sy,yx,sx->s', rowPhase, Image, columnPhase)
+    return samples.reshape(Trajectory.shape[:-1]).astype(np.complex64)
+
+
+def testRadialGriddingMatchesImage(tmp_path, monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'fid'))
+    image = phantom(32, 32)
+    trajectory = gridding.radialTrajectory(64, 64, 32)
+    plan = gridding.GriddingPlan(trajectory, 32)
+    gridded = plan.transform(sampled(image, trajectory)[None])[0]
+    assert gridded.shape == (32, 32)
+    error = np.linalg.norm(np.abs(gridded)-np.abs(image)) / \
+        np.linalg.norm(image)
+    assert error < 0.03
+
+
+def testOperatorsAreCachedUnderCacheDirectory(tmp_path, monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'fid'))
+    root = gridding.gridDirectory()
+    assert os.path.dirname(root) == fid_cache.cacheDirectory()
+    trajectory = gridding.radialTrajectory(16, 32)
+    first = gridding.GriddingPlan(trajectory, 32)
+    assert os.listdir(root) == [first.key+'.npz']
+    second = gridding.GriddingPlan(trajectory, 32)
+    assert np.array_equal(second.deapodization, first.deapodization)
+    # the subdirectory is not a cache entry, so it is never evicted
+    fid_cache.trim(0)
+    assert os.path.isdir(root)
@@ -0,0 +1,133 @@
+"""
+Tests of the process wide memory governor.
+
+"""
+
+import gc
+
+import numpy as np
+
+import frame_cache
+import memory_budget
+import volume
+
+
+class Pinned(object):
+    """ Counted against the cap, but never asked for memory """
+    def __init__(self, Bytes):
+        self.bytes = Bytes
+
+    def memoryUsage(self):
+        return self.bytes
+
+
+class Holder(Pinned):
+    """ A registered object that gives back what it is asked for """
+    def __init__(self, Bytes):
+        Pinned.__init__(self, Bytes)
+        self.released = []
+
+    def release(self, Bytes):
+        self.released.append(Bytes)
+        freed = min(self.bytes, Bytes)
+        self.bytes -= freed
+        return freed
+
+
+def testResidentBytesSkipsMappedArrays(tmp_path):
+    data = np.zeros(1000, dtype=np.complex64)
+    mapped = np.memmap(str(tmp_path/'mapped'), np.complex64, 'w+',
+                       shape=(1000,))
+    assert memory_budget.residentBytes(data, data[::2], mapped,
+                                       mapped[10:], None) == 8000+4000
+
+
+def testAccountsFollowTheirOwners():
+    governor = memory_budget.MemoryGovernor(1000)
+    held = Holder(300)
+    pinned = Pinned(200)
+    governor.register(held, 'held')
+    governor.register(pinned, 'pinned', memory_budget.PRIORITY_DISPLAY)
+    assert governor.used() == 500
+    stats = governor.stats()
+    assert stats['limit'] == 1000 and stats['used'] == 500
+    assert [(account['name'], account['evictable']) for account in
+            stats['accounts']] == [('held', True), ('pinned', False)]
+    # collected objects drop out of the accounts
+    del held
+    gc.collect()
+    assert governor.used() == 200
+    governor.unregister(pinned)
+    assert governor.stats()['accounts'] == []
+
+
+def testReserveEvictsLowestPriorityLargestFirst():
+    governor = memory_budget.MemoryGovernor(1000)
+    small = Holder(100)
+    large = Holder(400)
+    cache = Holder(400)
+    pinned = Pinned(100)
+    for holder, priority in ((small, memory_budget.PRIORITY_DERIVED),
+                             (large, memory_budget.PRIORITY_DERIVED),
+                             (cache, memory_budget.PRIORITY_CACHE),
+                             (pinned, memory_budget.PRIORITY_DERIVED)):
+        governor.register(holder, Priority=priority)
+    assert governor.trim() and large.released == []
+    # 200 over, which the larger of the derived products covers
+    assert governor.reserve(200)
+    assert large.released == [200] and small.released == []
+    assert cache.released == [] and governor.used() == 800
+    # 400 over, every derived product goes before the cache is asked
+    assert governor.reserve(600)
+    assert large.released == [200, 400] and small.released == [200]
+    assert cache.released == [100] and governor.used() == 400
+    accounts = governor.stats()['accounts']
+    assert [account['evictions'] for account in accounts] == [1, 2, 1, 0]
+    assert [account['freed'] for account in accounts] == [100, 400, 100, 0]
+
+def testReserveOnlyEvictsLowerPriorities():
+    governor = memory_budget.MemoryGovernor(1000)
+    derived = Holder(300)
+    cache = Holder(500)
+    governor.register(derived, Priority=memory_budget.PRIORITY_DERIVED)
+    governor.register(cache, Priority=memory_budget.PRIORITY_CACHE)
+    assert not governor.reserve(600, memory_budget.PRIORITY_CACHE)
+    # what could be freed was, but the cache was left alone
+    assert derived.bytes == 0 and cache.bytes == 500
+    assert governor.stats()['denied'] == 1
+    assert governor.reserve(600)
+    assert cache.bytes == 400
+    assert governor.setLimit(300) and cache.bytes == 300
+
+
+def testFrameCacheOnlyKeepsFramesThatFit(monkeypatch):
+    governor = memory_budget.MemoryGovernor(20000)
+    monkeypatch.setattr(memory_budget, '_GOVERNOR', governor)
+    cache = frame_cache.FrameCache()
+    pinned = Pinned(15000)
+    governor.register(pinned, Priority=memory_budget.PRIORITY_DISPLAY)
+
+    def reconstruct(Frame):
+        return {'image': np.full(500, Frame[0], dtype=np.complex64)}
+    first = cache.get((0, 0, 0), reconstruct)
+    assert cache.frames == {(0, 0, 0): first}
+    # the second frame pushes the first out, as it is further away
+    cache.get((1, 0, 0), reconstruct)
+    assert list(cache.frames) == [(1, 0, 0)]
+    # a frame that cannot fit is still returned, but not kept
+    pinned.bytes = 19000
+    frame = cache.get((2, 0, 0), reconstruct)
+    assert np.all(frame['image'] == 2)
+    assert cache.frames == {} and governor.stats()['denied'] == 1
+
+
+def testSlabsShrinkToFitTheGovernor(monkeypatch):
+    governor = memory_budget.MemoryGovernor(3*volume.SLAB_BYTES//4)
+    monkeypatch.setattr(memory_budget, '_GOVERNOR', governor)
+    shape = (1, 4, 1, 4096, 512)
+    row = 4*512*8
+    # a quarter of the slab size is the largest that fits three times
+    assert volume.slabRows(shape) == volume.SLAB_BYTES//4//row
+    governor.limit = 0
+    assert volume.slabRows(shape) == volume.MIN_SLAB_BYTES//row
+    assert volume.slabRows(shape, 1) == 1
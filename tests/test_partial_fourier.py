@@ -0,0 +1,40 @@
+"""
+Tests of the partial Fourier padding and its interaction with the filters.
+
+"""
+
+import numpy as np
+
+import filters
+import partial_fourier
+
+from conftest import kspaceOf, phantom
+
+
+def testDCOffsetIgnoresPaddedLines():
+    full = kspaceOf(phantom(64, 64))+np.complex64(3+2j)
+    lines = (64, 24, 64)
+    padded = partial_fourier.padLines(full[24:], lines)
+    corrected = filters.makeDCO().function(padded)
+    # the offset is that of the acquired rows, and the padding stays zero
+    expected = filters.makeDCO().function(full[24:])
+    assert np.allclose(corrected[24:], expected, atol=1e-4)
+    assert not np.any(corrected[:24])
+
+
+def testDCOffsetOfFullFrameIsUnchanged():
+    full = kspaceOf(phantom(32, 32))+np.complex64(1-1j)
+    corrected = filters.computeDCOffset(full, 5)
+    corners = [full[:5, :5], full[:-5, :5], full[:-5, :-5], full[:5, :-5]]
+    offset = np.mean([np.mean(corner) for corner in corners])
+    assert np.allclose(corrected, full-offset)
+
+
+def testPadLinesPlacesAcquiredRowsAtEnd():
+    procpar = {'nv': {'values': ['32']}, 'fract_ky': {'values': ['8']}}
+    lines = partial_fourier.acquiredLines(procpar, 24)
+    assert lines == (32, 8, 32)
+    acquired = np.ones((2, 24, 16), dtype=np.complex64)
+    padded = partial_fourier.padLines(acquired, lines)
+    assert padded.shape == (2, 32, 16)
+    assert not np.any(padded[:, :8]) and np.all(padded[:, 8:] == 1)
@@ -0,0 +1,58 @@
+"""
+Tests of the frame reconstruction in recon.
+
+"""
+
+import numpy as np
+
+import recon
+
+from conftest import kspaceOf, phantom
+
+
+def testRemoveOversamplingKeepsCentreOfImage():
+    rng = np.random.default_rng(0)
+    for points, factor in ((128, 2.0), (129, 2.0), (96, 1.5), (60, 3.0),
+                           (128, 3.0), (26, 2.0), (27, 2.0)):
+        kspace = (rng.standard_normal((3, 16, points)) +
+                  1j*rng.standard_normal((3, 16, points))).astype(np.complex64)
+        cropped = recon.removeOversampling(kspace, factor)
+        keep = recon.fovPoints(points, factor)
+        start = points//2-keep//2
+        full = np.fft.ifftshift(np.fft.ifft(np.fft.ifftshift(
+            kspace, axes=-1), axis=-1), axes=-1)
+        centre = np.fft.ifftshift(np.fft.ifft(np.fft.ifftshift(
+            cropped, axes=-1), axis=-1), axes=-1)
+        assert cropped.shape == (3, 16, keep)
+        assert cropped.dtype == np.complex64
+        assert np.allclose(centre, full[..., start:start+keep], atol=1e-6)
+
+
+def testRemoveOversamplingKeepsCentrePixelForOddAndEvenReadouts():
+    for points in (24, 25, 26, 27):
+        for factor in (2.0, 3.0):
+            image = np.zeros((4, points), dtype=np.complex64)
+            image[:, points//2] = 1.0
+            image[:, points//2+1] = 0.5
+            keep = recon.fovPoints(points, factor)
+            cropped = recon.transform(recon.removeOversampling(
+                kspaceOf(image), factor))
+            # the centre of the field of view does not move by a pixel
+            expected = np.zeros((4, keep))
+            expected[:, keep//2] = 1.0
+            expected[:, keep//2+1] = 0.5
+            assert np.allclose(cropped, expected, atol=1e-5)
+
+
+def testRemoveOversamplingWithoutFactorIsUnchanged():
+    kspace = kspaceOf(phantom(16, 32))
+    assert recon.removeOversampling(kspace, 1.0) is kspace
+
+
+def testZeroFillAspectFollowsPaddingFactors():
+    dim = (96, 128)
+    target = recon.zeroFillSize(dim, 2, (400, 300))
+    aspect = recon.zeroFillAspect(0.75, dim, target)
+    # the pixel height over width changes by the ratio of the factors
+    assert np.isclose(aspect, 0.75*(target[0]/96.0)/(target[1]/128.0))
+    assert recon.zeroFillAspect(0.75, dim, (192, 256)) == 0.75
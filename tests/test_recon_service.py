@@ -0,0 +1,189 @@
+"""
+Tests of the reconstruction service and its client, run against a service
+on its own event loop thread. The worker pool is swapped for threads so the
+batches and shared memory blocks can be watched from the test.
+
+"""
+
+import asyncio
+import json
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+import recon
+import recon_service
+
+from conftest import kspaceOf, phantom
+
+
+class Running(object):
+    """ Runs a service on an event loop thread for a with block """
+    def __init__(self, Service):
+        self.service = Service
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.service.start(),
+                                         self.loop).result()
+        self.service.pool.shutdown()
+        self.service.pool = ThreadPoolExecutor(2)
+        # for the tests to tell the loop from the worker threads
+        self.service.loopThread = self.thread
+        return self.service
+
+    def __exit__(self, *Error):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.service.close()
+
+    async def _shutdown(self):
+        """ Stops listening and ends the connections still open """
+        self.service.server.close()
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.fixture
+def service(tmp_path):
+    with Running(recon_service.ReconService(str(tmp_path/'service.sock'),
+                                            Window=0.2)) as running:
+        yield running
+
+
+@pytest.fixture
+def shared(monkeypatch):
+    """ Names of every shared memory block the service creates """
+    names = []
+    share = recon_service._sharedArray
+
+    def record(Data):
+        handle = share(Data)
+        names.append(handle['name'])
+        return handle
+    monkeypatch.setattr(recon_service, '_sharedArray', record)
+    return names
+
+
+def exists(Name):
+    """ True if a shared memory block has not been unlinked """
+    try:
+        block = shared_memory.SharedMemory(name=Name)
+    except FileNotFoundError:
+        return False
+    block.close()
+    return True
+
+
+def send(Path, Requests):
+    """ Sends requests down one connection and returns the replies by id """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(Path)
+    reader = connection.makefile('rb')
+    try:
+        connection.sendall(b''.join(json.dumps(request).encode()+b'\n'
+                                    for request in Requests))
+        replies = [json.loads(reader.readline()) for _ in Requests]
+    finally:
+        reader.close()
+        connection.close()
+    return dict((reply['id'], reply) for reply in replies)
+
+
+def testReconstructsThroughClient(service, study, shared):
+    path = study('one', kspaceOf(phantom(16, 16))[None])
+    client = recon_service.ReconClient(service.path)
+    try:
+        reply = client.reconstruct(path)
+    finally:
+        client.close()
+    expected = recon.reconstruct(path, Workers=1)
+    assert reply['status'] == 'ok'
+    assert tuple(reply['shape']) == expected.image.shape
+    assert np.allclose(reply['image'], expected.image, atol=1e-6)
+    assert np.allclose(reply['datafilt'], expected.datafilt, atol=1e-6)
+    assert shared and not any(exists(name) for name in shared)
+
+
+def testBatchesMatchingRequests(service, study, shared, monkeypatch):
+    batches = []
+    run = recon_service.reconstructBatch
+
+    def record(Paths, Spec, Dim):
+        batches.append(list(Paths))
+        return run(Paths, Spec, Dim)
+    monkeypatch.setattr(recon_service, 'reconstructBatch', record)
+    first = study('first', kspaceOf(phantom(16, 16))[None])
+    second = study('second', kspaceOf(phantom(16, 16, (2, 1)))[None])
+    other = study('other', kspaceOf(phantom(24, 16))[None])
+    replies = send(service.path, [{'id': 1, 'fid': first},
+                                  {'id': 2, 'fid': second},
+                                  {'id': 3, 'fid': other},
+                                  {'id': 4, 'fid': first}])
+    try:
+        assert all(reply['status'] == 'ok' for reply in replies.values())
+        # the two frame sizes make two batches, and the repeat is done once
+        assert sorted(map(sorted, batches)) == [sorted([first, second]),
+                                                [other]]
+        # a repeated study gets its own blocks to unlink
+        assert replies[1]['arrays']['image']['name'] != \
+            replies[4]['arrays']['image']['name']
+    finally:
+        for reply in replies.values():
+            recon_service.unlinkArrays(reply.get('arrays', {}))
+    assert not any(exists(name) for name in shared)
+
+
+def testErrorReplies(service, study, tmp_path):
+    missing = str(tmp_path/'missing.fid')
+    replies = send(service.path, [{'id': 1, 'fid': missing},
+                                  {'id': 2, 'nothing': True}])
+    assert replies[1]['status'] == 'error'
+    assert replies[2] == {'id': 2, 'status': 'error', 'error': 'bad request'}
+    client = recon_service.ReconClient(service.path)
+    try:
+        with pytest.raises(RuntimeError):
+            client.reconstruct(missing)
+    finally:
+        client.close()
+
+
+def testFailedStudyUnlinksItsBlocks(service, study, shared, monkeypatch):
+    share = recon_service._sharedArray
+
+    def failSecond(Data):
+        if len(shared) == 1:
+            raise MemoryError('no room for the second array')
+        return share(Data)
+    monkeypatch.setattr(recon_service, '_sharedArray', failSecond)
+    path = study('failing', kspaceOf(phantom(16, 16))[None])
+    replies = send(service.path, [{'id': 1, 'fid': path}])
+    assert replies[1]['status'] == 'error'
+    assert 'MemoryError' in replies[1]['error']
+    assert len(shared) == 1 and not exists(shared[0])
+
+
+def testHeadersAreReadOffTheLoop(service, study, monkeypatch):
+    threads = []
+    frameSize = recon_service._frameSize
+
+    def record(Path):
+        threads.append(threading.current_thread())
+        return frameSize(Path)
+    monkeypatch.setattr(recon_service, '_frameSize', record)
+    path = study('threaded', kspaceOf(phantom(16, 16))[None])
+    replies = send(service.path, [{'id': 1, 'fid': path}])
+    recon_service.unlinkArrays(replies[1]['arrays'])
+    assert threads and threads[0] is not service.loopThread
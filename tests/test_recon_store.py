@@ -0,0 +1,74 @@
+"""
+Tests of the chunked reconstruction store.
+
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import recon_store
+
+
+def frames(Count=6):
+    """ Complex (frame, pe, ro) test data """
+    rng = np.random.default_rng(0)
+    return (rng.standard_normal((Count, 8, 12)) +
+            1j*rng.standard_normal((Count, 8, 12))).astype(np.complex64)
+
+
+@pytest.mark.parametrize('compression', [0, 6])
+def testStoreReopensWithItsFrames(tmp_path, compression):
+    path = str(tmp_path/'study.mrs')
+    data = frames()
+    store = recon_store.ReconStore(path, compression)
+    store.setMetadata({'nv': {'values': ['8']}}, [{'Type': 'DC Offset'}])
+    for index in (3, 0, 1, 2, 5, 4):
+        store.write('image', index, data[index])
+    store.append('magnitude', np.abs(data[0]))
+    store.flush()
+
+    reopened = recon_store.ReconStore(path)
+    assert reopened.names == ['image', 'magnitude']
+    assert reopened.procpar == {'nv': {'values': ['8']}}
+    assert reopened.spec == [{'Type': 'DC Offset'}]
+    assert reopened.frames('image') == 6
+    assert reopened.shape('image') == (6, 8, 12)
+    frame = reopened.read('image', 3)
+    assert np.array_equal(frame, data[3])
+    # plain chunks are memory mapped, compressed ones read whole
+    assert isinstance(frame, np.memmap) == (compression == 0)
+    suffix = '.npy.z' if compression else '.npy'
+    assert os.path.exists(os.path.join(path, 'image', '000003'+suffix))
+    assert np.array_equal(reopened.load('image', Workers=3), data)
+    assert np.array_equal(reopened.read('magnitude', 0), np.abs(data[0]))
+
+
+def testRewrittenFrameChangesCompression(tmp_path):
+    path = str(tmp_path/'study.mrs')
+    data = frames(2)
+    recon_store.ReconStore(path, 6).write('image', 0, data[0])
+    store = recon_store.ReconStore(path)
+    store.write('image', 0, data[1])
+    chunks = os.listdir(os.path.join(path, 'image'))
+    assert chunks == ['000000.npy']
+    assert np.array_equal(store.read('image', 0), data[1])
+
+
+def testSetShapeRestoresLeadingAxes(tmp_path):
+    path = str(tmp_path/'study.mrs')
+    data = frames(6)
+    store = recon_store.ReconStore(path)
+    store.writeFrames('image', data.reshape(2, 3, 8, 12), Workers=2)
+    assert store.shape('image') == (2, 3, 8, 12)
+    assert np.array_equal(store.read('image', (1, 2)), data[5])
+    store.setShape('image', (3, 2))
+    reopened = recon_store.ReconStore(path)
+    assert reopened.load('image').shape == (3, 2, 8, 12)
+    assert np.array_equal(reopened.read('image', (1, 0)), data[2])
+    # a shape that does not account for every frame is not used
+    reopened.append('image', data[0])
+    assert reopened.shape('image') == (7, 8, 12)
+    with pytest.raises(ValueError):
+        reopened.write('image', 7, data[0, :4])
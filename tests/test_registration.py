@@ -0,0 +1,44 @@
+"""
+Tests of the phase correlation registration of repetitions.
+
+"""
+
+import numpy as np
+
+import registration
+
+from conftest import blocks, kspaceOf, phantom
+
+
+def image():
+    """ A test image with sharp edges, which phase correlation needs """
+    return blocks(64)+0.5*phantom(64, 64)
+
+
+def testEstimateShiftsRecoversKnownShifts():
+    reference = kspaceOf(image())
+    shifts = np.array([(2.3, -1.6), (-4.0, 0.5), (0.0, 0.0)])
+    frames = registration.shiftKspace(np.array([reference]*3), shifts)
+    assert np.allclose(registration.estimateShifts(frames, reference),
+                       shifts, atol=0.01)
+    # whole pixel moves of the image itself
+    moved = np.array([kspaceOf(np.roll(image(), shift, (0, 1)))
+                      for shift in ((3, -2), (-5, 1))])
+    assert np.allclose(registration.estimateShifts(moved, reference),
+                       [(3, -2), (-5, 1)], atol=1e-3)
+
+
+def testStudyShiftsRegisterCoilsTogether():
+    reference = kspaceOf(image())
+    shifts = np.array([(0.0, 0.0), (1.5, 2.0), (-3.0, -0.5)])
+    gains = np.array([1.0, 0.5j])[:, None, None]
+    # (rep*coil, slice, echo, pe, ro) with two coils to each repetition
+    kspace = np.concatenate([gains*registration.shiftKspace(reference, shift)
+                             for shift in shifts])[:, None, None]
+    estimated = registration.studyShifts(kspace, Receivers=2)
+    assert estimated.shape == (3, 1, 1, 2)
+    assert np.allclose(estimated[:, 0, 0], shifts, atol=0.01)
+    registered = registration.shiftKspace(kspace[4:6, 0, 0],
+                                          -estimated[2, 0, 0])
+    assert np.allclose(registered, gains*reference,
+                       atol=1e-3*np.abs(reference).max())
@@ -0,0 +1,75 @@
+"""
+Tests of the content addressed cache of reconstruction results.
+
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import batch_recon
+import filters
+import recon
+import recon_store
+import result_cache
+
+from conftest import kspaceOf, phantom
+
+
+OPTIONS = {'study': True, 'oversample': 1.0, 'zerofill': None,
+           'partial': 'homodyne', 'coils': 'rss', 'sliding': 4,
+           'average': 'complex', 'register': True, 'frame': (0, 1, 0)}
+
+# a different value of each option
+CHANGED = {'study': False, 'oversample': 2.0, 'zerofill': 2,
+           'partial': 'pocs', 'coils': 'adaptive', 'sliding': 8,
+           'average': 'magnitude', 'register': False, 'frame': (0, 2, 0)}
+
+
+def spec(Size=10):
+    """ The filter stack description of a DC offset correction """
+    return filters.stackSpec([filters.makeDCO(Size=Size)])
+
+
+def testKeyChangesWithEveryOption():
+    key = result_cache.resultKey('a'*40, spec(), Options=OPTIONS)
+    # the order the options were given in does not matter
+    reordered = dict(reversed(list(OPTIONS.items())))
+    assert result_cache.resultKey('a'*40, spec(), Options=reordered) == key
+    keys = set([key])
+    for name, value in CHANGED.items():
+        options = dict(OPTIONS)
+        options[name] = value
+        keys.add(result_cache.resultKey('a'*40, spec(), Options=options))
+        del options[name]
+        keys.add(result_cache.resultKey('a'*40, spec(), Options=options))
+    keys.add(result_cache.resultKey('b'*40, spec(), Options=OPTIONS))
+    keys.add(result_cache.resultKey('a'*40, spec(4), Options=OPTIONS))
+    keys.add(result_cache.resultKey('a'*40, spec(), 'double', OPTIONS))
+    assert len(keys) == 2*len(CHANGED)+4
+    with pytest.raises(ValueError):
+        result_cache.resultKey('a'*40, spec(), 'half')
+
+
+def testBatchResultsAreKeptPerOption(study, tmp_path, monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'cache'))
+    kspace = np.stack([kspaceOf(phantom(16, 24, (rep, 0.0)))
+                       for rep in range(2)])
+    path = study('series', kspace)
+    output = tmp_path/'output'
+    output.mkdir()
+    shapes = []
+    for zeroFill in (None, 2.0, None):
+        files = batch_recon.processFID(path, str(output), ZeroFill=zeroFill)
+        images = recon_store.ReconStore(files[0]).load('image')
+        expected = np.stack([image for _, _, image in list(
+            recon.reconstructFrames(path, ZeroFill=zeroFill))[1:]])
+        # a result cached for other options is never handed back
+        assert np.allclose(images.reshape(expected.shape), expected,
+                           atol=1e-4)
+        shapes.append(images.shape[-2:])
+    assert shapes[0] == shapes[2] != shapes[1]
+    entries = [name for name in os.listdir(result_cache.resultDirectory())
+               if not name.startswith('.')]
+    assert len(entries) == 2
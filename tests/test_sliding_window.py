@@ -0,0 +1,52 @@
+"""
+Tests of the sliding window reconstruction against whole frame ones.
+
+"""
+
+import numpy as np
+import pytest
+
+import filters
+import recon
+import sliding_window
+
+from conftest import kspaceOf, phantom
+
+
+def series(Reps, Lines, Points):
+    """ (rep, slice, echo, pe, ro) k-space of a moving phantom """
+    frames = [kspaceOf(phantom(Lines, Points, (0.5*rep, -0.3*rep)))
+              for rep in range(Reps)]
+    return np.asarray(frames)[:, None, None]
+
+
+def windowKspace(Kspace, Rep, Segments):
+    """ The latest lines of every segment at a repetition """
+    lines = Kspace.shape[-2]
+    window = np.zeros(Kspace.shape[-2:], dtype=np.complex64)
+    for rep in range(Rep+1):
+        rows = sliding_window.segmentRows(lines, Segments, rep % Segments)
+        window[rows] = Kspace[rep, 0, 0, rows]
+    return window
+
+
+@pytest.mark.parametrize('segments', [16, 2])
+def testSlidingFramesMatchWholeFrames(segments, monkeypatch):
+    # small segments are updated incrementally, large ones by a full FFT
+    monkeypatch.setattr(sliding_window, 'REFRESH', 5)
+    kspace = series(12, 64, 32)
+    stack = [filters.makeDCO(Size=4),
+             filters.makeLPF(Window='hann', Dim=(64, 32), Diameter=48)]
+    window = sliding_window.SlidingWindow(
+        sliding_window.LinePlan(stack, (64, 32)), segments)
+    assert (window.basis[0] is None) == (segments == 2)
+    frames = sliding_window.slidingFrames(kspace, stack, segments)
+    for (rep, _, _), datafilt, image in frames:
+        if rep < segments-1:
+            # the window is still filling up
+            continue
+        expected = recon.reconstructFrame(
+            windowKspace(kspace, rep, segments), stack)
+        scale = np.abs(expected[1]).max()
+        assert np.allclose(datafilt, expected[0], atol=1e-3*scale*64)
+        assert np.abs(image-expected[1]).max() < 1e-4*scale
@@ -0,0 +1,108 @@
+"""
+Tests of the line by line reconstruction.
+
+"""
+
+import numpy as np
+import pytest
+
+import batch_recon
+import fid_reader
+import filters
+import recon
+import recon_store
+import stream_recon
+
+from conftest import kspaceOf, phantom, volumeStudy
+
+
+def series(Reps=3, Lines=16, Points=24):
+    """ (rep, pe, ro) k-space of a moving phantom with a DC offset """
+    return np.stack([kspaceOf(phantom(Lines, Points, (rep, 0.0))) +
+                     np.complex64(0.05-0.02j) for rep in range(Reps)])
+
+
+def directFrames(Path, Stack, Oversampling=1.0):
+    """ Each frame reconstructed whole by :func:`recon.reconstructFrame` """
+    _, kspace = fid_reader.readFID(Path)
+    frames = {}
+    for frame in np.ndindex(*kspace.shape[:-2]):
+        lines = recon.removeOversampling(np.asarray(kspace[frame]),
+                                         Oversampling)
+        frames[frame] = recon.reconstructFrame(lines, Stack, Frame=frame)
+    return frames
+
+
+def testStreamedFramesMatchWholeFrames(study):
+    # two slices, so each block holds the lines of two frames
+    kspace = np.concatenate([series(), 2*series()], axis=1)
+    path = study('series', kspace, nv=16, pss=[0.0, 1.0])
+    frames = stream_recon.reconstructStream(path)
+    dic, leading, stack = next(frames)
+    assert leading == (3, 2, 1)
+    expected = directFrames(path, recon.defaultStack())
+    streamed = 0
+    for frame, datafilt, image in frames:
+        assert np.allclose(datafilt, expected[frame][0], atol=1e-4)
+        assert np.allclose(image, expected[frame][1], atol=1e-4)
+        streamed += 1
+    assert streamed == len(expected)
+
+
+def testStreamedFramesRemoveOversampling(study):
+    path = study('oversampled', series(2), oversample=2.0)
+    spec = filters.stackSpec([filters.makeDCO(Size=4)])
+    frames = stream_recon.reconstructStream(path, spec)
+    _, _, stack = next(frames)
+    expected = directFrames(path, stack, 2.0)
+    images = dict((frame, image) for frame, _, image in frames)
+    assert sorted(images) == sorted(expected)
+    for frame, image in images.items():
+        assert image.shape == (16, 12)
+        assert np.allclose(image, expected[frame][1], atol=1e-4)
+
+
+@pytest.mark.parametrize('params', [
+    {'nv': 32, 'fract_ky': 8},
+    {'rcvrs': 'yy'},
+    {'seqfil': 'radial2d'},
+])
+def testStudiesNeedingWholeFramesAreRefused(study, params):
+    lines = 24 if 'fract_ky' in params else 16
+    path = study('refused', series(2, lines), **params)
+    with pytest.raises(stream_recon.StreamingError):
+        stream_recon.reconstructStream(path)
+
+
+def testVolumesAreRefused(study):
+    with pytest.raises(stream_recon.StreamingError):
+        stream_recon.reconstructStream(volumeStudy(study))
+
+
+def testProcessFIDFallsBackToWholeFrames(study, tmp_path, monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'cache'))
+    refused = []
+    streamed = stream_recon.reconstructStream
+
+    def spy(*Args, **Kwargs):
+        try:
+            return streamed(*Args, **Kwargs)
+        except stream_recon.StreamingError as error:
+            refused.append(error)
+            raise
+    monkeypatch.setattr(stream_recon, 'reconstructStream', spy)
+    output = tmp_path/'output'
+    output.mkdir()
+    kspace = series(2, 24)
+    for name, params in (('full', {}), ('partial', {'nv': 32,
+                                                    'fract_ky': 8})):
+        path = study(name, kspace, **params)
+        files = batch_recon.processFID(path, str(output))
+        assert len(files) == 3
+        expected = np.stack([image for _, _, image in
+                             list(recon.reconstructFrames(path))[1:]])
+        images = recon_store.ReconStore(files[0]).load('image')
+        assert np.allclose(images.reshape(expected.shape), expected,
+                           atol=1e-4)
+    # only the partial Fourier study needed the whole frame path
+    assert len(refused) == 1
@@ -0,0 +1,65 @@
+"""
+Tests of the partition transform of 3D studies and its cache.
+
+"""
+
+import os
+import time
+
+import numpy as np
+
+import fid_reader
+import volume
+
+from conftest import volumeStudy
+
+
+def partitionTransform(Kspace):
+    """ The centred inverse FFT along the partitions, done directly """
+    kspace = np.asarray(Kspace)
+    return np.fft.ifftshift(np.fft.ifft(np.fft.ifftshift(kspace, axes=1),
+                                        axis=1), axes=1)
+
+
+def kept():
+    """ The volumes kept in the cache """
+    return sorted(name for name in os.listdir(volume.volumeDirectory())
+                  if name.endswith('.npy'))
+
+
+def testVolumesAreTrimmedLeastRecentlyUsedFirst(study, tmp_path,
+                                                monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'cache'))
+    first = str(tmp_path/'first.fid')
+    os.rename(volumeStudy(study), first)
+    second = volumeStudy(study)
+    _, kspace = fid_reader.readFID(first)
+    size = int(np.prod(kspace.shape))*8
+    # room for one volume and a bit
+    monkeypatch.setenv('MRMAGIC_VOLUME_CACHE_BYTES', str(size*3//2))
+    hybrid = volume.hybridKspace(first, kspace)
+    assert np.allclose(hybrid, partitionTransform(kspace), atol=1e-5)
+    assert len(kept()) == 1
+    old = time.time()-60
+    entry = os.path.join(volume.volumeDirectory(), kept()[0])
+    os.utime(entry, (old, old))
+    # an abandoned transform is removed along with the older volume
+    partial = os.path.join(volume.volumeDirectory(), '.partial-dead')
+    os.makedirs(partial)
+    old -= 2*24*60*60
+    os.utime(partial, (old, old))
+    _, kspace = fid_reader.readFID(second)
+    volume.hybridKspace(second, kspace)
+    assert len(kept()) == 1 and not os.path.exists(entry)
+    assert not os.path.exists(partial)
+    assert volume.trim(0) >= size and kept() == []
+
+
+def testOversizedVolumesAreNotKept(study, tmp_path, monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'cache'))
+    monkeypatch.setenv('MRMAGIC_VOLUME_CACHE_BYTES', '1024')
+    path = volumeStudy(study)
+    _, kspace = fid_reader.readFID(path)
+    hybrid = volume.hybridKspace(path, kspace)
+    assert np.allclose(hybrid, partitionTransform(kspace), atol=1e-5)
+    assert os.listdir(volume.volumeDirectory()) == []
@@ -0,0 +1,121 @@
+"""
+Tests of the watch folder ingestion and its command line options.
+
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+import batch_recon
+import coils
+import fid_reader
+import partial_fourier
+import recon
+import recon_store
+import watch
+
+from conftest import kspaceOf, phantom, volumeStudy
+
+
+def coilStudy(Study):
+    """ A two receiver study whose coils see the phantom differently """
+    image = phantom(24, 32)
+    ramp = np.linspace(0.5, 1.5, 32).astype(np.complex64)
+    kspace = np.stack([kspaceOf(image*ramp), kspaceOf(image*ramp[::-1])])
+    return Study('coils', kspace, rcvrs='yy'), kspace
+
+
+def testWatcherCombinesCoilsWithMethod(study, tmp_path):
+    path, kspace = coilStudy(study)
+    output = str(tmp_path/'out')
+    watcher = watch.FolderWatcher([str(tmp_path)], output, Coils='adaptive')
+    assert watcher.scan() == [path]
+    assert watcher.process(path) == 1
+    stored = recon_store.ReconStore(watcher.studies[path].store)
+    whitener = coils.whitener(coils.noiseCovariance(
+        coils.cornerSamples(kspace)))
+    _, expected = recon.combineFrame(kspace, recon.defaultStack(), whitener,
+                                     'adaptive')
+    _, rss = recon.combineFrame(kspace, recon.defaultStack(), whitener)
+    image = stored.read('image', 0)
+    assert np.allclose(image, expected, atol=1e-5*np.abs(expected).max())
+    assert not np.allclose(image, rss, atol=1e-3*np.abs(rss).max())
+
+
+def testWatcherZeroFillsFrames(study, tmp_path):
+    path = study('single', kspaceOf(phantom(24, 32))[None])
+    watcher = watch.FolderWatcher([str(tmp_path)], str(tmp_path/'out'),
+                                  ZeroFill=2)
+    watcher.scan()
+    watcher.process(path)
+    stored = recon_store.ReconStore(watcher.studies[path].store)
+    image = stored.read('image', 0)
+    assert image.shape[-2:] == tuple(recon.zeroFillSize((24, 32), 2))
+
+
+def testConfigureReconstructsStudiesAgain(study, tmp_path):
+    path = study('single', kspaceOf(phantom(24, 32))[None])
+    watcher = watch.FolderWatcher([str(tmp_path)], str(tmp_path/'out'))
+    watcher.scan()
+    watcher.process(path)
+    assert watcher.studies[path].finished
+    watcher.configure(ZeroFill=2)
+    # the finished study is queued again and its frames replaced
+    assert watcher.scan() == [path]
+    assert watcher.process(path) == 1
+    stored = recon_store.ReconStore(watcher.studies[path].store)
+    assert stored.frames('image') == 1
+    assert stored.read('image', 0).shape == \
+        tuple(recon.zeroFillSize((24, 32), 2))
+    with pytest.raises(ValueError):
+        watcher.configure(Coils='unknown')
+
+
+def testWatcherUsesPartialFourierMethod(study, tmp_path):
+    kspace = kspaceOf(phantom(32, 32))[None, 8:]
+    path = study('partial', kspace, nv=32, fract_ky=8)
+    watcher = watch.FolderWatcher([str(tmp_path)], str(tmp_path/'out'),
+                                  PartialFourier='pocs')
+    watcher.scan()
+    watcher.process(path)
+    stored = recon_store.ReconStore(watcher.studies[path].store)
+    lines = (32, 8, 32)
+    raw = partial_fourier.padLines(kspace[0], lines)
+    _, expected = recon.reconstructFrame(
+        raw, recon.defaultStack(),
+        PartialFourier=partial_fourier.plan((32, 32), lines, 'pocs'))
+    assert np.allclose(stored.read('image', 0), expected,
+                       atol=1e-5*np.abs(expected).max())
+
+
+def testWatchRejectsWholeStudyOptions(tmp_path):
+    for option in (['-a', 'complex'], ['--register'], ['--segments', '4']):
+        with pytest.raises(SystemExit):
+            batch_recon.main([str(tmp_path), '-o', str(tmp_path), '--watch']
+                             + option)
+
+
+def testWatcherWaitsForWholeVolume(study, tmp_path, monkeypatch):
+    monkeypatch.setenv('MRMAGIC_CACHE', str(tmp_path/'cache'))
+    path = volumeStudy(study)
+    fidName = fid_reader.fidFilename(path)
+    complete = open(fidName, 'rb').read()
+    # the second repetition has not been written yet
+    with open(fidName, 'wb') as fidFile:
+        fidFile.write(complete[:len(complete)-(len(complete)-32)//2])
+    watcher = watch.FolderWatcher([str(tmp_path)], str(tmp_path/'out'))
+    watcher.scan()
+    assert watcher.process(path) == 0
+    assert not os.path.exists(watcher.studies[path].store)
+    with open(fidName, 'wb') as fidFile:
+        fidFile.write(complete)
+    assert watcher.scan() == [path]
+    assert watcher.process(path) == 8
+    stored = recon_store.ReconStore(watcher.studies[path].store)
+    frames = recon.reconstructFrames(path, Workers=1)
+    next(frames)
+    for frame, _, image in frames:
+        index = int(np.ravel_multi_index(frame, (2, 4, 1)))
+        assert np.allclose(stored.read('image', index), image, atol=1e-5)
@@ -0,0 +1,289 @@
+"""
+.. py:module:: volume
+Volume Module
+=============
+
+Reconstruction of 3D studies, whose partitions are phase encoded with the
+nv2 loop. The decoded k-space has the partitions on the slice axis, see
+:func:`fid_reader.acquisitionOrder`, so once the partition axis has been
+inverse Fourier transformed each partition is an ordinary 2D frame of
+(phase-encode, readout) k-space, and the rest of the reconstruction goes
+ahead one slice at a time as for a multi-slice study.
+
+The partition transform needs every partition at once, which for large
+matrices is more than fits in memory. It is done as a streaming pass over
+slabs of phase-encode rows: each slab of every partition is read from the
+memory mapped k-space, windowed by the 3D filters of the stack, transformed
+along the partitions and written to a memory mapped .npy file. The slab
+size is bounded, so volumes larger than memory can be reconstructed.
+
+The transformed k-space is kept in the user cache directory, keyed by the
+study and the 3D filters, so a volume is only transformed once. The kept
+volumes are held under a size limit by removing the least recently used
+ones, see :func:`trim`, and a volume larger than the limit is transformed
+into a file that is removed once it is no longer mapped.
+
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy import fft as spfft
+
+import filters as filt
+import fid_cache
+import memory_budget
+from fid_reader import procparValue
+
+
+# largest slab read and transformed at once
+SLAB_BYTES = 64 << 20
+
+# smallest slab the memory governor can shrink it to
+MIN_SLAB_BYTES = 1 << 20
+
+# default size limit of the kept volumes, overridden by
+# MRMAGIC_VOLUME_CACHE_BYTES
+LIMIT_BYTES = 8 << 30
+
+
+def partitions(Procpar):
+    """ Returns the number of partitions of a study, 1 for 2D studies """
+    value = procparValue(Procpar, 'nv2', 1.0)
+    if not isinstance(value, float) or value < 1:
+        return 1
+    return int(value)
+
+
+def isVolume(Procpar):
+    """ True if the study is 3D, i.e. has more than one partition """
+    return partitions(Procpar) > 1
+
+
+def volumeDirectory():
+    """ Returns the directory holding the transformed volumes """
+    return os.path.join(fid_cache.cacheDirectory(), 'volume')
+
+
+def volumeLimit():
+    """
+    Returns the size limit of the kept volumes in bytes.
+
+    The MRMAGIC_VOLUME_CACHE_BYTES environment variable is used if it is
+    set, otherwise :data:`LIMIT_BYTES`.
+
+    """
+    return int(os.environ.get('MRMAGIC_VOLUME_CACHE_BYTES', LIMIT_BYTES))
+
+
+def _entries(Root):
+    """ (last use, size, path) of every kept volume """
+    entries = []
+    for name in os.listdir(Root):
+        path = os.path.join(Root, name)
+        if name.startswith('.') or not name.endswith('.npy'):
+            continue
+        try:
+            entries.append((os.path.getmtime(path), os.path.getsize(path),
+                            path))
+        except OSError:
+            # removed by another process
+            continue
+    return entries
+
+
+def trim(Limit=None, Root=None):
+    """
+    Removes the least recently used volumes until the kept ones fit.
+
+    Transforms abandoned by writers that died are removed first, see
+    :func:`fid_cache.removeStale`.
+
+    Parameters
+    ----------
+    Limit : int, optional
+        Size to trim to in bytes. Defaults to :func:`volumeLimit`.
+
+    Root : string, optional
+        The directory of the volumes. Defaults to :func:`volumeDirectory`.
+
+    Returns
+    -------
+    Removed : int
+        Bytes freed from the volumes.
+
+    """
+    root = volumeDirectory() if Root is None else Root
+    if Limit is None:
+        Limit = volumeLimit()
+    if not os.path.isdir(root):
+        return 0
+    fid_cache.removeStale(root)
+    entries = sorted(_entries(root))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in entries:
+        if total <= Limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += size
+    return removed
+
+
+def slabRows(Shape, Bytes=None):
+    """
+    Chooses the number of phase-encode rows in each slab.
+
+    Parameters
+    ----------
+    Shape : tuple
+        The (rep, partition, echo, phase-encode, readout) shape of the
+        k-space.
+
+    Bytes : int, optional
+        Largest slab. Defaults to :data:`SLAB_BYTES`, halved until the
+        memory governor can make room for it. If there is no room even for
+        :data:`MIN_SLAB_BYTES` that size is used anyway, as the transform
+        cannot go ahead without a slab, and only the governor's denied
+        count records it.
+
+    Returns
+    -------
+    Rows : int
+        Rows of every partition held at once, at least 1.
+
+    """
+    if Bytes is None:
+        Bytes = SLAB_BYTES
+        # the slab, its transform and the window are held at once
+        while Bytes > MIN_SLAB_BYTES and \
+                not memory_budget.governor().reserve(3*Bytes):
+            Bytes //= 2
+    row = Shape[1]*Shape[-1]*np.dtype(np.complex64).itemsize
+    return int(max(1, min(Shape[-2], Bytes//max(row, 1))))
+
+
+def partitionTransform(Kspace, Out, Stack=None, Rows=None):
+    """
+    Inverse Fourier transforms the partition axis of 3D k-space.
+
+    Parameters
+    ----------
+    Kspace : array-like
+        The (rep, partition, echo, phase-encode, readout) k-space, e.g. a
+        memory map.
+
+    Out : array
+        Where the hybrid (rep, slice, echo, phase-encode, readout) data is
+        written, e.g. a memory map of the same shape. May be Kspace.
+
+    Stack : 1D array :class:`filters.GFilter`\s, optional
+        The 3D filters, see :func:`filters.volumeStages`, applied to each
+        slab before it is transformed. Any other filters are ignored.
+
+    Rows : int, optional
+        Phase-encode rows of each slab. Defaults to :func:`slabRows`.
+
+    Returns
+    -------
+    Out : array
+        The transformed data.
+
+    """
+    shape = np.shape(Kspace)
+    stages = filt.volumeStages(Stack or [])
+    if Rows is None:
+        Rows = slabRows(shape)
+    reps, _, echoes, lines = shape[:4]
+    for rep, echo in np.ndindex(reps, echoes):
+        for start in range(0, lines, Rows):
+            rows = slice(start, min(start+Rows, lines))
+            slab = np.asarray(Kspace[rep, :, echo, rows], dtype=np.complex64)
+            for stage in stages:
+                slab = stage.function(slab, rows)
+            # the same shifts as recon.transform, along the partitions
+            slab = np.fft.ifftshift(spfft.ifft(np.fft.ifftshift(slab, axes=0),
+                                               axis=0, workers=-1), axes=0)
+            Out[rep, :, echo, rows] = slab
+    return Out
+
+
+def _volumeKey(Path, Stack):
+    """ Cache key of a study transformed with a stack's 3D filters """
+    digest = hashlib.sha1(fid_cache.cacheKey(Path).encode('ascii'))
+    digest.update(filt.canonicalSpec(filt.stackSpec(
+        filt.volumeStages(Stack or []))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def hybridKspace(Path, Kspace, Stack=None):
+    """
+    Returns the partition transformed k-space of a 3D study.
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Kspace : array-like
+        The decoded (rep, partition, echo, phase-encode, readout) k-space
+        of the study, see :func:`fid_cache.readFID`.
+
+    Stack : 1D array :class:`filters.GFilter`\s, optional
+        Filters applied to the study, only the 3D ones are used here.
+
+    Returns
+    -------
+    Hybrid : memory mapped array of complex64
+        The (rep, slice, echo, phase-encode, readout) data, read only. It
+        is kept for next time, unless it is larger than
+        :func:`volumeLimit`.
+
+    Raises
+    ------
+    ValueError
+        If the study is still being acquired.
+
+    """
+    fid = getattr(Kspace, 'fid', None)
+    if fid is not None and not fid.complete:
+        raise ValueError('a 3D study is transformed once it is complete')
+    root = volumeDirectory()
+    entry = os.path.join(root, _volumeKey(Path, Stack)+'.npy')
+    try:
+        hybrid = np.load(entry, mmap_mode='r')
+        # the modification time orders the volumes for eviction
+        os.utime(entry)
+        return hybrid
+    except (IOError, OSError, ValueError):
+        pass
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    shape = tuple(np.shape(Kspace))
+    size = int(np.prod(shape))*np.dtype(np.complex64).itemsize
+    limit = volumeLimit()
+    keep = size <= limit
+    if keep:
+        trim(limit-size, root)
+    working = tempfile.mkdtemp(dir=root, prefix=fid_cache.PARTIAL_PREFIX)
+    try:
+        name = os.path.join(working, 'hybrid.npy')
+        out = np.lib.format.open_memmap(name, mode='w+', dtype=np.complex64,
+                                        shape=shape)
+        partitionTransform(Kspace, out, Stack)
+        out.flush()
+        del out
+        if not keep:
+            # the mapping outlives the file, where the platform allows
+            return np.load(name, mmap_mode='r')
+        os.replace(name, entry)
+    finally:
+        shutil.rmtree(working, ignore_errors=True)
+    return np.load(entry, mmap_mode='r')
@@ -0,0 +1,408 @@
+"""
+.. py:module:: watch
+Watch Folder Module
+===================
+
+Streaming ingestion of FIDs as the scanner writes them. A
+:class:`FolderWatcher` polls a set of directories for new or growing \*.fid
+folders and queues them. A worker thread reconstructs every repetition that
+has been completely written since the last pass with the default stack,
+appends the frames to a :class:`recon_store.ReconStore` in the output
+directory, and publishes the progress on a queue that the GUI or a script
+can drain.
+
+Varian acquisitions write their fid one block at a time, so a study that is
+still growing is reconstructed a repetition at a time, as soon as all of
+the blocks holding it have arrived. The repetition being acquired is shown
+as it grows: the traces of it already on disk are streamed through a
+:class:`stream_recon.FrameAccumulator`, with the missing lines left empty,
+and its frames are written again once the repetition is complete. This is
+done for the studies :mod:`stream_recon` can reconstruct line by line.
+
+3D studies need every partition before the partition axis can be
+transformed, so they are left until the fid is complete, then transformed
+with :func:`volume.hybridKspace` and reconstructed a slice at a time.
+
+The reconstruction settings can be changed while the watcher runs, see
+:meth:`FolderWatcher.configure`, and every study is then done again.
+
+Errors reconstructing a study are logged and the study is tried again when
+its fid or procpar next change, so one bad study does not stop the watcher.
+
+"""
+
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+
+import coils
+import filters as filt
+import fid_reader
+import gridding
+import partial_fourier
+import recon
+import recon_store
+import stream_recon
+import volume
+
+
+log = logging.getLogger(__name__)
+
+
+class StudyState(object):
+    """
+    Progress of the ingestion of one study
+
+    Parameters
+    ----------
+    Path : string
+        The top level \*.fid folder.
+
+    Store : string
+        The store the reconstructed frames are appended to.
+
+    """
+    def __init__(self, Path, Store):
+        self.path = Path
+        self.store = Store
+        self.stamp = None  # fid size and procpar mtime at the last scan
+        self.blocks = 0  # repetitions reconstructed so far
+        self.queued = False
+        self.finished = False
+        self.redo = False  # reconstruct from the start, see configure
+
+
+class FolderWatcher(object):
+    """
+    Watches directories for FIDs and reconstructs them as they grow.
+
+    Parameters
+    ----------
+    Directories : list of strings
+        Directories searched for \*.fid folders.
+
+    Output : string
+        Directory the stores are written to.
+
+    Spec : list of Dictionaries, optional
+        The filter stack, see :func:`filters.stackSpec`. Defaults to
+        :func:`recon.defaultStack`.
+
+    Interval : float, optional
+        Seconds between scans. Defaults to 2.
+
+    Coils : string, optional
+        Combination of the coils of multi-receiver studies, one of
+        :data:`coils.METHODS`. Defaults to 'rss'.
+
+    PartialFourier : string, optional
+        Method used for partial Fourier studies, one of
+        :data:`partial_fourier.METHODS`. Defaults to 'homodyne'.
+
+    ZeroFill : float, optional
+        Interpolation factor for the images, see :func:`recon.zeroFillSize`.
+        The repetition being acquired is not previewed when it is given.
+        Defaults to none.
+
+    """
+    def __init__(self, Directories, Output, Spec=None, Interval=2.0,
+                 Coils='rss', PartialFourier='homodyne', ZeroFill=None):
+        if Coils not in coils.METHODS:
+            raise ValueError('unknown coil combination %r' % (Coils,))
+        self.directories = list(Directories)
+        self.output = Output
+        self.spec = Spec
+        self.interval = Interval
+        self.coils = Coils
+        self.partialFourier = PartialFourier
+        self.zeroFill = ZeroFill
+        self.studies = {}
+        self.pending = queue.Queue()
+        # (path, store, frames, finished) tuples for every published update
+        self.published = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._settings = None  # waiting to be applied, see configure
+
+    def configure(self, Spec=None, Coils='rss', PartialFourier='homodyne',
+                  ZeroFill=None):
+        """
+        Changes how the studies are reconstructed.
+
+        The new settings are taken up between studies, and every study seen
+        so far is reconstructed again with them.
+
+        Parameters
+        ----------
+        Spec, Coils, PartialFourier, ZeroFill : optional
+            See :class:`FolderWatcher`.
+
+        """
+        if Coils not in coils.METHODS:
+            raise ValueError('unknown coil combination %r' % (Coils,))
+        with self._lock:
+            self._settings = (Spec, Coils, PartialFourier, ZeroFill)
+        if self._thread is None:
+            self._applySettings()
+
+    def _applySettings(self):
+        """ Switches to the settings given to :meth:`configure`, if any """
+        with self._lock:
+            settings, self._settings = self._settings, None
+        if settings is None:
+            return
+        self.spec, self.coils, self.partialFourier, self.zeroFill = settings
+        for state in self.studies.values():
+            state.stamp = None
+            state.blocks = 0
+            state.finished = False
+            state.redo = True
+
+    def scan(self):
+        """
+        Queues every study that is new or has grown since the last scan.
+
+        Returns
+        -------
+        Queued : list of strings
+            The \*.fid folders that were queued.
+
+        """
+        queued = []
+        for path in fid_reader.findFIDs(self.directories):
+            fidName = fid_reader.fidFilename(path)
+            if not os.path.exists(fidName):
+                continue
+            state = self.studies.get(path)
+            if state is None:
+                name = os.path.splitext(os.path.basename(path))[0]
+                state = StudyState(path, os.path.join(self.output,
+                                                      name+'.mrs'))
+                self.studies[path] = state
+            # a procpar written after the fid has stopped growing is still
+            # picked up
+            procparName = os.path.join(os.path.dirname(fidName), 'procpar')
+            stamp = (os.path.getsize(fidName),
+                     os.path.getmtime(procparName)
+                     if os.path.exists(procparName) else None)
+            if state.finished or state.queued or stamp == state.stamp:
+                continue
+            state.stamp = stamp
+            state.queued = True
+            self.pending.put(path)
+            queued.append(path)
+        return queued
+
+    def process(self, Path):
+        """
+        Reconstructs the repetitions of a study completed since the last
+        pass.
+
+        Parameters
+        ----------
+        Path : string
+            The top level \*.fid folder.
+
+        Returns
+        -------
+        Frames : int
+            The number of frames added to the store.
+
+        """
+        state = self.studies[Path]
+        state.queued = False
+        try:
+            fid = fid_reader.LazyFID(Path)
+            procpar = fid_reader.readProcpar(Path)
+        except (IOError, OSError, ValueError):
+            # the header or procpar have not been written yet, tried again
+            # on the next scan
+            state.stamp = None
+            return 0
+        kspace = fid_reader.LazyKspace.fromProcpar(fid, procpar)
+        if volume.isVolume(procpar) and not fid.complete:
+            # queued again as it grows, and done once it is complete
+            return 0
+        oversampling = recon.readoutOversampling(procpar)
+        dim = recon.frameSize(procpar, kspace.shape, oversampling)
+        lines = partial_fourier.acquiredLines(procpar, kspace.shape[-2])
+        plan = partial_fourier.plan(dim, lines, self.partialFourier)
+        grid = gridding.plan(procpar, kspace.shape, oversampling)
+        if grid is not None:
+            oversampling = 1.0
+        size = dim if grid is None else (grid.matrix, grid.matrix)
+        target = None if self.zeroFill is None else \
+            recon.zeroFillSize(size, self.zeroFill)
+        leading = kspace.shape[1:-2]
+        perBlock = int(np.prod(leading))
+        store = recon_store.ReconStore(state.store)
+        if state.redo:
+            # the settings changed, so the old frames are thrown away
+            store.remove('image')
+            store.remove('datafilt')
+            state.redo = False
+        elif state.blocks == 0 and 'image' in store.names:
+            # pick up where a previous session stopped, doing the last
+            # repetition again as it may have been stored incomplete
+            state.blocks = max(store.frames('image')-1, 0)//perBlock
+        if self.spec is None:
+            stack = recon.defaultStack()
+        else:
+            stack = filt.buildStack(self.spec, dim)
+        store.setMetadata(procpar, filt.stackSpec(stack))
+        if volume.isVolume(procpar):
+            kspace = volume.hybridKspace(Path, kspace, stack)
+
+        added = 0
+        # the coils of a repetition are only combined once all are on disk
+        receivers = fid_reader.receiverCount(procpar)
+        reps = kspace.shape[0]//receivers
+        whitener = None
+        if receivers > 1 and reps > state.blocks:
+            whitener = coils.whitener(coils.noiseCovariance(
+                coils.cornerSamples(kspace[:receivers])))
+        for rep in range(state.blocks, reps):
+            for frame in np.ndindex(*leading):
+                if whitener is None:
+                    raw = kspace[(rep,)+frame]
+                else:
+                    raw = coils.coilFrame(kspace, (rep,)+frame, receivers)
+                raw = partial_fourier.padLines(
+                    recon.removeOversampling(raw, oversampling), lines)
+                if whitener is None:
+                    datafilt, image = recon.reconstructFrame(
+                        raw, stack, target, plan, grid, (rep,)+frame)
+                else:
+                    datafilt, image = recon.combineFrame(
+                        raw, stack, whitener, self.coils, target, plan,
+                        grid, (rep,)+frame)
+                index = rep*perBlock+int(np.ravel_multi_index(frame,
+                                                              leading))
+                store.write('image', index, image)
+                store.write('datafilt', index, datafilt)
+                added += 1
+        state.blocks = reps
+        previews = 0
+        if not fid.complete and receivers == 1 and lines is None and \
+                grid is None and target is None:
+            previews = self._preview(kspace, stack, dim, oversampling, store,
+                                     reps*perBlock)
+        if fid.complete:
+            store.setShape('image', (reps,)+leading)
+            store.setShape('datafilt', (reps,)+leading)
+            state.finished = True
+        else:
+            store.flush()
+        if added or previews or state.finished:
+            self.published.put((Path, state.store,
+                                state.blocks*perBlock+previews,
+                                state.finished))
+        return added+previews
+
+    def _preview(self, Kspace, Stack, Dim, Oversampling, Store, Start):
+        """
+        Reconstructs the lines on disk of the repetition being acquired.
+
+        Parameters
+        ----------
+        Kspace : :class:`fid_reader.LazyKspace`
+            The study.
+
+        Stack : list of :class:`filters.GFilter`\s
+            The filters, built for Dim.
+
+        Dim : tuple
+            The (phase-encode, readout) size of the filtered frames.
+
+        Oversampling : float
+            Readout oversampling removed from the lines.
+
+        Store : :class:`recon_store.ReconStore`
+            Where the frames are written.
+
+        Start : int
+            Flat index of the first frame of the repetition.
+
+        Returns
+        -------
+        Frames : int
+            The number of frames written, the frames of the repetition up
+            to the last one with any lines on disk.
+
+        """
+        try:
+            plan = stream_recon.LinePlan(Stack, Dim)
+        except stream_recon.StreamingError:
+            # only complete repetitions for stacks that need whole frames
+            return 0
+        present, raw = Kspace.partialRep()
+        if present is None:
+            return 0
+        frames = 0
+        for offset, frame in enumerate(np.ndindex(*present.shape[:-1])):
+            rows = np.flatnonzero(present[frame])
+            if len(rows) == 0:
+                continue
+            accumulator = stream_recon.FrameAccumulator(plan)
+            accumulator.add(recon.removeOversampling(raw[frame][rows],
+                                                     Oversampling), rows)
+            datafilt, image = accumulator.finish()
+            Store.write('image', Start+offset, image)
+            Store.write('datafilt', Start+offset, datafilt)
+            frames = offset+1
+        return frames
+
+    def run(self):
+        """ Scans and processes until :meth:`stop` is called. """
+        while not self._stop.is_set():
+            self._applySettings()
+            try:
+                self.scan()
+            except (IOError, OSError):
+                # e.g. a directory unmounted or a study deleted mid scan
+                log.exception('scanning %s failed', self.directories)
+            while not self.pending.empty() and not self._stop.is_set():
+                self._applySettings()
+                path = self.pending.get()
+                try:
+                    self.process(path)
+                except Exception:
+                    # retried when the study next changes
+                    log.exception('reconstructing %s failed', path)
+                    self.studies[path].queued = False
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """ Runs the watcher on a background thread. """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the background thread after the current study. """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def updates(self):
+        """
+        Drains the published updates without blocking.
+
+        Returns
+        -------
+        Updates : list of tuples
+            (path, store, frames, finished) for every update since the last
+            call.
+
+        """
+        updates = []
+        while True:
+            try:
+                updates.append(self.published.get_nowait())
+            except queue.Empty:
+                return updates